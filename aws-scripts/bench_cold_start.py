@@ -0,0 +1,191 @@
+"""
+Benchmark de cold start: tiempo de import/init de cada handler Lambda
+
+Cada medición corre en un proceso Python nuevo (como un contenedor frío) e
+importa el módulo del handler sin invocarlo. Reporta la mediana por handler,
+los imports más caros (-X importtime) y falla si se excede el presupuesto.
+
+Uso:
+    python bench_cold_start.py
+    python bench_cold_start.py --runs 10 --no-bytecode
+    python bench_cold_start.py --budget lambda_claude=150 --top 8 --json cold.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Presupuesto de import por handler (ms, mediana). boto3/botocore, pypdf,
+# Pillow y urllib3 se cargan en el primer uso, no al importar el handler.
+HANDLERS = {
+    'lambda_claude': 150,
+    'extract-pdf-to-s3': 80,
+    'lambda_postgres_writer': 120,
+    'lambda_claude_retry': 80,
+    'lambda_sunat_retry': 80,
+    'lambda_function': 60
+}
+
+# Variables requeridas al importar (sin valores reales: no se invoca nada)
+HANDLER_ENV = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'DEST_BUCKET': 'bench-cold-start'
+}
+
+# json e importlib ya están cargados por el bootstrap del runtime de Lambda,
+# así que se importan antes de medir. La marca en stderr separa los imports
+# del arranque del intérprete de los del handler en -X importtime.
+IMPORT_MARKER = '--- handler import ---'
+IMPORT_SNIPPET = """
+import importlib.util, json, sys, time
+sys.stderr.write({marker!r} + '\\n')
+sys.stderr.flush()
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location({module!r}, {path!r})
+module = importlib.util.module_from_spec(spec)
+sys.modules[{module!r}] = module
+spec.loader.exec_module(module)
+elapsed = (time.perf_counter() - started) * 1000
+print(json.dumps({{'ms': elapsed, 'modules': len(sys.modules)}}))
+"""
+
+
+def run_import(handler, bytecode, importtime):
+    """
+    Importa el handler en un subproceso. Retorna (ms, módulos cargados,
+    stderr). Sin bytecode, el handler se copia a un directorio sin
+    __pycache__ y se compila en cada corrida (la stdlib sí usa sus .pyc,
+    como en el runtime de Lambda).
+    """
+    env = {**os.environ, **HANDLER_ENV}
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+
+    with tempfile.TemporaryDirectory(prefix='cold-start-') as workdir:
+        path = os.path.join(SCRIPTS_DIR, f"{handler}.py")
+        if not bytecode:
+            shutil.copy(path, workdir)
+            path = os.path.join(workdir, f"{handler}.py")
+            env['PYTHONDONTWRITEBYTECODE'] = '1'
+        snippet = IMPORT_SNIPPET.format(marker=IMPORT_MARKER, module=handler.replace('-', '_'), path=path)
+        result = subprocess.run(
+            command + ['-c', snippet], env=env, cwd=SCRIPTS_DIR, capture_output=True, text=True
+        )
+
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"exit {result.returncode}"
+        raise RuntimeError(error)
+    measurement = json.loads(result.stdout.strip().splitlines()[-1])
+    return measurement['ms'], measurement['modules'], result.stderr
+
+
+def top_imports(importtime_output, top):
+    """
+    Imports directos del handler ordenados por tiempo acumulado, a partir de
+    la salida de -X importtime (solo lo que sigue a la marca, primer nivel).
+    """
+    entries = []
+    lines = importtime_output.splitlines()
+    if IMPORT_MARKER in lines:
+        lines = lines[lines.index(IMPORT_MARKER) + 1:]
+    for line in lines:
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Un espacio = nivel superior; los submódulos van con sangría extra
+        if not name.startswith('  '):
+            entries.append((int(cumulative) / 1000.0, name.strip()))
+    return sorted(entries, reverse=True)[:top]
+
+
+def benchmark(handler, runs, bytecode, top):
+    timings = []
+    modules = 0
+    for _ in range(runs):
+        ms, modules, _ = run_import(handler, bytecode, importtime=False)
+        timings.append(ms)
+    _, _, importtime_output = run_import(handler, bytecode, importtime=True)
+    return {
+        'medianMs': round(statistics.median(timings), 1),
+        'minMs': round(min(timings), 1),
+        'maxMs': round(max(timings), 1),
+        'modules': modules,
+        'topImports': [
+            {'module': name, 'ms': round(ms, 1)}
+            for ms, name in top_imports(importtime_output, top)
+        ]
+    }
+
+
+def parse_budgets(values):
+    budgets = dict(HANDLERS)
+    for value in values or []:
+        for pair in value.split(','):
+            name, _, raw = pair.partition('=')
+            if name.strip() not in HANDLERS or not raw:
+                raise SystemExit(f"Unknown handler or missing budget: {pair!r}")
+            budgets[name.strip()] = float(raw)
+    return budgets
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tiempo de import/init (cold start) de los handlers Lambda")
+    parser.add_argument('handlers', nargs='*', help=f"Handlers a medir (por defecto: {', '.join(HANDLERS)})")
+    parser.add_argument('--runs', type=int, default=5, help="Procesos nuevos por handler")
+    parser.add_argument('--budget', action='append', help="Presupuesto en ms, ej. lambda_claude=150")
+    parser.add_argument('--no-bytecode', action='store_true',
+                        help="Compilar en cada corrida (paquete de deploy sin .pyc)")
+    parser.add_argument('--top', type=int, default=5, help="Imports más caros a mostrar por handler")
+    parser.add_argument('--json', help="Guardar el reporte en este archivo")
+    args = parser.parse_args()
+
+    budgets = parse_budgets(args.budget)
+    handlers = args.handlers or list(HANDLERS)
+    unknown = [handler for handler in handlers if handler not in HANDLERS]
+    if unknown:
+        raise SystemExit(f"Unknown handler(s): {', '.join(unknown)}")
+
+    report = {}
+    over_budget = []
+    print(f"{'handler':<26}{'mediana':>10}{'min':>10}{'max':>10}{'budget':>10}{'módulos':>10}")
+    for handler in handlers:
+        try:
+            result = benchmark(handler, args.runs, not args.no_bytecode, args.top)
+        except RuntimeError as err:
+            print(f"{handler:<26}❌ import failed: {err}")
+            report[handler] = {'error': str(err)}
+            over_budget.append(handler)
+            continue
+
+        result['budgetMs'] = budgets[handler]
+        result['withinBudget'] = result['medianMs'] <= budgets[handler]
+        report[handler] = result
+        flag = '✅' if result['withinBudget'] else '❌'
+        print(f"{handler:<26}{result['medianMs']:>10}{result['minMs']:>10}{result['maxMs']:>10}"
+              f"{budgets[handler]:>10}{result['modules']:>10} {flag}")
+        for entry in result['topImports']:
+            print(f"{'':<6}{entry['ms']:>8.1f} ms  {entry['module']}")
+        if not result['withinBudget']:
+            over_budget.append(handler)
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(report, output, indent=2)
+        print(f"\n💾 Reporte guardado en {args.json}")
+
+    if over_budget:
+        print(f"\n❌ Sobre presupuesto o con error: {', '.join(over_budget)}")
+        sys.exit(1)
+    print("\n✅ Todos los handlers dentro del presupuesto")
+
+
+if __name__ == '__main__':
+    main()
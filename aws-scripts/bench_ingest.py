@@ -0,0 +1,1026 @@
+"""
+Benchmark offline del pipeline de ingesta (sin red ni cuotas de AWS)
+
+Importa extract-pdf-to-s3.py, lambda_claude, lambda_postgres_writer y
+lambda_sunat_retry (etapa de validación SUNAT en cola) con stand-ins en proceso para S3, Textract (sync y jobs asíncronos), Bedrock,
+DynamoDB (+ stream hacia el writer), SQS, la API de SUNAT y PostgreSQL.
+Cada stand-in tiene latencia y tasa de error configurables.
+
+Reproduce un corpus de .eml (o correos sintéticos) a una tasa objetivo y
+reporta throughput, percentiles de latencia por etapa y memoria pico.
+
+Uso:
+    python bench_ingest.py --synthetic 200 --rate 5 --concurrency 8
+    python bench_ingest.py --corpus ./emails --rate 2 --latency bedrock=800 --error-rate sunat=0.05
+    python bench_ingest.py --synthetic 50 --latency-scale 0.1 --json reporte.json
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import io
+import json
+import os
+import random
+import re
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import types
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+from email.message import EmailMessage
+
+from fake_dynamodb import ClientError, FakeDynamoResource, FakeTable, client_error
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SOURCE_BUCKET = 'bench-ses-inbox'
+DEST_BUCKET = 'bench-facturas'
+INVOICE_TABLE = 'Facturas-bench'
+CONTROL_TABLE = 'FlowControl-bench'
+SUNAT_QUEUE_URL = 'https://sqs.bench.local/sunat-validation'
+
+# Latencias medias por servicio (ms); cada llamada varía ±JITTER
+DEFAULT_LATENCY_MS = {
+    's3': 15,
+    'textract': 400,
+    'textract_async': 3000,
+    'bedrock': 2500,
+    'bedrock_fast': 900,
+    'dynamodb': 8,
+    'sqs': 10,
+    'sunat_token': 150,
+    'sunat': 200,
+    'postgres': 10
+}
+JITTER = 0.3
+
+EMISORES = [
+    ('20517482472', 'CORPORACION LIDER PERU S.A.'),
+    ('20100070970', 'SUPERMERCADOS PERUANOS S.A.'),
+    ('20601234567', 'SERVICIOS INTEGRALES DEL SUR S.A.C.'),
+    ('10456789012', 'QUISPE MAMANI JUAN CARLOS')
+]
+TENANTS = ['acme', 'heladero', 'lider']
+
+
+class BenchConfig:
+    """
+    Latencias, errores y contadores compartidos por todos los stand-ins.
+    """
+
+    def __init__(self, latency, error_rates, latency_scale, seed):
+        self.latency = {**DEFAULT_LATENCY_MS, **latency}
+        self.error_rates = error_rates
+        self.latency_scale = latency_scale
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = defaultdict(int)
+        self.injected_errors = defaultdict(int)
+
+    def call(self, service):
+        """
+        Simula la latencia del servicio y decide si la llamada falla.
+        Retorna True si se debe inyectar un error.
+        """
+        with self.lock:
+            self.calls[service] += 1
+            mean = self.latency.get(service, 0) * self.latency_scale
+            delay = mean * (1 + self.random.uniform(-JITTER, JITTER)) / 1000.0
+            failed = self.random.random() < self.error_rates.get(service, 0.0)
+            if failed:
+                self.injected_errors[service] += 1
+        if delay > 0:
+            time.sleep(delay)
+        return failed
+
+
+# ---------- Stand-ins de botocore / boto3 ----------
+
+class StreamingBody:
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    def read(self, amount=None):
+        return self._stream.read() if amount is None else self._stream.read(amount)
+
+    def iter_chunks(self, chunk_size=1024):
+        for chunk in iter(lambda: self._stream.read(chunk_size), b''):
+            yield chunk
+
+    def close(self):
+        self._stream.close()
+
+
+class FakeS3:
+    def __init__(self, config):
+        self.config = config
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.listeners = []
+
+    def _store(self, bucket, key, data, content_type=None):
+        with self.lock:
+            self.objects[(bucket, key)] = (data, content_type)
+        for listener in self.listeners:
+            listener(bucket, key, data)
+
+    def put_object(self, Bucket, Key, Body=b'', ContentType=None, **kwargs):
+        if self.config.call('s3'):
+            raise client_error('InternalError', 'PutObject')
+        data = Body.read() if hasattr(Body, 'read') else bytes(Body)
+        self._store(Bucket, Key, data, ContentType)
+        return {'ETag': uuid.uuid4().hex}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, **kwargs):
+        if self.config.call('s3'):
+            raise client_error('InternalError', 'PutObject')
+        with open(Filename, 'rb') as source:
+            self._store(Bucket, Key, source.read(), (ExtraArgs or {}).get('ContentType'))
+
+    def get_object(self, Bucket, Key, **kwargs):
+        if self.config.call('s3'):
+            raise client_error('InternalError', 'GetObject')
+        with self.lock:
+            stored = self.objects.get((Bucket, Key))
+        if stored is None:
+            raise client_error('NoSuchKey', 'GetObject')
+        data, content_type = stored
+        return {
+            'Body': StreamingBody(data),
+            'ContentLength': len(data),
+            'ContentType': content_type or 'application/octet-stream'
+        }
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.config.call('s3')
+        with self.lock:
+            stored = self.objects.get((Bucket, Key))
+        if stored is None:
+            raise client_error('404', 'HeadObject', 'Not Found')
+        return {'ContentLength': len(stored[0])}
+
+
+BENCH_STREAM_RE = re.compile(rb'<< /BenchPage (\d+) /Length (\d+) >>\nstream\n')
+PDF_TEXT_RE = re.compile(rb"\(((?:[^()\\]|\\.)*)\)\s*(?:Tj|')")
+
+
+def pdf_text_lines(data):
+    """
+    (página, línea) de los streams marcados con /BenchPage del PDF sintético:
+    lo que "lee" Textract, incluso en páginas escaneadas sin capa de texto.
+    Un PDF real del corpus, sin marcas, se lee como una sola página.
+    """
+    chunks = [
+        (int(match.group(1)), data[match.end():match.end() + int(match.group(2))])
+        for match in BENCH_STREAM_RE.finditer(data)
+    ] or [(1, data)]
+    return [
+        (page, text.decode('latin-1').replace('\\(', '(').replace('\\)', ')'))
+        for page, chunk in chunks
+        for text in PDF_TEXT_RE.findall(chunk)
+    ]
+
+
+def textract_blocks(data):
+    return [
+        {'BlockType': 'LINE', 'Text': text, 'Page': page}
+        for page, text in pdf_text_lines(data)
+    ]
+
+
+class FakeTextract:
+    def __init__(self, config, s3, scheduler):
+        self.config = config
+        self.s3 = s3
+        self.scheduler = scheduler
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def _document_bytes(self, document):
+        if 'Bytes' in document:
+            return document['Bytes']
+        location = document['S3Object']
+        return self.s3.get_object(Bucket=location['Bucket'], Key=location['Name'])['Body'].read()
+
+    def analyze_expense(self, Document, **kwargs):
+        if self.config.call('textract'):
+            raise client_error('ProvisionedThroughputExceededException', 'AnalyzeExpense')
+        data = self._document_bytes(Document)
+        return {'ExpenseDocuments': [{'ExpenseIndex': 1, 'Blocks': textract_blocks(data)}]}
+
+    def detect_document_text(self, Document, **kwargs):
+        if self.config.call('textract'):
+            raise client_error('ProvisionedThroughputExceededException', 'DetectDocumentText')
+        return {'Blocks': textract_blocks(self._document_bytes(Document))}
+
+    def start_expense_analysis(self, DocumentLocation, NotificationChannel=None, ClientRequestToken=None, **kwargs):
+        if self.config.call('textract'):
+            raise client_error('ProvisionedThroughputExceededException', 'StartExpenseAnalysis')
+        with self.lock:
+            job_id = self.jobs.get(('token', ClientRequestToken)) if ClientRequestToken else None
+            if job_id:
+                return {'JobId': job_id}
+            job_id = uuid.uuid4().hex
+            if ClientRequestToken:
+                self.jobs[('token', ClientRequestToken)] = job_id
+        data = self._document_bytes({'S3Object': DocumentLocation['S3Object']})
+        failed = self.config.random.random() < self.config.error_rates.get('textract_async', 0.0)
+        with self.lock:
+            self.jobs[job_id] = {
+                'status': 'FAILED' if failed else 'SUCCEEDED',
+                'blocks': [] if failed else textract_blocks(data)
+            }
+        delay = self.config.latency['textract_async'] * self.config.latency_scale / 1000.0
+        self.scheduler.schedule_textract_completion(job_id, self.jobs[job_id]['status'], delay)
+        return {'JobId': job_id}
+
+    def get_expense_analysis(self, JobId, MaxResults=20, NextToken=None, **kwargs):
+        self.config.call('textract')
+        with self.lock:
+            job = self.jobs[JobId]
+        # Un documento por página, paginado como la API real
+        pages = sorted({block['Page'] for block in job['blocks']}) or [1]
+        start = int(NextToken or 0)
+        chunk = pages[start:start + MaxResults]
+        documents = [
+            {'ExpenseIndex': page, 'Blocks': [b for b in job['blocks'] if b['Page'] == page]}
+            for page in chunk
+        ]
+        response = {'JobStatus': job['status'], 'ExpenseDocuments': documents}
+        if start + MaxResults < len(pages):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+
+class FakeBedrock:
+    """
+    Responde con una llamada a la herramienta de extracción construida a
+    partir del texto del request (ruta de texto) o con datos aleatorios
+    (documento / imagen).
+    """
+
+    def __init__(self, config, fast_model_id, escalation_rate):
+        self.config = config
+        self.fast_model_id = fast_model_id
+        self.escalation_rate = escalation_rate
+
+    def _invoice(self, request_body, model_id):
+        body = json.loads(bytes(request_body)) if isinstance(request_body, (bytes, bytearray)) else json.loads(request_body)
+        text = ' '.join(
+            block.get('text', '')
+            for message in body.get('messages', [])
+            for block in message.get('content', [])
+            if block.get('type') == 'text'
+        )
+        rng = self.config.random
+        ruc_match = re.search(r'\b(1[07]\d{9}|20\d{9})\b', text)
+        serie_match = re.search(r'\b([FB]\d{3})-(\d{6,8})\b', text)
+        ruc, razon = rng.choice(EMISORES)
+        ruc = ruc_match.group(1) if ruc_match else ruc
+        serie, correlativo = (serie_match.groups() if serie_match
+                              else (f"F{rng.randint(1, 20):03d}", f"{rng.randint(1, 99999999):08d}"))
+        subtotal = round(rng.uniform(50, 5000), 2)
+        igv = round(subtotal * 0.18, 2)
+        total_ok = not (model_id == self.fast_model_id and rng.random() < self.escalation_rate)
+        return {
+            'numeroFactura': f"{serie}-{correlativo}",
+            'serie': serie,
+            'correlativo': correlativo,
+            'tipoComprobante': 'FACTURA',
+            'fechaEmision': datetime.utcnow().strftime('%Y-%m-%d'),
+            'emisor': {'tipoDocumento': 'RUC', 'numeroDocumento': ruc, 'razonSocial': razon},
+            'receptor': {'tipoDocumento': 'RUC', 'numeroDocumento': '20604163642', 'razonSocial': 'EL HELADERO S.A.C.'},
+            'montos': {'moneda': 'PEN', 'subtotal': subtotal, 'igv': igv, 'total': round(subtotal + igv, 2)},
+            'items': [{'linea': 1, 'descripcion': 'SERVICIO', 'cantidad': 1, 'total': round(subtotal + igv, 2)}],
+            'condiciones': {'formaPago': 'CONTADO'},
+            'validaciones': {
+                'rucEmisorValido': True,
+                'igvCalculoCorrecto': True,
+                'totalCalculoCorrecto': total_ok,
+                'warnings': [],
+                'errores': []
+            }
+        }
+
+    def _latency_service(self, model_id):
+        return 'bedrock_fast' if model_id == self.fast_model_id else 'bedrock'
+
+    def _usage(self):
+        return {'input_tokens': 1800, 'output_tokens': 600, 'cache_read_input_tokens': 2400}
+
+    def invoke_model(self, modelId, body, **kwargs):
+        if self.config.call(self._latency_service(modelId)):
+            raise client_error('ThrottlingException', 'InvokeModel', 'Too many requests')
+        payload = {
+            'content': [{'type': 'tool_use', 'name': 'registrar_comprobante', 'input': self._invoice(body, modelId)}],
+            'stop_reason': 'tool_use',
+            'usage': self._usage()
+        }
+        return {'body': StreamingBody(json.dumps(payload).encode('utf-8'))}
+
+    def invoke_model_with_response_stream(self, modelId, body, **kwargs):
+        if self.config.call(self._latency_service(modelId)):
+            raise client_error('ThrottlingException', 'InvokeModelWithResponseStream', 'Too many requests')
+        arguments = json.dumps(self._invoice(body, modelId))
+
+        def event(payload):
+            return {'chunk': {'bytes': json.dumps(payload).encode('utf-8')}}
+
+        events = [
+            event({'type': 'message_start', 'message': {'usage': self._usage()}}),
+            event({'type': 'content_block_start', 'index': 0,
+                   'content_block': {'type': 'tool_use', 'name': 'registrar_comprobante', 'input': {}}})
+        ]
+        events += [
+            event({'type': 'content_block_delta', 'index': 0,
+                   'delta': {'type': 'input_json_delta', 'partial_json': arguments[i:i + 64]}})
+            for i in range(0, len(arguments), 64)
+        ]
+        events += [
+            event({'type': 'content_block_stop', 'index': 0}),
+            event({'type': 'message_delta', 'delta': {'stop_reason': 'tool_use'}, 'usage': {'output_tokens': 600}}),
+            event({'type': 'message_stop'})
+        ]
+        return {'body': events}
+
+
+class FakeSQS:
+    def __init__(self, config):
+        self.config = config
+        self.messages = []
+        self.lock = threading.Lock()
+        self.consumers = {}
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0, **kwargs):
+        if self.config.call('sqs'):
+            raise client_error('ServiceUnavailable', 'SendMessage')
+        message_id = uuid.uuid4().hex
+        consumer = self.consumers.get(QueueUrl)
+        if consumer:
+            consumer({'messageId': message_id, 'eventSource': 'aws:sqs', 'body': MessageBody})
+        else:
+            with self.lock:
+                self.messages.append({'QueueUrl': QueueUrl, 'Body': MessageBody, 'DelaySeconds': DelaySeconds})
+        return {'MessageId': message_id}
+
+
+# ---------- Stand-ins de SUNAT (urllib3) y PostgreSQL (psycopg2) ----------
+
+class FakeHTTPResponse:
+    def __init__(self, status, payload):
+        self.status = status
+        self.data = json.dumps(payload).encode('utf-8')
+        self.headers = {'Content-Type': 'application/json'}
+
+
+class FakeSunatPoolManager:
+    def __init__(self, config):
+        self.config = config
+
+    def request(self, method, url, headers=None, body=None, fields=None, **kwargs):
+        if '/oauth2/token' in url:
+            if self.config.call('sunat_token'):
+                return FakeHTTPResponse(500, {'error': 'server_error'})
+            return FakeHTTPResponse(200, {'access_token': uuid.uuid4().hex, 'token_type': 'JWT', 'expires_in': 3600})
+        if self.config.call('sunat'):
+            return FakeHTTPResponse(503, {'success': False, 'message': 'Servicio no disponible'})
+        return FakeHTTPResponse(200, {
+            'success': True,
+            'message': 'Operation Success! ',
+            'data': {'estadoCp': '1', 'estadoRuc': '00', 'condDomiRuc': '00', 'observaciones': []}
+        })
+
+
+class FakeCursor:
+    def __init__(self, config):
+        self.config = config
+        self.row = None
+
+    def execute(self, sql, params=None):
+        if self.config.call('postgres'):
+            raise RuntimeError('could not serialize access due to concurrent update')
+        self.row = (uuid.uuid4(),)
+
+    def fetchone(self):
+        return self.row
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class FakeConnection:
+    def __init__(self, config):
+        self.config = config
+
+    def cursor(self):
+        return FakeCursor(self.config)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def install_stand_ins(config, services):
+    """
+    Registra módulos boto3/botocore/urllib3/psycopg2 falsos en sys.modules
+    antes de importar los handlers: ninguna llamada sale del proceso.
+    """
+    from urllib.parse import urlencode as real_urlencode
+
+    botocore = types.ModuleType('botocore')
+    botocore_exceptions = types.ModuleType('botocore.exceptions')
+    botocore_exceptions.ClientError = ClientError
+    botocore_config = types.ModuleType('botocore.config')
+    botocore_config.Config = lambda *args, **kwargs: None
+    botocore.exceptions = botocore_exceptions
+    botocore.config = botocore_config
+
+    boto3 = types.ModuleType('boto3')
+
+    def client(name, *args, **kwargs):
+        return services[name]
+
+    def resource(name, *args, **kwargs):
+        return services['dynamodb']
+
+    class Session:
+        def client(self, name, *args, **kwargs):
+            return client(name)
+
+        def resource(self, name, *args, **kwargs):
+            return resource(name)
+
+    boto3.client = client
+    boto3.resource = resource
+    boto3.session = types.SimpleNamespace(Session=Session)
+
+    urllib3 = types.ModuleType('urllib3')
+    urllib3.PoolManager = lambda *args, **kwargs: FakeSunatPoolManager(config)
+    urllib3.request = types.SimpleNamespace(urlencode=real_urlencode)
+    urllib3.Timeout = lambda *args, **kwargs: None
+    urllib3.util = types.SimpleNamespace(Retry=lambda *args, **kwargs: None)
+
+    psycopg2 = types.ModuleType('psycopg2')
+    psycopg2.connect = lambda *args, **kwargs: FakeConnection(config)
+    psycopg2_extras = types.ModuleType('psycopg2.extras')
+    psycopg2_extras.Json = lambda value, *args, **kwargs: value
+    psycopg2.extras = psycopg2_extras
+
+    sys.modules.update({
+        'boto3': boto3,
+        'botocore': botocore,
+        'botocore.exceptions': botocore_exceptions,
+        'botocore.config': botocore_config,
+        'urllib3': urllib3,
+        'psycopg2': psycopg2,
+        'psycopg2.extras': psycopg2_extras
+    })
+
+
+def install_async_sunat_stand_in(config):
+    """
+    El cliente asyncio de SUNAT abre sockets propios: sus requests se
+    desvían al mismo stand-in de urllib3 (en un thread, como I/O real).
+    """
+    import sunat_async
+
+    pool_manager = FakeSunatPoolManager(config)
+
+    async def request(self, method, url, headers=None, body=b'', timeout=None):
+        response = await asyncio.to_thread(pool_manager.request, method, url, headers=headers, body=body)
+        headers = {name.lower(): value for name, value in response.headers.items()}
+        return sunat_async.HTTPResponse(response.status, headers, response.data)
+
+    sunat_async.AsyncConnectionPool.request = request
+
+
+def import_handlers(config):
+    sys.path.insert(0, SCRIPTS_DIR)
+    install_async_sunat_stand_in(config)
+    spec = importlib.util.spec_from_file_location(
+        'extract_pdf_to_s3', os.path.join(SCRIPTS_DIR, 'extract-pdf-to-s3.py')
+    )
+    extract_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(extract_module)
+    import lambda_claude
+    import lambda_postgres_writer
+    import lambda_sunat_retry
+    return types.SimpleNamespace(
+        extract=extract_module,
+        claude=lambda_claude,
+        writer=lambda_postgres_writer,
+        sunat=lambda_sunat_retry
+    )
+
+
+# ---------- Corpus ----------
+
+def escape_pdf_text(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def build_pdf(pages_lines, scanned=False, padding=0):
+    """
+    PDF mínimo válido con una página por lista de líneas. Cada página lleva
+    su texto en un stream marcado con /BenchPage; si scanned, ese stream no
+    está referenciado por la página (sin capa de texto, solo "OCR").
+    padding agrega un stream binario aleatorio.
+    """
+    page_count = len(pages_lines)
+    font_id = 3 + 2 * page_count
+    next_id = font_id + 1
+    objects = [(1, b'<< /Type /Catalog /Pages 2 0 R >>'), (2, (
+        f"<< /Type /Pages /Kids [{' '.join(f'{3 + 2 * i} 0 R' for i in range(page_count))}] /Count {page_count} >>"
+    ).encode('ascii'))]
+    for index, lines in enumerate(pages_lines):
+        page_id = 3 + 2 * index
+        text = b'BT /F1 9 Tf 40 800 Td 12 TL ' + b' '.join(
+            f"({escape_pdf_text(line)}) '".encode('latin-1', 'replace') for line in lines
+        ) + b' ET'
+        marked = b'<< /BenchPage %d /Length %d >>\nstream\n' % (index + 1, len(text)) + text + b'\nendstream'
+        objects.append((page_id, (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {page_id + 1} 0 R "
+            f"/Resources << /Font << /F1 {font_id} 0 R >> >> >>"
+        ).encode('ascii')))
+        if scanned:
+            objects.append((page_id + 1, b'<< /Length 0 >>\nstream\n\nendstream'))
+            objects.append((next_id, marked))
+            next_id += 1
+        else:
+            objects.append((page_id + 1, marked))
+    objects.append((font_id, b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>'))
+    if padding:
+        blob = os.urandom(padding)
+        objects.append((next_id, b'<< /Length %d >>\nstream\n' % len(blob) + blob + b'\nendstream'))
+
+    output = io.BytesIO()
+    output.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    offsets = {}
+    for object_id, body in sorted(objects):
+        offsets[object_id] = output.tell()
+        output.write(b'%d 0 obj\n' % object_id + body + b'\nendobj\n')
+    xref_at = output.tell()
+    size = max(offsets) + 1
+    output.write(b'xref\n0 %d\n0000000000 65535 f \n' % size)
+    for object_id in range(1, size):
+        output.write(b'%010d 00000 n \n' % offsets[object_id])
+    output.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (size, xref_at))
+    return output.getvalue()
+
+
+def invoice_lines(rng):
+    ruc, razon = rng.choice(EMISORES)
+    serie = f"F{rng.randint(1, 20):03d}-{rng.randint(1, 99999999):08d}"
+    lines = [
+        razon,
+        f"RUC {ruc}",
+        'FACTURA ELECTRONICA',
+        serie,
+        f"Fecha de emision: {datetime.utcnow().strftime('%d/%m/%Y')}",
+        'Senor(es): EL HELADERO S.A.C. RUC 20604163642'
+    ]
+    subtotal = 0.0
+    for line in range(1, rng.randint(8, 20)):
+        amount = round(rng.uniform(5, 400), 2)
+        subtotal += amount
+        lines.append(f"{line} UNI PRODUCTO {rng.randint(1000, 9999)} DESCRIPCION DEL ITEM {amount:.2f}")
+    igv = subtotal * 0.18
+    lines += [
+        f"OP. GRAVADA S/. {subtotal:,.2f}",
+        f"IGV 18% S/. {igv:,.2f}",
+        f"IMPORTE TOTAL S/. {subtotal + igv:,.2f}",
+        'Representacion impresa de la factura electronica - SUNAT'
+    ]
+    return lines
+
+
+def synthetic_email(rng, index, scanned_ratio, pages, padding):
+    tenant = rng.choice(TENANTS)
+    message = EmailMessage()
+    message['From'] = 'facturacion@proveedor.pe'
+    message['To'] = f"{tenant}@flow-cfo.com"
+    message['Subject'] = f"Factura electronica {index}"
+    message['Message-ID'] = f"<bench-{index}-{uuid.uuid4().hex}@bench>"
+    message.set_content('Adjuntamos su comprobante electronico.')
+
+    page_lines = [invoice_lines(rng)] + [
+        [f"Terminos y condiciones pagina {page}", 'Clausula de servicio'] for page in range(2, pages + 1)
+    ]
+    pdf = build_pdf(page_lines, scanned=rng.random() < scanned_ratio, padding=padding)
+    message.add_attachment(pdf, maintype='application', subtype='pdf', filename=f"factura-{index}.pdf")
+    return message.as_bytes()
+
+
+def load_corpus(args, rng):
+    if args.corpus:
+        paths = sorted(
+            os.path.join(args.corpus, name) for name in os.listdir(args.corpus) if name.lower().endswith('.eml')
+        )
+        if not paths:
+            raise SystemExit(f"No .eml files in {args.corpus}")
+        emails = []
+        for path in paths:
+            with open(path, 'rb') as source:
+                emails.append(source.read())
+        count = args.count or len(emails)
+        return [emails[i % len(emails)] for i in range(count)]
+    return [
+        synthetic_email(rng, index, args.scanned_ratio, args.pages, args.padding_kb * 1024)
+        for index in range(args.count or args.synthetic)
+    ]
+
+
+# ---------- Orquestación ----------
+
+def to_dynamodb_json(value):
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    if value is None:
+        return {'NULL': True}
+    if isinstance(value, (int, float, Decimal)):
+        return {'N': str(value)}
+    if isinstance(value, dict):
+        return {'M': {k: to_dynamodb_json(v) for k, v in value.items()}}
+    if isinstance(value, (list, tuple)):
+        return {'L': [to_dynamodb_json(v) for v in value]}
+    return {'S': str(value)}
+
+
+class FakeContext:
+    def __init__(self, name):
+        self.function_name = name
+        self.aws_request_id = uuid.uuid4().hex
+        self.memory_limit_in_mb = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', '1024'))
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+class BenchRun:
+    """
+    Encadena los handlers como en AWS: correo en S3 → extract-pdf-to-s3 →
+    adjunto en S3 → lambda_claude → item DynamoDB → stream → postgres writer.
+    """
+
+    def __init__(self, args, config, services):
+        self.args = args
+        self.config = config
+        self.services = services
+        self.executor = ThreadPoolExecutor(max_workers=args.concurrency)
+        self.pending = 0
+        self.pending_lock = threading.Condition()
+        self.timings = defaultdict(list)
+        self.timings_lock = threading.Lock()
+        self.counts = defaultdict(int)
+        self.errors = defaultdict(list)
+        self.email_started = {}
+        self.handlers = None
+
+    # -- tareas --
+    def submit(self, fn, *args):
+        with self.pending_lock:
+            self.pending += 1
+
+        def run():
+            try:
+                fn(*args)
+            except Exception as err:
+                self.record_error(fn.__name__, err)
+            finally:
+                with self.pending_lock:
+                    self.pending -= 1
+                    self.pending_lock.notify_all()
+
+        self.executor.submit(run)
+
+    def wait_idle(self):
+        with self.pending_lock:
+            while self.pending:
+                self.pending_lock.wait()
+
+    def record_timing(self, stage, ms):
+        with self.timings_lock:
+            self.timings[stage].append(ms)
+
+    def record_error(self, stage, err):
+        with self.timings_lock:
+            self.counts[f'{stage}_errors'] += 1
+            if len(self.errors[stage]) < 5:
+                self.errors[stage].append(str(err)[:200])
+
+    def collect_metrics(self, record):
+        for name, value in record.items():
+            if name.endswith('Ms') and name != '_aws':
+                for item in value if isinstance(value, list) else [value]:
+                    self.record_timing(name[:-2], item)
+
+    # -- handlers --
+    def run_extract(self, key):
+        event = {'Records': [{
+            'eventSource': 'aws:s3',
+            's3': {'bucket': {'name': SOURCE_BUCKET}, 'object': {'key': key, 'versionId': uuid.uuid4().hex}}
+        }]}
+        started = time.perf_counter()
+        result = self.handlers.extract.handler(event, FakeContext('extract-pdf-to-s3'))
+        self.record_timing('ExtractHandler', (time.perf_counter() - started) * 1000)
+        with self.timings_lock:
+            self.counts['attachments_uploaded'] += result['uploaded_count'] + len(result['uploaded_unvalidated'])
+        keys = result['uploaded_keys'] + result['uploaded_unvalidated']
+        for index in range(0, len(keys), self.args.batch_size):
+            self.submit(self.run_claude, keys[index:index + self.args.batch_size])
+
+    def run_claude(self, keys):
+        records = []
+        for key in keys:
+            data, _ = self.services['s3'].objects[(DEST_BUCKET, key)]
+            records.append({'eventSource': 'aws:s3', 's3': {
+                'bucket': {'name': DEST_BUCKET}, 'object': {'key': key, 'size': len(data)}
+            }})
+        self.invoke_claude({'Records': records})
+
+    def run_claude_event(self, event):
+        self.invoke_claude(event)
+
+    def invoke_claude(self, event):
+        started = time.perf_counter()
+        response = self.handlers.claude.lambda_handler(event, FakeContext('lambda_claude'))
+        self.record_timing('ClaudeHandler', (time.perf_counter() - started) * 1000)
+        body = json.loads(response.get('body') or '{}')
+        with self.timings_lock:
+            self.counts['claude_records_failed'] += len(response.get('batchItemFailures') or [])
+            for record in body.get('records', []):
+                if record.get('status') == 'deferred':
+                    self.counts['claude_records_deferred'] += 1
+
+    def run_writer(self, item, event_name):
+        event = {'Records': [{
+            'eventName': event_name,
+            'dynamodb': {'NewImage': {k: to_dynamodb_json(v) for k, v in item.items()}}
+        }]}
+        started = time.perf_counter()
+        self.handlers.writer.lambda_handler(event, FakeContext('lambda_postgres_writer'))
+        self.record_timing('WriterHandler', (time.perf_counter() - started) * 1000)
+        with self.timings_lock:
+            self.counts['invoices_written'] += 1
+
+    def run_sunat_stage(self, record):
+        started = time.perf_counter()
+        response = self.handlers.sunat.handler({'Records': [record]}, FakeContext('lambda_sunat_retry'))
+        self.record_timing('SunatStageHandler', (time.perf_counter() - started) * 1000)
+        with self.timings_lock:
+            self.counts['sunat_messages_failed'] += len(response.get('batchItemFailures') or [])
+
+    # -- hooks de los stand-ins --
+    def on_invoice_put(self, item, event_name):
+        if not str(item.get('SK', '')).startswith('INVOICE#'):
+            return
+        with self.timings_lock:
+            if event_name == 'MODIFY':
+                self.counts['invoices_updated'] += 1
+            else:
+                self.counts['invoices_saved'] += 1
+        if not self.args.skip_writer:
+            self.submit(self.run_writer, item, event_name)
+
+    def schedule_textract_completion(self, job_id, status, delay):
+        notification = {'JobId': job_id, 'Status': status, 'API': 'StartExpenseAnalysis', 'JobTag': 'flow-ingest'}
+        event = {'Records': [{'EventSource': 'aws:sns', 'Sns': {'Message': json.dumps(notification)}}]}
+        with self.pending_lock:
+            self.pending += 1
+
+        def fire():
+            try:
+                self.submit(self.run_claude_event, event)
+            finally:
+                with self.pending_lock:
+                    self.pending -= 1
+                    self.pending_lock.notify_all()
+
+        timer = threading.Timer(delay, fire)
+        timer.daemon = True
+        timer.start()
+
+    # -- replay --
+    def replay(self, emails):
+        interval = 1.0 / self.args.rate if self.args.rate > 0 else 0
+        started = time.perf_counter()
+        for index, raw in enumerate(emails):
+            target = started + index * interval
+            delay = target - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            key = f"inbox/{uuid.uuid4().hex}.eml"
+            self.services['s3'].objects[(SOURCE_BUCKET, key)] = (raw, 'message/rfc822')
+            if self.args.entry == 'claude':
+                self.services['s3'].objects[(DEST_BUCKET, key)] = (raw, 'message/rfc822')
+                self.submit(self.run_claude, [key])
+            else:
+                self.submit(self.run_extract, key)
+        self.wait_idle()
+        return time.perf_counter() - started
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def parse_pairs(values, cast):
+    result = {}
+    for value in values or []:
+        for pair in value.split(','):
+            name, _, raw = pair.partition('=')
+            if not raw:
+                raise SystemExit(f"Expected service=value, got {pair!r}")
+            result[name.strip()] = cast(raw)
+    return result
+
+
+def configure_environment(args):
+    os.environ.update({
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_LAMBDA_FUNCTION_MEMORY_SIZE': str(args.memory_mb),
+        'DEST_BUCKET': DEST_BUCKET,
+        'DELAY_SECONDS': '0',
+        'DYNAMODB_TABLE': INVOICE_TABLE,
+        'CONTROL_TABLE': CONTROL_TABLE,
+        'RETRY_QUEUE_URL': 'https://sqs.bench.local/retry',
+        'SUNAT_CLIENT_ID': 'bench-client',
+        'SUNAT_CLIENT_SECRET': 'bench-secret',
+        'SUNAT_RUC': '20604163642',
+        'BEDROCK_RATE_INITIAL': str(args.bedrock_rate),
+        'BEDROCK_RATE_MAX': str(max(args.bedrock_rate, 1.0) * 2),
+        'BEDROCK_RATE_BURST': str(max(args.bedrock_rate, 1.0)),
+        'DB_HOST': 'bench.local',
+        'DB_NAME': 'bench',
+        'DB_USER': 'bench',
+        'DB_PASSWORD': 'bench'
+    })
+    if args.sunat_async:
+        os.environ.update({
+            'SUNAT_VALIDATION_QUEUE_URL': SUNAT_QUEUE_URL,
+            'SUNAT_VALIDATION_RATE': str(args.sunat_rate)
+        })
+    if args.async_textract:
+        os.environ.update({
+            'TEXTRACT_SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:000000000000:bench-textract',
+            'TEXTRACT_SNS_ROLE_ARN': 'arn:aws:iam::000000000000:role/bench-textract',
+            'TEXTRACT_ASYNC_MIN_PAGES': str(args.async_min_pages)
+        })
+    if args.quiet:
+        os.environ.setdefault('METRICS_ENABLED', 'true')
+
+
+def build_report(run, config, emails, elapsed, traced_peak):
+    stages = {}
+    for stage, values in sorted(run.timings.items()):
+        stages[stage] = {
+            'count': len(values),
+            'p50': round(percentile(values, 0.50), 1),
+            'p90': round(percentile(values, 0.90), 1),
+            'p95': round(percentile(values, 0.95), 1),
+            'p99': round(percentile(values, 0.99), 1),
+            'max': round(max(values), 1)
+        }
+    return {
+        'emails': len(emails),
+        'elapsedSeconds': round(elapsed, 2),
+        'emailsPerSecond': round(len(emails) / elapsed, 2) if elapsed else 0,
+        'invoicesPerSecond': round(run.counts['invoices_saved'] / elapsed, 2) if elapsed else 0,
+        'counts': dict(run.counts),
+        'errors': dict(run.errors),
+        'serviceCalls': dict(config.calls),
+        'injectedErrors': dict(config.injected_errors),
+        'deferredMessages': len(run.services['sqs'].messages),
+        'stagesMs': stages,
+        'peakRssMb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'tracedPeakMb': round(traced_peak / 1024 / 1024, 1) if traced_peak is not None else None
+    }
+
+
+def print_report(report):
+    print("\n===== Benchmark de ingesta (offline) =====")
+    print(f"Correos: {report['emails']} en {report['elapsedSeconds']}s "
+          f"→ {report['emailsPerSecond']} correos/s, {report['invoicesPerSecond']} facturas/s")
+    for name, value in sorted(report['counts'].items()):
+        print(f"  {name}: {value}")
+    print(f"  mensajes diferidos a SQS: {report['deferredMessages']}")
+    print(f"Memoria pico: RSS {report['peakRssMb']} MB"
+          + (f", tracemalloc {report['tracedPeakMb']} MB" if report['tracedPeakMb'] is not None else ''))
+    print(f"\n{'etapa':<20}{'n':>6}{'p50':>10}{'p90':>10}{'p95':>10}{'p99':>10}{'max':>10}  (ms)")
+    for stage, stats in report['stagesMs'].items():
+        print(f"{stage:<20}{stats['count']:>6}{stats['p50']:>10}{stats['p90']:>10}"
+              f"{stats['p95']:>10}{stats['p99']:>10}{stats['max']:>10}")
+    if report['injectedErrors']:
+        print(f"\nErrores inyectados: {report['injectedErrors']}")
+    for stage, samples in report['errors'].items():
+        print(f"❌ {stage}: {samples}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline del pipeline de ingesta con servicios simulados")
+    parser.add_argument('--corpus', help="Directorio con archivos .eml a reproducir")
+    parser.add_argument('--synthetic', type=int, default=50, help="Correos sintéticos si no hay --corpus")
+    parser.add_argument('--count', type=int, default=0, help="Total de correos a enviar (repite el corpus)")
+    parser.add_argument('--rate', type=float, default=5.0, help="Correos por segundo (0 = sin pausa)")
+    parser.add_argument('--concurrency', type=int, default=8, help="Invocaciones simultáneas de handlers")
+    parser.add_argument('--batch-size', type=int, default=10, help="Records S3 por invocación de lambda_claude")
+    parser.add_argument('--entry', choices=('email', 'claude'), default='email',
+                        help="email: correo → extract-pdf-to-s3 → lambda_claude; claude: correo directo a lambda_claude")
+    parser.add_argument('--latency', action='append', help="Latencia media por servicio en ms, ej. bedrock=800,sunat=50")
+    parser.add_argument('--latency-scale', type=float, default=1.0, help="Multiplica todas las latencias")
+    parser.add_argument('--error-rate', action='append', help="Probabilidad de error por servicio, ej. bedrock=0.05")
+    parser.add_argument('--escalation-rate', type=float, default=0.1,
+                        help="Fracción de respuestas del modelo rápido que fuerzan escalamiento")
+    parser.add_argument('--bedrock-rate', type=float, default=50.0, help="Tasa inicial del rate limiter de Bedrock")
+    parser.add_argument('--scanned-ratio', type=float, default=0.2, help="Fracción de PDFs sin capa de texto")
+    parser.add_argument('--pages', type=int, default=1, help="Páginas por PDF sintético")
+    parser.add_argument('--padding-kb', type=int, default=0, help="Relleno binario por PDF sintético (KB)")
+    parser.add_argument('--async-textract', action='store_true', help="Habilita Textract asíncrono")
+    parser.add_argument('--async-min-pages', type=int, default=2)
+    parser.add_argument('--sunat-async', action='store_true',
+                        help="Validación SUNAT en cola (lambda_sunat_retry) en lugar de en línea")
+    parser.add_argument('--sunat-rate', type=float, default=50.0, help="SUNAT_VALIDATION_RATE de la etapa en cola")
+    parser.add_argument('--skip-writer', action='store_true', help="No invocar lambda_postgres_writer")
+    parser.add_argument('--memory-mb', type=int, default=1024, help="AWS_LAMBDA_FUNCTION_MEMORY_SIZE simulado")
+    parser.add_argument('--tracemalloc', action='store_true', help="Medir pico de asignaciones Python (más lento)")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--quiet', action='store_true', help="Silenciar los logs de los handlers")
+    parser.add_argument('--json', help="Guardar el reporte en este archivo")
+    args = parser.parse_args()
+
+    configure_environment(args)
+    config = BenchConfig(
+        latency=parse_pairs(args.latency, float),
+        error_rates=parse_pairs(args.error_rate, float),
+        latency_scale=args.latency_scale,
+        seed=args.seed
+    )
+    rng = random.Random(args.seed)
+
+    services = {'s3': FakeS3(config), 'sqs': FakeSQS(config)}
+    run = BenchRun(args, config, services)
+    services['textract'] = FakeTextract(config, services['s3'], run)
+    services['bedrock-runtime'] = FakeBedrock(
+        config,
+        os.environ.get('FAST_MODEL_ID', 'us.anthropic.claude-3-5-haiku-20241022-v1:0'),
+        args.escalation_rate
+    )
+    services['dynamodb'] = FakeDynamoResource({
+        INVOICE_TABLE: FakeTable(INVOICE_TABLE, config, on_put=run.on_invoice_put),
+        CONTROL_TABLE: FakeTable(CONTROL_TABLE, config)
+    })
+
+    if args.sunat_async:
+        services['sqs'].consumers[SUNAT_QUEUE_URL] = lambda record: run.submit(run.run_sunat_stage, record)
+
+    install_stand_ins(config, services)
+    emails = load_corpus(args, rng)
+    print(f"📬 {len(emails)} correo(s), {sum(len(e) for e in emails) / 1024 / 1024:.1f} MB en total")
+
+    real_stdout = sys.stdout
+    if args.quiet:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        run.handlers = import_handlers(config)
+        run.handlers.claude.set_metrics_sink(run.collect_metrics)
+        if args.tracemalloc:
+            tracemalloc.start()
+        elapsed = run.replay(emails)
+        traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    finally:
+        if args.tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        if args.quiet:
+            sys.stdout.close()
+            sys.stdout = real_stdout
+        run.executor.shutdown(wait=True)
+
+    report = build_report(run, config, emails, elapsed, traced_peak)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(report, output, indent=2)
+        print(f"\n💾 Reporte guardado en {args.json}")
+
+
+if __name__ == '__main__':
+    main()
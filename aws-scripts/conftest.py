@@ -0,0 +1,27 @@
+"""
+Configuración de pytest para aws-scripts.
+
+test_sunat_*.py son scripts manuales contra la API real de SUNAT (requieren
+credenciales y red): se ejecutan con python, no se recolectan como tests.
+"""
+
+import os
+import sys
+
+import pytest
+
+collect_ignore = ['test_sunat_minimal.py', 'test_sunat_final.py', 'test_sunat_validation.py']
+
+# Los handlers se importan como módulos sueltos (igual que en el zip de cada Lambda)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+
+@pytest.fixture
+def fake_table():
+    """
+    Fábrica de tablas DynamoDB en memoria (fake_dynamodb.FakeTable, la misma
+    del bench): fake_table('nombre').
+    """
+    import fake_dynamodb
+    return lambda name='tabla': fake_dynamodb.FakeTable(name)
@@ -1,13 +1,13 @@
-import os, re, time, uuid, boto3
+import os, re, time, uuid, resource
 from urllib.parse import unquote_plus
 from datetime import datetime, timedelta, timezone
-from email import policy
-from email.parser import BytesParser
 from email.utils import getaddresses
 from botocore.exceptions import ClientError
 
-s3 = boto3.client("s3")
-textract = boto3.client("textract")
+import mime_stream
+
+# Clientes creados en el primer uso: boto3 y textract no cargan en el cold start
+_clients = {}
 
 DEST_BUCKET = os.environ["DEST_BUCKET"]
 BASE_PREFIX = os.environ.get("BASE_PREFIX", "").strip().strip("/")
@@ -18,10 +18,21 @@ TZ_OFFSET_MIN = int(os.environ.get("DATE_TZ_OFFSET_MINUTES", "-300"))
 VALIDATION_MIN_MATCHES = int(os.environ.get("VALIDATION_MIN_MATCHES", "2"))
 IMAGE_VALIDATION_MIN_MATCHES = int(os.environ.get("IMAGE_VALIDATION_MIN_MATCHES", "0"))
 ALLOW_UNVALIDATED_ATTACHMENTS = os.environ.get("ALLOW_UNVALIDATED_ATTACHMENTS", "true").lower() == "true"
+MIME_CHUNK_SIZE = int(os.environ.get("MIME_CHUNK_SIZE", str(1024 * 1024)))
+SPILL_THRESHOLD = int(os.environ.get("ATTACHMENT_SPILL_THRESHOLD_BYTES", str(2 * 1024 * 1024)))
+SPILL_DIR = os.environ.get("ATTACHMENT_SPILL_DIR", "/tmp")
+TEXTRACT_BYTES_LIMIT = 10 * 1024 * 1024  # límite de Document.Bytes en Textract síncrono
 
 ALLOWED_IMAGE_TYPES = {"image/jpeg", "image/png"}
 ALLOWED_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
 
+def _client(service_name: str):
+    if service_name not in _clients:
+        import boto3
+        _clients[service_name] = boto3.client(service_name)
+    return _clients[service_name]
+
+
 def _normalize_tenant_id(value: str) -> str:
     value = (value or "").strip().lower()
     if not value:
@@ -67,7 +78,7 @@ def _ensure_folder_marker(prefix: str):
     key = prefix.rstrip("/") + "/"
     try:
         # Just try to create it - if it exists, S3 will just overwrite with empty content
-        s3.put_object(Bucket=DEST_BUCKET, Key=key, Body=b"")
+        _client("s3").put_object(Bucket=DEST_BUCKET, Key=key, Body=b"")
     except ClientError as e:
         # Only raise if it's not a permission issue on an existing object
         if e.response.get("Error", {}).get("Code") not in ("AccessDenied", "Forbidden"):
@@ -104,18 +115,56 @@ def _guess_image_type(filename: str) -> str:
     return "image/jpeg"
 
 
-def _attachments(msg):
-    for part in msg.walk():
-        if part.get_content_maintype() == "multipart":
-            continue
+def _parse_email_stream(chunks):
+    """
+    Parse the email as it streams in: PDF/image parts are decoded straight into
+    spools (spilled to SPILL_DIR above SPILL_THRESHOLD); other bodies are dropped.
+    Returns (root headers, parts).
+    """
+    parser = mime_stream.StreamingMimeParser(
+        lambda headers: _is_pdf(headers) or _is_image(headers), SPILL_THRESHOLD, SPILL_DIR
+    )
+    for chunk in chunks:
+        parser.feed(chunk)
+    parts = parser.close()
+    return parser.headers, parts
 
-        is_pdf = _is_pdf(part)
-        is_image = _is_image(part)
-        if not is_pdf and not is_image:
-            continue
 
-        data = part.get_payload(decode=True)
-        if not data:
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _memory_window():
+    return _rss_mb(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _log_memory(window) -> dict:
+    # ru_maxrss is the container lifetime peak (KB on Linux); report what this invocation added
+    start_rss, start_peak = window
+    rss = _rss_mb()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    report = {
+        "rss_mb": round(rss, 1) if rss else None,
+        "rss_delta_mb": round(rss - start_rss, 1) if rss and start_rss else None,
+        "peak_rss_growth_mb": round(peak - start_peak, 1),
+    }
+    print(f"Memory: {report}")
+    return report
+
+
+def _attachments(parts):
+    """
+    Yield (filename, data, content_type, kind, spilled_path). Attachments larger
+    than SPILL_THRESHOLD were spooled to SPILL_DIR and are yielded with data=None.
+    """
+    for part in parts:
+        is_pdf = _is_pdf(part)
+        if not part.size:
+            part.spool.discard()
             continue
 
         filename = part.get_filename()
@@ -123,13 +172,17 @@ def _attachments(msg):
             filename = "adjunto.pdf" if is_pdf else "imagen.jpg"
 
         content_type = (part.get_content_type() or "").lower()
-        if is_image and content_type not in ALLOWED_IMAGE_TYPES:
+        if not is_pdf and content_type not in ALLOWED_IMAGE_TYPES:
             content_type = _guess_image_type(filename)
         if is_pdf:
             content_type = "application/pdf"
 
         kind = "pdf" if is_pdf else "image"
-        yield filename, data, content_type, kind
+        data = part.spool.getvalue()
+        spilled_path = part.spool.path
+        if spilled_path:
+            print(f"Spilled {filename} ({part.size} bytes) to {spilled_path}")
+        yield filename, data, content_type, kind, spilled_path
 
 # ---------- Validación simple ----------
 RUC_RE    = re.compile(r"\b(1[07]\d{9}|20\d{9})\b")
@@ -139,7 +192,7 @@ KEYWORDS  = re.compile(r"\b(FACTURA|BOLETA|SUNAT)\b", re.IGNORECASE)
 
 def _extract_text(pdf_bytes: bytes) -> str:
     try:
-        resp = textract.detect_document_text(Document={"Bytes": pdf_bytes})
+        resp = _client("textract").detect_document_text(Document={"Bytes": pdf_bytes})
         return " ".join(b["Text"] for b in resp.get("Blocks", []) if b.get("BlockType") == "LINE")
     except ClientError as e:
         print(f"Textract error: {e}")
@@ -164,6 +217,7 @@ def handler(event, context):
     import json
 
     print(f"Event received: {json.dumps(event)}")
+    memory_window = _memory_window()
 
     record = event.get("Records", [{}])[0]
 
@@ -172,8 +226,8 @@ def handler(event, context):
         s3_bucket = record["s3"]["bucket"]["name"]
         s3_key = unquote_plus(record["s3"]["object"]["key"])
         print(f"S3 event -> fetching email from s3://{s3_bucket}/{s3_key}")
-        s3_obj = s3.get_object(Bucket=s3_bucket, Key=s3_key)
-        raw_bytes = s3_obj["Body"].read()
+        s3_obj = _client("s3").get_object(Bucket=s3_bucket, Key=s3_key)
+        chunks = s3_obj["Body"].iter_chunks(MIME_CHUNK_SIZE)
         message_id = _extract_message_id({"messageId": record["s3"]["object"].get("versionId")})
 
     # 2) SNS notification (SES -> SNS -> Lambda)
@@ -190,11 +244,11 @@ def handler(event, context):
             s3_bucket = action["bucketName"]
             s3_key = action["objectKey"]
             print(f"Fetching email from s3://{s3_bucket}/{s3_key}")
-            s3_obj = s3.get_object(Bucket=s3_bucket, Key=s3_key)
-            raw_bytes = s3_obj["Body"].read()
+            s3_obj = _client("s3").get_object(Bucket=s3_bucket, Key=s3_key)
+            chunks = s3_obj["Body"].iter_chunks(MIME_CHUNK_SIZE)
         elif "content" in sns_message:
             raw_email = sns_message["content"]
-            raw_bytes = raw_email.encode("utf-8") if isinstance(raw_email, str) else raw_email
+            chunks = [raw_email.encode("utf-8") if isinstance(raw_email, str) else raw_email]
         else:
             raise ValueError(f"Cannot find email content in SNS message. Message structure: {json.dumps(sns_message)}")
 
@@ -203,18 +257,18 @@ def handler(event, context):
         ses_rec = record["ses"]
         mail_data = ses_rec.get("mail", {})
         raw_email = mail_data.get("content", "")
-        raw_bytes = raw_email.encode("utf-8") if isinstance(raw_email, str) else raw_email
+        chunks = [raw_email.encode("utf-8") if isinstance(raw_email, str) else raw_email]
         message_id = _extract_message_id(mail_data)
 
     else:
         raise ValueError("Unsupported event source")
 
-    msg = BytesParser(policy=policy.default).parsebytes(raw_bytes)
+    headers, parts = _parse_email_stream(chunks)
     recipients = []
     if "mail_data" in locals():
         recipients = mail_data.get("destination") or []
     if not recipients:
-        recipients = _extract_recipients_from_headers(msg)
+        recipients = _extract_recipients_from_headers(headers)
     tenant_id = _extract_tenant_id(recipients)
     print(f"Tenant ID: {tenant_id}")
 
@@ -222,28 +276,47 @@ def handler(event, context):
     _ensure_folder_marker(day_prefix)
 
     uploaded, uploaded_unvalidated, skipped = [], [], []
-    for i, (fname, content, content_type, kind) in enumerate(_attachments(msg)):
-        if i > 0 and DELAY_SECONDS > 0:
-            time.sleep(DELAY_SECONDS)
-
-        min_matches = VALIDATION_MIN_MATCHES if kind == "pdf" else IMAGE_VALIDATION_MIN_MATCHES
-        if min_matches > 0:
-            text = _extract_text(content)
-            passes = text and _passes_simple_invoice_check(text, min_matches)
-        else:
-            passes = True
-
-        if not passes and not ALLOW_UNVALIDATED_ATTACHMENTS:
-            skipped.append({"file": fname, "reason": "no pasa validación simple"})
-            continue
-
-        key = f"{day_prefix}/{message_id}/{_sanitize(fname)}"
-        s3.put_object(Bucket=DEST_BUCKET, Key=key, Body=content, ContentType=content_type)
-        if passes:
-            uploaded.append(key)
-        else:
-            uploaded_unvalidated.append(key)
-        print(f"OK -> s3://{DEST_BUCKET}/{key}")
+    try:
+        for i, (fname, content, content_type, kind, spilled_path) in enumerate(_attachments(parts)):
+            try:
+                if i > 0 and DELAY_SECONDS > 0:
+                    time.sleep(DELAY_SECONDS)
+
+                min_matches = VALIDATION_MIN_MATCHES if kind == "pdf" else IMAGE_VALIDATION_MIN_MATCHES
+                if min_matches > 0:
+                    if content is None and os.path.getsize(spilled_path) <= TEXTRACT_BYTES_LIMIT:
+                        with open(spilled_path, "rb") as f:
+                            text = _extract_text(f.read())
+                    elif content is None:
+                        text = ""
+                    else:
+                        text = _extract_text(content)
+                    passes = text and _passes_simple_invoice_check(text, min_matches)
+                else:
+                    passes = True
+
+                if not passes and not ALLOW_UNVALIDATED_ATTACHMENTS:
+                    skipped.append({"file": fname, "reason": "no pasa validación simple"})
+                    continue
+
+                key = f"{day_prefix}/{message_id}/{_sanitize(fname)}"
+                if spilled_path:
+                    _client("s3").upload_file(spilled_path, DEST_BUCKET, key, ExtraArgs={"ContentType": content_type})
+                else:
+                    _client("s3").put_object(Bucket=DEST_BUCKET, Key=key, Body=content, ContentType=content_type)
+                if passes:
+                    uploaded.append(key)
+                else:
+                    uploaded_unvalidated.append(key)
+                print(f"OK -> s3://{DEST_BUCKET}/{key}")
+            finally:
+                content = None
+                if spilled_path:
+                    os.remove(spilled_path)
+    finally:
+        # Spools left behind if an upload failed mid-loop
+        for part in parts:
+            part.spool.discard()
 
     return {
         "ok": True,
@@ -254,5 +327,6 @@ def handler(event, context):
         "dest_bucket": DEST_BUCKET,
         "day_prefix": day_prefix,
         "delay_seconds_between": DELAY_SECONDS,
-        "min_matches": VALIDATION_MIN_MATCHES
+        "min_matches": VALIDATION_MIN_MATCHES,
+        "memory": _log_memory(memory_window)
     }
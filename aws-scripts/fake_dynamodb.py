@@ -0,0 +1,429 @@
+"""
+DynamoDB en memoria para bench_ingest y los tests (conftest.py): FakeTable
+evalúa de verdad ConditionExpression / UpdateExpression / KeyCondition con
+DynamoExpression, y sus errores son el ClientError de botocore (o uno con la
+misma forma si botocore no está instalado), el mismo que capturan los
+handlers.
+"""
+
+import copy
+import re
+import threading
+from decimal import Decimal
+
+try:
+    from botocore.exceptions import ClientError
+except ImportError:
+    class ClientError(Exception):
+        def __init__(self, error_response, operation_name):
+            self.response = error_response
+            self.operation_name = operation_name
+            error = error_response.get('Error', {})
+            super().__init__(
+                f"An error occurred ({error.get('Code')}) when calling the {operation_name} operation: "
+                f"{error.get('Message', '')}"
+            )
+
+
+def client_error(code, operation, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+class NoFaults:
+    """
+    Config por defecto de FakeTable fuera del bench: sin latencia ni errores.
+    """
+
+    def call(self, service):
+        return False
+
+
+# ---------- Expresiones de DynamoDB (subconjunto que usa el pipeline) ----------
+
+EXPRESSION_TOKEN_RE = re.compile(r'\s*(:[A-Za-z0-9_]+|#[A-Za-z0-9_]+|[A-Za-z_][A-Za-z0-9_]*|<>|<=|>=|[=<>(),.+-])')
+MISSING = object()
+
+
+class UnsupportedExpression(ValueError):
+    """
+    La expresión usa algo que FakeTable no implementa: el bench o el test
+    falla en vez de dar la condición por cumplida.
+    """
+
+
+class DynamoExpression:
+    """
+    Evalúa ConditionExpression / KeyConditionExpression (comparaciones,
+    BETWEEN, AND/OR/NOT, paréntesis, attribute_exists, attribute_not_exists,
+    begins_with) y aplica UpdateExpression (SET con + / - e if_not_exists,
+    REMOVE, ADD de números y sets, DELETE de sets) sobre un item en memoria.
+    """
+
+    def __init__(self, expression, names=None, values=None):
+        self.expression = expression
+        self.names = names or {}
+        self.values = values or {}
+        self.tokens = []
+        position = 0
+        expression = expression.rstrip()
+        while position < len(expression):
+            match = EXPRESSION_TOKEN_RE.match(expression, position)
+            if not match:
+                raise UnsupportedExpression(f"Token no soportado en {self.expression!r} (posición {position})")
+            self.tokens.append(match.group(1))
+            position = match.end()
+        self.position = 0
+
+    # -- lectura de tokens --
+    def _peek(self, offset=0):
+        index = self.position + offset
+        return self.tokens[index] if index < len(self.tokens) else None
+
+    def _keyword(self, offset=0):
+        token = self._peek(offset)
+        return token.upper() if token else None
+
+    def _next(self, expected=None):
+        token = self._peek()
+        if token is None or (expected is not None and token.upper() != expected):
+            raise UnsupportedExpression(f"Se esperaba {expected or 'un token'} en {self.expression!r}, llegó {token!r}")
+        self.position += 1
+        return token
+
+    def _done(self):
+        if self._peek() is not None:
+            raise UnsupportedExpression(f"Sobra {self._peek()!r} en {self.expression!r}")
+
+    # -- paths y operandos --
+    def _path(self):
+        parts = []
+        while True:
+            token = self._next()
+            if token.startswith('#'):
+                if token not in self.names:
+                    raise UnsupportedExpression(f"Falta ExpressionAttributeNames[{token}]")
+                token = self.names[token]
+            elif not re.match(r'[A-Za-z_]', token) or token.upper() in {'AND', 'OR', 'NOT', 'BETWEEN'}:
+                raise UnsupportedExpression(f"Path inválido {token!r} en {self.expression!r}")
+            parts.append(token)
+            if self._peek() != '.':
+                return parts
+            self._next('.')
+
+    def _value(self, token):
+        if token not in self.values:
+            raise UnsupportedExpression(f"Falta ExpressionAttributeValues[{token}]")
+        return self.values[token]
+
+    @staticmethod
+    def _get(item, path):
+        current = item
+        for part in path:
+            if not isinstance(current, dict) or part not in current:
+                return MISSING
+            current = current[part]
+        return current
+
+    @staticmethod
+    def _set(item, path, value):
+        current = item
+        for part in path[:-1]:
+            if not isinstance(current.get(part), dict):
+                raise client_error('ValidationException', 'UpdateItem',
+                                   'The document path provided in the update expression is invalid for update')
+            current = current[part]
+        current[path[-1]] = value
+
+    @staticmethod
+    def _remove(item, path):
+        current = DynamoExpression._get(item, path[:-1]) if len(path) > 1 else item
+        if isinstance(current, dict):
+            current.pop(path[-1], None)
+
+    def _operand(self, item):
+        token = self._peek()
+        if token is None:
+            raise UnsupportedExpression(f"Falta un operando en {self.expression!r}")
+        if token.startswith(':'):
+            return self._value(self._next())
+        if token == 'if_not_exists' and self._peek(1) == '(':
+            self._next()
+            self._next('(')
+            current = self._get(item, self._path())
+            self._next(',')
+            default = self._operand(item)
+            self._next(')')
+            return default if current is MISSING else current
+        return self._get(item, self._path())
+
+    # -- condiciones --
+    def matches(self, item):
+        self.position = 0
+        result = self._or(item or {})
+        self._done()
+        return result
+
+    def _or(self, item):
+        result = self._and(item)
+        while self._keyword() == 'OR':
+            self._next()
+            result = self._and(item) or result
+        return result
+
+    def _and(self, item):
+        result = self._not(item)
+        while self._keyword() == 'AND':
+            self._next()
+            result = self._not(item) and result
+        return result
+
+    def _not(self, item):
+        if self._keyword() == 'NOT':
+            self._next()
+            return not self._not(item)
+        if self._peek() == '(':
+            self._next('(')
+            result = self._or(item)
+            self._next(')')
+            return result
+        return self._predicate(item)
+
+    def _predicate(self, item):
+        token = self._peek()
+        if token in ('attribute_exists', 'attribute_not_exists', 'begins_with') and self._peek(1) == '(':
+            self._next()
+            self._next('(')
+            current = self._get(item, self._path())
+            if token == 'begins_with':
+                self._next(',')
+                prefix = self._operand(item)
+                self._next(')')
+                return isinstance(current, str) and current.startswith(prefix)
+            self._next(')')
+            return (current is not MISSING) == (token == 'attribute_exists')
+        if re.match(r'[a-z_]+$', token or '') and self._peek(1) == '(':
+            raise UnsupportedExpression(f"Función {token}() no soportada en {self.expression!r}")
+
+        left = self._operand(item)
+        operator = self._next()
+        if operator.upper() == 'BETWEEN':
+            low = self._operand(item)
+            self._next('AND')
+            high = self._operand(item)
+            return self._compare(left, '>=', low) and self._compare(left, '<=', high)
+        if operator not in ('=', '<>', '<', '<=', '>', '>='):
+            raise UnsupportedExpression(f"Operador {operator!r} no soportado en {self.expression!r}")
+        return self._compare(left, operator, self._operand(item))
+
+    @staticmethod
+    def _compare(left, operator, right):
+        if left is MISSING or right is MISSING:
+            return operator == '<>' and not (left is MISSING and right is MISSING)
+        if operator == '=':
+            return left == right
+        if operator == '<>':
+            return left != right
+        numeric = (int, float, Decimal)
+        if not (isinstance(left, numeric) and isinstance(right, numeric)) and type(left) is not type(right):
+            # DynamoDB no compara tipos distintos: la condición no se cumple
+            return False
+        return {'<': left < right, '<=': left <= right, '>': left > right, '>=': left >= right}[operator]
+
+    def key_attributes(self):
+        """
+        Atributos de una KeyConditionExpression: (partición, orden o None).
+        """
+        attributes = [self.names.get(token, token) for token in self.tokens
+                      if (token.startswith('#') or re.match(r'[A-Za-z_]', token))
+                      and token.upper() not in {'AND', 'BETWEEN', 'BEGINS_WITH'}]
+        return attributes[0], (attributes[1] if len(attributes) > 1 else None)
+
+    # -- actualizaciones --
+    def apply(self, item):
+        self.position = 0
+        seen = set()
+        while self._peek() is not None:
+            clause = self._keyword()
+            if clause not in ('SET', 'REMOVE', 'ADD', 'DELETE') or clause in seen:
+                raise UnsupportedExpression(f"Cláusula {self._peek()!r} no soportada en {self.expression!r}")
+            seen.add(clause)
+            self._next()
+            while True:
+                getattr(self, f'_apply_{clause.lower()}')(item)
+                if self._peek() != ',':
+                    break
+                self._next(',')
+        return item
+
+    def _apply_set(self, item):
+        path = self._path()
+        self._next('=')
+        value = self._operand(item)
+        while self._peek() in ('+', '-'):
+            operator = self._next()
+            other = self._operand(item)
+            if value is MISSING or other is MISSING:
+                raise client_error('ValidationException', 'UpdateItem',
+                                   'The provided expression refers to an attribute that does not exist in the item')
+            value = value + other if operator == '+' else value - other
+        if value is MISSING:
+            raise client_error('ValidationException', 'UpdateItem',
+                               'The provided expression refers to an attribute that does not exist in the item')
+        self._set(item, path, value)
+
+    def _apply_remove(self, item):
+        self._remove(item, self._path())
+
+    def _apply_add(self, item):
+        path = self._path()
+        value = self._value(self._next())
+        current = self._get(item, path)
+        if current is MISSING:
+            self._set(item, path, set(value) if isinstance(value, (set, frozenset)) else value)
+        elif isinstance(current, set) and isinstance(value, (set, frozenset)):
+            current |= value
+        elif isinstance(current, (int, Decimal)) and isinstance(value, (int, Decimal)):
+            self._set(item, path, current + value)
+        else:
+            raise client_error('ValidationException', 'UpdateItem', 'Incorrect operand type for operator or function')
+
+    def _apply_delete(self, item):
+        path = self._path()
+        value = self._value(self._next())
+        current = self._get(item, path)
+        if isinstance(current, set):
+            current -= value
+            if not current:
+                self._remove(item, path)
+
+
+class FakeTable:
+    """
+    Tabla en memoria. Las ConditionExpression / UpdateExpression se evalúan
+    con DynamoExpression; una expresión que no reconoce lanza
+    UnsupportedExpression (no se da por cumplida). Los Query sobre un índice
+    devuelven solo las claves (los GSI del pipeline son KEYS_ONLY).
+    """
+
+    def __init__(self, name, config=None, on_put=None):
+        self.name = name
+        self.config = config or NoFaults()
+        self.items = {}
+        self.lock = threading.Lock()
+        self.on_put = on_put
+
+    def _key(self, item):
+        return (item.get('PK'), item.get('SK'))
+
+    @staticmethod
+    def _condition_failed(operation, current, kwargs):
+        error = client_error('ConditionalCheckFailedException', operation, 'The conditional request failed')
+        if kwargs.get('ReturnValuesOnConditionCheckFailure') == 'ALL_OLD' and current is not None:
+            error.response['Item'] = copy.deepcopy(current)
+        return error
+
+    def _check(self, operation, current, condition, kwargs):
+        if condition and not DynamoExpression(
+            condition, kwargs.get('ExpressionAttributeNames'), kwargs.get('ExpressionAttributeValues')
+        ).matches(current):
+            raise self._condition_failed(operation, current, kwargs)
+
+    def get_item(self, Key, **kwargs):
+        if self.config.call('dynamodb'):
+            raise client_error('ProvisionedThroughputExceededException', 'GetItem')
+        with self.lock:
+            item = self.items.get(self._key(Key))
+            return {'Item': copy.deepcopy(item)} if item is not None else {}
+
+    def put_item(self, Item, ConditionExpression=None, **kwargs):
+        if self.config.call('dynamodb'):
+            raise client_error('ProvisionedThroughputExceededException', 'PutItem')
+        with self.lock:
+            current = self.items.get(self._key(Item))
+            self._check('PutItem', current, ConditionExpression, kwargs)
+            self.items[self._key(Item)] = copy.deepcopy(Item)
+        if self.on_put:
+            self.on_put(Item, 'MODIFY' if current is not None else 'INSERT')
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None, ReturnValues='NONE', **kwargs):
+        if self.config.call('dynamodb'):
+            raise client_error('ProvisionedThroughputExceededException', 'UpdateItem')
+        with self.lock:
+            current = self.items.get(self._key(Key))
+            self._check('UpdateItem', current, ConditionExpression, kwargs)
+            updated = DynamoExpression(
+                UpdateExpression, kwargs.get('ExpressionAttributeNames'), kwargs.get('ExpressionAttributeValues')
+            ).apply(copy.deepcopy(current) if current is not None else dict(Key))
+            self.items[self._key(Key)] = updated
+            snapshot = copy.deepcopy(updated)
+        if self.on_put:
+            self.on_put(snapshot, 'MODIFY' if current is not None else 'INSERT')
+        if ReturnValues == 'ALL_NEW':
+            return {'Attributes': snapshot}
+        if ReturnValues != 'NONE':
+            raise UnsupportedExpression(f"ReturnValues={ReturnValues} no soportado")
+        return {}
+
+    def delete_item(self, Key, ConditionExpression=None, **kwargs):
+        if self.config.call('dynamodb'):
+            raise client_error('ProvisionedThroughputExceededException', 'DeleteItem')
+        with self.lock:
+            self._check('DeleteItem', self.items.get(self._key(Key)), ConditionExpression, kwargs)
+            self.items.pop(self._key(Key), None)
+        return {}
+
+    def query(self, KeyConditionExpression, IndexName=None, Limit=None, ExclusiveStartKey=None,
+              ScanIndexForward=True, **kwargs):
+        if self.config.call('dynamodb'):
+            raise client_error('ProvisionedThroughputExceededException', 'Query')
+        unsupported = set(kwargs) - {'ExpressionAttributeNames', 'ExpressionAttributeValues'}
+        if unsupported:
+            raise UnsupportedExpression(f"Parámetros de Query no soportados: {sorted(unsupported)}")
+        expression = DynamoExpression(
+            KeyConditionExpression, kwargs.get('ExpressionAttributeNames'), kwargs.get('ExpressionAttributeValues')
+        )
+        partition, sort = expression.key_attributes()
+        with self.lock:
+            found = [item for item in self.items.values()
+                     if partition in item and (sort is None or sort in item) and expression.matches(item)]
+            found = [copy.deepcopy(item) for item in found]
+        found.sort(key=lambda item: (item.get(sort, ''), self._key(item)), reverse=not ScanIndexForward)
+        if IndexName:
+            keys = ('PK', 'SK', partition) + ((sort,) if sort else ())
+            found = [{name: item[name] for name in keys} for item in found]
+        if ExclusiveStartKey:
+            position = next((index for index, item in enumerate(found)
+                             if self._key(item) == self._key(ExclusiveStartKey)), -1)
+            found = found[position + 1:]
+        response = {'Items': found[:Limit] if Limit else found}
+        if Limit and len(found) > Limit:
+            last = response['Items'][-1]
+            response['LastEvaluatedKey'] = {name: last[name] for name in (('PK', 'SK', partition) + ((sort,) if sort else ()))}
+        return response
+
+    def scan(self, **kwargs):
+        self.config.call('dynamodb')
+        unsupported = set(kwargs) - {'ProjectionExpression', 'ExpressionAttributeNames', 'ExclusiveStartKey'}
+        if unsupported:
+            raise UnsupportedExpression(f"Parámetros de Scan no soportados: {sorted(unsupported)}")
+        with self.lock:
+            return {'Items': [copy.deepcopy(item) for item in self.items.values()]}
+
+
+class FakeDynamoResource:
+    def __init__(self, tables):
+        self.tables = tables
+
+    def Table(self, name):
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        responses = {}
+        for name, request in RequestItems.items():
+            table = self.tables[name]
+            table.config.call('dynamodb')
+            with table.lock:
+                found = [table.items.get(table._key(key)) for key in request['Keys']]
+                responses[name] = [copy.deepcopy(item) for item in found if item is not None]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
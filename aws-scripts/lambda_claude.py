@@ -7,44 +7,172 @@ Modelo: Claude 3.5 Sonnet v2 (mejor para documentos financieros)
 """
 
 import json
-import boto3
 import os
-import base64
-import urllib3
+import re
+import binascii
+import hashlib
+import importlib
+import itertools
+import resource
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
 from datetime import datetime
 from decimal import Decimal, InvalidOperation
-from email import policy
-from email.parser import BytesParser
+from functools import lru_cache
+from io import BytesIO
 from botocore.exceptions import ClientError
 
-# AWS Clients
-s3_client = boto3.client('s3')
-bedrock_runtime = boto3.client('bedrock-runtime')
-textract_client = boto3.client('textract')
-dynamodb = boto3.resource('dynamodb')
+import mime_stream
+import sunat_client
+
+# AWS Clients: se crean en el primer uso. Importar boto3 y construir cada
+# cliente cuesta decenas de ms del cold start, y no todas las rutas usan
+# todos los servicios (p. ej. textract en fotos, sqs sin diferidos).
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(service_name):
+    """
+    Cliente boto3 compartido por el contenedor (los clientes son thread-safe;
+    la sesión por defecto no, por eso la creación va bajo lock).
+    """
+    client = _clients.get(service_name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(service_name)
+            if client is None:
+                import boto3
+                client = _clients[service_name] = boto3.client(service_name)
+    return client
+
+
+@lru_cache(maxsize=None)
+def optional_import(module_name):
+    """
+    Importa una dependencia opcional solo cuando una ruta la necesita.
+    pypdf: sin la librería todos los PDFs pasan por Textract.
+    PIL: sin la librería las fotos se envían tal cual.
+    """
+    try:
+        return importlib.import_module(module_name)
+    except ImportError:
+        return None
+
 
 # Environment variables
 TABLE_NAME = os.environ.get('DYNAMODB_TABLE', 'Facturas-dev')
-table = dynamodb.Table(TABLE_NAME)
+# Tabla de control (índice de hashes de adjuntos y estado compartido)
+CONTROL_TABLE_NAME = os.environ.get('CONTROL_TABLE', 'FlowControl-dev')
 BASE_PREFIX = os.environ.get('BASE_PREFIX', '').strip().strip('/')
-
-# SUNAT API credentials (from environment variables)
-SUNAT_CLIENT_ID = os.environ.get('SUNAT_CLIENT_ID')
-SUNAT_CLIENT_SECRET = os.environ.get('SUNAT_CLIENT_SECRET')
-SUNAT_RUC = os.environ.get('SUNAT_RUC')  # RUC del consultante
+# Máximo de records del batch procesados en paralelo por invocación
+RECORD_CONCURRENCY = max(1, int(os.environ.get('RECORD_CONCURRENCY', '4')))
+# Parseo MIME en streaming: tamaño de lectura del body S3 y umbral para
+# mover adjuntos grandes a disco (/tmp) en lugar de mantenerlos en memoria
+MIME_CHUNK_SIZE = int(os.environ.get('MIME_CHUNK_SIZE', str(1024 * 1024)))
+ATTACHMENT_SPILL_THRESHOLD = int(os.environ.get('ATTACHMENT_SPILL_THRESHOLD_BYTES', str(2 * 1024 * 1024)))
+ATTACHMENT_SPILL_DIR = os.environ.get('ATTACHMENT_SPILL_DIR', '/tmp')
+# Adjuntos de un mismo correo procesados en paralelo
+ATTACHMENT_CONCURRENCY = max(1, int(os.environ.get('ATTACHMENT_CONCURRENCY', '4')))
+# Imágenes más pequeñas que esto suelen ser logos/firmas, no comprobantes
+MIN_IMAGE_ATTACHMENT_BYTES = int(os.environ.get('MIN_IMAGE_ATTACHMENT_BYTES', '15000'))
+# Pico de memoria por invocación con tracemalloc (agrega overhead; para diagnóstico)
+MEMORY_TRACE = os.environ.get('MEMORY_TRACE', 'false').lower() == 'true'
+# Llamadas simultáneas a Bedrock por contenedor (compartido entre records y adjuntos)
+BEDROCK_MAX_CONCURRENCY = max(1, int(os.environ.get('BEDROCK_MAX_CONCURRENCY', '4')))
+bedrock_semaphore = threading.BoundedSemaphore(BEDROCK_MAX_CONCURRENCY)
+# Documentos hasta este tamaño van a Textract como Bytes (sin esperar la copia en S3)
+TEXTRACT_BYTES_MAX = int(os.environ.get('TEXTRACT_BYTES_MAX', str(5 * 1024 * 1024)))
+# Las copias de depuración se suben en segundo plano
+debug_upload_executor = ThreadPoolExecutor(max_workers=4)
+
+# Rate limiter adaptativo (AIMD) para Bedrock, compartido vía tabla de control.
+# Tasas en requests/segundo para toda la cuenta (todas las invocaciones).
+BEDROCK_RATE_INITIAL = float(os.environ.get('BEDROCK_RATE_INITIAL', '2'))
+BEDROCK_RATE_MIN = float(os.environ.get('BEDROCK_RATE_MIN', '0.2'))
+BEDROCK_RATE_MAX = float(os.environ.get('BEDROCK_RATE_MAX', '20'))
+BEDROCK_RATE_INCREASE = float(os.environ.get('BEDROCK_RATE_INCREASE', '0.05'))
+BEDROCK_RATE_DECREASE = float(os.environ.get('BEDROCK_RATE_DECREASE', '0.5'))
+BEDROCK_RATE_BURST = float(os.environ.get('BEDROCK_RATE_BURST', '5'))
+# Espera máxima en proceso por un token; si no alcanza, el trabajo se difiere a SQS
+BEDROCK_MAX_TOKEN_WAIT = float(os.environ.get('BEDROCK_MAX_TOKEN_WAIT_SECONDS', '0.5'))
+# Respuestas de Bedrock en streaming con parseo incremental del JSON
+BEDROCK_STREAMING = os.environ.get('BEDROCK_STREAMING', 'true').lower() in ('1', 'true', 'yes')
+# Texto tolerado antes del '{' inicial (p. ej. ```json) antes de abortar el stream
+BEDROCK_JSON_PREAMBLE_MAX = int(os.environ.get('BEDROCK_JSON_PREAMBLE_MAX', '200'))
+
+# Memoria máxima para cuerpos de request a Bedrock en vuelo (todas las llamadas
+# del contenedor). Por defecto, la mitad de la memoria de la Lambda.
+BEDROCK_REQUEST_MEMORY_BUDGET = int(os.environ.get(
+    'BEDROCK_REQUEST_MEMORY_BUDGET_MB',
+    str(int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', '1024')) // 2)
+)) * 1024 * 1024
+# Bloques de lectura/encoding base64 (múltiplo de 3: sin padding intermedio)
+BASE64_CHUNK_SIZE = 3 * 256 * 1024
+DOCUMENT_DATA_PLACEHOLDER = '__DOCUMENT_BASE64__'
+request_memory_condition = threading.Condition()
+request_memory_in_use = 0
+
+# Preproceso de fotos antes de Bedrock: Claude reescala internamente a ~1568 px
+# de lado mayor / ~1.15 MP, así que resoluciones mayores solo suman bytes.
+IMAGE_MAX_EDGE = int(os.environ.get('IMAGE_MAX_EDGE', '1568'))
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', '1150000'))
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', '85'))
+# Saturación media (0-255) bajo la cual la foto se pasa a escala de grises
+IMAGE_GRAYSCALE_MAX_SATURATION = int(os.environ.get('IMAGE_GRAYSCALE_MAX_SATURATION', '24'))
+
+# Latencia por etapa como CloudWatch Embedded Metric Format (una línea JSON en
+# stdout; CloudWatch Logs la convierte en métricas sin llamadas de red).
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'FlowIngest')
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+METRIC_DIMENSIONS = ('ruta', 'mediaType', 'tenant')
+_metrics_local = threading.local()
+RETRY_QUEUE_URL = os.environ.get('RETRY_QUEUE_URL')
+MAX_DEFER_SECONDS = 900  # máximo DelaySeconds de SQS
+# Documentos sin RUC emisor o número (términos, guías, etc.) se guardan en la
+# tabla de control para revisión en vez de como factura
+QUARANTINE_TTL_DAYS = int(os.environ.get('QUARANTINE_TTL_DAYS', '30'))
+
+# Textract asíncrono (StartExpenseAnalysis) para PDFs de varias páginas
+# (AnalyzeExpense síncrono solo acepta PDFs de una página).
+# La finalización llega por SNS (directo o vía SQS) y retoma el pipeline.
+TEXTRACT_ASYNC_MIN_PAGES = int(os.environ.get('TEXTRACT_ASYNC_MIN_PAGES', '2'))
+TEXTRACT_SNS_TOPIC_ARN = os.environ.get('TEXTRACT_SNS_TOPIC_ARN')
+TEXTRACT_SNS_ROLE_ARN = os.environ.get('TEXTRACT_SNS_ROLE_ARN')
+TEXTRACT_JOB_CONTEXT_TTL_DAYS = 7
+# Una notificación reentregada no retoma un job que otra invocación está
+# procesando hasta que venza este lease (timeout máximo de la Lambda)
+TEXTRACT_JOB_CLAIM_SECONDS = int(os.environ.get('TEXTRACT_JOB_CLAIM_SECONDS', '900'))
+PDF_PAGE_RE = re.compile(rb'/Type\s*/Page(?![a-zA-Z])')
+
+# Selección de páginas para PDFs largos en la ruta de documento completo:
+# solo se envían a Bedrock las páginas que parecen comprobante.
+PAGE_SELECTION_MIN_PAGES = int(os.environ.get('PAGE_SELECTION_MIN_PAGES', '3'))
+PAGE_SELECTION_MIN_SCORE = int(os.environ.get('PAGE_SELECTION_MIN_SCORE', '2'))
+# Mismos patrones que la validación simple de extract-pdf-to-s3.py
+RUC_RE = re.compile(r"\b(1[07]\d{9}|20\d{9})\b")
+SERIE_RE = re.compile(r"\b[FB]\d{3}-\d{6,8}\b")
+TOTAL_RE = re.compile(r"(S\/\.|PEN|\sS\s|\$|USD|US\$)\s*\d{1,3}(?:[.,]\d{3})*(?:[.,]\d{2})?")
+KEYWORDS_RE = re.compile(r"\b(FACTURA|BOLETA|SUNAT)\b", re.IGNORECASE)
+
+# Validación SUNAT asíncrona: con cola configurada, la factura se guarda como
+# PENDIENTE y lambda_sunat_retry la valida desde la cola. Sin cola, se valida
+# en línea antes de guardar.
+SUNAT_VALIDATION_QUEUE_URL = os.environ.get('SUNAT_VALIDATION_QUEUE_URL')
 
 # Bedrock model - Claude 3.5 Sonnet v2 (mejor para facturación)
 # Usar inference profile en lugar de model ID directo
 MODEL_ID = "us.anthropic.claude-3-5-sonnet-20241022-v2:0"
+MODEL_NAME = 'Claude 3.5 Sonnet v2'
 
-# HTTP client for SUNAT API
-http = urllib3.PoolManager()
-
-# Token cache (se reutiliza durante su vigencia)
-sunat_token_cache = {
-    'token': None,
-    'expires_at': None
-}
+# Modelo rápido para las rutas de solo texto; se escala a MODEL_ID cuando el
+# resultado no pasa los chequeos locales. Vacío = siempre MODEL_ID.
+FAST_MODEL_ID = os.environ.get('FAST_MODEL_ID', 'us.anthropic.claude-3-5-haiku-20241022-v1:0').strip()
+FAST_MODEL_NAME = os.environ.get('FAST_MODEL_NAME', 'Claude 3.5 Haiku')
+RUC_PATTERN = re.compile(r'^\d{11}$')
 
 ALLOWED_PDF_MIME_TYPES = {'application/pdf'}
 ALLOWED_IMAGE_MIME_TYPES = {'image/jpeg', 'image/png'}
@@ -55,6 +183,28 @@ MEDIA_TYPE_EXTENSION = {
     'image/png': '.png'
 }
 
+# Los resources de boto3 no son thread-safe: cada worker usa su propia Table
+_thread_local = threading.local()
+
+
+def _get_thread_table(table_name):
+    tables = getattr(_thread_local, 'tables', None)
+    if tables is None:
+        tables = _thread_local.tables = {}
+    if table_name not in tables:
+        import boto3
+        tables[table_name] = boto3.session.Session().resource('dynamodb').Table(table_name)
+    return tables[table_name]
+
+
+def get_table():
+    return _get_thread_table(TABLE_NAME)
+
+
+def get_control_table():
+    return _get_thread_table(CONTROL_TABLE_NAME)
+
+
 def extract_client_id(s3_key: str) -> str:
     parts = (s3_key or '').split('/')
     if BASE_PREFIX and parts and parts[0] == BASE_PREFIX:
@@ -64,346 +214,739 @@ def extract_client_id(s3_key: str) -> str:
 
 def lambda_handler(event, context):
     """
-    Main handler - triggered by S3 upload
+    Main handler - triggered by S3 upload (directo o vía SQS)
+
+    Procesa todos los records del batch en paralelo (máximo RECORD_CONCURRENCY)
+    y retorna un reporte por record. `batchItemFailures` sigue el formato de
+    partial batch response de SQS para que solo se reintenten los fallidos.
     """
-    try:
-        # 1. Get S3 event info
-        record = event['Records'][0]
-        bucket = record['s3']['bucket']['name']
-        key = record['s3']['object']['key']
-        file_size = record['s3']['object']['size']
-        
-        print(f"📄 Processing: s3://{bucket}/{key}")
-        print(f"📦 Size: {file_size} bytes")
-
-        if key.endswith('/') or file_size == 0:
-            print("⏭️ Skipping folder marker or empty object")
-            return {
-                'statusCode': 200,
-                'body': json.dumps({
-                    'message': 'Skipped empty object',
-                    'key': key
+    records = event.get('Records') or []
+    print(f"📥 Received {len(records)} record(s)")
+    memory_window = start_memory_window()
+
+    if not records:
+        return {
+            'statusCode': 200,
+            'batchItemFailures': [],
+            'body': json.dumps({'message': 'No records to process'})
+        }
+
+    report = []
+    failures = []
+    workers = min(RECORD_CONCURRENCY, len(records))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        futures_records = {}
+        for record in records:
+            future = executor.submit(process_event_record, record)
+            futures[future] = get_record_identifier(record)
+            futures_records[future] = record
+        for future in as_completed(futures):
+            identifier = futures[future]
+            try:
+                results = future.result()
+                report.append({
+                    'itemIdentifier': identifier,
+                    'status': 'ok',
+                    'results': results
                 })
-            }
-        
-        # 2. Extract client_id (tenant) from path
-        client_id = extract_client_id(key)
-        
-        print(f"👤 Client ID: {client_id}")
-        print(f"🏷️ Tenant ID: {client_id}")
-        
-        # 3. Download raw email from S3 and extract PDF attachment
-        print("📥 Downloading raw SES email from S3...")
-        email_obj = s3_client.get_object(Bucket=bucket, Key=key)
-        raw_email = email_obj['Body'].read()
+            except BedrockCapacityUnavailable as e:
+                if defer_record(futures_records[future], e.retry_after):
+                    report.append({
+                        'itemIdentifier': identifier,
+                        'status': 'deferred',
+                        'retryAfter': e.retry_after
+                    })
+                else:
+                    report.append({
+                        'itemIdentifier': identifier,
+                        'status': 'error',
+                        'error': str(e),
+                        'type': type(e).__name__
+                    })
+                    failures.append({'itemIdentifier': identifier})
+            except Exception as e:
+                print(f"❌ ERROR [{identifier}]: {str(e)}")
+                report.append({
+                    'itemIdentifier': identifier,
+                    'status': 'error',
+                    'error': str(e),
+                    'type': type(e).__name__
+                })
+                failures.append({'itemIdentifier': identifier})
 
-        print("🔍 Extracting attachment from email...")
-        attachment = extract_attachment_from_email(raw_email, key)
-        if not attachment:
-            print("⚠️ No attachment found; treating S3 object as direct file")
-            attachment = wrap_raw_object_as_attachment(raw_email, key, email_obj.get('ContentType'))
+    if not failures:
+        status_code = 200
+    elif len(failures) == len(records):
+        status_code = 500
+    else:
+        status_code = 207
 
-        print(f"📎 Attachment detected: {attachment['filename']} ({attachment['media_type']})")
+    print(f"📊 Batch finished: {len(records) - len(failures)} ok, {len(failures)} failed")
+    memory = log_memory_usage(memory_window)
 
-        print("📤 Uploading debug copy to S3 for verification...")
-        debug_key = upload_debug_attachment(bucket, attachment)
+    return {
+        'statusCode': status_code,
+        'batchItemFailures': failures,
+        'body': json.dumps({
+            'processed': len(records) - len(failures),
+            'failed': len(failures),
+            'records': report,
+            'memoria': memory
+        })
+    }
 
-        # 4. Call Textract + Bedrock depending on media type
-        print("🤖 Calling Bedrock Claude 3.5 Sonnet...")
-        invoice_data, processing_overrides = process_attachment(attachment, bucket, debug_key)
 
-        print(f"✅ Claude completed - Invoice: {invoice_data.get('numeroFactura')}")
+def read_rss_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
 
-        # 5. Validate invoice with SUNAT API
-        print("🔍 Validating invoice with SUNAT...")
-        sunat_validation = validate_invoice_with_sunat(invoice_data)
-
-        print(f"✅ SUNAT validation: {sunat_validation['estado']}")
-
-        # 6. Build DynamoDB item (including SUNAT validation)
-        dynamo_item = build_item(
-            client_id,
-            invoice_data,
-            bucket,
-            key,
-            file_size,
-            sunat_validation,
-            processing_overrides
-        )
-        
-        # 6. Save to DynamoDB
-        print("💾 Saving to DynamoDB...")
-        table.put_item(Item=dynamo_item)
-        
-        print(f"✅ SUCCESS - Invoice ID: {dynamo_item['invoiceId']}")
-        
-        return {
-            'statusCode': 200,
-            'body': json.dumps({
-                'message': 'Invoice processed successfully',
-                'invoiceId': dynamo_item['invoiceId'],
-                'clientId': client_id,
-                'total': safe_float(invoice_data.get('montos', {}).get('total', 0)),
-                'numeroFactura': invoice_data.get('numeroFactura')
-            })
-        }
-        
-    except Exception as e:
-        print(f"❌ ERROR: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        
-        return {
-            'statusCode': 500,
-            'body': json.dumps({
-                'error': str(e),
-                'type': type(e).__name__
-            })
-        }
+
+def start_memory_window():
+    """
+    Marca el inicio de la invocación. ru_maxrss es el pico de todo el
+    contenedor (incluye invocaciones anteriores), así que se guarda para
+    reportar solo lo que esta invocación agregó. Con MEMORY_TRACE=true también
+    se reinicia el pico de tracemalloc (asignaciones de Python).
+    """
+    if MEMORY_TRACE:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    return {
+        'rssMb': read_rss_mb(),
+        'maxRssMb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
 
 
-def get_sunat_token():
+def log_memory_usage(window):
     """
-    Obtiene token de autenticación de SUNAT API
-    Usa cache para evitar solicitar token en cada invocación
+    Reporta la memoria de esta invocación (MB): RSS al final, su variación
+    respecto del inicio y cuánto subió el pico del contenedor (0 si no superó
+    el de invocaciones anteriores). Con MEMORY_TRACE, el pico de tracemalloc.
     """
-    global sunat_token_cache
+    current_mb = read_rss_mb()
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    report = {
+        'rssMb': round(current_mb, 1) if current_mb else None,
+        'rssDeltaMb': round(current_mb - window['rssMb'], 1) if current_mb and window['rssMb'] else None,
+        'peakRssGrowthMb': round(peak_mb - window['maxRssMb'], 1),
+        'containerPeakRssMb': round(peak_mb, 1)
+    }
+    if MEMORY_TRACE and tracemalloc.is_tracing():
+        report['tracedPeakMb'] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
 
-    # Verificar si hay credenciales configuradas
-    if not SUNAT_CLIENT_ID or not SUNAT_CLIENT_SECRET:
-        print("⚠️ SUNAT credentials not configured, skipping validation")
-        return None
+    print(
+        f"🧠 Memory: RSS {report['rssMb']} MB (Δ {report['rssDeltaMb']} MB), "
+        f"peak growth {report['peakRssGrowthMb']} MB"
+        + (f", traced peak {report['tracedPeakMb']} MB" if 'tracedPeakMb' in report else "")
+    )
+    return report
 
-    # Verificar si el token en cache sigue válido
-    now = datetime.now().timestamp()
-    if sunat_token_cache['token'] and sunat_token_cache['expires_at']:
-        if now < sunat_token_cache['expires_at']:
-            print("🔑 Using cached SUNAT token")
-            return sunat_token_cache['token']
 
-    # Solicitar nuevo token
-    print("🔑 Requesting new SUNAT token...")
+def emit_metrics_stdout(record):
+    print(json.dumps(record, separators=(',', ':')))
 
-    try:
-        url = f"https://api-seguridad.sunat.gob.pe/v1/clientesextranet/{SUNAT_CLIENT_ID}/oauth2/token/"
 
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded'
+# Destino de los registros EMF; reemplazable (p. ej. el harness offline)
+metrics_sink = emit_metrics_stdout
+
+
+def set_metrics_sink(sink):
+    global metrics_sink
+    metrics_sink = sink
+
+
+class StageMetrics:
+    """
+    Tiempos de etapa de un adjunto (o de la lectura de un correo) con sus
+    dimensiones. Las dimensiones se completan a medida que se conocen (la
+    ruta se decide después de Textract) y todo se emite en un solo registro.
+    """
+
+    def __init__(self, **dimensions):
+        self.dimensions = {name: 'desconocido' for name in METRIC_DIMENSIONS}
+        self.set_dimensions(**dimensions)
+        self.timings = {}
+        self.lock = threading.Lock()
+        self.emitted = False
+
+    def set_dimensions(self, **dimensions):
+        self.dimensions.update({name: str(value) for name, value in dimensions.items() if value})
+
+    def record(self, stage, elapsed_ms):
+        with self.lock:
+            if not self.emitted:
+                self.timings.setdefault(stage, []).append(round(elapsed_ms, 1))
+                return
+        # Etapas que terminan después de emitir (p. ej. subida en segundo plano)
+        late = StageMetrics(**self.dimensions)
+        late.record(stage, elapsed_ms)
+        late.emit()
+
+    def emit(self):
+        with self.lock:
+            if self.emitted:
+                return
+            self.emitted = True
+            timings = dict(self.timings)
+        if not METRICS_ENABLED or not timings:
+            return
+        metric_names = [f'{stage}Ms' for stage in timings]
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [list(METRIC_DIMENSIONS), ['ruta', 'mediaType']],
+                    'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in metric_names]
+                }]
+            },
+            **self.dimensions
         }
+        for stage, values in timings.items():
+            record[f'{stage}Ms'] = values[0] if len(values) == 1 else values
+        try:
+            metrics_sink(record)
+        except Exception as err:
+            print(f"⚠️ Metrics sink failed: {err}")
 
-        body = urllib3.request.urlencode({
-            'grant_type': 'client_credentials',
-            'scope': 'https://api.sunat.gob.pe/v1/contribuyente/contribuyentes',
-            'client_id': SUNAT_CLIENT_ID,
-            'client_secret': SUNAT_CLIENT_SECRET
-        })
 
-        response = http.request(
-            'POST',
-            url,
-            headers=headers,
-            body=body
-        )
+@contextmanager
+def metrics_scope(metrics):
+    """
+    Asocia las métricas al thread actual; los span() de funciones internas
+    registran en ellas. Al salir se emite el registro.
+    """
+    previous = getattr(_metrics_local, 'current', None)
+    _metrics_local.current = metrics
+    try:
+        yield metrics
+    finally:
+        _metrics_local.current = previous
+        metrics.emit()
+
+
+def current_metrics():
+    return getattr(_metrics_local, 'current', None)
+
 
-        if response.status == 200:
-            data = json.loads(response.data.decode('utf-8'))
-            token = data.get('access_token')
-            expires_in = data.get('expires_in', 3600)  # Default 1 hora
+def bind_metrics(fn):
+    """
+    Envuelve fn para que, ejecutada en otro thread (executor), registre sus
+    spans en las métricas del thread que la creó.
+    """
+    metrics = current_metrics()
+    if metrics is None:
+        return fn
+
+    def bound(*args, **kwargs):
+        previous = getattr(_metrics_local, 'current', None)
+        _metrics_local.current = metrics
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _metrics_local.current = previous
+    return bound
 
-            # Guardar en cache (restar 60 segundos para evitar usar token expirado)
-            sunat_token_cache['token'] = token
-            sunat_token_cache['expires_at'] = now + expires_in - 60
 
-            print(f"✅ SUNAT token obtained (expires in {expires_in}s)")
-            return token
+@contextmanager
+def span(stage):
+    """
+    Mide la duración de una etapa. Sin métricas activas en el thread se emite
+    un registro propio con dimensiones desconocidas.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.record(stage, elapsed_ms)
         else:
-            print(f"❌ Failed to get SUNAT token: {response.status}")
-            print(f"Response: {response.data.decode('utf-8')}")
-            return None
+            standalone = StageMetrics()
+            standalone.record(stage, elapsed_ms)
+            standalone.emit()
 
-    except Exception as e:
-        print(f"❌ Error getting SUNAT token: {str(e)}")
-        return None
+
+def get_record_identifier(record):
+    """
+    Identificador del record para el reporte: messageId en SQS, URL S3 en eventos directos.
+    """
+    if record.get('messageId'):
+        return record['messageId']
+    s3_info = record.get('s3') or {}
+    bucket = s3_info.get('bucket', {}).get('name')
+    key = s3_info.get('object', {}).get('key')
+    if bucket and key:
+        return f"s3://{bucket}/{key}"
+    return record.get('eventID') or 'unknown'
 
 
-def validate_invoice_with_sunat(invoice_data):
+def expand_s3_records(record):
     """
-    Valida la factura contra la API de SUNAT
-    Retorna el estado de validación y detalles
+    Retorna los records S3 contenidos en un record del evento.
+    Soporta eventos S3 directos y notificaciones S3 entregadas vía SQS.
     """
+    if 's3' in record:
+        return [record]
+
+    if 'body' in record:
+        body = json.loads(record['body'])
+        if body.get('Event') == 's3:TestEvent':
+            print("⏭️ Skipping S3 test event")
+            return []
+        if 'Records' in body:
+            return [r for r in body['Records'] if 's3' in r]
+        # Mensaje de reintento manual
+        if body.get('bucket') and body.get('key'):
+            return [{
+                's3': {
+                    'bucket': {'name': body['bucket']},
+                    'object': {'key': body['key'], 'size': body.get('size', -1)}
+                }
+            }]
+
+    raise ValueError("Unsupported record format")
 
-    # Verificar si hay RUC consultante configurado
-    if not SUNAT_RUC:
-        print("⚠️ SUNAT_RUC not configured, skipping SUNAT validation")
+
+def process_event_record(record):
+    """
+    Procesa un record del evento; falla si cualquiera de sus objetos S3 falla.
+    """
+    try:
+        notification = parse_textract_notification(record)
+        if notification:
+            return [resume_textract_job(notification)]
+        return [process_s3_record(s3_record) for s3_record in expand_s3_records(record)]
+    except BedrockCapacityUnavailable:
+        raise
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        raise
+
+
+def defer_record(record, retry_after):
+    """
+    Reencola los objetos S3 del record en la cola de reintentos (mensaje de
+    reintento manual) con DelaySeconds, en lugar de esperar dentro de la Lambda.
+    Retorna False si no hay cola configurada: el record se reporta como fallido.
+    """
+    if not RETRY_QUEUE_URL:
+        print("⚠️ RETRY_QUEUE_URL not configured; reporting record as failed")
+        return False
+
+    delay = int(min(MAX_DEFER_SECONDS, max(1, retry_after)))
+    notification = parse_textract_notification(record)
+    if notification:
+        messages = [{'textractJob': notification, 'motivo': 'bedrock_capacity'}]
+    else:
+        messages = [
+            {
+                'bucket': s3_record['s3']['bucket']['name'],
+                'key': s3_record['s3']['object']['key'],
+                'size': s3_record['s3']['object'].get('size', -1),
+                'motivo': 'bedrock_capacity'
+            }
+            for s3_record in expand_s3_records(record)
+        ]
+    try:
+        for message in messages:
+            get_client('sqs').send_message(
+                QueueUrl=RETRY_QUEUE_URL,
+                MessageBody=json.dumps(message),
+                DelaySeconds=delay
+            )
+    except ClientError as err:
+        print(f"❌ Could not defer record: {str(err)}")
+        return False
+
+    print(f"⏳ Bedrock capacity unavailable; record deferred {delay}s via SQS")
+    return True
+
+
+def process_s3_record(s3_record):
+    """
+    Pipeline completo para un objeto S3:
+    download → parse → Textract/Bedrock → SUNAT → put_item
+    """
+    bucket = s3_record['s3']['bucket']['name']
+    key = s3_record['s3']['object']['key']
+    file_size = s3_record['s3']['object'].get('size', -1)
+
+    print(f"📄 Processing: s3://{bucket}/{key}")
+    print(f"📦 Size: {file_size} bytes")
+
+    if key.endswith('/') or file_size == 0:
+        print("⏭️ Skipping folder marker or empty object")
         return {
-            'validado': False,
-            'estado': 'NO_VALIDADO',
-            'motivo': 'Credenciales SUNAT no configuradas',
-            'estadoSunat': None,
-            'timestampValidacion': datetime.now().isoformat() + 'Z'
+            'message': 'Skipped empty object',
+            'key': key
         }
 
-    # Obtener token
-    token = get_sunat_token()
-    if not token:
+    # 2. Extract client_id (tenant) from path
+    client_id = extract_client_id(key)
+
+    print(f"👤 Client ID: {client_id}")
+    print(f"🏷️ Tenant ID: {client_id}")
+
+    # 3. Stream raw email from S3 and extract PDF attachment
+    # (el cuerpo se descarga mientras se parsea: MimeParse incluye la transferencia)
+    with metrics_scope(StageMetrics(ruta='correo', tenant=client_id)) as metrics:
+        print("📥 Streaming raw SES email from S3...")
+        with span('S3Get'):
+            email_obj = get_client('s3').get_object(Bucket=bucket, Key=key)
+        if file_size is None or file_size < 0:
+            file_size = email_obj.get('ContentLength', 0)
+        metrics.set_dimensions(mediaType=(email_obj.get('ContentType') or '').split(';', 1)[0])
+
+        print("🔍 Extracting attachments from email...")
+        with span('MimeParse'):
+            attachments = read_attachments_from_s3_object(email_obj, bucket, key)
+    print(f"📎 {len(attachments)} attachment(s) to process")
+
+    results = []
+    errors = []
+    capacity_errors = []
+    try:
+        workers = min(ATTACHMENT_CONCURRENCY, len(attachments))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    process_ingested_attachment, client_id, attachment, bucket, key, file_size
+                ): attachment['filename']
+                for attachment in attachments
+            }
+            for future in as_completed(futures):
+                filename = futures[future]
+                try:
+                    results.append(future.result())
+                except BedrockCapacityUnavailable as e:
+                    print(f"⏳ Attachment {filename} deferred: {str(e)}")
+                    capacity_errors.append(e)
+                except Exception as e:
+                    print(f"❌ Attachment {filename} failed: {str(e)}")
+                    errors.append(f"{filename}: {str(e)}")
+    finally:
+        for attachment in attachments:
+            release_attachment(attachment)
+
+    # Reintentar el record completo: los adjuntos ya guardados se omiten por hash
+    if capacity_errors and not errors:
+        raise BedrockCapacityUnavailable(max(e.retry_after for e in capacity_errors))
+    if errors or capacity_errors:
+        errors.extend(f"capacidad Bedrock: {str(e)}" for e in capacity_errors)
+        raise RuntimeError(f"{len(errors)}/{len(attachments)} attachment(s) failed: {'; '.join(errors)}")
+
+    return {
+        'message': 'Email processed successfully',
+        'key': key,
+        'clientId': client_id,
+        'adjuntos': results
+    }
+
+
+def process_ingested_attachment(client_id, attachment, bucket, key, file_size):
+    """
+    Dedupe → debug copy → Textract/Bedrock → SUNAT → put_item para un adjunto.
+    Emite un registro de métricas por adjunto con la ruta elegida.
+    """
+    metrics = StageMetrics(mediaType=attachment['media_type'], tenant=client_id)
+    with metrics_scope(metrics):
+        return run_attachment_pipeline(client_id, attachment, bucket, key, file_size, metrics)
+
+
+def run_attachment_pipeline(client_id, attachment, bucket, key, file_size, metrics):
+    print(f"📎 Attachment: {attachment['filename']} ({attachment['media_type']})")
+
+    # Adjuntos reenviados (mismo contenido) se enlazan a la factura existente
+    content_hash = compute_content_hash(attachment)
+    attachment['sha256'] = content_hash
+    duplicate = find_invoice_by_content_hash(client_id, content_hash)
+    if duplicate and link_duplicate_source(duplicate, bucket, key):
+        print(f"♻️ Duplicate attachment (sha256={content_hash[:12]}...) of invoice {duplicate['invoiceId']}")
+        metrics.set_dimensions(ruta='duplicado')
         return {
-            'validado': False,
-            'estado': 'ERROR_TOKEN',
-            'motivo': 'No se pudo obtener token de SUNAT',
-            'estadoSunat': None,
-            'timestampValidacion': datetime.now().isoformat() + 'Z'
+            'message': 'Duplicate attachment linked to existing invoice',
+            'adjunto': attachment['filename'],
+            'invoiceId': duplicate['invoiceId'],
+            'duplicado': True
         }
 
-    # Extraer datos necesarios de la factura
-    try:
-        ruc_emisor = invoice_data.get('emisor', {}).get('numeroDocumento')
-        numero_factura = invoice_data.get('numeroFactura', '')
-        serie = invoice_data.get('serie', '')
-        correlativo = invoice_data.get('correlativo', '')
-        fecha_emision = invoice_data.get('fechaEmision', '')
-        monto_total = invoice_data.get('montos', {}).get('total', 0)
-
-        # Determinar código de tipo de comprobante según SUNAT
-        tipo_comprobante = normalize_tipo_comprobante(invoice_data.get('tipoComprobante'), serie, numero_factura)
-        invoice_data['tipoComprobante'] = tipo_comprobante
-
-        if tipo_comprobante == 'RECIBO_HONORARIOS':
-            return validate_rhe_with_sunat(
-                token,
-                invoice_data,
-                ESTADOS_COMPROBANTE,
-                ESTADOS_RUC,
-                CONDICIONES_DOMICILIO
-            )
+    if attachment['media_type'] in ALLOWED_PDF_MIME_TYPES:
+        attach_pdf_text_layer(attachment)
 
-        codigo_comprobante = {
-            'FACTURA': '01',
-            'BOLETA': '03',
-            'NOTA_CREDITO': '07',
-            'NOTA_DEBITO': '08'
-        }.get(tipo_comprobante)
-
-        if not codigo_comprobante:
-            return {
-                'validado': False,
-                'estado': 'NO_VALIDADO',
-                'motivo': f'Tipo de comprobante no soportado por SUNAT: {tipo_comprobante}',
-                'estadoSunat': None,
-                'timestampValidacion': datetime.now().isoformat() + 'Z'
-            }
+    print("📤 Uploading debug copy to S3 for verification (background)...")
+    debug_upload = debug_upload_executor.submit(bind_metrics(upload_debug_attachment), bucket, attachment)
 
-        if numero_factura and (not serie or not correlativo):
-            parsed = parse_serie_correlativo(numero_factura)
-            if parsed:
-                serie = serie or parsed[0]
-                correlativo = correlativo or parsed[1]
-
-        if not ruc_emisor or not numero_factura:
-            print("⚠️ Missing required data for SUNAT validation")
-            return {
-                'validado': False,
-                'estado': 'DATOS_INCOMPLETOS',
-                'motivo': 'Faltan datos requeridos (RUC o número de factura)',
-                'estadoSunat': None,
-                'timestampValidacion': datetime.now().isoformat() + 'Z'
-            }
+    if should_use_async_textract(attachment):
+        metrics.set_dimensions(ruta='textract-async')
+        job_id = start_async_textract_job(client_id, attachment, bucket, key, file_size, debug_upload)
+        return {
+            'message': 'Textract async job started',
+            'adjunto': attachment['filename'],
+            'textractJobId': job_id,
+            'pendiente': True
+        }
+
+    # 4. Call Textract + Bedrock depending on media type
+    print("🤖 Calling Bedrock Claude 3.5 Sonnet...")
+    try:
+        invoice_data, processing_overrides = process_attachment(attachment, bucket, debug_upload)
+        metrics.set_dimensions(ruta=processing_overrides.get('ruta'))
 
-        print(f"🔍 Validating invoice with SUNAT: {ruc_emisor}-{numero_factura}")
+        return save_processed_invoice(
+            client_id, attachment, invoice_data, processing_overrides, bucket, key, file_size
+        )
+    finally:
+        # La subida lee el archivo temporal del adjunto, que se elimina al
+        # terminar el record (también si algo falla); y no debe quedar
+        # pendiente cuando el contenedor se congele
+        wait([debug_upload])
 
-        # Construir URL del endpoint
-        url = f"https://api.sunat.gob.pe/v1/contribuyente/contribuyentes/{SUNAT_RUC}/validarcomprobante"
 
-        headers = {
-            'Authorization': f'Bearer {token}',
-            'Content-Type': 'application/json'
+def save_processed_invoice(client_id, attachment, invoice_data, processing_overrides, bucket, key, file_size):
+    """
+    SUNAT (en línea o en cola) → build_item → put_item → índice de hash, a
+    partir de los datos extraídos.
+    """
+    content_hash = attachment.get('sha256')
+    print(f"✅ Claude completed - Invoice: {invoice_data.get('numeroFactura')}")
+
+    # Sin RUC emisor o número no hay clave de factura: no se guarda bajo un
+    # placeholder compartido (UNKNOWN-UNKNOWN) que otros documentos pisarían
+    missing = missing_invoice_identity(invoice_data)
+    if missing:
+        return quarantine_document(client_id, attachment, invoice_data, processing_overrides, bucket, key, missing)
+
+    # 5. Validate invoice with SUNAT API (o dejarla pendiente para la cola).
+    # Un emisor no activo en el padrón se marca de inmediato y no se encola.
+    padron_result = None
+    if sunat_client.padron_configured():
+        with span('SunatPadron'):
+            padron_result = sunat_client.prescreen_emisor(invoice_data)
+    if padron_result:
+        sunat_validation = padron_result
+    elif SUNAT_VALIDATION_QUEUE_URL:
+        sunat_validation = pending_sunat_validation()
+    else:
+        print("🔍 Validating invoice with SUNAT...")
+        with span('SunatValidate'):
+            sunat_validation = validate_invoice_with_sunat(invoice_data)
+
+    print(f"✅ SUNAT validation: {sunat_validation['estado']}")
+
+    # 6. Build DynamoDB item (including SUNAT validation)
+    dynamo_item = build_item(
+        client_id,
+        invoice_data,
+        bucket,
+        key,
+        file_size,
+        sunat_validation,
+        processing_overrides,
+        content_hash=content_hash,
+        attachment_info={
+            'nombreAdjunto': attachment['filename'],
+            'indiceAdjunto': attachment.get('index', 0),
+            'tipoAdjunto': attachment['media_type']
         }
+    )
+    # Índice disperso de reintentos SUNAT (PENDIENTE o error reintentable)
+    dynamo_item.update(sunat_client.retry_schedule(sunat_validation))
 
-        # Convertir fecha de YYYY-MM-DD a DD/MM/YYYY
-        if fecha_emision and '-' in fecha_emision:
-            parts = fecha_emision.split('-')
-            if len(parts) == 3:
-                fecha_sunat = f"{parts[2]}/{parts[1]}/{parts[0]}"
-            else:
-                fecha_sunat = fecha_emision
-        else:
-            fecha_sunat = fecha_emision
+    # 7. Save to DynamoDB
+    print("💾 Saving to DynamoDB...")
+    with span('DynamoPut'):
+        get_table().put_item(Item=dynamo_item)
+    register_content_hash(client_id, content_hash, dynamo_item)
+    if SUNAT_VALIDATION_QUEUE_URL and not padron_result:
+        enqueue_sunat_validation(dynamo_item)
 
-        # Cuerpo de la solicitud según documentación SUNAT
-        try:
-            numero_int = int(correlativo) if correlativo else 0
-        except ValueError:
-            numero_int = 0
-
-        body = json.dumps({
-            'numRuc': ruc_emisor,
-            'codComp': codigo_comprobante,
-            'numeroSerie': serie,
-            'numero': numero_int,  # numero debe ser int
-            'fechaEmision': fecha_sunat,  # Formato DD/MM/YYYY
-            'monto': float(monto_total) if monto_total is not None else 0
+    print(f"✅ SUCCESS - Invoice ID: {dynamo_item['invoiceId']}")
+
+    return {
+        'message': 'Invoice processed successfully',
+        'adjunto': attachment['filename'],
+        'invoiceId': dynamo_item['invoiceId'],
+        'total': safe_float(invoice_data.get('montos', {}).get('total', 0)),
+        'numeroFactura': invoice_data.get('numeroFactura')
+    }
+
+
+def missing_invoice_identity(invoice_data):
+    """
+    Campos que forman el invoiceId y faltan en los datos extraídos.
+    """
+    missing = []
+    if not str((invoice_data.get('emisor') or {}).get('numeroDocumento') or '').strip():
+        missing.append('emisor.numeroDocumento')
+    if not str(invoice_data.get('numeroFactura') or '').strip():
+        missing.append('numeroFactura')
+    return missing
+
+
+def quarantine_document(client_id, attachment, invoice_data, processing_overrides, bucket, key, missing):
+    """
+    Registra en la tabla de control (con TTL) un documento que no es factura o
+    no se pudo identificar. La clave es el sha256 del adjunto, así una
+    reentrega actualiza el mismo registro. No se valida con SUNAT ni se
+    escribe en la tabla de facturas (el stream la enviaría a Postgres).
+    """
+    motivo = f"Sin {' ni '.join(missing)}"
+    print(f"🚧 Quarantining {attachment['filename']}: {motivo}")
+    with span('DynamoPut'):
+        get_control_table().put_item(Item={
+            'PK': f'QUARANTINE#{client_id}',
+            'SK': f"SHA256#{attachment.get('sha256') or compute_content_hash(attachment)}",
+            'clientId': client_id,
+            'motivo': motivo,
+            's3Bucket': bucket,
+            's3Key': key,
+            'nombreAdjunto': attachment['filename'],
+            'indiceAdjunto': attachment.get('index', 0),
+            'tipoAdjunto': attachment['media_type'],
+            'tipoComprobante': invoice_data.get('tipoComprobante'),
+            'emisorRUC': (invoice_data.get('emisor') or {}).get('numeroDocumento'),
+            'numeroFactura': invoice_data.get('numeroFactura'),
+            'ruta': (processing_overrides or {}).get('ruta'),
+            'creadoEn': datetime.utcnow().isoformat() + 'Z',
+            'expiresAt': int(time.time()) + QUARANTINE_TTL_DAYS * 86400
         })
+    return {
+        'message': 'Document quarantined: no invoice identity',
+        'adjunto': attachment['filename'],
+        'cuarentena': True,
+        'motivo': motivo
+    }
 
-        response = http.request(
-            'POST',
-            url,
-            headers=headers,
-            body=body
-        )
 
-        if response.status == 200:
-            data = json.loads(response.data.decode('utf-8'))
+def pending_sunat_validation():
+    return {
+        'validado': False,
+        'estado': 'PENDIENTE',
+        'motivo': 'Validación SUNAT en cola',
+        'estadoSunat': None,
+        'timestampEncolado': datetime.utcnow().isoformat() + 'Z'
+    }
 
-            # Interpretar respuesta de SUNAT
-            estado_cp = data.get('estadoCp')  # Estado del comprobante
-            estado_ruc = data.get('estadoRuc')  # Estado del RUC emisor
-            condicion_domicilio = data.get('condDomiRuc')  # Condición domicilio
 
-            # Determinar si es válido
-            es_valido = (
-                estado_cp in ['1', '0'] and  # 1=Aceptado, 0=Anulado (pero existió)
-                estado_ruc == '00'  # 00=Activo
+def enqueue_sunat_validation(dynamo_item):
+    """
+    Envía la clave de la factura a la cola de validación SUNAT. Si el envío
+    falla la factura queda PENDIENTE y el barrido programado de
+    lambda_sunat_retry la recoge; no se pierde la extracción.
+    """
+    message = {
+        'sunatValidation': {
+            'PK': dynamo_item['PK'],
+            'SK': dynamo_item['SK'],
+            'invoiceId': dynamo_item['invoiceId']
+        }
+    }
+    try:
+        with span('SunatEnqueue'):
+            get_client('sqs').send_message(
+                QueueUrl=SUNAT_VALIDATION_QUEUE_URL,
+                MessageBody=json.dumps(message)
             )
+        print(f"📨 SUNAT validation queued for {dynamo_item['invoiceId']}")
+    except Exception as e:
+        print(f"⚠️ Could not queue SUNAT validation ({dynamo_item['invoiceId']}): {str(e)}")
 
-            print(f"✅ SUNAT validation completed: {estado_cp}")
-
-            return {
-                'validado': True,
-                'estado': 'VALIDO' if es_valido else 'INVALIDO',
-                'motivo': 'Comprobante validado exitosamente' if es_valido else 'Comprobante no válido en SUNAT',
-                'estadoSunat': {
-                    'estadoComprobante': estado_cp,
-                    'estadoRuc': estado_ruc,
-                    'condicionDomicilio': condicion_domicilio,
-                    'observaciones': data.get('observaciones', [])
-                },
-                'timestampValidacion': datetime.now().isoformat() + 'Z'
-            }
-        else:
-            error_msg = response.data.decode('utf-8')
-            print(f"❌ SUNAT validation failed: {response.status}")
-            print(f"Response: {error_msg}")
-
-            return {
-                'validado': False,
-                'estado': 'ERROR_API',
-                'motivo': f'Error al consultar SUNAT: HTTP {response.status}',
-                'estadoSunat': None,
-                'timestampValidacion': datetime.now().isoformat() + 'Z',
-                'errorDetalle': error_msg
+
+def compute_content_hash(attachment):
+    if attachment.get('path'):
+        digest = hashlib.sha256()
+        with open(attachment['path'], 'rb') as spilled:
+            for chunk in iter(lambda: spilled.read(MIME_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    return hashlib.sha256(attachment['bytes']).hexdigest()
+
+
+def content_hash_key(client_id, content_hash):
+    return {
+        'PK': f'CONTENT#{client_id}',
+        'SK': f'SHA256#{content_hash}'
+    }
+
+
+def find_invoice_by_content_hash(client_id, content_hash):
+    """
+    Busca en el índice de hashes una factura ya extraída con el mismo contenido.
+    Un error de lectura no bloquea la ingesta: se procesa como adjunto nuevo.
+    """
+    try:
+        response = get_control_table().get_item(
+            Key=content_hash_key(client_id, content_hash),
+            ConsistentRead=True
+        )
+    except ClientError as err:
+        print(f"⚠️ Content-hash lookup failed: {str(err)}")
+        return None
+    return response.get('Item')
+
+
+def register_content_hash(client_id, content_hash, dynamo_item):
+    """
+    Registra el hash del adjunto apuntando a la factura guardada.
+    """
+    try:
+        get_control_table().put_item(Item={
+            **content_hash_key(client_id, content_hash),
+            'invoicePK': dynamo_item['PK'],
+            'invoiceSK': dynamo_item['SK'],
+            'invoiceId': dynamo_item['invoiceId'],
+            's3Bucket': dynamo_item['archivo']['s3Bucket'],
+            's3Key': dynamo_item['archivo']['s3Key'],
+            'creadoEn': datetime.utcnow().isoformat() + 'Z'
+        })
+    except ClientError as err:
+        print(f"⚠️ Could not register content hash: {str(err)}")
+
+
+def link_duplicate_source(duplicate, bucket, key):
+    """
+    Agrega la nueva key S3 a la factura existente en lugar de re-extraerla.
+    Las keys se guardan en un string set (ADD): un reenvío del mismo objeto
+    no duplica entradas, y la key original de la factura no se agrega.
+    Retorna False si la factura ya no existe (el adjunto se procesa de nuevo).
+    """
+    if duplicate.get('s3Bucket') == bucket and duplicate.get('s3Key') == key:
+        # Reentrega del mismo objeto que originó la factura
+        return True
+    try:
+        get_table().update_item(
+            Key={'PK': duplicate['invoicePK'], 'SK': duplicate['invoiceSK']},
+            UpdateExpression='ADD archivo.duplicados :dup SET archivo.ultimoDuplicadoEn = :at',
+            ConditionExpression='attribute_exists(PK)',
+            ExpressionAttributeValues={
+                ':dup': {f's3://{bucket}/{key}'},
+                ':at': datetime.utcnow().isoformat() + 'Z'
             }
+        )
+    except ClientError as err:
+        if err.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+            print(f"⚠️ Indexed invoice {duplicate['invoiceId']} no longer exists; reprocessing")
+            return False
+        raise
+    return True
 
-    except Exception as e:
-        print(f"❌ Error validating with SUNAT: {str(e)}")
-        import traceback
-        traceback.print_exc()
 
-        return {
-            'validado': False,
-            'estado': 'ERROR_EXCEPCION',
-            'motivo': f'Excepción al validar: {str(e)}',
-            'estadoSunat': None,
-            'timestampValidacion': datetime.now().isoformat() + 'Z'
-        }
+def validate_invoice_with_sunat(invoice_data):
+    """
+    Valida la factura contra la API de SUNAT (token y caché de resultados
+    compartidos en sunat_client). Retorna el estado de validación y detalles.
+    El emisor ya pasó por el padrón en save_processed_invoice.
+    """
+    return sunat_client.validate_invoice(invoice_data, span=span, prescreen=False)
 
 
 def normalize_media_type(content_type, filename):
@@ -434,192 +977,6 @@ def detect_media_type_by_signature(raw_bytes):
     return None
 
 
-def normalize_tipo_comprobante(tipo_raw, serie='', numero_factura=''):
-    raw = (tipo_raw or '').strip().upper()
-    raw = (raw.replace('Á', 'A')
-              .replace('É', 'E')
-              .replace('Í', 'I')
-              .replace('Ó', 'O')
-              .replace('Ú', 'U')
-              .replace('Ñ', 'N'))
-
-    if 'CREDITO' in raw or raw in {'NC', 'NOTA_CREDITO', 'NOTA DE CREDITO'}:
-        return 'NOTA_CREDITO'
-    if 'DEBITO' in raw or raw in {'ND', 'NOTA_DEBITO', 'NOTA DE DEBITO'}:
-        return 'NOTA_DEBITO'
-    if 'BOLETA' in raw:
-        return 'BOLETA'
-    if 'FACTURA' in raw:
-        return 'FACTURA'
-    if 'HONORARIO' in raw:
-        return 'RECIBO_HONORARIOS'
-
-    candidate = (serie or '').strip().upper()
-    if not candidate and numero_factura and '-' in numero_factura:
-        candidate = numero_factura.split('-', 1)[0].strip().upper()
-
-    if candidate.startswith(('FC', 'BC')):
-        return 'NOTA_CREDITO'
-    if candidate.startswith(('FD', 'BD')):
-        return 'NOTA_DEBITO'
-    if candidate.startswith('F'):
-        return 'FACTURA'
-    if candidate.startswith('B'):
-        return 'BOLETA'
-
-    return raw or 'OTRO'
-
-
-def parse_serie_correlativo(numero_factura):
-    if not numero_factura:
-        return None
-    numero = str(numero_factura).strip().upper()
-    if '-' not in numero:
-        return None
-    serie, correlativo = numero.split('-', 1)
-    serie = serie.strip()
-    correlativo = correlativo.strip()
-    if not serie or not correlativo:
-        return None
-    return serie, correlativo
-
-
-def normalize_tipo_documento(tipo_raw):
-    raw = (tipo_raw or '').strip().upper()
-    raw = (raw.replace('Á', 'A')
-              .replace('É', 'E')
-              .replace('Í', 'I')
-              .replace('Ó', 'O')
-              .replace('Ú', 'U')
-              .replace('Ñ', 'N'))
-
-    if raw in {'DNI', '01', '1'}:
-        return '1'
-    if raw in {'RUC', '06', '6'}:
-        return '6'
-    if raw in {'CE', 'CARNET DE EXTRANJERIA', 'CARNET DE EXTRANJERIA', '04', '4'}:
-        return '4'
-    if raw in {'PASAPORTE', '07', '7'}:
-        return '7'
-    if raw in {'PTP', '09', '9'}:
-        return '9'
-    return None
-
-
-def validate_rhe_with_sunat(token, invoice_data, estado_cp_descriptions, estado_ruc_descriptions, condicion_domicilio_descriptions):
-    ruc_emisor = invoice_data.get('emisor', {}).get('numeroDocumento')
-    numero_factura = invoice_data.get('numeroFactura', '')
-    serie = invoice_data.get('serie', '')
-    correlativo = invoice_data.get('correlativo', '')
-    fecha_emision = invoice_data.get('fechaEmision', '')
-    monto_total = invoice_data.get('montos', {}).get('total', 0)
-    receptor = invoice_data.get('receptor', {}) or {}
-    receptor_tipo = normalize_tipo_documento(receptor.get('tipoDocumento'))
-    receptor_num = receptor.get('numeroDocumento')
-
-    if numero_factura and (not serie or not correlativo):
-        parsed = parse_serie_correlativo(numero_factura)
-        if parsed:
-            serie = serie or parsed[0]
-            correlativo = correlativo or parsed[1]
-
-    if not ruc_emisor or not numero_factura or not receptor_tipo or not receptor_num:
-        print("⚠️ Missing required data for RHE SUNAT validation")
-        return {
-            'validado': False,
-            'estado': 'DATOS_INCOMPLETOS',
-            'motivo': 'Faltan datos requeridos (RUC emisor, tipo/num doc receptor o número)',
-            'estadoSunat': None,
-            'timestampValidacion': datetime.now().isoformat() + 'Z'
-        }
-
-    # Convertir fecha de YYYY-MM-DD a DD/MM/YYYY
-    if fecha_emision and '-' in fecha_emision:
-        parts = fecha_emision.split('-')
-        if len(parts) == 3:
-            fecha_sunat = f"{parts[2]}/{parts[1]}/{parts[0]}"
-        else:
-            fecha_sunat = fecha_emision
-    else:
-        fecha_sunat = fecha_emision
-
-    try:
-        numero_int = int(correlativo) if correlativo else 0
-    except ValueError:
-        numero_int = 0
-
-    url = f"https://api.sunat.gob.pe/v1/contribuyente/contribuyentes/{SUNAT_RUC}/validarreciboporhonorario"
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json'
-    }
-    body = json.dumps({
-        'numRuc': ruc_emisor,
-        'codTipDoc': receptor_tipo,
-        'numDoc': receptor_num,
-        'numSerie': serie,
-        'numRec': numero_int,
-        'fechaEmision': fecha_sunat,
-        'monto': float(monto_total)
-    })
-
-    response = http.request('POST', url, headers=headers, body=body)
-
-    if response.status == 200:
-        data = json.loads(response.data.decode('utf-8'))
-        if data.get('success') is False:
-            return {
-                'validado': False,
-                'estado': 'ERROR_API',
-                'motivo': data.get('message', 'Error desconocido de SUNAT'),
-                'estadoSunat': None,
-                'timestampValidacion': datetime.now().isoformat() + 'Z',
-                'errorDetalle': json.dumps(data)
-            }
-
-        response_data = data.get('data', data)
-        estado_cp = str(response_data.get('estadoCp', ''))
-        estado_ruc = str(response_data.get('estadoRuc', ''))
-        cond_dom = str(response_data.get('condDomicilio', ''))
-
-        desc_comprobante = estado_cp_descriptions.get(estado_cp, 'DESCONOCIDO')
-        desc_ruc = estado_ruc_descriptions.get(estado_ruc, 'DESCONOCIDO')
-
-        es_valido = estado_cp in {'1', '0'} and estado_ruc == '00'
-
-        return {
-            'validado': es_valido,
-            'estado': 'VALIDO' if es_valido else 'NO_VALIDO',
-            'motivo': 'Comprobante validado exitosamente' if es_valido else 'Comprobante no válido en SUNAT',
-            'timestampValidacion': datetime.now().isoformat() + 'Z',
-            'esValido': es_valido,
-            'estadoSunat': {
-                'estadoComprobante': {
-                    'codigo': estado_cp,
-                    'descripcion': desc_comprobante
-                },
-                'estadoRuc': {
-                    'codigo': estado_ruc,
-                    'descripcion': desc_ruc
-                },
-                'condicionDomicilio': {
-                    'codigo': cond_dom,
-                    'descripcion': condicion_domicilio_descriptions.get(cond_dom, 'DESCONOCIDO')
-                },
-                'observaciones': response_data.get('observaciones', [])
-            }
-        }
-
-    print(f"❌ SUNAT RHE validation failed: {response.status}")
-    return {
-        'validado': False,
-        'estado': 'ERROR_API',
-        'motivo': f'Error al consultar SUNAT (RHE): HTTP {response.status}',
-        'estadoSunat': None,
-        'timestampValidacion': datetime.now().isoformat() + 'Z'
-    }
-
-
 def wrap_raw_object_as_attachment(raw_bytes, key, content_type=None):
     """
     Trata el objeto S3 como un archivo directo (no email) y lo envuelve como adjunto.
@@ -641,274 +998,1376 @@ def wrap_raw_object_as_attachment(raw_bytes, key, content_type=None):
     }
 
 
-def extract_attachment_from_email(raw_email_bytes, key):
+def wrap_spooled_object_as_attachment(spool, key, content_type=None):
     """
-    Busca el primer adjunto PDF o imagen dentro del correo SES y retorna metadata + bytes.
+    Igual que wrap_raw_object_as_attachment, con el objeto ya volcado a un
+    Spool: queda en 'bytes' si cupo en memoria o en 'path'/'size' si no.
     """
-    parser = BytesParser(policy=policy.default)
-    msg = parser.parsebytes(raw_email_bytes)
+    raw_bytes = spool.getvalue()
+    if raw_bytes is not None:
+        return wrap_raw_object_as_attachment(raw_bytes, key, content_type)
 
-    candidates = []
-    for part in msg.walk():
-        if part.get_content_maintype() == 'multipart':
-            continue
+    attachment = wrap_raw_object_as_attachment(spool.head, key, content_type)
+    attachment.pop('bytes')
+    attachment['path'] = spool.path
+    attachment['size'] = spool.size
+    print(f"💽 Attachment {attachment['filename']} ({spool.size} bytes) spilled to {spool.path}")
+    return attachment
+
+
+def read_attachments_from_s3_object(s3_object, bucket, key):
+    """
+    Lee el objeto S3 en bloques una sola vez: si es un PDF/imagen directo lo
+    vuelca a un Spool; si es un correo lo parsea con mime_stream, que decodifica
+    cada adjunto a su Spool a medida que llega (a disco sobre
+    ATTACHMENT_SPILL_THRESHOLD). Ni el correo crudo ni el texto base64 quedan
+    en memoria.
+    """
+    chunks = s3_object['Body'].iter_chunks(MIME_CHUNK_SIZE)
+    first_chunk = next(chunks, b'')
+    content_type = s3_object.get('ContentType')
+
+    if detect_media_type_by_signature(first_chunk):
+        print("📄 S3 object is a direct file (not an email)")
+        return [spool_direct_object(itertools.chain([first_chunk], chunks), key, content_type)]
+
+    # Si el correo no trae adjuntos el objeto se trata como archivo directo, lo
+    # que solo es posible si ContentType/extensión lo declaran PDF/imagen: en
+    # ese caso se guarda la copia cruda durante la misma lectura.
+    filename = os.path.basename(key) or 'archivo'
+    raw_copy = None
+    if normalize_media_type(content_type or '', filename) in ALLOWED_PDF_MIME_TYPES | ALLOWED_IMAGE_MIME_TYPES:
+        raw_copy = mime_stream.Spool(ATTACHMENT_SPILL_THRESHOLD, ATTACHMENT_SPILL_DIR)
 
-        content_type = part.get_content_type()
+    parser = mime_stream.StreamingMimeParser(
+        is_attachment_candidate, ATTACHMENT_SPILL_THRESHOLD, ATTACHMENT_SPILL_DIR
+    )
+    try:
+        for chunk in itertools.chain([first_chunk], chunks):
+            parser.feed(chunk)
+            if raw_copy is not None:
+                raw_copy.write(chunk)
+        attachments = select_attachments(parser.close())
+    except Exception:
+        for part in parser.parts:
+            part.spool.discard()
+        if raw_copy is not None:
+            raw_copy.discard()
+        raise
+
+    if attachments:
+        if raw_copy is not None:
+            raw_copy.discard()
+        return attachments
+
+    print("⚠️ No attachment found; treating S3 object as direct file")
+    if raw_copy is None:
+        raise ValueError(f"Tipo de archivo no soportado para {filename}")
+    raw_copy.close()
+    try:
+        return [wrap_spooled_object_as_attachment(raw_copy, key, content_type)]
+    except Exception:
+        raw_copy.discard()
+        raise
+
+
+def spool_direct_object(chunks, key, content_type=None):
+    """
+    Vuelca un PDF/imagen subido directo a un Spool y lo envuelve como adjunto.
+    """
+    spool = mime_stream.Spool(ATTACHMENT_SPILL_THRESHOLD, ATTACHMENT_SPILL_DIR,
+                              suffix=os.path.splitext(key)[1][:16])
+    try:
+        for chunk in chunks:
+            spool.write(chunk)
+        spool.close()
+        return wrap_spooled_object_as_attachment(spool, key, content_type)
+    except Exception:
+        spool.discard()
+        raise
+
+
+def is_attachment_candidate(headers):
+    """
+    Partes que se decodifican: con filename o disposición attachment/inline.
+    """
+    return bool(headers.get_filename('')) or headers.get_content_disposition() in {'attachment', 'inline'}
+
+
+def select_attachments(parts):
+    """
+    Retorna todos los adjuntos PDF/imagen que califican como comprobante a
+    partir de las partes decodificadas por mime_stream.
+    Si hay PDFs se descartan imágenes inline (logos, firmas); imágenes menores a
+    MIN_IMAGE_ATTACHMENT_BYTES nunca califican. Los Spool descartados se borran.
+    """
+    candidates = []
+    for part in parts:
         filename = part.get_filename('')
         disposition = part.get_content_disposition()
 
-        if not filename and disposition not in {'attachment', 'inline'}:
+        normalized_type = normalize_media_type(part.get_content_type(), filename)
+        signature_type = detect_media_type_by_signature(part.spool.head)
+        if signature_type:
+            normalized_type = signature_type
+        if normalized_type not in ALLOWED_PDF_MIME_TYPES | ALLOWED_IMAGE_MIME_TYPES or not part.size:
+            part.spool.discard()
+            continue
+
+        if normalized_type in ALLOWED_IMAGE_MIME_TYPES and part.size < MIN_IMAGE_ATTACHMENT_BYTES:
+            print(f"⏭️ Skipping small image {filename or '(sin nombre)'} ({part.size} bytes)")
+            part.spool.discard()
             continue
 
-        payload = part.get_content()
-        if isinstance(payload, str):
-            payload = payload.encode('utf-8')
+        if not filename:
+            filename = f"attachment{MEDIA_TYPE_EXTENSION.get(normalized_type, '')}"
 
-        normalized_type = normalize_media_type(content_type, filename)
-        signature_type = detect_media_type_by_signature(payload)
-        if signature_type:
-            normalized_type = signature_type
-        if normalized_type not in ALLOWED_PDF_MIME_TYPES | ALLOWED_IMAGE_MIME_TYPES:
+        attachment = {
+            'media_type': normalized_type,
+            'filename': filename,
+            'disposition': disposition
+        }
+        payload = part.spool.getvalue()
+        if payload is not None:
+            attachment['bytes'] = payload
+        else:
+            attachment['path'] = part.spool.path
+            attachment['size'] = part.size
+            print(f"💽 Attachment {filename} ({part.size} bytes) spilled to {part.spool.path}")
+        candidates.append(attachment)
+
+    has_pdf = any(candidate['media_type'] in ALLOWED_PDF_MIME_TYPES for candidate in candidates)
+    selected = []
+    for candidate in candidates:
+        if has_pdf and candidate['media_type'] in ALLOWED_IMAGE_MIME_TYPES and candidate['disposition'] == 'inline':
+            print(f"⏭️ Skipping inline image {candidate['filename']} (email has PDF attachments)")
+            release_attachment(candidate)
             continue
+        candidate['index'] = len(selected)
+        selected.append(candidate)
+
+    if selected:
+        print(f"📎 {len(selected)} adjunto(s) de comprobante en el correo ({len(candidates)} candidato(s)).")
+    return selected
+
+
+def get_attachment_bytes(attachment):
+    if attachment.get('bytes') is not None:
+        return attachment['bytes']
+    if attachment.get('path'):
+        with open(attachment['path'], 'rb') as spilled:
+            return spilled.read()
+    # Adjunto retomado desde un job asíncrono: se lee la copia en S3
+    s3_object = get_client('s3').get_object(Bucket=attachment['s3Bucket'], Key=attachment['s3Key'])
+    attachment['bytes'] = s3_object['Body'].read()
+    return attachment['bytes']
+
+
+def release_attachment(attachment):
+    """
+    Elimina el archivo temporal de un adjunto movido a disco.
+    """
+    path = attachment.pop('path', None) if attachment else None
+    if path:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class S3CopyUnavailable(Exception):
+    """
+    Textract necesita la copia del adjunto en S3 y la subida falló.
+    """
+
+
+def upload_debug_attachment(bucket, attachment):
+    """
+    Guarda una copia de depuración del adjunto extraído en la carpeta debug.
+    La key es el hash del contenido: reintentos y reenvíos no duplican objetos.
+    Retorna la key, o None si la subida falló (el objeto no existe).
+    """
+    with span('DebugUpload'):
+        content_hash = attachment.get('sha256') or compute_content_hash(attachment)
+        extension = MEDIA_TYPE_EXTENSION.get(attachment['media_type'], '')
+        debug_key = f"debug/sha256/{content_hash}{extension}"
+
+        try:
+            get_client('s3').head_object(Bucket=bucket, Key=debug_key)
+            print(f"📤 Copia de depuración ya existe en s3://{bucket}/{debug_key}")
+            return debug_key
+        except ClientError as err:
+            if err.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+                print(f"⚠️ No se pudo verificar la copia de depuración: {str(err)}")
+
+        metadata = {'filename': (attachment.get('filename') or '').encode('ascii', 'ignore').decode()}
+        try:
+            if attachment.get('path'):
+                get_client('s3').upload_file(
+                    attachment['path'],
+                    bucket,
+                    debug_key,
+                    ExtraArgs={'ContentType': attachment['media_type'], 'Metadata': metadata}
+                )
+            else:
+                get_client('s3').put_object(
+                    Bucket=bucket,
+                    Key=debug_key,
+                    Body=attachment['bytes'],
+                    ContentType=attachment['media_type'],
+                    Metadata=metadata
+                )
+            print(f"📤 Copia de depuración subida a s3://{bucket}/{debug_key}")
+        except Exception as err:
+            # upload_file envuelve el ClientError en S3UploadFailedError
+            print(f"⚠️ No se pudo subir la copia de depuración: {str(err)}")
+            return None
+
+        return debug_key
+
+
+def get_attachment_source(attachment):
+    """
+    Ruta del archivo temporal si el adjunto se volcó a disco (se lee por
+    bloques al armar el request); si no, los bytes en memoria.
+    """
+    if attachment.get('path'):
+        return attachment['path']
+    return get_attachment_bytes(attachment)
+
+
+def get_attachment_size(attachment):
+    if attachment.get('bytes') is not None:
+        return len(attachment['bytes'])
+    return attachment.get('size') or os.path.getsize(attachment['path'])
+
+
+def build_textract_document(attachment, bucket, debug_upload):
+    """
+    Documentos pequeños van como Bytes; los grandes esperan la copia en S3
+    (S3CopyUnavailable si la subida falló: pasan por la ruta sin Textract).
+    """
+    if get_attachment_size(attachment) <= TEXTRACT_BYTES_MAX:
+        return {'Bytes': get_attachment_bytes(attachment)}
+    debug_key = debug_upload.result()
+    if not debug_key:
+        raise S3CopyUnavailable(
+            f"No hay copia en S3 de {attachment['filename']} ({get_attachment_size(attachment)} bytes, "
+            f"más que TEXTRACT_BYTES_MAX para enviarlo como Bytes)"
+        )
+    return {
+        'S3Object': {
+            'Bucket': bucket,
+            'Name': debug_key
+        }
+    }
+
+
+def extract_raw_text_from_textract(textract_response):
+    """
+    Extrae texto plano de Textract para reducir tokens.
+    """
+    text = []
+    for doc in textract_response.get('ExpenseDocuments', []):
+        for block in doc.get('Blocks', []):
+            if block.get('BlockType') == 'LINE':
+                text.append(block.get('Text', ''))
+    return "\n".join(line for line in text if line)
+
+
+def estimate_image_tokens(width, height):
+    # Regla de Anthropic: tokens ≈ ancho * alto / 750
+    return int(width * height / 750)
+
+
+def flatten_transparency(Image, image):
+    """
+    Compone las imágenes con transparencia (RGBA, LA, paleta con
+    transparencia) sobre fondo blanco. convert('RGB') directo deja negras las
+    zonas transparentes y el texto oscuro encima deja de leerse.
+    """
+    if image.mode not in ('RGBA', 'LA', 'PA', 'RGBa', 'La') and not (
+        image.mode == 'P' and 'transparency' in image.info
+    ):
+        return image
+    image = image.convert('RGBA')
+    background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+    return Image.alpha_composite(background, image).convert('RGB')
+
+
+def preprocess_invoice_image(image_bytes, media_type):
+    """
+    Orienta según EXIF, compone la transparencia sobre blanco, reduce a la
+    resolución útil del modelo, pasa a escala de grises si la foto casi no
+    tiene color y recomprime como JPEG.
+    Si Pillow no está o el resultado no es más liviano, retorna el original.
+    Retorna (bytes, media_type, stats) con stats listos para procesamiento.
+    """
+    Image, ImageOps, ImageStat = (optional_import(f'PIL.{name}') for name in ('Image', 'ImageOps', 'ImageStat'))
+    if Image is None:
+        return image_bytes, media_type, {}
+
+    try:
+        with Image.open(BytesIO(image_bytes)) as original:
+            original_size = original.size
+            image = flatten_transparency(Image, ImageOps.exif_transpose(original))
+
+            width, height = image.size
+            scale = min(
+                1.0,
+                IMAGE_MAX_EDGE / max(width, height),
+                (IMAGE_MAX_PIXELS / float(width * height)) ** 0.5
+            )
+            if scale < 1.0:
+                image = image.resize(
+                    (max(1, int(width * scale)), max(1, int(height * scale))),
+                    Image.LANCZOS
+                )
+
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            grayscale = image.mode == 'L'
+            if not grayscale:
+                saturation = ImageStat.Stat(image.convert('HSV').getchannel('S')).mean[0]
+                if saturation <= IMAGE_GRAYSCALE_MAX_SATURATION:
+                    image = image.convert('L')
+                    grayscale = True
+
+            output = BytesIO()
+            image.save(output, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+            processed = output.getvalue()
+            processed_size = image.size
+    except Exception as err:
+        print(f"⚠️ Image preprocessing failed, sending original: {err}")
+        return image_bytes, media_type, {}
+
+    tokens_before = estimate_image_tokens(*original_size)
+    tokens_after = estimate_image_tokens(*processed_size)
+    print(
+        f"🖼️ Image preprocessing: {len(image_bytes)} → {len(processed)} bytes, "
+        f"{original_size[0]}x{original_size[1]} → {processed_size[0]}x{processed_size[1]}, "
+        f"~{tokens_before} → ~{tokens_after} tokens{' (grayscale)' if grayscale else ''}"
+    )
+    if len(processed) >= len(image_bytes) and processed_size == original_size:
+        return image_bytes, media_type, {}
+
+    return processed, 'image/jpeg', {
+        'imagenBytesOriginal': len(image_bytes),
+        'imagenBytesEnviados': len(processed),
+        'imagenTokensEstimados': tokens_after,
+        'imagenGrises': grayscale
+    }
+
+
+def extract_pdf_text_layer(attachment):
+    """
+    Texto plano de la capa de texto del PDF (una línea por renglón, como
+    extract_raw_text_from_textract). Retorna None si pypdf no está disponible
+    o el PDF no se puede leer.
+    """
+    pypdf = optional_import('pypdf')
+    if pypdf is None:
+        return None
+    try:
+        if attachment.get('path'):
+            with open(attachment['path'], 'rb') as spilled:
+                reader = pypdf.PdfReader(spilled)
+                pages = [page.extract_text() or '' for page in reader.pages]
+        else:
+            reader = pypdf.PdfReader(BytesIO(attachment['bytes']))
+            pages = [page.extract_text() or '' for page in reader.pages]
+    except Exception as err:
+        print(f"⚠️ Local PDF text extraction failed: {err}")
+        return None
+
+    attachment['pages'] = len(pages)
+    attachment.setdefault('page_texts', {number: text for number, text in enumerate(pages, start=1)})
+    lines = []
+    for page_text in pages:
+        lines.extend(line.strip() for line in page_text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def attach_pdf_text_layer(attachment):
+    """
+    Guarda la capa de texto local en attachment['text_layer'] solo si pasa el
+    chequeo de cobertura; en caso contrario el PDF sigue por Textract.
+    """
+    text_layer = extract_pdf_text_layer(attachment)
+    if text_layer is None:
+        return
+    if is_low_text_coverage(text_layer):
+        print(f"🖼️ Local text layer too thin ({len(text_layer)} chars); using Textract")
+        return
+    print(f"📝 Local text layer: {len(text_layer)} chars")
+    attachment['text_layer'] = text_layer
+
+
+def extract_page_texts_from_textract(textract_response):
+    """
+    Texto LINE de Textract agrupado por número de página.
+    """
+    pages = {}
+    for doc in textract_response.get('ExpenseDocuments', []):
+        for block in doc.get('Blocks', []):
+            if block.get('BlockType') == 'LINE' and block.get('Text'):
+                pages.setdefault(block.get('Page', 1), []).append(block['Text'])
+    return {number: "\n".join(lines) for number, lines in pages.items()}
+
+
+def score_invoice_page(text):
+    """
+    Cuántos indicios de comprobante tiene la página (RUC, serie-correlativo,
+    total con moneda, palabras clave), de 0 a 4.
+    """
+    if not text:
+        return 0
+    return sum(1 for pattern in (RUC_RE, SERIE_RE, TOTAL_RE, KEYWORDS_RE) if pattern.search(text))
+
+
+def select_invoice_pages(attachment):
+    """
+    Para PDFs largos arma un PDF reducido con las páginas que puntúan como
+    comprobante. Si no hay texto por página, pypdf no está disponible o
+    ninguna página puntúa, retorna el PDF completo (ruta o bytes, ver
+    get_attachment_source).
+    Retorna (pdf_source, page_info) con page_info listo para procesamiento.
+    """
+    pdf_source = get_attachment_source(attachment)
+    page_texts = attachment.get('page_texts') or {}
+    pypdf = optional_import('pypdf')
+    if pypdf is None or not page_texts:
+        return pdf_source, {}
+
+    try:
+        reader = pypdf.PdfReader(pdf_source if isinstance(pdf_source, str) else BytesIO(pdf_source))
+        total_pages = len(reader.pages)
+        if total_pages < PAGE_SELECTION_MIN_PAGES:
+            return pdf_source, {}
+
+        selected = []
+        for number in range(1, total_pages + 1):
+            score = score_invoice_page(page_texts.get(number))
+            # Una página con algún indicio justo después de una seleccionada
+            # suele ser la continuación del comprobante (ítems, totales)
+            continuation = score > 0 and selected and selected[-1] == number - 1
+            if score >= PAGE_SELECTION_MIN_SCORE or continuation:
+                selected.append(number)
+        if not selected or len(selected) == total_pages:
+            return pdf_source, {}
+
+        writer = pypdf.PdfWriter()
+        for number in selected:
+            writer.add_page(reader.pages[number - 1])
+        output = BytesIO()
+        writer.write(output)
+    except Exception as err:
+        print(f"⚠️ Page selection failed, sending full PDF: {err}")
+        return pdf_source, {}
+
+    reduced = output.getvalue()
+    print(
+        f"✂️ Page selection: {len(selected)}/{total_pages} pages {selected}, "
+        f"{get_attachment_size(attachment)} → {len(reduced)} bytes"
+    )
+    return reduced, {'paginasEnviadas': selected, 'paginasTotales': total_pages}
+
+
+def is_low_text_coverage(text, min_chars=200, min_lines=10):
+    """
+    Heurística simple para identificar PDFs escaneados.
+    """
+    if not text:
+        return True
+    lines = [line for line in text.splitlines() if line.strip()]
+    return len(text.strip()) < min_chars or len(lines) < min_lines
+
+
+def process_attachment(attachment, bucket, debug_upload):
+    """
+    Decide el pipeline: PDF con Textract+Bedrock o imagen con Bedrock.
+    debug_upload es el Future de upload_debug_attachment (key de la copia en S3).
+    """
+    media_type = attachment['media_type']
+    processing_overrides = {}
+
+    if media_type == 'application/pdf' and attachment.get('text_layer'):
+        print("📝 Using local PDF text layer; skipping Textract")
+        text_layer = attachment['text_layer']
+        extra_context = (
+            "TEXTO DEL PDF (capa de texto digital):\n"
+            f"{text_layer}\n\n"
+            "Usa este texto como fuente principal."
+        )
+        invoice_data, model_info = analyze_invoice_text_tiered(
+            extra_context,
+            max_tokens=4000
+        )
+        processing_overrides = {
+            'motor': 'bedrock-claude+pdf-texto',
+            'ruta': 'pdf-texto-local',
+            'textoLocalChars': len(text_layer),
+            **model_info
+        }
+    elif media_type == 'application/pdf':
+        print("🔍 Running Textract AnalyzeExpense for PDF...")
+        textract_text = ""
+        textract_error = None
+        try:
+            document = build_textract_document(attachment, bucket, debug_upload)
+            with span('Textract'):
+                textract_response = get_client('textract').analyze_expense(Document=document)
+            textract_text = extract_raw_text_from_textract(textract_response)
+            attachment['page_texts'] = extract_page_texts_from_textract(textract_response)
+            print(f"🧾 Textract text length: {len(textract_text)} chars")
+        except ClientError as err:
+            textract_error = str(err)
+            print(f"⚠️ Textract AnalyzeExpense failed: {textract_error}")
+        except Exception as err:
+            textract_error = str(err)
+            print(f"⚠️ Textract AnalyzeExpense error: {textract_error}")
+
+        invoice_data, processing_overrides = analyze_pdf_from_textract(attachment, textract_text, textract_error)
+    elif media_type in ALLOWED_IMAGE_MIME_TYPES:
+        extra_context = (
+            "NOTA: La factura es una foto/imagen. Haz un esfuerzo adicional para leer texto borroso; "
+            "si no es legible, usa null y agrega un warning en validaciones.warnings."
+        )
+        image_bytes, image_media_type, image_stats = preprocess_invoice_image(
+            get_attachment_bytes(attachment),
+            media_type
+        )
+        invoice_data = analyze_invoice_with_bedrock_document(
+            image_bytes,
+            image_media_type,
+            extra_context=extra_context,
+            max_tokens=8000
+        )
+        processing_overrides = {
+            'motor': 'bedrock-claude-image',
+            'ruta': 'imagen',
+            **image_stats
+        }
+    else:
+        raise ValueError(f"Tipo de archivo no soportado: {media_type}")
+
+    return invoice_data, processing_overrides
+
+
+def analyze_pdf_from_textract(attachment, textract_text, textract_error=None):
+    """
+    Elige la ruta de Bedrock para un PDF según el resultado de Textract
+    (síncrono o asíncrono): documento completo si falló o parece escaneado,
+    solo texto OCR si la cobertura de texto es suficiente.
+    """
+    media_type = attachment['media_type']
+    if textract_error:
+        extra_context = (
+            "NOTA: Textract falló al procesar este PDF. "
+            "Haz un esfuerzo adicional para leer el documento; si no es legible, usa null "
+            "y agrega un warning en validaciones.warnings."
+        )
+        pdf_source, page_info = select_invoice_pages(attachment)
+        invoice_data = analyze_invoice_with_bedrock_document(
+            pdf_source,
+            media_type,
+            extra_context=extra_context,
+            max_tokens=8000
+        )
+        processing_overrides = {
+            'motor': 'bedrock-claude-image',
+            'ruta': 'pdf-textract-error',
+            'textractError': textract_error[:200],
+            **page_info
+        }
+    elif is_low_text_coverage(textract_text):
+        print("🖼️ PDF parece escaneado; usando Bedrock con documento completo.")
+        extra_context = (
+            "NOTA: La factura proviene de un escaneo/imagen dentro de un PDF. "
+            "Haz un esfuerzo adicional para leer texto borroso; si no es legible, usa null "
+            "y agrega un warning en validaciones.warnings."
+        )
+        pdf_source, page_info = select_invoice_pages(attachment)
+        invoice_data = analyze_invoice_with_bedrock_document(
+            pdf_source,
+            media_type,
+            extra_context=extra_context,
+            max_tokens=8000
+        )
+        processing_overrides = {
+            'motor': 'bedrock-claude-image',
+            'ruta': 'pdf-imagen',
+            **page_info
+        }
+    else:
+        extra_context = (
+            "TEXTO OCR (puede tener errores):\n"
+            f"{textract_text}\n\n"
+            "Usa el texto OCR como fuente principal y corrige errores evidentes."
+        )
+        invoice_data, model_info = analyze_invoice_text_tiered(
+            extra_context,
+            max_tokens=4000
+        )
+        processing_overrides = {
+            'motor': 'bedrock-claude+textract',
+            'ruta': 'pdf-textract-texto',
+            'textractChars': len(textract_text),
+            **model_info
+        }
+
+    return invoice_data, processing_overrides
+
+
+def count_pdf_pages(attachment):
+    """
+    Conteo de páginas: objetos /Type /Page y, si no aparece ninguno (páginas
+    en object streams comprimidos), el de pypdf. Retorna 0 si no se sabe.
+    """
+    if attachment.get('pages'):
+        return attachment['pages']
+    if attachment.get('path'):
+        with open(attachment['path'], 'rb') as spilled:
+            pages = len(PDF_PAGE_RE.findall(spilled.read()))
+    else:
+        pages = len(PDF_PAGE_RE.findall(attachment.get('bytes') or b''))
+    if pages:
+        return pages
+
+    pypdf = optional_import('pypdf')
+    if pypdf is None:
+        return 0
+    try:
+        if attachment.get('path'):
+            with open(attachment['path'], 'rb') as spilled:
+                pages = len(pypdf.PdfReader(spilled).pages)
+        else:
+            pages = len(pypdf.PdfReader(BytesIO(attachment['bytes'])).pages)
+    except Exception as err:
+        print(f"⚠️ Could not count PDF pages: {err}")
+        return 0
+    attachment['pages'] = pages
+    return pages
+
+
+def should_use_async_textract(attachment):
+    if attachment['media_type'] not in ALLOWED_PDF_MIME_TYPES or attachment.get('text_layer'):
+        return False
+    if TEXTRACT_ASYNC_MIN_PAGES <= 0 or not TEXTRACT_SNS_TOPIC_ARN or not TEXTRACT_SNS_ROLE_ARN:
+        return False
+    pages = count_pdf_pages(attachment)
+    if not pages:
+        # Conteo desconocido: el job asíncrono acepta cualquier número de
+        # páginas, AnalyzeExpense solo una
+        print("📚 PDF page count unknown; using async Textract")
+        return True
+    if pages >= TEXTRACT_ASYNC_MIN_PAGES:
+        print(f"📚 PDF with {pages} pages; using async Textract")
+        return True
+    return False
+
+
+def textract_job_context_key(job_id):
+    return {'PK': f'TEXTRACT_JOB#{job_id}', 'SK': 'CONTEXT'}
+
+
+def start_async_textract_job(client_id, attachment, bucket, key, file_size, debug_upload):
+    """
+    Inicia StartExpenseAnalysis sobre la copia en S3 y guarda el contexto para
+    retomar el pipeline cuando llegue la notificación de Textract. El hash del
+    contenido como ClientRequestToken hace idempotentes los reintentos.
+    Sin copia en S3 lanza S3CopyUnavailable: el record se reintenta.
+    """
+    debug_key = debug_upload.result()
+    if not debug_key:
+        raise S3CopyUnavailable(f"No hay copia en S3 de {attachment['filename']} para Textract asíncrono")
+    with span('TextractStart'):
+        response = get_client('textract').start_expense_analysis(
+            DocumentLocation={'S3Object': {'Bucket': bucket, 'Name': debug_key}},
+            ClientRequestToken=attachment['sha256'][:64],
+            JobTag='flow-ingest',
+            NotificationChannel={
+                'SNSTopicArn': TEXTRACT_SNS_TOPIC_ARN,
+                'RoleArn': TEXTRACT_SNS_ROLE_ARN
+            }
+        )
+    job_id = response['JobId']
 
-        if not filename:
-            filename = f"attachment{MEDIA_TYPE_EXTENSION.get(normalized_type, '')}"
+    get_control_table().put_item(Item={
+        **textract_job_context_key(job_id),
+        'clientId': client_id,
+        'bucket': bucket,
+        'key': key,
+        'fileSize': file_size,
+        'debugKey': debug_key,
+        'mediaType': attachment['media_type'],
+        'filename': attachment['filename'],
+        'index': attachment.get('index', 0),
+        'sha256': attachment['sha256'],
+        'creadoEn': datetime.utcnow().isoformat() + 'Z',
+        'expiresAt': int(time.time()) + TEXTRACT_JOB_CONTEXT_TTL_DAYS * 86400
+    })
+    print(f"⏳ Textract job {job_id} started for {attachment['filename']}")
+    return job_id
 
-        candidates.append({
-            'bytes': payload,
-            'media_type': normalized_type,
-            'filename': filename
-        })
 
-    if not candidates:
+def parse_textract_notification(record):
+    """
+    Retorna la notificación de Textract contenida en el record (SNS directo,
+    SNS → SQS o mensaje de reintento) o None si es otro tipo de record.
+    """
+    message = None
+    if 'Sns' in record:
+        message = record['Sns'].get('Message')
+    elif 'body' in record:
+        try:
+            body = json.loads(record['body'])
+        except (TypeError, ValueError):
+            return None
+        if 'textractJob' in body:
+            return body['textractJob']
+        if body.get('Type') == 'Notification':
+            message = body.get('Message')
+
+    if not message:
+        return None
+    try:
+        notification = json.loads(message) if isinstance(message, str) else message
+    except ValueError:
         return None
+    if notification.get('JobId') and notification.get('API') == 'StartExpenseAnalysis':
+        return notification
+    return None
 
-    for candidate in candidates:
-        if candidate['media_type'] == 'application/pdf':
-            print(f"📎 PDF encontrado en el correo ({len(candidates)} candidato(s)); usando el primero.")
-            return candidate
 
-    print(f"🖼️ Imagen encontrada en el correo ({len(candidates)} candidato(s)); usando la primera.")
-    return candidates[0]
+def get_expense_analysis_pages(job_id):
+    """
+    Lee el resultado completo del job, siguiendo NextToken.
+    """
+    documents = []
+    next_token = None
+    while True:
+        params = {'JobId': job_id, 'MaxResults': 20}
+        if next_token:
+            params['NextToken'] = next_token
+        with span('TextractGet'):
+            response = get_client('textract').get_expense_analysis(**params)
+        if response.get('JobStatus') not in (None, 'SUCCEEDED', 'PARTIAL_SUCCESS'):
+            raise ValueError(f"Textract job {job_id} status {response.get('JobStatus')}")
+        documents.extend(response.get('ExpenseDocuments', []))
+        next_token = response.get('NextToken')
+        if not next_token:
+            return {'ExpenseDocuments': documents}
+
+
+def claim_textract_job(job_id):
+    """
+    Marca el contexto del job como PROCESSING con un lease, de forma
+    condicional: SNS/SQS entregan al menos una vez y una notificación
+    duplicada no debe repetir Textract, Bedrock ni el guardado.
+    Retorna (contexto, None) si esta invocación lo procesa, o (None, motivo)
+    si el job no existe, ya se completó o lo procesa otra invocación.
+    """
+    now = time.time()
+    try:
+        response = get_control_table().update_item(
+            Key=textract_job_context_key(job_id),
+            UpdateExpression='SET jobStatus = :processing, claimedUntil = :until',
+            ConditionExpression=(
+                'attribute_exists(PK) AND (attribute_not_exists(jobStatus) '
+                'OR (jobStatus = :processing AND claimedUntil < :now))'
+            ),
+            ExpressionAttributeValues={
+                ':processing': 'PROCESSING',
+                ':until': Decimal(str(round(now + TEXTRACT_JOB_CLAIM_SECONDS, 3))),
+                ':now': Decimal(str(round(now, 3)))
+            },
+            ReturnValues='ALL_NEW',
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
+        )
+    except ClientError as err:
+        if err.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+            raise
+        current = err.response.get('Item') or {}
+        if not current:
+            return None, 'unknown'
+        status = current.get('jobStatus')
+        # Item crudo de ALL_OLD: {'S': 'COMPLETED'}
+        status = status.get('S') if isinstance(status, dict) else status
+        return None, 'completed' if status == 'COMPLETED' else 'in_progress'
+    return response['Attributes'], None
 
 
-def upload_debug_attachment(bucket, attachment):
+def complete_textract_job(job_id, invoice_id):
     """
-    Guarda una copia de depuración del adjunto extraído en la carpeta debug.
+    Deja el contexto como COMPLETED hasta su TTL: una reentrega posterior se
+    descarta en claim_textract_job.
     """
-    filename = attachment.get('filename') or f"attachment{MEDIA_TYPE_EXTENSION.get(attachment['media_type'], '')}"
-    safe_filename = filename.replace('/', '_')
-    timestamp = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
-    debug_key = f"debug/{timestamp}-{safe_filename}"
-    tmp_path = f"/tmp/{timestamp}-{safe_filename}"
+    get_control_table().update_item(
+        Key=textract_job_context_key(job_id),
+        UpdateExpression='SET jobStatus = :completed, completadoEn = :at, invoiceId = :invoice REMOVE claimedUntil',
+        ExpressionAttributeValues={
+            ':completed': 'COMPLETED',
+            ':at': datetime.utcnow().isoformat() + 'Z',
+            ':invoice': invoice_id or ''
+        }
+    )
 
-    with open(tmp_path, 'wb') as tmp_file:
-        tmp_file.write(attachment['bytes'])
 
+def release_textract_job(job_id):
+    """
+    Libera el lease tras un error para que la reentrega lo reintente.
+    """
     try:
-        s3_client.upload_file(tmp_path, bucket, debug_key)
-        print(f"📤 Copia de depuración subida a s3://{bucket}/{debug_key}")
+        get_control_table().update_item(
+            Key=textract_job_context_key(job_id),
+            UpdateExpression='REMOVE jobStatus, claimedUntil',
+            ConditionExpression='jobStatus = :processing',
+            ExpressionAttributeValues={':processing': 'PROCESSING'}
+        )
     except ClientError as err:
-        print(f"⚠️ No se pudo subir la copia de depuración: {str(err)}")
+        print(f"⚠️ Could not release Textract job {job_id}: {str(err)}")
 
-    return debug_key
 
-
-def extract_raw_text_from_textract(textract_response):
+def resume_textract_job(notification):
     """
-    Extrae texto plano de Textract para reducir tokens.
+    Retoma el pipeline de un PDF cuando Textract termina el job asíncrono.
+    Idempotente: el job se reclama antes de leer el resultado.
     """
-    text = []
-    for doc in textract_response.get('ExpenseDocuments', []):
-        for block in doc.get('Blocks', []):
-            if block.get('BlockType') == 'LINE':
-                text.append(block.get('Text', ''))
-    return "\n".join(line for line in text if line)
+    job_id = notification['JobId']
+    status = notification.get('Status')
+    print(f"📬 Textract job {job_id} finished with status {status}")
+
+    context, skipped = claim_textract_job(job_id)
+    if skipped == 'unknown':
+        print(f"⚠️ No pending context for Textract job {job_id}; ignoring")
+        return {'message': 'Unknown Textract job', 'textractJobId': job_id}
+    if skipped:
+        print(f"⏭️ Textract job {job_id} already {'processed' if skipped == 'completed' else 'being processed'}; ignoring duplicate notification")
+        return {'message': 'Duplicate Textract notification', 'textractJobId': job_id, 'duplicado': True}
+
+    attachment = {
+        'media_type': context['mediaType'],
+        'filename': context['filename'],
+        'index': int(context.get('index', 0)),
+        'sha256': context['sha256'],
+        's3Bucket': context['bucket'],
+        's3Key': context['debugKey']
+    }
 
+    metrics = StageMetrics(mediaType=context['mediaType'], tenant=context['clientId'])
+    try:
+        with metrics_scope(metrics):
+            textract_text = ""
+            textract_error = None
+            if status in ('SUCCEEDED', 'PARTIAL_SUCCESS'):
+                try:
+                    textract_response = get_expense_analysis_pages(job_id)
+                    textract_text = extract_raw_text_from_textract(textract_response)
+                    attachment['page_texts'] = extract_page_texts_from_textract(textract_response)
+                    print(f"🧾 Textract text length: {len(textract_text)} chars")
+                except ClientError as err:
+                    textract_error = str(err)
+            else:
+                textract_error = f"Textract job {status}"
 
-def is_low_text_coverage(text, min_chars=200, min_lines=10):
+            invoice_data, processing_overrides = analyze_pdf_from_textract(attachment, textract_text, textract_error)
+            processing_overrides.update({'textractModo': 'async', 'textractJobId': job_id})
+            metrics.set_dimensions(ruta=processing_overrides.get('ruta'))
+
+            file_size = context.get('fileSize')
+            result = save_processed_invoice(
+                context['clientId'],
+                attachment,
+                invoice_data,
+                processing_overrides,
+                context['bucket'],
+                context['key'],
+                int(file_size) if file_size is not None else -1
+            )
+    except Exception:
+        release_textract_job(job_id)
+        raise
+    complete_textract_job(job_id, result.get('invoiceId'))
+    return result
+
+
+class BedrockCapacityUnavailable(Exception):
     """
-    Heurística simple para identificar PDFs escaneados.
+    No hay capacidad de Bedrock disponible; el trabajo debe diferirse.
     """
-    if not text:
-        return True
-    lines = [line for line in text.splitlines() if line.strip()]
-    return len(text.strip()) < min_chars or len(lines) < min_lines
 
+    def __init__(self, retry_after):
+        super().__init__(f"Bedrock capacity unavailable, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
 
-def process_attachment(attachment, bucket, debug_key):
+
+class AdaptiveTokenBucket:
     """
-    Decide el pipeline: PDF con Textract+Bedrock o imagen con Bedrock.
+    Token bucket con tasa AIMD compartido entre invocaciones vía un item de la
+    tabla de control. Si DynamoDB no responde usa un bucket en proceso con la
+    misma lógica.
+
+    El bucket se guarda como `tat` (instante teórico en que se liberan todos
+    los tokens consumidos, GCRA) y `rate`: tokens disponibles en `now` =
+    burst - (tat - now) * rate. Así cada acquire es un solo UpdateItem
+    condicional y atómico, sin leer antes el item:
+      SET tat = tat + :interval  IF tat BETWEEN :now AND :limit
+    (bucket en uso) o SET tat = :now + :interval IF tat < :now (bucket lleno).
+    Dos contenedores nunca pisan su escritura; solo falla la condición si
+    de verdad no hay token, y el item previo (ALL_OLD) da la espera exacta.
+
+    - try_acquire(): consume un token; retorna 0 o los segundos hasta el próximo.
+    - record_success(): incremento aditivo de la tasa (SET rate = rate + :inc).
+    - record_throttle(): decremento multiplicativo de la tasa; no vacía el bucket.
     """
-    media_type = attachment['media_type']
-    processing_overrides = {}
 
-    if media_type == 'application/pdf':
-        print("🔍 Running Textract AnalyzeExpense for PDF...")
-        textract_text = ""
-        textract_error = None
+    # Intentos por acquire: el item puede pasar de lleno a en uso (o al revés)
+    # entre el cálculo y la escritura
+    MAX_ATTEMPTS = 3
+    # Espera sugerida si la contención agota los intentos (se reintenta, no se difiere)
+    CONTENTION_RETRY_SECONDS = 0.05
+
+    def __init__(self, name, initial_rate, min_rate, max_rate, burst, increase, decrease):
+        self.key = {'PK': f'RATELIMIT#{name}', 'SK': 'BUCKET'}
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self._lock = threading.Lock()
+        # Última vista del item compartido (se refresca con cada respuesta)
+        self._seen = {'tat': None, 'rate': initial_rate}
+        self._local = {'tat': 0.0, 'rate': initial_rate}
+
+    @staticmethod
+    def _number(value):
+        """
+        Número de un atributo: Decimal del recurso Table o {'N': '...'} del
+        item crudo que trae ConditionalCheckFailedException (ALL_OLD).
+        """
+        if isinstance(value, dict):
+            value = value.get('N')
+        return float(value) if value is not None else None
+
+    def _remember(self, item):
+        with self._lock:
+            self._seen['tat'] = self._number(item.get('tat'))
+            self._seen['rate'] = self._number(item.get('rate')) or self.initial_rate
+
+    def _limit(self, now, rate):
+        # tat máximo que aún deja un token: burst - (tat - now) * rate >= 1
+        return now + (self.burst - 1) / rate
+
+    def _take_local(self, now):
+        with self._lock:
+            state = self._local
+            interval = 1.0 / state['rate']
+            tat = max(state['tat'], now)
+            if tat > self._limit(now, state['rate']):
+                return tat - self._limit(now, state['rate'])
+            state['tat'] = tat + interval
+            return 0.0
+
+    def try_acquire(self):
         try:
-            textract_response = textract_client.analyze_expense(
-                Document={
-                    'S3Object': {
-                        'Bucket': bucket,
-                        'Name': debug_key
+            return self._take_shared()
+        except Exception as err:
+            print(f"⚠️ Shared Bedrock rate limiter unavailable, using local bucket: {str(err)}")
+            return self._take_local(time.time())
+
+    def _take_shared(self):
+        table = get_control_table()
+        with self._lock:
+            tat, rate = self._seen['tat'], self._seen['rate']
+        for _ in range(self.MAX_ATTEMPTS):
+            now = time.time()
+            interval = 1.0 / rate
+            if tat is not None and tat >= now:
+                update = {
+                    'UpdateExpression': 'SET tat = tat + :interval',
+                    'ConditionExpression': 'tat BETWEEN :now AND :limit',
+                    'ExpressionAttributeValues': {
+                        ':interval': Decimal(str(round(interval, 4))),
+                        ':now': Decimal(str(round(now, 3))),
+                        ':limit': Decimal(str(round(self._limit(now, rate), 3)))
                     }
                 }
+            else:
+                update = {
+                    'UpdateExpression': 'SET tat = :next, rate = if_not_exists(rate, :rate)',
+                    'ConditionExpression': 'attribute_not_exists(tat) OR tat < :now',
+                    'ExpressionAttributeValues': {
+                        ':next': Decimal(str(round(now + interval, 3))),
+                        ':rate': Decimal(str(self.initial_rate)),
+                        ':now': Decimal(str(round(now, 3)))
+                    }
+                }
+            try:
+                response = table.update_item(
+                    Key=self.key,
+                    ReturnValues='ALL_NEW',
+                    ReturnValuesOnConditionCheckFailure='ALL_OLD',
+                    **update
+                )
+                self._remember(response.get('Attributes') or {})
+                return 0.0
+            except ClientError as err:
+                if err.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                    raise
+                current = err.response.get('Item') or {}
+                self._remember(current)
+                tat = self._number(current.get('tat'))
+                rate = self._number(current.get('rate')) or self.initial_rate
+                now = time.time()
+                if tat is not None and tat > self._limit(now, rate):
+                    # Sin token: el próximo se libera cuando tat baje al límite
+                    return tat - self._limit(now, rate)
+        # El item cambió de forma en cada intento: reintentar enseguida
+        return self.CONTENTION_RETRY_SECONDS
+
+    def record_success(self):
+        try:
+            response = get_control_table().update_item(
+                Key=self.key,
+                UpdateExpression='SET rate = rate + :increase',
+                ConditionExpression='rate <= :ceiling',
+                ExpressionAttributeValues={
+                    ':increase': Decimal(str(self.increase)),
+                    ':ceiling': Decimal(str(round(self.max_rate - self.increase, 4)))
+                },
+                ReturnValues='ALL_NEW'
             )
-            textract_text = extract_raw_text_from_textract(textract_response)
-            print(f"🧾 Textract text length: {len(textract_text)} chars")
+            self._remember(response.get('Attributes') or {})
         except ClientError as err:
-            textract_error = str(err)
-            print(f"⚠️ Textract AnalyzeExpense failed: {textract_error}")
+            # En el máximo (o sin item todavía): no hay nada que subir
+            if err.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                self._grow_local(err)
         except Exception as err:
-            textract_error = str(err)
-            print(f"⚠️ Textract AnalyzeExpense error: {textract_error}")
+            self._grow_local(err)
 
-        if textract_error:
-            extra_context = (
-                "NOTA: Textract falló al procesar este PDF. "
-                "Haz un esfuerzo adicional para leer el documento; si no es legible, usa null "
-                "y agrega un warning en validaciones.warnings."
-            )
-            invoice_data = analyze_invoice_with_bedrock_document(
-                attachment['bytes'],
-                media_type,
-                extra_context=extra_context,
-                max_tokens=8000
-            )
-            processing_overrides = {
-                'motor': 'bedrock-claude-image',
-                'ruta': 'pdf-textract-error',
-                'textractError': textract_error[:200]
-            }
-        elif is_low_text_coverage(textract_text):
-            print("🖼️ PDF parece escaneado; usando Bedrock con documento completo.")
-            extra_context = (
-                "NOTA: La factura proviene de un escaneo/imagen dentro de un PDF. "
-                "Haz un esfuerzo adicional para leer texto borroso; si no es legible, usa null "
-                "y agrega un warning en validaciones.warnings."
-            )
-            invoice_data = analyze_invoice_with_bedrock_document(
-                attachment['bytes'],
-                media_type,
-                extra_context=extra_context,
-                max_tokens=8000
-            )
-            processing_overrides = {
-                'motor': 'bedrock-claude-image',
-                'ruta': 'pdf-imagen'
-            }
-        else:
-            extra_context = (
-                "TEXTO OCR (puede tener errores):\n"
-                f"{textract_text}\n\n"
-                "Usa el texto OCR como fuente principal y corrige errores evidentes."
-            )
-            invoice_data = analyze_invoice_with_bedrock_text(
-                extra_context,
-                max_tokens=4000
-            )
-            processing_overrides = {
-                'motor': 'bedrock-claude+textract',
-                'ruta': 'pdf-textract-texto',
-                'textractChars': len(textract_text)
-            }
-    elif media_type in ALLOWED_IMAGE_MIME_TYPES:
-        extra_context = (
-            "NOTA: La factura es una foto/imagen. Haz un esfuerzo adicional para leer texto borroso; "
-            "si no es legible, usa null y agrega un warning en validaciones.warnings."
-        )
-        invoice_data = analyze_invoice_with_bedrock_document(
-            attachment['bytes'],
-            media_type,
-            extra_context=extra_context,
-            max_tokens=8000
-        )
-        processing_overrides = {
-            'motor': 'bedrock-claude-image',
-            'ruta': 'imagen'
-        }
-    else:
-        raise ValueError(f"Tipo de archivo no soportado: {media_type}")
+    def _grow_local(self, err):
+        print(f"⚠️ Shared Bedrock rate limiter unavailable, using local bucket: {str(err)}")
+        with self._lock:
+            self._local['rate'] = min(self.max_rate, self._local['rate'] + self.increase)
+
+    def record_throttle(self):
+        """
+        rate = max(min_rate, rate * decrease). DynamoDB no multiplica en un
+        UpdateExpression: se escribe el valor calculado con la condición de
+        que la tasa siga siendo la vista; si otro contenedor la cambió se
+        recalcula sobre la actual (ALL_OLD).
+        """
+        with self._lock:
+            seen = self._seen['rate']
+        try:
+            table = get_control_table()
+            for _ in range(self.MAX_ATTEMPTS):
+                shrunk = max(self.min_rate, seen * self.decrease)
+                if shrunk >= seen:
+                    return
+                try:
+                    table.update_item(
+                        Key=self.key,
+                        UpdateExpression='SET rate = :shrunk',
+                        ConditionExpression='rate = :seen',
+                        ExpressionAttributeValues={
+                            ':shrunk': Decimal(str(round(shrunk, 4))),
+                            ':seen': Decimal(str(round(seen, 4)))
+                        },
+                        ReturnValuesOnConditionCheckFailure='ALL_OLD'
+                    )
+                    with self._lock:
+                        self._seen['rate'] = shrunk
+                    return
+                except ClientError as err:
+                    if err.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                        raise
+                    current = self._number((err.response.get('Item') or {}).get('rate'))
+                    if current is None:
+                        return
+                    seen = current
+        except Exception as err:
+            print(f"⚠️ Shared Bedrock rate limiter unavailable, using local bucket: {str(err)}")
+            with self._lock:
+                self._local['rate'] = max(self.min_rate, self._local['rate'] * self.decrease)
 
-    return invoice_data, processing_overrides
 
+bedrock_rate_limiter = AdaptiveTokenBucket(
+    'bedrock',
+    initial_rate=BEDROCK_RATE_INITIAL,
+    min_rate=BEDROCK_RATE_MIN,
+    max_rate=BEDROCK_RATE_MAX,
+    burst=BEDROCK_RATE_BURST,
+    increase=BEDROCK_RATE_INCREASE,
+    decrease=BEDROCK_RATE_DECREASE
+)
 
-def invoke_bedrock(request_body):
+
+def acquire_bedrock_capacity():
     """
-    Ejecuta la llamada a Bedrock con retries y parsea el JSON resultante.
+    Obtiene un token del rate limiter; espera solo si el próximo token llega
+    dentro de BEDROCK_MAX_TOKEN_WAIT, de lo contrario difiere el trabajo.
     """
-    # Reintentos con backoff exponencial para manejar throttling
-    max_retries = 5
-    base_delay = 2  # segundos
+    for _ in range(2):
+        wait = bedrock_rate_limiter.try_acquire()
+        if wait <= 0:
+            return
+        if wait > BEDROCK_MAX_TOKEN_WAIT:
+            raise BedrockCapacityUnavailable(wait)
+        time.sleep(wait)
+    raise BedrockCapacityUnavailable(BEDROCK_MAX_TOKEN_WAIT)
 
-    for attempt in range(max_retries):
-        try:
-            if attempt > 0:
-                print(f"🔄 Retry {attempt}/{max_retries} - Invoking Bedrock model: {MODEL_ID}")
-            else:
-                print(f"🔄 Invoking Bedrock model: {MODEL_ID}")
 
-            response = bedrock_runtime.invoke_model(
-                modelId=MODEL_ID,
-                body=json.dumps(request_body)
-            )
-            break
-        except ClientError as e:
-            error_code = e.response['Error']['Code']
-
-            if error_code == 'ThrottlingException':
-                if attempt < max_retries - 1:
-                    delay = base_delay * (2 ** attempt)
-                    print(f"⚠️ Throttling detected. Waiting {delay}s before retry...")
-                    time.sleep(delay)
-                    continue
-                print("❌ Max retries reached after throttling")
-                raise
-            raise
+class InvalidJsonStream(ValueError):
+    """
+    El stream de Bedrock dejó de ser un objeto JSON válido.
+    """
 
-    try:
-        response_body = json.loads(response['body'].read())
 
-        content = response_body.get('content', [])
-        if not content:
-            raise ValueError("Empty response from Bedrock")
+class IncrementalJsonParser:
+    """
+    Parser incremental del objeto JSON que genera Claude.
+    Valida la estructura carácter a carácter (strings, escapes, anidamiento),
+    expone los campos escalares de primer nivel apenas se completan y marca
+    el objeto como terminado al cerrar la llave raíz.
+    """
+
+    def __init__(self, preamble_max=BEDROCK_JSON_PREAMBLE_MAX):
+        self.preamble_max = preamble_max
+        self.preamble = 0
+        self.chars = []
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.string_start = None
+        self.expect_key = False
+        self.current_key = None
+        self.value_start = None
+        self.headers = {}
+        self.done = False
+
+    def feed(self, text):
+        """
+        Procesa un fragmento; retorna los campos de cabecera nuevos.
+        Lanza InvalidJsonStream si el texto ya no puede ser un JSON válido.
+        """
+        new_headers = {}
+        for char in text:
+            if self.done:
+                break
+            if not self.stack:
+                if char == '{':
+                    self.stack.append('}')
+                    self.chars.append(char)
+                    self.expect_key = True
+                    continue
+                self.preamble += 1
+                if self.preamble > self.preamble_max:
+                    raise InvalidJsonStream("No JSON object at start of response")
+                continue
+
+            position = len(self.chars)
+            self.chars.append(char)
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    if len(self.stack) == 1:
+                        self._top_level_string(position, new_headers)
+                elif char in '\n\r':
+                    raise InvalidJsonStream("Unescaped newline inside JSON string")
+                continue
+
+            if char == '"':
+                self.in_string = True
+                self.string_start = position
+            elif char in '{[':
+                self.stack.append('}' if char == '{' else ']')
+            elif char in '}]':
+                if char != self.stack[-1]:
+                    raise InvalidJsonStream(f"Unexpected '{char}' at offset {position}")
+                self.stack.pop()
+                if not self.stack:
+                    self._close_top_level_value(position, new_headers)
+                    self.done = True
+            elif len(self.stack) == 1:
+                if char == ':':
+                    self.expect_key = False
+                    self.value_start = position + 1
+                elif char == ',':
+                    self._close_top_level_value(position, new_headers)
+                    self.expect_key = True
+        return new_headers
+
+    def _decode(self, raw):
+        try:
+            return json.loads(raw)
+        except ValueError as err:
+            raise InvalidJsonStream(f"Invalid JSON value: {raw[:50]}") from err
+
+    def _top_level_string(self, position, new_headers):
+        value = self._decode(''.join(self.chars[self.string_start:position + 1]))
+        if self.expect_key:
+            self.current_key = value
+        elif self.current_key is not None:
+            new_headers[self.current_key] = value
+            self.headers[self.current_key] = value
+            self.current_key = None
+
+    def _close_top_level_value(self, position, new_headers):
+        # Números, booleanos y null de primer nivel (los strings ya se registraron)
+        key, self.current_key = self.current_key, None
+        if key is None or self.value_start is None:
+            return
+        raw = ''.join(self.chars[self.value_start:position]).strip()
+        if not raw or raw[0] in '{["':
+            return
+        value = self._decode(raw)
+        new_headers[key] = value
+        self.headers[key] = value
+
+    @property
+    def text(self):
+        return ''.join(self.chars)
+
+
+def read_bedrock_response(model_id, request_body):
+    """
+    Llamada no streaming; retorna los argumentos de la llamada a la herramienta
+    de extracción (ya estructurados).
+    """
+    response = get_client('bedrock-runtime').invoke_model(
+        modelId=model_id,
+        body=serialize_request_body(request_body)
+    )
+    response_body = json.loads(response['body'].read())
+    log_bedrock_usage(response_body)
+
+    for block in response_body.get('content', []):
+        if block.get('type') == 'tool_use' and block.get('name') == INVOICE_TOOL_NAME:
+            return block.get('input') or {}
+    raise ValueError(f"No {INVOICE_TOOL_NAME} call in Bedrock response (stop_reason={response_body.get('stop_reason')})")
 
-        response_text = content[0].get('text', '')
 
-        print(f"📝 Claude response length: {len(response_text)} chars")
+def stream_bedrock_response(model_id, request_body):
+    """
+    Llamada con invoke_model_with_response_stream: parsea los argumentos de la
+    herramienta (input_json_delta) a medida que llegan, corta el stream apenas
+    dejan de ser JSON válido y registra time-to-first-byte y tiempo total.
+    """
+    started = time.monotonic()
+    first_byte_at = None
+    parser = IncrementalJsonParser()
+    usage = {}
+    stop_reason = None
+
+    response = get_client('bedrock-runtime').invoke_model_with_response_stream(
+        modelId=model_id,
+        body=serialize_request_body(request_body)
+    )
+    stream = response['body']
+    try:
+        for event in stream:
+            if 'throttlingException' in event:
+                raise ClientError(
+                    {'Error': {'Code': 'ThrottlingException', 'Message': str(event['throttlingException'])}},
+                    'InvokeModelWithResponseStream'
+                )
+            if 'chunk' not in event:
+                error_type = next(iter(event), 'unknown')
+                raise ValueError(f"Bedrock stream error: {error_type} {event.get(error_type)}")
+
+            payload = json.loads(event['chunk']['bytes'])
+            payload_type = payload.get('type')
+            if payload_type == 'message_start':
+                usage.update(payload.get('message', {}).get('usage') or {})
+            elif payload_type == 'content_block_delta':
+                delta = payload.get('delta', {})
+                if delta.get('type') != 'input_json_delta':
+                    continue
+                text = delta.get('partial_json')
+                if not text:
+                    continue
+                if first_byte_at is None:
+                    first_byte_at = time.monotonic()
+                headers = parser.feed(text)
+                if headers:
+                    print(f"🧾 Header fields: {headers}")
+            elif payload_type == 'message_delta':
+                usage.update(payload.get('usage') or {})
+                stop_reason = payload.get('delta', {}).get('stop_reason')
+    except InvalidJsonStream as err:
+        print(f"🛑 Aborting Bedrock stream after {len(parser.text)} chars: {err}")
+        raise
+    finally:
+        close = getattr(stream, 'close', None)
+        if close:
+            close()
+        elapsed_ms = (time.monotonic() - started) * 1000
+        ttfb_ms = (first_byte_at - started) * 1000 if first_byte_at else None
+        print(
+            f"⏱️ Bedrock stream - TTFB: {f'{ttfb_ms:.0f}ms' if ttfb_ms is not None else 'n/a'}, "
+            f"total: {elapsed_ms:.0f}ms"
+        )
 
-        json_start = response_text.find('{')
-        json_end = response_text.rfind('}') + 1
+    if usage:
+        log_bedrock_usage({'usage': usage})
+    if not parser.done:
+        raise ValueError(f"Incomplete {INVOICE_TOOL_NAME} input from Claude (stop_reason={stop_reason})")
+    try:
+        return json.loads(parser.text)
+    except json.JSONDecodeError as e:
+        print(f"Response text: {parser.text[:1000]}")
+        raise ValueError(f"Invalid JSON from Claude: {str(e)}")
 
-        if json_start == -1 or json_end == 0:
-            print(f"⚠️ Response text: {response_text[:500]}")
-            raise ValueError("No JSON found in Claude response")
 
-        invoice_json = response_text[json_start:json_end]
-        invoice_data = json.loads(invoice_json)
+def invoke_bedrock(request_body, model_id=MODEL_ID):
+    """
+    Ejecuta la llamada a Bedrock bajo el rate limiter y retorna los datos de la
+    herramienta de extracción.
+    Ante throttling reduce la tasa compartida y difiere el trabajo (sin sleep).
+    """
+    acquire_bedrock_capacity()
+    print(f"🔄 Invoking Bedrock model: {model_id}{' (stream)' if BEDROCK_STREAMING else ''}")
 
-        print("✅ Successfully parsed invoice data")
-        print(f"📊 Items extracted: {len(invoice_data.get('items', []))}")
-        print(f"💰 Total: {invoice_data.get('montos', {}).get('total', 0)}")
+    # La espera por un cupo del contenedor se mide aparte: el span Bedrock
+    # solo cuenta la latencia del modelo
+    with span('BedrockQueue'):
+        bedrock_semaphore.acquire()
+    try:
+        with span('Bedrock'):
+            if BEDROCK_STREAMING:
+                invoice_data = stream_bedrock_response(model_id, request_body)
+            else:
+                invoice_data = read_bedrock_response(model_id, request_body)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ThrottlingException':
+            print("⚠️ Bedrock throttling detected; lowering shared rate")
+            bedrock_rate_limiter.record_throttle()
+            raise BedrockCapacityUnavailable(1.0 / max(BEDROCK_RATE_MIN, 0.001)) from e
+        raise
+    finally:
+        bedrock_semaphore.release()
 
-        validations = invoice_data.get('validaciones', {})
-        if validations.get('warnings'):
-            print(f"⚠️ Warnings: {validations['warnings']}")
-        if validations.get('errores'):
-            print(f"❌ Errors: {validations['errores']}")
+    bedrock_rate_limiter.record_success()
 
-        return invoice_data
+    print("✅ Successfully parsed invoice data")
+    print(f"📊 Items extracted: {len(invoice_data.get('items') or [])}")
+    print(f"💰 Total: {(invoice_data.get('montos') or {}).get('total', 0)}")
 
-    except json.JSONDecodeError as e:
-        print(f"❌ JSON parse error: {str(e)}")
-        print(f"Response text: {response_text[:1000]}")
-        raise ValueError(f"Invalid JSON from Claude: {str(e)}")
+    validations = invoice_data.get('validaciones') or {}
+    if validations.get('warnings'):
+        print(f"⚠️ Warnings: {validations['warnings']}")
+    if validations.get('errores'):
+        print(f"❌ Errors: {validations['errores']}")
 
-    except Exception as e:
-        print(f"❌ Bedrock invocation error: {str(e)}")
-        raise
+    return invoice_data
 
 
 def get_expert_prompt():
@@ -923,147 +2382,9 @@ Eres experto en:
 - Reglamento de Comprobantes de Pago (Resolución de Superintendencia N° 007-99/SUNAT)
 - Validación de documentos tributarios según estándares peruanos
 
-Tu tarea es analizar este comprobante electrónico peruano con máxima precisión y extraer TODOS los datos en formato JSON estructurado.
-
-ESTRUCTURA JSON REQUERIDA (retorna SOLO este JSON, sin texto adicional):
-
-{
-  "numeroFactura": "F006-0171739",
-  "serie": "F006",
-  "correlativo": "0171739",
-  "tipoComprobante": "FACTURA",
-  "fechaEmision": "2025-09-22",
-  "horaEmision": "10:30:00",
-  
-  "emisor": {
-    "tipoDocumento": "RUC",
-    "numeroDocumento": "20517482472",
-    "razonSocial": "CORPORACION LIDER PERU S.A.",
-    "nombreComercial": null,
-    "direccion": "Calle Leoncio Prado 446 - SURQUILLO - LIMA",
-    "ubigeo": null,
-    "departamento": "LIMA",
-    "provincia": "LIMA",
-    "distrito": "SURQUILLO",
-    "telefono": "924956748",
-    "email": "ventas@corporacionliderperu.com",
-    "web": "www.corporacionliderperu.com"
-  },
-  
-  "receptor": {
-    "tipoDocumento": "RUC",
-    "numeroDocumento": "20604163642",
-    "razonSocial": "EL HELADERO S.A.C.",
-    "direccion": "AV. MARISCAL ELOY URETA 185 URB. EL PINO",
-    "departamento": "LIMA",
-    "provincia": "LIMA",
-    "distrito": "SAN LUIS"
-  },
-  
-  "montos": {
-    "moneda": "PEN",
-    "tipoMoneda": "SOLES",
-    "subtotal": 1305.17,
-    "descuentoGlobal": 0.00,
-    "baseImponible": 1305.17,
-    "igv": 234.93,
-    "igvPorcentaje": 18.00,
-    "isc": 0.00,
-    "icbper": 0.00,
-    "otrosTributos": 0.00,
-    "percepcion": 0.96,
-    "percepcionPorcentaje": 2.00,
-    "retencion": 0.00,
-    "detraccion": 0.00,
-    "opGravadas": 1305.17,
-    "opExoneradas": 0.00,
-    "opInafectas": 0.00,
-    "opGratuitas": 0.00,
-    "anticipos": 0.00,
-    "redondeo": 0.00,
-    "total": 1540.10,
-    "montoTotal": 1541.06,
-    "totalLetras": "MIL QUINIENTOS CUARENTA Y 10/100 SOLES"
-  },
-  
-  "items": [
-    {
-      "linea": 1,
-      "codigo": "BEB0094",
-      "codigoSunat": null,
-      "cantidad": 6.000,
-      "unidadMedida": "UNI",
-      "descripcion": "CIELO AGUA MINERAL X 7 LT SIN GAS",
-      "valorUnitario": 6.78,
-      "precioUnitario": 8.00,
-      "descuento": 0.00,
-      "valorVenta": 40.68,
-      "igv": 7.32,
-      "icbper": 0.00,
-      "total": 48.00,
-      "tipoAfectacion": "GRAVADO"
-    }
-  ],
-  
-  "condiciones": {
-    "formaPago": "CONTADO",
-    "medioPago": "TRANSFERENCIA",
-    "plazoCredito": null,
-    "cuotas": null,
-    "vendedor": "CHRISTIAN",
-    "numeroPedido": "0006-2849",
-    "ordenCompra": null,
-    "guiaRemision": null,
-    "observaciones": "NO ACEPTAMOS DEVOLUCIONES NI CAMBIOS DESPUES DE 48 HORAS"
-  },
-  
-  "datosBancarios": [
-    {
-      "banco": "BCP",
-      "tipoCuenta": "CORRIENTE",
-      "moneda": "PEN",
-      "numeroCuenta": "194-2522444-0-31",
-      "cci": "002-19400252244403190",
-      "titular": "CORPORACION LIDER PERU SA"
-    },
-    {
-      "banco": "SCOTIABANK",
-      "tipoCuenta": "CORRIENTE",
-      "moneda": "PEN",
-      "numeroCuenta": "000-6309240",
-      "cci": "009-29000006309240-57",
-      "titular": "CORPORACION LIDER PERU SA"
-    }
-  ],
-  
-  "sunat": {
-    "codigoHash": null,
-    "firmaDigital": null,
-    "qr": null,
-    "urlConsulta": "https://cpe.facilerp.com/comprobantes/consultar/20517482472",
-    "sistemaEmision": "FACILERP",
-    "autorizacionSunat": "034-005-007244/SUNAT",
-    "agenteRetencion": true,
-    "resolucionAgenteRetencion": "R.S.186-2023",
-    "tipoOperacion": "VENTA_INTERNA",
-    "leyendas": [
-      "Operación Sujeta al 2.00% de Percepción del IGV"
-    ]
-  },
-  
-  "validaciones": {
-    "rucEmisorValido": true,
-    "rucReceptorValido": true,
-    "formatoNumeroFacturaValido": true,
-    "fechaValida": true,
-    "igvCalculoCorrecto": true,
-    "totalCalculoCorrecto": true,
-    "serieValida": true,
-    "todosItemsTienenCodigo": true,
-    "warnings": [],
-    "errores": []
-  }
-}
+Tu tarea es analizar este comprobante electrónico peruano con máxima precisión y extraer TODOS los datos.
+
+Registra los datos llamando a la herramienta registrar_comprobante; su esquema define la estructura completa.
 
 INSTRUCCIONES CRÍTICAS:
 
@@ -1125,37 +2446,288 @@ INSTRUCCIONES CRÍTICAS:
    - En validaciones.errores: problemas graves (ej: RUC inválido, total no cuadra)
 
 9. RESPUESTA:
-   - Retornar ÚNICAMENTE el JSON
-   - NO agregar texto explicativo antes o después
-   - NO usar markdown (```json)
-   - JSON válido y bien formateado
+   - Llamar UNA sola vez a registrar_comprobante con todos los campos
+   - Fechas de vencimiento y plazo van en condiciones (fechaVencimiento, plazoCredito)
 
 Analiza la factura con máximo rigor profesional y precisión contable.
 """
 
 
-def analyze_invoice_with_bedrock_document(file_bytes, media_type, extra_context=None, max_tokens=8000):
+EXTRACTION_INSTRUCTION = "Extrae los datos de este comprobante y regístralos con la herramienta registrar_comprobante."
+
+INVOICE_TOOL_NAME = 'registrar_comprobante'
+
+
+def nullable(type_name, **extra):
+    return {'type': [type_name, 'null'], **extra}
+
+
+def build_invoice_schema():
     """
-    Envía PDF o imagen a Claude via Bedrock y obtiene JSON estructurado.
+    Esquema JSON de la extracción (antes descrito con un ejemplo en el prompt).
+    """
+    number = nullable('number')
+    text = nullable('string')
+    party = {
+        'type': 'object',
+        'properties': {
+            'tipoDocumento': text,
+            'numeroDocumento': nullable('string', description='RUC de 11 dígitos o DNI'),
+            'razonSocial': text,
+            'nombreComercial': text,
+            'direccion': text,
+            'ubigeo': text,
+            'departamento': text,
+            'provincia': text,
+            'distrito': text,
+            'telefono': text,
+            'email': text,
+            'web': text
+        },
+        'required': ['numeroDocumento', 'razonSocial']
+    }
+    montos = {
+        field: number for field in (
+            'subtotal', 'descuentoGlobal', 'baseImponible', 'igv', 'igvPorcentaje', 'isc', 'icbper',
+            'otrosTributos', 'percepcion', 'percepcionPorcentaje', 'retencion', 'detraccion',
+            'opGravadas', 'opExoneradas', 'opInafectas', 'opGratuitas', 'anticipos', 'redondeo',
+            'total', 'montoTotal'
+        )
+    }
+    montos.update({
+        'moneda': nullable('string', description='Código ISO, ej. PEN o USD'),
+        'tipoMoneda': text,
+        'totalLetras': text
+    })
+    item = {
+        'type': 'object',
+        'properties': {
+            'linea': nullable('integer'),
+            'codigo': text,
+            'codigoSunat': text,
+            'cantidad': number,
+            'unidadMedida': text,
+            'descripcion': text,
+            'valorUnitario': number,
+            'precioUnitario': number,
+            'descuento': number,
+            'valorVenta': number,
+            'igv': number,
+            'icbper': number,
+            'total': number,
+            'tipoAfectacion': nullable('string', enum=['GRAVADO', 'EXONERADO', 'INAFECTO', 'GRATUITO', None])
+        }
+    }
+    cuenta = {
+        'type': 'object',
+        'properties': {
+            'banco': text,
+            'tipoCuenta': nullable('string', enum=['CORRIENTE', 'AHORRO', 'DETRACCION', None]),
+            'moneda': text,
+            'numeroCuenta': text,
+            'cci': text,
+            'titular': text
+        }
+    }
+    flags = {
+        field: nullable('boolean') for field in (
+            'rucEmisorValido', 'rucReceptorValido', 'formatoNumeroFacturaValido', 'fechaValida',
+            'igvCalculoCorrecto', 'totalCalculoCorrecto', 'serieValida', 'todosItemsTienenCodigo'
+        )
+    }
+    flags.update({
+        'warnings': {'type': 'array', 'items': {'type': 'string'}},
+        'errores': {'type': 'array', 'items': {'type': 'string'}}
+    })
+
+    return {
+        'type': 'object',
+        'properties': {
+            'numeroFactura': nullable('string', description='Serie-correlativo, ej. F006-0171739'),
+            'serie': text,
+            'correlativo': text,
+            'tipoComprobante': {
+                'type': 'string',
+                'enum': ['FACTURA', 'BOLETA', 'NOTA_CREDITO', 'NOTA_DEBITO', 'RECIBO_HONORARIOS', 'OTRO']
+            },
+            'fechaEmision': nullable('string', description='YYYY-MM-DD'),
+            'horaEmision': nullable('string', description='HH:MM:SS'),
+            'emisor': party,
+            'receptor': party,
+            'montos': {'type': 'object', 'properties': montos, 'required': ['moneda', 'total']},
+            'items': {'type': 'array', 'items': item},
+            'condiciones': {
+                'type': 'object',
+                'properties': {
+                    'formaPago': nullable('string', description='CONTADO o CREDITO'),
+                    'medioPago': text,
+                    'plazoCredito': nullable('integer', description='Días de crédito'),
+                    'fechaVencimiento': nullable('string', description='YYYY-MM-DD'),
+                    'cuotas': {'type': ['array', 'null']},
+                    'vendedor': text,
+                    'numeroPedido': text,
+                    'ordenCompra': text,
+                    'guiaRemision': text,
+                    'observaciones': text
+                }
+            },
+            'datosBancarios': {'type': 'array', 'items': cuenta},
+            'sunat': {
+                'type': 'object',
+                'properties': {
+                    'codigoHash': text,
+                    'firmaDigital': text,
+                    'qr': text,
+                    'urlConsulta': text,
+                    'sistemaEmision': text,
+                    'autorizacionSunat': text,
+                    'agenteRetencion': nullable('boolean'),
+                    'resolucionAgenteRetencion': text,
+                    'tipoOperacion': text,
+                    'leyendas': {'type': 'array', 'items': {'type': 'string'}}
+                }
+            },
+            'validaciones': {'type': 'object', 'properties': flags, 'required': ['warnings', 'errores']}
+        },
+        'required': [
+            'numeroFactura', 'tipoComprobante', 'fechaEmision', 'emisor', 'receptor',
+            'montos', 'items', 'validaciones'
+        ]
+    }
+
+
+@lru_cache(maxsize=None)
+def get_invoice_tool():
+    """
+    Definición de la herramienta; el esquema se arma en la primera llamada
+    a Bedrock, no al importar el módulo.
+    """
+    return {
+        'name': INVOICE_TOOL_NAME,
+        'description': 'Registra los datos extraídos de un comprobante electrónico peruano.',
+        'input_schema': build_invoice_schema()
+    }
+
+
+def build_tool_params():
     """
-    expert_prompt = get_expert_prompt()
+    Herramienta de extracción forzada: Claude responde con argumentos que ya
+    cumplen el esquema en lugar de texto JSON libre.
+    """
+    return {
+        'tools': [get_invoice_tool()],
+        'tool_choice': {'type': 'tool', 'name': INVOICE_TOOL_NAME}
+    }
+
+
+def build_system_prompt():
+    """
+    Prompt experto como bloque system cacheable: es idéntico en cada llamada,
+    así que va antes del contenido variable (documento / texto OCR).
+    """
+    return [
+        {
+            "type": "text",
+            "text": get_expert_prompt(),
+            "cache_control": {"type": "ephemeral"}
+        }
+    ]
+
 
+def build_user_prompt(extra_context=None):
     context_prefix = f"{extra_context}\n\n" if extra_context else ""
-    full_prompt = f"{context_prefix}{expert_prompt}"
-    media_type = (media_type or '').split(';', 1)[0].strip().lower()
-    if media_type in ALLOWED_IMAGE_MIME_TYPES:
-        content_type = "image"
-    elif media_type in ALLOWED_PDF_MIME_TYPES:
-        content_type = "document"
-    else:
-        raise ValueError(f"Tipo de archivo no soportado: {media_type}")
+    return f"{context_prefix}{EXTRACTION_INSTRUCTION}"
 
-    # Construir request para Bedrock
-    request_body = {
+
+def log_bedrock_usage(response_body):
+    """
+    Registra tokens consumidos, incluyendo lecturas/escrituras del prompt cache.
+    """
+    usage = response_body.get('usage') or {}
+    cache_read = usage.get('cache_read_input_tokens', 0) or 0
+    cache_write = usage.get('cache_creation_input_tokens', 0) or 0
+    print(
+        f"🧮 Tokens - input: {usage.get('input_tokens', 0)}, output: {usage.get('output_tokens', 0)}, "
+        f"cache read: {cache_read}, cache write: {cache_write} "
+        f"({'HIT' if cache_read else 'MISS'})"
+    )
+    return usage
+
+
+def serialize_request_body(request_body):
+    # Los requests de documento ya llegan serializados (build_document_request_body)
+    if isinstance(request_body, (bytes, bytearray)):
+        return request_body
+    return json.dumps(request_body)
+
+
+def iter_source_chunks(file_source, chunk_size=BASE64_CHUNK_SIZE):
+    """
+    Bloques del documento sin copiarlo entero: vistas sobre los bytes en
+    memoria o lecturas sucesivas del archivo temporal.
+    """
+    if isinstance(file_source, str):
+        with open(file_source, 'rb') as source:
+            for chunk in iter(lambda: source.read(chunk_size), b''):
+                yield chunk
+        return
+    view = memoryview(file_source)
+    for offset in range(0, len(view), chunk_size):
+        yield view[offset:offset + chunk_size]
+
+
+class RequestMemoryReservation:
+    """
+    Reserva memoria del presupuesto BEDROCK_REQUEST_MEMORY_BUDGET mientras un
+    cuerpo de request existe. Espera a que otras llamadas liberen memoria y
+    falla de inmediato si el request solo ya excede el presupuesto.
+    """
+
+    def __init__(self, size):
+        self.size = size
+
+    def __enter__(self):
+        global request_memory_in_use
+        if self.size > BEDROCK_REQUEST_MEMORY_BUDGET:
+            raise ValueError(
+                f"Bedrock request of {self.size / 1024 / 1024:.1f} MB exceeds memory budget "
+                f"({BEDROCK_REQUEST_MEMORY_BUDGET / 1024 / 1024:.0f} MB)"
+            )
+        with request_memory_condition:
+            while request_memory_in_use + self.size > BEDROCK_REQUEST_MEMORY_BUDGET:
+                request_memory_condition.wait()
+            request_memory_in_use += self.size
+        return self
+
+    def __exit__(self, *exc_info):
+        global request_memory_in_use
+        with request_memory_condition:
+            request_memory_in_use -= self.size
+            request_memory_condition.notify_all()
+        return False
+
+
+def build_document_request_body(file_source, media_type, content_type, extra_context=None, max_tokens=8000):
+    """
+    Serializa el request de documento/imagen en un único bytearray pre-dimensionado:
+    el JSON se arma con un marcador en "data" y el base64 se escribe por bloques
+    directamente en el buffer (sin str intermedio ni json.dumps del documento).
+
+    Retorna (write, body_size): body_size es el tamaño exacto del cuerpo,
+    calculado sin leer el archivo, y write(body) llena un bytearray de
+    exactamente body_size bytes y lo retorna (ValueError si no coincide).
+    El llamador reserva body_size con RequestMemoryReservation y recién
+    dentro de la reserva aloca el buffer y llama a write:
+        with RequestMemoryReservation(body_size):
+            body = write(bytearray(body_size))
+    """
+    skeleton = {
         "anthropic_version": "bedrock-2023-05-31",
         "max_tokens": max_tokens,
         "temperature": 0.1,  # Baja temperatura para mayor precisión
         "top_p": 0.9,
+        "system": build_system_prompt(),
+        **build_tool_params(),
         "messages": [
             {
                 "role": "user",
@@ -1165,50 +2737,146 @@ def analyze_invoice_with_bedrock_document(file_bytes, media_type, extra_context=
                         "source": {
                             "type": "base64",
                             "media_type": media_type,
-                            "data": base64.standard_b64encode(file_bytes).decode('utf-8')
+                            "data": DOCUMENT_DATA_PLACEHOLDER
                         }
                     },
                     {
                         "type": "text",
-                        "text": full_prompt
+                        "text": build_user_prompt(extra_context)
                     }
                 ]
             }
         ]
     }
-    return invoke_bedrock(request_body)
+    prefix, suffix = json.dumps(skeleton).encode('utf-8').split(DOCUMENT_DATA_PLACEHOLDER.encode('ascii'))
 
+    source_size = os.path.getsize(file_source) if isinstance(file_source, str) else len(file_source)
+    body_size = len(prefix) + 4 * ((source_size + 2) // 3) + len(suffix)
 
-def analyze_invoice_with_bedrock_text(context_text, max_tokens=4000):
+    def write(body):
+        position = len(prefix)
+        body[:position] = prefix
+        for chunk in iter_source_chunks(file_source):
+            encoded = binascii.b2a_base64(chunk, newline=False)
+            body[position:position + len(encoded)] = encoded
+            position += len(encoded)
+        body[position:] = suffix
+        if len(body) != body_size:
+            raise ValueError(f"Bedrock request size mismatch: {len(body)} != {body_size}")
+        return body
+
+    return write, body_size
+
+
+def analyze_invoice_with_bedrock_document(file_source, media_type, extra_context=None, max_tokens=8000):
     """
-    Envía solo texto OCR a Claude para reducir tokens.
+    Envía PDF o imagen a Claude via Bedrock y obtiene JSON estructurado.
+    file_source puede ser bytes o la ruta del archivo temporal del adjunto.
     """
-    context_prefix = f"{context_text}\n\n" if context_text else ""
-    expert_prompt = get_expert_prompt()
-    full_prompt = f"{context_prefix}{expert_prompt}"
+    media_type = (media_type or '').split(';', 1)[0].strip().lower()
+    if media_type in ALLOWED_IMAGE_MIME_TYPES:
+        content_type = "image"
+    elif media_type in ALLOWED_PDF_MIME_TYPES:
+        content_type = "document"
+    else:
+        raise ValueError(f"Tipo de archivo no soportado: {media_type}")
 
+    # Construir request para Bedrock
+    write_body, body_size = build_document_request_body(
+        file_source, media_type, content_type, extra_context=extra_context, max_tokens=max_tokens
+    )
+    with RequestMemoryReservation(body_size):
+        request_body = write_body(bytearray(body_size))
+        print(f"📦 Bedrock request body: {body_size / 1024 / 1024:.2f} MB")
+        return invoke_bedrock(request_body)
+
+
+def analyze_invoice_with_bedrock_text(context_text, max_tokens=4000, model_id=MODEL_ID):
+    """
+    Envía solo texto OCR a Claude para reducir tokens.
+    """
     request_body = {
         "anthropic_version": "bedrock-2023-05-31",
         "max_tokens": max_tokens,
         "temperature": 0.1,
         "top_p": 0.9,
+        "system": build_system_prompt(),
+        **build_tool_params(),
         "messages": [
             {
                 "role": "user",
                 "content": [
                     {
                         "type": "text",
-                        "text": full_prompt
+                        "text": build_user_prompt(context_text)
                     }
                 ]
             }
         ]
     }
 
-    return invoke_bedrock(request_body)
+    return invoke_bedrock(request_body, model_id=model_id)
+
+
+def get_escalation_reasons(invoice_data):
+    """
+    Chequeos locales sobre el resultado del modelo rápido; cualquier motivo
+    devuelto obliga a repetir la extracción con MODEL_ID.
+    """
+    reasons = []
+    ruc = str((invoice_data.get('emisor') or {}).get('numeroDocumento') or '').strip()
+    if not RUC_PATTERN.match(ruc):
+        reasons.append('ruc-emisor-faltante')
+    if (invoice_data.get('validaciones') or {}).get('totalCalculoCorrecto') is False:
+        reasons.append('total-incorrecto')
+    return reasons
+
+
+def analyze_invoice_text_tiered(context_text, max_tokens=4000):
+    """
+    Ruta de texto en dos niveles: FAST_MODEL_ID primero y MODEL_ID solo si el
+    resultado no es JSON válido, falla get_escalation_reasons o la llamada al
+    modelo rápido falla con un error que no es throttling.
+    Retorna (invoice_data, model_info) para registrar en procesamiento.
+    """
+    if not FAST_MODEL_ID or FAST_MODEL_ID == MODEL_ID:
+        invoice_data = analyze_invoice_with_bedrock_text(context_text, max_tokens=max_tokens)
+        return invoice_data, {'modelId': MODEL_ID, 'modelName': MODEL_NAME, 'modelTier': 'large'}
+
+    try:
+        invoice_data = analyze_invoice_with_bedrock_text(
+            context_text, max_tokens=max_tokens, model_id=FAST_MODEL_ID
+        )
+        reasons = get_escalation_reasons(invoice_data)
+    except ValueError as err:
+        reasons = ['json-invalido']
+        print(f"⚠️ Fast model output unusable: {err}")
+    except ClientError as err:
+        # ValidationException (contexto sobre el límite), AccessDenied o modelo
+        # no habilitado en la región: MODEL_ID puede resolverlo. El throttling
+        # ya llega como BedrockCapacityUnavailable (y se difiere el record)
+        if err.response.get('Error', {}).get('Code') == 'ThrottlingException':
+            raise
+        reasons = ['error-modelo-rapido']
+        print(f"⚠️ Fast model call failed: {err}")
+
+    if not reasons:
+        print(f"⚡ Fast tier accepted ({FAST_MODEL_ID})")
+        return invoice_data, {'modelId': FAST_MODEL_ID, 'modelName': FAST_MODEL_NAME, 'modelTier': 'fast'}
+
+    print(f"⬆️ Escalating to {MODEL_ID}: {', '.join(reasons)}")
+    invoice_data = analyze_invoice_with_bedrock_text(context_text, max_tokens=max_tokens)
+    return invoice_data, {
+        'modelId': MODEL_ID,
+        'modelName': MODEL_NAME,
+        'modelTier': 'large',
+        'escalado': True,
+        'motivosEscalado': reasons
+    }
 
 
-def build_item(client_id, invoice_data, bucket, key, file_size, sunat_validation=None, processing_overrides=None):
+def build_item(client_id, invoice_data, bucket, key, file_size, sunat_validation=None, processing_overrides=None,
+               content_hash=None, attachment_info=None):
     """
     Build DynamoDB item from Claude's structured response
     Includes SUNAT validation data if provided
@@ -1283,7 +2951,8 @@ def build_item(client_id, invoice_data, bucket, key, file_size, sunat_validation
             's3Key': key,
             's3Url': f's3://{bucket}/{key}',
             'nombreArchivo': key.split('/')[-1],
-            'tamanoBytes': file_size
+            'tamanoBytes': file_size,
+            'sha256': content_hash
         },
         
         # Processing metadata
@@ -1291,7 +2960,8 @@ def build_item(client_id, invoice_data, bucket, key, file_size, sunat_validation
             'status': 'processed',
             'motor': 'bedrock-claude',
             'modelId': MODEL_ID,
-            'modelName': 'Claude 3.5 Sonnet v2',
+            'modelName': MODEL_NAME,
+            'modelTier': 'large',
             'confidence': 'high',
             'timestampProcesado': datetime.utcnow().isoformat() + 'Z',
             'warnings': invoice_data.get('validaciones', {}).get('warnings', []),
@@ -1327,6 +2997,8 @@ def build_item(client_id, invoice_data, bucket, key, file_size, sunat_validation
 
     if processing_overrides:
         item['procesamiento'].update(processing_overrides)
+    if attachment_info:
+        item['archivo'].update(attachment_info)
     
     return item
 
@@ -5,7 +5,6 @@ Trigger: SQS Queue (invoice-processing-retry-poc)
 """
 
 import json
-import boto3
 import base64
 import time
 import os
@@ -13,12 +12,6 @@ from datetime import datetime
 from decimal import Decimal
 from botocore.exceptions import ClientError
 
-# AWS Clients
-s3 = boto3.client('s3')
-bedrock_runtime = boto3.client('bedrock-runtime', region_name='us-east-1')
-dynamodb = boto3.resource('dynamodb')
-sqs = boto3.client('sqs')
-
 # Configuration
 TABLE_NAME = 'Facturas-dev'
 MODEL_ID = 'anthropic.claude-3-5-sonnet-20240620-v1:0'
@@ -26,8 +19,22 @@ MAX_RETRIES = 5
 INITIAL_BACKOFF = 1  # segundos
 BASE_PREFIX = os.environ.get('BASE_PREFIX', '').strip().strip('/')
 
-# DynamoDB table
-table = dynamodb.Table(TABLE_NAME)
+# AWS Clients (se crean en el primer uso)
+_clients = {}
+
+
+def get_client(service_name, **kwargs):
+    if service_name not in _clients:
+        import boto3
+        _clients[service_name] = boto3.client(service_name, **kwargs)
+    return _clients[service_name]
+
+
+def get_table():
+    if 'table' not in _clients:
+        import boto3
+        _clients['table'] = boto3.resource('dynamodb').Table(TABLE_NAME)
+    return _clients['table']
 
 
 def lambda_handler(event, context):
@@ -154,7 +161,7 @@ def download_pdf_from_s3(bucket, key):
     Descarga PDF desde S3
     """
     try:
-        response = s3.get_object(Bucket=bucket, Key=key)
+        response = get_client('s3').get_object(Bucket=bucket, Key=key)
         pdf_data = response['Body'].read()
         print(f"📦 Downloaded PDF: {len(pdf_data)} bytes")
         return pdf_data
@@ -249,7 +256,7 @@ Estructura requerida:
 
     print(f"🤖 Invoking Claude (attempt {attempt})...")
 
-    response = bedrock_runtime.invoke_model(
+    response = get_client('bedrock-runtime', region_name='us-east-1').invoke_model(
         modelId=MODEL_ID,
         body=json.dumps(request_body)
     )
@@ -340,5 +347,5 @@ def save_to_dynamodb(client_id, invoice_data, bucket, key):
         }
     }
 
-    table.put_item(Item=item)
+    get_table().put_item(Item=item)
     print(f"💾 Saved to DynamoDB: {invoice_id}")
@@ -5,23 +5,36 @@ Flow: S3 PDF → Textract → DynamoDB
 """
 
 import json
-import boto3
 import os
 import re
 from datetime import datetime
 from decimal import Decimal
 from urllib.parse import unquote_plus
 
-# AWS Clients
-s3_client = boto3.client('s3')
-textract_client = boto3.client('textract')
-dynamodb = boto3.resource('dynamodb')
-
 # Environment variables
 TABLE_NAME = os.environ.get('DYNAMODB_TABLE', 'Facturas-dev')
-table = dynamodb.Table(TABLE_NAME)
 BASE_PREFIX = os.environ.get('BASE_PREFIX', '').strip().strip('/')
 
+# AWS Clients (se crean en la primera invocación)
+_textract_client = None
+_table = None
+
+
+def get_textract_client():
+    global _textract_client
+    if _textract_client is None:
+        import boto3
+        _textract_client = boto3.client('textract')
+    return _textract_client
+
+
+def get_table():
+    global _table
+    if _table is None:
+        import boto3
+        _table = boto3.resource('dynamodb').Table(TABLE_NAME)
+    return _table
+
 
 def extract_client_id(s3_key: str) -> str:
     parts = (s3_key or '').split('/')
@@ -52,7 +65,7 @@ def lambda_handler(event, context):
         # 3. Call Textract to analyze invoice
         print("🔍 Calling Textract AnalyzeExpense...")
         
-        textract_response = textract_client.analyze_expense(
+        textract_response = get_textract_client().analyze_expense(
             Document={
                 'S3Object': {
                     'Bucket': bucket,
@@ -72,7 +85,7 @@ def lambda_handler(event, context):
         
         # 6. Save to DynamoDB
         print("💾 Saving to DynamoDB...")
-        table.put_item(Item=dynamo_item)
+        get_table().put_item(Item=dynamo_item)
         
         print(f"✅ SUCCESS - Invoice ID: {dynamo_item['invoiceId']}")
         
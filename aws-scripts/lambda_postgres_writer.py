@@ -5,7 +5,6 @@ Trigger: Invocado por lambda_claude.py después de procesar factura
 
 Dependencies (requirements.txt):
 - psycopg2-binary
-- boto3
 """
 
 import json
@@ -13,8 +12,6 @@ import os
 import psycopg2
 from psycopg2.extras import Json
 from datetime import datetime, timedelta
-import boto3
-from botocore.exceptions import ClientError
 import re
 
 # Environment variables
@@ -1,15 +1,24 @@
+import json
 import os
 import re
+import threading
+import time
 from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 from typing import Any, Dict, Optional, Tuple
 
-import boto3
-import urllib3
-
+import sunat_client
+from sunat_client import build_invoice_data, should_validate
 
 TABLE_NAME = os.environ.get('DYNAMODB_TABLE', 'Facturas-dev')
 REGION = os.environ.get('AWS_REGION', 'us-east-1')
+# GSI disperso (sunatRetryBucket, sunatNextRetryAt): solo items con reintento agendado
+RETRY_INDEX_NAME = os.environ.get('SUNAT_RETRY_INDEX', 'GSI3-SunatRetryIndex')
+# Días hacia atrás que se revisan (buckets de vencimiento atrasados)
+RETRY_LOOKBACK_DAYS = int(os.environ.get('SUNAT_RETRY_LOOKBACK_DAYS', '7'))
+# Días que revisa la recuperación ({"catchUpRetryIndex": true}): vencimientos
+# más viejos que RETRY_LOOKBACK_DAYS (p. ej. tras una caída larga del barrido)
+RETRY_CATCHUP_DAYS = int(os.environ.get('SUNAT_RETRY_CATCHUP_DAYS', '365'))
 
 MAX_ITEMS = int(os.environ.get('SUNAT_RETRY_MAX_ITEMS', '100'))
 MAX_RETRIES = int(os.environ.get('SUNAT_RETRY_MAX_ATTEMPTS', '5'))
@@ -19,19 +28,54 @@ BACKOFF_MINUTES = [
     if value.strip()
 ]
 
-RETRYABLE_STATUSES = {'ERROR_TOKEN', 'ERROR_API', 'ERROR_EXCEPCION', 'NO_VALIDADO'}
+# PENDIENTE: guardada por lambda_claude con la validación en cola. El barrido
+# solo la toma pasado SUNAT_PENDING_GRACE_MINUTES (el mensaje pudo perderse).
+RETRYABLE_STATUSES = sunat_client.RETRY_STATUSES
+SUNAT_PENDING_GRACE_MINUTES = sunat_client.RETRY_PENDING_GRACE_MINUTES
+# Consultas por segundo a SUNAT por invocación en la etapa de cola y en el
+# barrido (multiplicar por la concurrencia máxima del event source mapping)
+SUNAT_VALIDATION_RATE = float(os.environ.get('SUNAT_VALIDATION_RATE', '5'))
+# Consultas en curso a la vez por invocación (cliente asyncio)
+SUNAT_VALIDATION_CONCURRENCY = int(os.environ.get('SUNAT_VALIDATION_CONCURRENCY', '10'))
 NON_RETRY_STATUSES = {'INVALIDO', 'VALIDO', 'DATOS_INCOMPLETOS'}
 RETRYABLE_HTTP = {429, 500, 502, 503, 504}
 
-SUNAT_CLIENT_ID = os.environ.get('SUNAT_CLIENT_ID')
-SUNAT_CLIENT_SECRET = os.environ.get('SUNAT_CLIENT_SECRET')
-SUNAT_RUC = os.environ.get('SUNAT_RUC')
+# Clientes creados en la primera invocación (cold start más corto)
+_dynamodb = None
+_table = None
+# Cliente asyncio por thread (queda ligado al loop de sunat_async.run)
+_thread_local = threading.local()
+
+
+def get_dynamodb():
+    global _dynamodb
+    if _dynamodb is None:
+        import boto3
+        _dynamodb = boto3.resource('dynamodb', region_name=REGION)
+    return _dynamodb
+
+
+def get_table():
+    global _table
+    if _table is None:
+        _table = get_dynamodb().Table(TABLE_NAME)
+    return _table
 
-http = urllib3.PoolManager()
-sunat_token_cache = {'token': None, 'expires_at': None}
 
-dynamodb = boto3.resource('dynamodb', region_name=REGION)
-table = dynamodb.Table(TABLE_NAME)
+def get_async_client():
+    """
+    Cliente asyncio del contenedor: sus conexiones keep-alive se reutilizan
+    entre invocaciones. asyncio se importa en la primera validación.
+    """
+    client = getattr(_thread_local, 'async_client', None)
+    if client is None:
+        import sunat_async
+        client = _thread_local.async_client = sunat_async.AsyncSunatClient(
+            concurrency=SUNAT_VALIDATION_CONCURRENCY,
+            rate=SUNAT_VALIDATION_RATE,
+            prescreen=False
+        )
+    return client
 
 
 def convert_to_decimal(obj: Any) -> Any:
@@ -73,278 +117,13 @@ def extract_http_code(text: str) -> Optional[int]:
     return None
 
 
-def get_sunat_token() -> Optional[str]:
-    if not SUNAT_CLIENT_ID or not SUNAT_CLIENT_SECRET:
-        return None
-
-    now = datetime.now().timestamp()
-    if sunat_token_cache['token'] and sunat_token_cache['expires_at']:
-        if now < sunat_token_cache['expires_at']:
-            return sunat_token_cache['token']
-
-    url = (
-        f"https://api-seguridad.sunat.gob.pe/v1/clientesextranet/"
-        f"{SUNAT_CLIENT_ID}/oauth2/token/"
-    )
-    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-    body = urllib3.request.urlencode(
-        {
-            'grant_type': 'client_credentials',
-            'scope': 'https://api.sunat.gob.pe/v1/contribuyente/contribuyentes',
-            'client_id': SUNAT_CLIENT_ID,
-            'client_secret': SUNAT_CLIENT_SECRET,
-        }
-    )
-
-    response = http.request('POST', url, headers=headers, body=body)
-    if response.status != 200:
-        return None
-
-    data = response.data.decode('utf-8')
-    token_data = eval_json(data)
-    token = token_data.get('access_token')
-    expires_in = token_data.get('expires_in', 3600)
-    sunat_token_cache['token'] = token
-    sunat_token_cache['expires_at'] = now + expires_in - 60
-    return token
-
-
 def eval_json(raw: str) -> Dict[str, Any]:
     try:
-        import json
         return json.loads(raw)
     except Exception:
         return {}
 
 
-def validate_invoice_with_sunat(invoice_data: Dict[str, Any]) -> Dict[str, Any]:
-    estados_comprobante = {
-        '0': 'NO EXISTE - Comprobante no informado',
-        '1': 'ACEPTADO - Comprobante aceptado',
-        '2': 'ANULADO - Comunicado en una baja',
-        '3': 'AUTORIZADO - Con autorizacion de imprenta',
-        '4': 'NO AUTORIZADO - No autorizado por imprenta',
-    }
-
-    estados_ruc = {
-        '00': 'ACTIVO',
-        '01': 'BAJA PROVISIONAL',
-        '02': 'BAJA PROV. POR OFICIO',
-        '03': 'SUSPENSION TEMPORAL',
-        '10': 'BAJA DEFINITIVA',
-        '11': 'BAJA DE OFICIO',
-        '22': 'INHABILITADO-VENT.UNICA',
-    }
-
-    condiciones_domicilio = {
-        '00': 'HABIDO',
-        '09': 'PENDIENTE',
-        '11': 'POR VERIFICAR',
-        '12': 'NO HABIDO',
-        '20': 'NO HALLADO',
-    }
-
-    if not SUNAT_RUC:
-        return {
-            'validado': False,
-            'estado': 'NO_VALIDADO',
-            'motivo': 'Credenciales SUNAT no configuradas',
-            'estadoSunat': None,
-            'timestampValidacion': datetime.utcnow().isoformat() + 'Z',
-        }
-
-    token = get_sunat_token()
-    if not token:
-        return {
-            'validado': False,
-            'estado': 'ERROR_TOKEN',
-            'motivo': 'No se pudo obtener token de SUNAT',
-            'estadoSunat': None,
-            'timestampValidacion': datetime.utcnow().isoformat() + 'Z',
-        }
-
-    ruc_emisor = invoice_data.get('emisor', {}).get('numeroDocumento')
-    numero_factura = invoice_data.get('numeroFactura', '')
-    serie = invoice_data.get('serie', '')
-    correlativo = invoice_data.get('correlativo', '')
-    fecha_emision = invoice_data.get('fechaEmision', '')
-    monto_total = invoice_data.get('montos', {}).get('total', 0)
-
-    tipo_comprobante = invoice_data.get('tipoComprobante', 'FACTURA')
-    codigo_comprobante = '01' if tipo_comprobante == 'FACTURA' else '03'
-
-    if not ruc_emisor or not numero_factura:
-        return {
-            'validado': False,
-            'estado': 'DATOS_INCOMPLETOS',
-            'motivo': 'Faltan datos requeridos (RUC o numero de factura)',
-            'estadoSunat': None,
-            'timestampValidacion': datetime.utcnow().isoformat() + 'Z',
-        }
-
-    if fecha_emision and '-' in fecha_emision:
-        parts = fecha_emision.split('-')
-        if len(parts) == 3:
-            fecha_sunat = f"{parts[2]}/{parts[1]}/{parts[0]}"
-        else:
-            fecha_sunat = fecha_emision
-    else:
-        fecha_sunat = fecha_emision
-
-    url = f"https://api.sunat.gob.pe/v1/contribuyente/contribuyentes/{SUNAT_RUC}/validarcomprobante"
-    headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
-
-    try:
-        numero_int = int(correlativo) if correlativo else 0
-    except Exception:
-        numero_int = 0
-
-    body = {
-        'numRuc': ruc_emisor,
-        'codComp': codigo_comprobante,
-        'numeroSerie': serie,
-        'numero': numero_int,
-        'fechaEmision': fecha_sunat,
-        'monto': float(monto_total) if monto_total is not None else 0,
-    }
-
-    import json
-    response = http.request('POST', url, headers=headers, body=json.dumps(body))
-
-    if response.status != 200:
-        return {
-            'validado': False,
-            'estado': 'ERROR_API',
-            'motivo': f'Error al consultar SUNAT: HTTP {response.status}',
-            'estadoSunat': None,
-            'timestampValidacion': datetime.utcnow().isoformat() + 'Z',
-            'errorDetalle': response.data.decode('utf-8'),
-        }
-
-    data = eval_json(response.data.decode('utf-8'))
-    if not data.get('success'):
-        return {
-            'validado': False,
-            'estado': 'ERROR_API',
-            'motivo': data.get('message', 'Error desconocido de SUNAT'),
-            'estadoSunat': None,
-            'timestampValidacion': datetime.utcnow().isoformat() + 'Z',
-            'errorDetalle': response.data.decode('utf-8'),
-        }
-
-    response_data = data.get('data', {})
-    estado_cp = response_data.get('estadoCp', '')
-    estado_ruc = response_data.get('estadoRuc', '')
-    condicion_domicilio = response_data.get('condDomiRuc', '')
-    observaciones = response_data.get('observaciones', [])
-
-    desc_comprobante = estados_comprobante.get(estado_cp, f'Codigo desconocido: {estado_cp}')
-    desc_ruc = estados_ruc.get(estado_ruc, f'Codigo desconocido: {estado_ruc}')
-    desc_domicilio = condiciones_domicilio.get(
-        condicion_domicilio, f'Codigo desconocido: {condicion_domicilio}'
-    )
-
-    es_valido = estado_cp in ['1', '0'] and estado_ruc == '00'
-
-    return {
-        'validado': True,
-        'esValido': es_valido,
-        'estado': 'VALIDO' if es_valido else 'INVALIDO',
-        'motivo': 'Comprobante validado exitosamente'
-        if es_valido
-        else 'Comprobante no valido en SUNAT',
-        'estadoSunat': {
-            'estadoComprobante': {'codigo': estado_cp, 'descripcion': desc_comprobante},
-            'estadoRuc': {'codigo': estado_ruc, 'descripcion': desc_ruc},
-            'condicionDomicilio': {
-                'codigo': condicion_domicilio,
-                'descripcion': desc_domicilio,
-            },
-            'observaciones': observaciones,
-        },
-        'timestampValidacion': datetime.utcnow().isoformat() + 'Z',
-    }
-
-
-def parse_serie_correlativo(invoice_data: Dict[str, Any]) -> None:
-    if invoice_data.get('serie') and invoice_data.get('correlativo'):
-        return
-
-    numero_factura = (invoice_data.get('numeroFactura') or '').strip().upper()
-    if not numero_factura:
-        return
-
-    match = re.match(r'^([A-Z0-9]{1,4})[- ]?0*([0-9]{1,12})$', numero_factura)
-    if not match:
-        return
-
-    invoice_data.setdefault('serie', match.group(1))
-    invoice_data.setdefault('correlativo', match.group(2))
-
-
-def build_invoice_data(item: Dict[str, Any]) -> Dict[str, Any]:
-    data = item.get('data') if isinstance(item.get('data'), dict) else {}
-    invoice_data: Dict[str, Any] = dict(data)
-
-    invoice_data.setdefault('emisor', {})
-    invoice_data.setdefault('receptor', {})
-    invoice_data.setdefault('montos', {})
-
-    if not invoice_data.get('numeroFactura') and item.get('numeroFactura'):
-        invoice_data['numeroFactura'] = item.get('numeroFactura')
-    if not invoice_data.get('fechaEmision') and item.get('fechaEmision'):
-        invoice_data['fechaEmision'] = item.get('fechaEmision')
-    if not invoice_data.get('tipoComprobante') and item.get('tipoComprobante'):
-        invoice_data['tipoComprobante'] = item.get('tipoComprobante')
-
-    if not invoice_data['emisor'].get('numeroDocumento') and item.get('emisorRUC'):
-        invoice_data['emisor']['numeroDocumento'] = str(item.get('emisorRUC'))
-    if not invoice_data['emisor'].get('razonSocial') and item.get('emisorRazonSocial'):
-        invoice_data['emisor']['razonSocial'] = item.get('emisorRazonSocial')
-
-    if not invoice_data['receptor'].get('numeroDocumento') and item.get('receptorRUC'):
-        invoice_data['receptor']['numeroDocumento'] = str(item.get('receptorRUC'))
-    if not invoice_data['receptor'].get('razonSocial') and item.get('receptorRazonSocial'):
-        invoice_data['receptor']['razonSocial'] = item.get('receptorRazonSocial')
-
-    if invoice_data['montos'].get('total') is None and item.get('total') is not None:
-        invoice_data['montos']['total'] = item.get('total')
-    if not invoice_data['montos'].get('moneda') and item.get('moneda'):
-        invoice_data['montos']['moneda'] = item.get('moneda')
-
-    parse_serie_correlativo(invoice_data)
-    return invoice_data
-
-
-def should_validate(invoice_data: Dict[str, Any]) -> Tuple[bool, str]:
-    ruc_emisor = invoice_data.get('emisor', {}).get('numeroDocumento')
-    numero_factura = invoice_data.get('numeroFactura')
-    fecha_emision = invoice_data.get('fechaEmision')
-    total = invoice_data.get('montos', {}).get('total')
-    serie = invoice_data.get('serie')
-    correlativo = invoice_data.get('correlativo')
-
-    if not ruc_emisor or not numero_factura:
-        return False, 'missing_ruc_or_numero'
-    if not fecha_emision:
-        return False, 'missing_fecha'
-    if total is None:
-        return False, 'missing_total'
-
-    try:
-        if float(total) <= 0:
-            return False, 'total_zero'
-    except Exception:
-        return False, 'invalid_total'
-
-    if not serie or not correlativo:
-        return False, 'missing_serie_correlativo'
-    if not str(correlativo).isdigit():
-        return False, 'invalid_correlativo'
-
-    return True, 'ok'
-
-
 def should_retry(item: Dict[str, Any]) -> Tuple[bool, str]:
     sunat = item.get('validacionSunat') or {}
     estado = sunat.get('estado') or 'NO_VALIDADO'
@@ -415,129 +194,421 @@ def update_item(
     }
 
     if next_retry_at:
-        expression += ', sunatNextRetryAt = :n'
+        expression += ', sunatNextRetryAt = :n, sunatRetryBucket = :b'
         values[':n'] = next_retry_at
+        values[':b'] = sunat_client.retry_bucket(next_retry_at)
     else:
-        expression += ' REMOVE sunatNextRetryAt'
+        # Sale del índice de reintentos
+        expression += ' REMOVE sunatNextRetryAt, sunatRetryBucket'
 
-    table.update_item(
+    get_table().update_item(
         Key=key,
         UpdateExpression=expression,
         ExpressionAttributeValues=values,
     )
 
 
-def handler(event, context):
-    processed = 0
-    scanned = 0
-    last_key = None
+def clear_retry_schedule(key: Dict[str, Any]) -> None:
+    """
+    Saca del índice un item que ya no necesita reintento (p. ej. validado
+    por validate_sunat_batch).
+    """
+    get_table().update_item(Key=key, UpdateExpression='REMOVE sunatNextRetryAt, sunatRetryBucket')
 
-    while processed < MAX_ITEMS:
-        scan_kwargs: Dict[str, Any] = {}
-        if last_key:
-            scan_kwargs['ExclusiveStartKey'] = last_key
-        scan_kwargs['Limit'] = min(200, MAX_ITEMS - processed)
 
-        response = table.scan(**scan_kwargs)
-        items = response.get('Items', [])
-        scanned += len(items)
+def pending_grace_elapsed(sunat: Dict[str, Any]) -> bool:
+    queued_at = parse_iso_datetime(sunat.get('timestampEncolado') or '')
+    if not queued_at:
+        return True
+    return now_utc() >= queued_at + timedelta(minutes=SUNAT_PENDING_GRACE_MINUTES)
 
-        for item in items:
-            if processed >= MAX_ITEMS:
-                break
 
-            key = {
-                'clientId': item.get('clientId'),
-                'invoiceId': item.get('invoiceId'),
-            }
-            if not key['clientId'] or not key['invoiceId']:
-                continue
+def mark_incomplete(key: Dict[str, Any], retry_count: int) -> Dict[str, Any]:
+    result = sunat_client.build_result('DATOS_INCOMPLETOS', 'Faltan datos requeridos (RUC o numero de factura)')
+    new_count, new_next, error_code, error_msg = build_retry_metadata(
+        retry_count,
+        result,
+        False,
+    )
+    update_item(key, result, new_count, new_next, error_code, error_msg)
+    return result
 
-            sunat = item.get('validacionSunat') or {}
-            estado = sunat.get('estado') or 'NO_VALIDADO'
 
-            if estado in {'VALIDO', 'INVALIDO'}:
-                continue
+def validate_many(invoices: list) -> list:
+    """
+    Consultas a SUNAT concurrentes (acotadas y al ritmo configurado) con el
+    cliente asyncio. El padrón ya se consultó en la ingesta (lambda_claude):
+    un emisor no activo nunca llega a la cola ni al barrido.
+    """
+    import sunat_async
+    return sunat_async.run(get_async_client().validate_many(invoices))
 
-            retry_allowed, reason = should_retry(item)
-            retry_count = int(item.get('sunatRetryCount', 0) or 0)
 
-            if retry_count >= MAX_RETRIES:
-                retry_allowed = False
-                reason = 'max_retries'
+def record_result(key: Dict[str, Any], result: Dict[str, Any], retry_count: int) -> None:
+    if result.get('circuitoAbierto'):
+        # No se consultó SUNAT: no cuenta como intento; se reagenda para
+        # cuando el breaker deje pasar una consulta
+        update_item(key, result, retry_count, result.get('reintentarDesde'), 'CIRCUIT_OPEN', result.get('motivo'))
+        return
+
+    allow_retry = result.get('estado') in RETRYABLE_STATUSES
+
+    if result.get('estado') == 'ERROR_API':
+        code = extract_http_code(result.get('motivo', '') or '')
+        if code == 422:
+            allow_retry = False
+
+    if result.get('estado') in {'VALIDO', 'INVALIDO'}:
+        retry_count = 0
+
+    new_count, new_next, error_code, error_msg = build_retry_metadata(
+        retry_count,
+        result,
+        allow_retry,
+    )
+    update_item(key, result, new_count, new_next, error_code, error_msg)
+
+
+def batch_get_items(keys: list) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    """
+    Lee las facturas de un batch de la cola en lotes de 100 claves. Lectura
+    consistente: el mensaje se envía justo después del put_item y una lectura
+    eventual podría no ver el item todavía (el mensaje se perdería).
+    """
+    items: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for start in range(0, len(keys), 100):
+        request = {TABLE_NAME: {'Keys': keys[start:start + 100], 'ConsistentRead': True}}
+        for attempt in range(5):
+            response = get_dynamodb().batch_get_item(RequestItems=request)
+            for item in response.get('Responses', {}).get(TABLE_NAME, []):
+                items[(item['PK'], item['SK'])] = item
+            request = response.get('UnprocessedKeys') or {}
+            if not request:
+                break
+            time.sleep(0.1 * (2 ** attempt))
+    return items
 
-            next_retry_at = item.get('sunatNextRetryAt')
-            due_at = parse_iso_datetime(next_retry_at) if next_retry_at else None
-            if due_at and now_utc() < due_at:
-                continue
 
+def parse_validation_message(record: Dict[str, Any]) -> Optional[Dict[str, str]]:
+    body = eval_json(record.get('body') or '')
+    message = body.get('sunatValidation') or {}
+    if not message.get('PK') or not message.get('SK'):
+        return None
+    return {'PK': message['PK'], 'SK': message['SK']}
+
+
+def handle_validation_queue(records: list) -> Dict[str, Any]:
+    """
+    Etapa de validación asíncrona: mensajes de lambda_claude con la clave de
+    una factura guardada como PENDIENTE. Las consultas van por el cliente
+    asyncio: hasta SUNAT_VALIDATION_CONCURRENCY en curso y
+    SUNAT_VALIDATION_RATE por segundo. Los errores transitorios de SUNAT
+    quedan con sunatNextRetryAt para el barrido programado; solo los
+    errores propios (p. ej. DynamoDB) devuelven el mensaje a la cola.
+    """
+    keys = {}
+    failures = []
+    for record in records:
+        key = parse_validation_message(record)
+        if key is None:
+            print(f"⚠️ Ignoring malformed validation message {record.get('messageId')}")
+            continue
+        keys[record['messageId']] = key
+
+    unique_keys = list({(key['PK'], key['SK']): key for key in keys.values()}.values())
+    try:
+        items = batch_get_items(unique_keys)
+    except Exception as e:
+        print(f"❌ Error reading invoices: {str(e)}")
+        return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in keys]}
+
+    validated = set()
+    pending = []
+    summary: Dict[str, int] = {}
+
+    for message_id, key in keys.items():
+        item_key = (key['PK'], key['SK'])
+        item = items.get(item_key)
+        if item is None:
+            # Clave que quedó en UnprocessedKeys tras los reintentos (o item
+            # borrado): el mensaje vuelve a la cola y termina en la DLQ
+            print(f"⚠️ Invoice not found: {item_key}")
+            failures.append({'itemIdentifier': message_id})
+            continue
+        if item_key in validated:
+            continue
+
+        sunat = item.get('validacionSunat') or {}
+        estado = sunat.get('estado') or 'NO_VALIDADO'
+        if estado not in RETRYABLE_STATUSES:
+            # Ya validada (mensaje duplicado o el barrido llegó antes)
+            continue
+
+        validated.add(item_key)
+        try:
+            retry_count = int(item.get('sunatRetryCount', 0) or 0)
             invoice_data = build_invoice_data(item)
-            can_validate, validate_reason = should_validate(invoice_data)
-            if not can_validate:
-                result = {
-                    'validado': False,
-                    'estado': 'DATOS_INCOMPLETOS',
-                    'motivo': 'Faltan datos requeridos (RUC o numero de factura)',
-                    'estadoSunat': None,
-                    'timestampValidacion': datetime.utcnow().isoformat() + 'Z',
-                }
-                new_count, new_next, error_code, error_msg = build_retry_metadata(
-                    retry_count,
-                    result,
-                    False,
-                )
-                update_item(key, result, new_count, new_next, error_code, error_msg)
-                processed += 1
+            can_validate, _ = should_validate(invoice_data)
+            if can_validate:
+                pending.append((message_id, key, retry_count, invoice_data))
                 continue
+            result = mark_incomplete(key, retry_count)
+            summary[result['estado']] = summary.get(result['estado'], 0) + 1
+        except Exception as e:
+            print(f"❌ Error validating {item_key}: {str(e)}")
+            failures.append({'itemIdentifier': message_id})
+
+    # Las escrituras en DynamoDB siguen en este thread
+    if pending:
+        outcomes = validate_many([invoice_data for _, _, _, invoice_data in pending])
+        for (message_id, key, retry_count, _), outcome in zip(pending, outcomes):
+            try:
+                record_result(key, outcome.result, retry_count)
+                summary[outcome.estado] = summary.get(outcome.estado, 0) + 1
+            except Exception as e:
+                print(f"❌ Error saving validation {(key['PK'], key['SK'])}: {str(e)}")
+                failures.append({'itemIdentifier': message_id})
+
+    print(f"📊 SUNAT validation batch: {summary}, {len(failures)} failed")
+    return {'batchItemFailures': failures}
+
+
+def iter_due_entries(bucket: str, now_iso: str, limit: Optional[int] = None):
+    """
+    Entradas del índice (claves de la tabla y del GSI) vencidas en un bucket,
+    como máximo `limit` (None: todas).
+    """
+    found = 0
+    last_key = None
+    while limit is None or found < limit:
+        query_kwargs: Dict[str, Any] = {
+            'IndexName': RETRY_INDEX_NAME,
+            'KeyConditionExpression': 'sunatRetryBucket = :b AND sunatNextRetryAt <= :now',
+            'ExpressionAttributeValues': {':b': bucket, ':now': now_iso},
+            'Limit': 200 if limit is None else min(200, limit - found),
+        }
+        if last_key:
+            query_kwargs['ExclusiveStartKey'] = last_key
+        response = get_table().query(**query_kwargs)
+        for entry in response.get('Items', []):
+            yield entry
+            found += 1
+        last_key = response.get('LastEvaluatedKey')
+        if not last_key:
+            break
 
-            if not retry_allowed and estado in NON_RETRY_STATUSES:
-                continue
 
-            if not retry_allowed:
-                result = sunat or {
-                    'validado': False,
-                    'estado': estado,
-                    'motivo': sunat.get('motivo', ''),
-                    'estadoSunat': sunat.get('estadoSunat'),
-                    'timestampValidacion': datetime.utcnow().isoformat() + 'Z',
-                }
-                new_count, new_next, error_code, error_msg = build_retry_metadata(
-                    retry_count,
-                    result,
-                    False,
-                )
-                update_item(key, result, new_count, new_next, error_code, error_msg)
-                processed += 1
-                continue
+def iter_due_keys(now: datetime, limit: int):
+    """
+    Claves con reintento vencido, del día más antiguo (RETRY_LOOKBACK_DAYS)
+    a hoy: un Query por shard de cada bucket diario. El índice solo proyecta
+    las claves; lee tanto como el backlog, no la tabla.
+    """
+    now_iso = isoformat_z(now)
+    found = 0
+    for days_ago in range(RETRY_LOOKBACK_DAYS, -1, -1):
+        day = isoformat_z(now - timedelta(days=days_ago))[:10]
+        for bucket in sunat_client.retry_buckets(day):
+            for entry in iter_due_entries(bucket, now_iso, limit - found):
+                yield {'PK': entry['PK'], 'SK': entry['SK']}
+                found += 1
+            if found >= limit:
+                return
+
+
+def reschedule_now(key: Dict[str, Any], bucket: Optional[str], now_iso: str) -> bool:
+    """
+    Mueve el reintento a un bucket de hoy (vencido ya: lo toma el próximo
+    barrido). Con bucket, solo si el item sigue en él (no pisa un reintento
+    que se reagendó mientras tanto).
+    """
+    kwargs: Dict[str, Any] = {
+        'Key': key,
+        'UpdateExpression': 'SET sunatNextRetryAt = :n, sunatRetryBucket = :b',
+        'ExpressionAttributeValues': {':n': now_iso, ':b': sunat_client.retry_bucket(now_iso)},
+    }
+    if bucket:
+        kwargs['ConditionExpression'] = 'sunatRetryBucket = :old'
+        kwargs['ExpressionAttributeValues'][':old'] = bucket
+    try:
+        get_table().update_item(**kwargs)
+    except Exception as e:
+        if sunat_client.error_code(e) == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+
+def catch_up_retry_index(days: int) -> Dict[str, Any]:
+    """
+    Recuperación de vencimientos que quedaron fuera de la ventana del
+    barrido (más viejos que RETRY_LOOKBACK_DAYS, hasta `days` atrás): se
+    reagendan para ahora y el barrido normal los procesa a su ritmo.
+    Se programa una vez al día con {"catchUpRetryIndex": true}.
+    """
+    now = now_utc()
+    now_iso = isoformat_z(now)
+    moved = 0
+    for days_ago in range(max(days, RETRY_LOOKBACK_DAYS), RETRY_LOOKBACK_DAYS, -1):
+        day = isoformat_z(now - timedelta(days=days_ago))[:10]
+        for bucket in sunat_client.retry_buckets(day):
+            # Se consulta completo antes de mover: las escrituras no alteran la paginación
+            entries = list(iter_due_entries(bucket, now_iso))
+            for entry in entries:
+                if reschedule_now({'PK': entry['PK'], 'SK': entry['SK']}, bucket, now_iso):
+                    moved += 1
+    print(f"📇 SUNAT retry index catch-up: {moved} overdue retries rescheduled")
+    return {'statusCode': 200, 'body': {'rescheduled': moved, 'days': days, 'table': TABLE_NAME}}
+
+
+def retry_item(key: Dict[str, Any], item: Dict[str, Any]) -> Optional[Tuple[Dict[str, Any], int]]:
+    """
+    Procesa un item vencido del índice. Retorna (invoice_data, retry_count)
+    si hay que consultar SUNAT, None si solo se actualizó o se descartó.
+    """
+    sunat = item.get('validacionSunat') or {}
+    estado = sunat.get('estado') or 'NO_VALIDADO'
 
-            result = validate_invoice_with_sunat(invoice_data)
-            allow_retry = result.get('estado') in RETRYABLE_STATUSES
+    if estado in {'VALIDO', 'INVALIDO'}:
+        clear_retry_schedule(key)
+        return None
 
-            if result.get('estado') == 'ERROR_API':
-                code = extract_http_code(result.get('motivo', '') or '')
-                if code == 422:
-                    allow_retry = False
+    retry_allowed, _ = should_retry(item)
+    retry_count = int(item.get('sunatRetryCount', 0) or 0)
 
-            if result.get('estado') in {'VALIDO', 'INVALIDO'}:
-                retry_count = 0
+    if retry_count >= MAX_RETRIES:
+        retry_allowed = False
 
-            new_count, new_next, error_code, error_msg = build_retry_metadata(
-                retry_count,
-                result,
-                allow_retry,
-            )
-            update_item(key, result, new_count, new_next, error_code, error_msg)
-            processed += 1
+    if estado == 'PENDIENTE' and not pending_grace_elapsed(sunat):
+        return None
+
+    invoice_data = build_invoice_data(item)
+    can_validate, _ = should_validate(invoice_data)
+    if not can_validate:
+        mark_incomplete(key, retry_count)
+        return None
+
+    if not retry_allowed and estado in NON_RETRY_STATUSES:
+        clear_retry_schedule(key)
+        return None
+
+    if not retry_allowed:
+        result = sunat or {
+            'validado': False,
+            'estado': estado,
+            'motivo': sunat.get('motivo', ''),
+            'estadoSunat': sunat.get('estadoSunat'),
+            'timestampValidacion': datetime.utcnow().isoformat() + 'Z',
+        }
+        new_count, new_next, error_code, error_msg = build_retry_metadata(
+            retry_count,
+            result,
+            False,
+        )
+        update_item(key, result, new_count, new_next, error_code, error_msg)
+        return None
+
+    return invoice_data, retry_count
 
+
+def backfill_retry_index() -> Dict[str, Any]:
+    """
+    Carga inicial del índice: agenda los items pendientes o con error
+    reintentable que se guardaron antes de existir sunatRetryBucket, los de
+    buckets sin shard (RETRY#YYYY-MM-DD) y los que vencieron antes de la
+    ventana del barrido. Un vencimiento pasado se agenda para ahora.
+    Se invoca una vez con {"backfillRetryIndex": true}.
+    """
+    now = now_utc()
+    window_start = isoformat_z(now - timedelta(days=RETRY_LOOKBACK_DAYS))[:10]
+    scanned = 0
+    scheduled = 0
+    last_key = None
+    while True:
+        scan_kwargs: Dict[str, Any] = {
+            'ProjectionExpression': 'PK, SK, validacionSunat.estado, sunatNextRetryAt, sunatRetryBucket',
+        }
+        if last_key:
+            scan_kwargs['ExclusiveStartKey'] = last_key
+        response = get_table().scan(**scan_kwargs)
+        for item in response.get('Items', []):
+            scanned += 1
+            estado = (item.get('validacionSunat') or {}).get('estado') or 'NO_VALIDADO'
+            if estado not in RETRYABLE_STATUSES:
+                continue
+            bucket = item.get('sunatRetryBucket') or ''
+            if bucket.count('#') == 2 and bucket.split('#')[1] >= window_start:
+                # Ya en un bucket que el barrido revisa
+                continue
+            # max(existente, ahora): un vencimiento viejo iría a un bucket fuera de la ventana
+            next_retry = parse_iso_datetime(item.get('sunatNextRetryAt') or '')
+            next_retry_at = isoformat_z(max(next_retry, now) if next_retry else now)
+            get_table().update_item(
+                Key={'PK': item['PK'], 'SK': item['SK']},
+                UpdateExpression='SET sunatNextRetryAt = :n, sunatRetryBucket = :b',
+                ExpressionAttributeValues={':n': next_retry_at, ':b': sunat_client.retry_bucket(next_retry_at)},
+            )
+            scheduled += 1
         last_key = response.get('LastEvaluatedKey')
         if not last_key:
             break
+    print(f"📇 SUNAT retry index backfill: {scheduled} scheduled of {scanned} scanned")
+    return {'statusCode': 200, 'body': {'scanned': scanned, 'scheduled': scheduled, 'table': TABLE_NAME}}
+
+
+def handler(event, context):
+    records = (event or {}).get('Records') or []
+    if records and records[0].get('eventSource') == 'aws:sqs':
+        return handle_validation_queue(records)
+    if (event or {}).get('backfillRetryIndex'):
+        return backfill_retry_index()
+    if (event or {}).get('catchUpRetryIndex'):
+        return catch_up_retry_index(int(event.get('days') or RETRY_CATCHUP_DAYS))
+
+    breaker = sunat_client.get_breaker()
+    if breaker and breaker.is_open():
+        print("⛔ SUNAT circuit open, skipping retry sweep")
+        return {
+            'statusCode': 200,
+            'body': {'processed': 0, 'due': 0, 'table': TABLE_NAME, 'circuitOpen': True},
+        }
+
+    processed = 0
+    due = 0
+    circuit_open = False
+    keys = list(iter_due_keys(now_utc(), MAX_ITEMS))
+
+    # Solo los items vencidos se leen completos (batch_get en el orden del índice)
+    for start in range(0, len(keys), 100):
+        page = keys[start:start + 100]
+        items = batch_get_items(page)
+        pending = []
+        for key in page:
+            item = items.get((key['PK'], key['SK']))
+            if item is None:
+                continue
+            due += 1
+            processed += 1
+            retry = retry_item(key, item)
+            if retry:
+                pending.append((key, *retry))
+
+        if pending:
+            outcomes = validate_many([invoice_data for _, invoice_data, _ in pending])
+            for (key, _, retry_count), outcome in zip(pending, outcomes):
+                record_result(key, outcome.result, retry_count)
+                circuit_open = circuit_open or bool(outcome.result.get('circuitoAbierto'))
+        if circuit_open:
+            # SUNAT sigue caída: el resto del backlog espera al próximo barrido
+            break
 
+    print(f"📊 SUNAT retry sweep: {processed} processed, {due} due")
     return {
         'statusCode': 200,
         'body': {
             'processed': processed,
-            'scanned': scanned,
+            'due': due,
             'table': TABLE_NAME,
+            'circuitOpen': circuit_open,
         },
     }
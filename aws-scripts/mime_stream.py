@@ -0,0 +1,300 @@
+"""
+Parseo MIME en streaming para correos de SES (lambda_claude y
+extract-pdf-to-s3; se empaqueta junto al handler de cada Lambda).
+
+El correo se recorre por los delimitadores de cada multipart a medida que
+llegan los bloques de S3: el cuerpo de cada adjunto se decodifica (base64,
+quoted-printable o binario) directo a un Spool, que guarda en memoria hasta
+el umbral y pasa a un archivo en disco al superarlo. Ni el correo crudo ni
+el texto codificado de los adjuntos se acumulan en memoria; los cuerpos de
+las partes que no interesan se descartan sin decodificar.
+"""
+
+import binascii
+import io
+import os
+import tempfile
+from email import policy
+from email.parser import BytesHeaderParser
+
+# Una línea sin salto más larga que esto se procesa por partes (RFC 5322: 998)
+MAX_LINE_BYTES = 64 * 1024
+# Los cuerpos se decodifican en bloques de este tamaño (copias transitorias acotadas)
+DECODE_BLOCK_BYTES = 64 * 1024
+SIGNATURE_BYTES = 16
+BASE64_WHITESPACE = b' \t\r\n'
+
+HEADERS = 'headers'
+BODY = 'body'
+SKIP = 'skip'
+
+
+class Spool:
+    """
+    Destino de bytes que vive en memoria hasta `threshold` y luego en un
+    archivo de `directory` (NamedTemporaryFile, lo elimina discard()).
+    """
+
+    def __init__(self, threshold, directory=None, suffix=''):
+        self.threshold = threshold
+        self.directory = directory
+        self.suffix = suffix
+        self.size = 0
+        self.head = b''
+        self.path = None
+        self._buffer = io.BytesIO()
+        self._file = None
+
+    def write(self, data):
+        if not data:
+            return
+        if len(self.head) < SIGNATURE_BYTES:
+            self.head += bytes(data[:SIGNATURE_BYTES - len(self.head)])
+        self.size += len(data)
+        if self._file is None and self.size > self.threshold:
+            self._file = tempfile.NamedTemporaryFile(dir=self.directory, suffix=self.suffix, delete=False)
+            self.path = self._file.name
+            self._file.write(self._buffer.getbuffer())
+            self._buffer = None
+        (self._file or self._buffer).write(data)
+
+    def close(self):
+        if self._file is not None and not self._file.closed:
+            self._file.close()
+
+    def getvalue(self):
+        """
+        Bytes si el contenido quedó en memoria; None si está en disco (path).
+        """
+        return self._buffer.getvalue() if self._buffer is not None else None
+
+    def discard(self):
+        self.close()
+        self._buffer = None
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+
+class MimePart:
+    """
+    Parte hoja del correo: sus headers (EmailMessage sin cuerpo) y el Spool
+    con el contenido ya decodificado.
+    """
+
+    def __init__(self, headers, spool):
+        self.headers = headers
+        self.spool = spool
+
+    def get_content_type(self):
+        return self.headers.get_content_type()
+
+    def get_filename(self, failobj=None):
+        return self.headers.get_filename(failobj)
+
+    def get_content_disposition(self):
+        return self.headers.get_content_disposition()
+
+    @property
+    def size(self):
+        return self.spool.size
+
+
+class _BodyDecoder:
+    """
+    Decodifica el cuerpo de una parte por bloques de líneas completas. El
+    último salto de línea se retiene: pertenece al delimitador siguiente.
+    """
+
+    def __init__(self, encoding, spool):
+        self.encoding = encoding
+        self.spool = spool
+        self._pending = b''
+        self._newline = b''
+
+    def write(self, data):
+        if self.encoding == 'quoted-printable':
+            # Un bloque no puede cortar una secuencia '=XX' ni un salto suave
+            self._write(binascii.a2b_qp(bytes(data)))
+            return
+        for start in range(0, len(data), DECODE_BLOCK_BYTES):
+            block = bytes(data[start:start + DECODE_BLOCK_BYTES])
+            if self.encoding == 'base64':
+                self._write_base64(block)
+            else:
+                self._write(block)
+
+    def _write_base64(self, block):
+        block = block.translate(None, BASE64_WHITESPACE)
+        if self._pending:
+            block = self._pending + block
+        usable = len(block) - len(block) % 4
+        if usable:
+            self.spool.write(binascii.a2b_base64(block[:usable]))
+        self._pending = block[usable:]
+
+    def _write(self, data):
+        if self._newline:
+            self.spool.write(self._newline)
+            self._newline = b''
+        if data.endswith(b'\r\n'):
+            self._newline = b'\r\n'
+        elif data.endswith(b'\n'):
+            self._newline = b'\n'
+        self.spool.write(data[:len(data) - len(self._newline)] if self._newline else data)
+
+    def finish(self):
+        if self._pending:
+            try:
+                self.spool.write(binascii.a2b_base64(self._pending + b'=' * (-len(self._pending) % 4)))
+            except binascii.Error:
+                pass
+            self._pending = b''
+        self.spool.close()
+
+
+class StreamingMimeParser:
+    """
+    feed(bloque) ... close() -> lista de MimePart.
+
+    accept(headers) decide qué partes hoja se decodifican; el resto se
+    descarta. `headers` queda con los headers del mensaje raíz. Se siguen
+    multipart anidados y message/rfc822 adjuntos (correos reenviados).
+    """
+
+    def __init__(self, accept, spill_threshold, spill_dir=None):
+        self.accept = accept
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self.headers = None
+        self.parts = []
+        self._boundaries = []
+        self._state = HEADERS
+        self._header_lines = []
+        self._decoder = None
+        self._current = None
+        self._buffer = b''
+        self._mid_line = False
+
+    def feed(self, chunk):
+        data = self._buffer + chunk if self._buffer else bytes(chunk)
+        self._buffer = b''
+        pos = self._consume(data, 0)
+        self._buffer = data[pos:]
+
+    def close(self):
+        if self._buffer:
+            if self._state == HEADERS:
+                self._header_lines.append(self._buffer)
+            else:
+                self._emit(self._buffer)
+            self._buffer = b''
+        if self._state == HEADERS and (self._header_lines or self.headers is None):
+            # Mensaje o parte sin línea en blanco tras los headers (sin cuerpo)
+            self._end_headers()
+        self._finish_part()
+        return self.parts
+
+    # ---------- Máquina de estados ----------
+
+    def _consume(self, data, pos):
+        # Los cuerpos se pasan como memoryview: sin copiar el bloque leído
+        view = memoryview(data)
+        end = len(data)
+        while pos < end:
+            if self._mid_line:
+                newline = data.find(b'\n', pos)
+                stop = end if newline == -1 else newline + 1
+                self._emit(view[pos:stop])
+                self._mid_line = newline == -1
+                pos = stop
+                continue
+
+            if self._state == HEADERS or data.startswith(b'--', pos):
+                newline = data.find(b'\n', pos)
+                if newline == -1:
+                    if end - pos > MAX_LINE_BYTES and self._state != HEADERS:
+                        self._emit(view[pos:])
+                        self._mid_line = True
+                        return end
+                    return pos
+                line = data[pos:newline + 1]
+                pos = newline + 1
+                if self._boundaries and line.startswith(b'--') and self._boundary(line):
+                    continue
+                if self._state == HEADERS:
+                    if line in (b'\r\n', b'\n'):
+                        self._end_headers()
+                    else:
+                        self._header_lines.append(line)
+                else:
+                    self._emit(line)
+                continue
+
+            # Cuerpo: todo hasta la próxima línea que empiece con '--' va junto
+            candidate = data.find(b'\n--', pos) if self._boundaries else -1
+            if candidate != -1:
+                self._emit(view[pos:candidate + 1])
+                pos = candidate + 1
+                continue
+            last_newline = data.rfind(b'\n', pos)
+            if last_newline == -1:
+                if end - pos > MAX_LINE_BYTES:
+                    self._emit(view[pos:])
+                    self._mid_line = True
+                    return end
+                return pos
+            self._emit(view[pos:last_newline + 1])
+            pos = last_newline + 1
+        return pos
+
+    def _boundary(self, line):
+        marker = line.rstrip(b'\r\n').rstrip(b' \t')
+        for level in range(len(self._boundaries) - 1, -1, -1):
+            delimiter = self._boundaries[level]
+            if marker == delimiter or marker == delimiter + b'--':
+                self._finish_part()
+                del self._boundaries[level + 1:]
+                if marker == delimiter:
+                    self._state = HEADERS
+                    self._header_lines = []
+                else:
+                    del self._boundaries[level]
+                    self._state = SKIP
+                return True
+        return False
+
+    def _end_headers(self):
+        headers = BytesHeaderParser(policy=policy.default).parsebytes(b''.join(self._header_lines))
+        self._header_lines = []
+        if self.headers is None:
+            self.headers = headers
+
+        encoding = str(headers.get('content-transfer-encoding', '')).strip().lower()
+        if headers.get_content_maintype() == 'multipart' and headers.get_boundary():
+            self._boundaries.append(b'--' + headers.get_boundary().encode('utf-8', 'surrogateescape'))
+            self._state = SKIP
+        elif headers.get_content_type() == 'message/rfc822' and encoding not in ('base64', 'quoted-printable'):
+            # Correo adjunto: su cuerpo empieza con otro bloque de headers
+            self._state = HEADERS
+        else:
+            self._state = BODY
+            if self.accept(headers):
+                suffix = os.path.splitext(headers.get_filename('') or '')[1][:16]
+                spool = Spool(self.spill_threshold, self.spill_dir, suffix=suffix)
+                self._current = MimePart(headers, spool)
+                self._decoder = _BodyDecoder(encoding, spool)
+
+    def _emit(self, data):
+        if self._state == BODY and self._decoder is not None:
+            self._decoder.write(data)
+
+    def _finish_part(self):
+        if self._decoder is not None:
+            self._decoder.finish()
+            self.parts.append(self._current)
+        self._decoder = None
+        self._current = None
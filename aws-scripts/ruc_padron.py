@@ -0,0 +1,354 @@
+"""
+Índice offline del padrón reducido de RUC de SUNAT
+
+El padrón (padron_reducido_ruc.zip, ~10M filas separadas por '|') se
+convierte en un archivo binario ordenado por RUC, con registros de ancho fijo
+que se consultan por búsqueda binaria sobre un mmap: unos microsegundos por
+consulta y sin cargar el archivo en memoria.
+
+Formato del índice:
+    MAGIC (8 bytes) | largo del header (uint32 BE) | header JSON | registros
+    registro = RUC (5 bytes BE) | índice de estado (1) | índice de condición (1)
+El header guarda las etiquetas de estado / condición tal como vienen en el
+padrón, la cantidad de registros y la fecha de generación.
+
+Uso:
+    python ruc_padron.py import padron_reducido_ruc.zip -o padron.idx
+    python ruc_padron.py import padron_reducido_ruc.zip -o padron.idx --upload s3://bucket/padron/padron.idx
+    python ruc_padron.py lookup padron.idx 20100070970 20601234567
+    python ruc_padron.py bench padron.idx --lookups 100000
+
+En las Lambdas: RUC_PADRON_PATH (archivo local) o RUC_PADRON_S3_URI (se
+descarga a /tmp en el primer uso del contenedor).
+"""
+
+import argparse
+import bisect
+import io
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zipfile
+from array import array
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional
+
+MAGIC = b'RUCIDX01'
+RECORD_SIZE = 7
+RUC_BYTES = 5
+MAX_LABELS = 255
+ESTADO_ACTIVO = 'ACTIVO'
+CONDICION_HABIDO = 'HABIDO'
+# Índices más antiguos que esto se reportan al abrirlos (SUNAT publica a diario)
+STALE_AFTER_DAYS = 7
+
+PADRON_PATH = os.environ.get('RUC_PADRON_PATH')
+PADRON_S3_URI = os.environ.get('RUC_PADRON_S3_URI')
+PADRON_LOCAL_COPY = os.environ.get('RUC_PADRON_LOCAL_COPY', '/tmp/ruc_padron.idx')
+
+_index = None
+_index_loaded = False
+_index_lock = threading.Lock()
+
+
+@dataclass
+class RucStatus:
+    ruc: str
+    estado: str
+    condicion: str
+
+    @property
+    def activo(self) -> bool:
+        return self.estado == ESTADO_ACTIVO
+
+    @property
+    def habido(self) -> bool:
+        return self.condicion == CONDICION_HABIDO
+
+
+class _Keys:
+    """
+    Vista de solo los RUC del mmap para bisect (sin copiar registros).
+    """
+
+    def __init__(self, buffer, offset: int, count: int):
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        start = self.offset + position * RECORD_SIZE
+        return self.buffer[start:start + RUC_BYTES]
+
+
+class RucIndex:
+    """
+    Índice abierto (mmap de solo lectura). lookup() retorna RucStatus o
+    None si el RUC no figura en el padrón.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} no es un índice de padrón RUC")
+        header_size = struct.unpack_from('>I', self._mmap, len(MAGIC))[0]
+        header_start = len(MAGIC) + 4
+        self.header = json.loads(self._mmap[header_start:header_start + header_size].decode('utf-8'))
+        self.count = self.header['count']
+        self.estados = self.header['estados']
+        self.condiciones = self.header['condiciones']
+        self._data_offset = header_start + header_size
+        self._keys = _Keys(self._mmap, self._data_offset, self.count)
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, ruc) -> Optional[RucStatus]:
+        ruc = str(ruc or '').strip()
+        if len(ruc) != 11 or not ruc.isdigit():
+            return None
+        key = int(ruc).to_bytes(RUC_BYTES, 'big')
+        position = bisect.bisect_left(self._keys, key)
+        if position >= self.count or self._keys[position] != key:
+            return None
+        start = self._data_offset + position * RECORD_SIZE + RUC_BYTES
+        return RucStatus(ruc, self.estados[self._mmap[start]], self.condiciones[self._mmap[start + 1]])
+
+    def age_days(self) -> Optional[float]:
+        try:
+            generated = datetime.fromisoformat(self.header['generadoEn'].replace('Z', ''))
+        except (KeyError, ValueError):
+            return None
+        return (datetime.utcnow() - generated).total_seconds() / 86400
+
+    def close(self) -> None:
+        if getattr(self, '_mmap', None) is not None:
+            self._mmap.close()
+        self._file.close()
+
+
+# ---------- Acceso desde las Lambdas ----------
+
+def download_index(s3_uri: str, destination: str) -> str:
+    import boto3
+    bucket, _, key = s3_uri[len('s3://'):].partition('/')
+    partial = f"{destination}.part"
+    boto3.client('s3').download_file(bucket, key, partial)
+    os.replace(partial, destination)
+    return destination
+
+
+def get_index() -> Optional[RucIndex]:
+    """
+    Índice del contenedor (se abre o descarga en el primer uso). Retorna
+    None si no está configurado o no se pudo abrir: la validación sigue
+    contra la API de SUNAT.
+    """
+    global _index, _index_loaded
+    if _index_loaded:
+        return _index
+    with _index_lock:
+        if _index_loaded:
+            return _index
+        try:
+            path = PADRON_PATH
+            if not path and PADRON_S3_URI:
+                path = PADRON_LOCAL_COPY
+                if not os.path.exists(path):
+                    print(f"⬇️ Downloading RUC padrón index from {PADRON_S3_URI}")
+                    download_index(PADRON_S3_URI, path)
+            if path:
+                _index = RucIndex(path)
+                age = _index.age_days()
+                print(f"📇 RUC padrón index loaded: {len(_index)} RUCs")
+                if age is not None and age > STALE_AFTER_DAYS:
+                    print(f"⚠️ RUC padrón index is {age:.0f} days old")
+        except Exception as e:
+            print(f"⚠️ RUC padrón index unavailable: {str(e)}")
+            _index = None
+        _index_loaded = True
+    return _index
+
+
+def lookup(ruc) -> Optional[RucStatus]:
+    index = get_index()
+    return index.lookup(ruc) if index else None
+
+
+# ---------- Importador ----------
+
+def open_padron(path: str) -> io.TextIOBase:
+    """
+    Acepta el .zip publicado por SUNAT o el .txt ya extraído (latin-1).
+    """
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        name = next(n for n in archive.namelist() if n.lower().endswith('.txt'))
+        return io.TextIOWrapper(archive.open(name), encoding='latin-1', newline='')
+    return open(path, encoding='latin-1', newline='')
+
+
+def label_index(labels: List[str], positions: Dict[str, int], label: str) -> int:
+    position = positions.get(label)
+    if position is None:
+        if len(labels) >= MAX_LABELS:
+            raise ValueError(f"Demasiadas etiquetas distintas en el padrón ({label!r})")
+        position = positions[label] = len(labels)
+        labels.append(label)
+    return position
+
+
+def build_index(source: str, output: str, progress_every: int = 1_000_000) -> Dict:
+    """
+    Lee el padrón y escribe el índice ordenado en `output` (reemplazo
+    atómico). Cada registro se acumula como un entero de 64 bits
+    (RUC << 16 | estado << 8 | condición) en un array compacto.
+    """
+    estados: List[str] = []
+    condiciones: List[str] = []
+    estado_positions: Dict[str, int] = {}
+    condicion_positions: Dict[str, int] = {}
+    records = array('Q')
+    skipped = 0
+    ordered = True
+    last = -1
+    started = time.monotonic()
+
+    with open_padron(source) as padron:
+        next(padron, None)  # encabezado
+        for line_number, line in enumerate(padron, start=2):
+            fields = line.split('|', 4)
+            ruc = fields[0].strip()
+            if len(fields) < 4 or len(ruc) != 11 or not ruc.isdigit():
+                skipped += 1
+                continue
+            estado = label_index(estados, estado_positions, fields[2].strip().upper())
+            condicion = label_index(condiciones, condicion_positions, fields[3].strip().upper())
+            value = (int(ruc) << 16) | (estado << 8) | condicion
+            ordered = ordered and value >= last
+            last = value
+            records.append(value)
+            if progress_every and line_number % progress_every == 0:
+                print(f"  {line_number:,} filas ({time.monotonic() - started:.0f}s)")
+
+    if not ordered:
+        # El padrón suele venir ordenado; si no, se ordena en memoria (~40 B por
+        # fila). Orden estable por RUC: entre repetidos se conserva el del archivo
+        records = array('Q', sorted(records, key=lambda value: value >> 16))
+
+    # RUC repetido: gana la última fila
+    unique = array('Q')
+    for value in records:
+        if unique and unique[-1] >> 16 == value >> 16:
+            unique[-1] = value
+        else:
+            unique.append(value)
+
+    header = json.dumps({
+        'version': 1,
+        'count': len(unique),
+        'recordSize': RECORD_SIZE,
+        'estados': estados,
+        'condiciones': condiciones,
+        'fuente': os.path.basename(source),
+        'generadoEn': datetime.utcnow().isoformat() + 'Z'
+    }, ensure_ascii=False).encode('utf-8')
+
+    partial = f"{output}.part"
+    with open(partial, 'wb') as out:
+        out.write(MAGIC)
+        out.write(struct.pack('>I', len(header)))
+        out.write(header)
+        buffer = bytearray()
+        for value in unique:
+            buffer += (value >> 16).to_bytes(RUC_BYTES, 'big')
+            buffer.append((value >> 8) & 0xFF)
+            buffer.append(value & 0xFF)
+            if len(buffer) >= 1 << 20:
+                out.write(buffer)
+                buffer.clear()
+        out.write(buffer)
+    os.replace(partial, output)
+
+    return {
+        'rucs': len(unique),
+        'duplicados': len(records) - len(unique),
+        'filasOmitidas': skipped,
+        'estados': estados,
+        'condiciones': condiciones,
+        'bytes': os.path.getsize(output),
+        'segundos': round(time.monotonic() - started, 1)
+    }
+
+
+def upload_index(path: str, s3_uri: str) -> None:
+    import boto3
+    bucket, _, key = s3_uri[len('s3://'):].partition('/')
+    boto3.client('s3').upload_file(path, bucket, key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Índice offline del padrón reducido de RUC")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('import', help="Generar el índice desde el padrón (.zip o .txt)")
+    build.add_argument('source')
+    build.add_argument('-o', '--output', default='ruc_padron.idx')
+    build.add_argument('--upload', help="Subir el índice a s3://bucket/key (RUC_PADRON_S3_URI)")
+
+    query = commands.add_parser('lookup', help="Consultar RUCs en un índice")
+    query.add_argument('index')
+    query.add_argument('rucs', nargs='+')
+
+    bench = commands.add_parser('bench', help="Medir el tiempo por consulta")
+    bench.add_argument('index')
+    bench.add_argument('--lookups', type=int, default=100000)
+
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        summary = build_index(args.source, args.output)
+        print(json.dumps(summary, indent=2, ensure_ascii=False))
+        if args.upload:
+            upload_index(args.output, args.upload)
+            print(f"☁️ Subido a {args.upload}")
+        return
+
+    index = RucIndex(args.index)
+    if args.command == 'lookup':
+        for ruc in args.rucs:
+            status = index.lookup(ruc)
+            if status is None:
+                print(f"{ruc}: no figura en el padrón")
+            else:
+                flag = '✅' if status.activo else '❌'
+                print(f"{ruc}: {status.estado} / {status.condicion} {flag}")
+        return
+
+    # bench: RUCs presentes (leídos del propio índice) y ausentes, intercalados
+    import random
+    rng = random.Random(0)
+    present = [str(int.from_bytes(index._keys[rng.randrange(len(index))], 'big')) for _ in range(1000)]
+    absent = [str(rng.randrange(10**10, 10**11)) for _ in range(1000)]
+    sample = [present[i % 1000] if i % 2 else absent[i % 1000] for i in range(args.lookups)]
+    started = time.perf_counter()
+    for ruc in sample:
+        index.lookup(ruc)
+    elapsed = time.perf_counter() - started
+    print(f"{args.lookups} consultas en {elapsed:.3f}s → {elapsed / args.lookups * 1e6:.1f} µs/consulta "
+          f"({len(index)} RUCs, {os.path.getsize(args.index) / 1024 / 1024:.1f} MB)")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,431 @@
+"""
+Cliente SUNAT asíncrono (asyncio) para validaciones en volumen.
+
+Misma superficie que sunat_client.validate_invoice (comprobantes y recibos
+por honorarios), pero las consultas no ocupan un thread cada una:
+
+- Pool HTTP/1.1 keep-alive por host sobre asyncio streams (sin
+  dependencias: el runtime de Lambda no trae aiohttp).
+- Concurrencia acotada (semáforo) y timeout por consulta.
+- Ritmo con el TokenBucket de sunat_client y reintentos de 429/5xx
+  respetando Retry-After.
+- Resultados como ValidationResult; `.result` es el dict que se guarda en
+  validacionSunat.
+
+El token y la caché de resultados son los de sunat_client (tabla de
+control); esas lecturas de DynamoDB van a threads con asyncio.to_thread.
+La consulta del token a api-seguridad vuelve al loop y sale por el pool.
+
+Uso:
+    client = AsyncSunatClient(concurrency=200, rate=50)
+    results = sunat_async.run(client.validate_many(invoices))
+"""
+
+import asyncio
+import json
+import ssl
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import sunat_client
+from sunat_client import (
+    API_URL,
+    RETRYABLE_HTTP,
+    SUNAT_HTTP_TIMEOUT,
+    breaker_outcome,
+    build_result,
+    circuit_open_result,
+    parse_validation_response,
+    prepare_validation,
+    prescreen_emisor,
+    retry_delay
+)
+
+CONNECT_TIMEOUT_SECONDS = 3.0
+# El servidor suele cerrar conexiones ociosas antes; se descartan antes de usarlas
+IDLE_TIMEOUT_SECONDS = 30.0
+MAX_HEADER_LINES = 100
+
+# Loop persistente por thread: en Lambda las conexiones keep-alive
+# sobreviven entre invocaciones del mismo contenedor
+_thread_local = threading.local()
+
+
+def run(coro):
+    """
+    Ejecuta la corrutina en el loop del thread (se crea en el primer uso).
+    Un AsyncSunatClient queda ligado al loop en que se usó por primera vez.
+    """
+    loop = getattr(_thread_local, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = _thread_local.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coro)
+
+
+@dataclass
+class HTTPResponse:
+    status: int
+    headers: Dict[str, str]  # nombres en minúsculas
+    data: bytes
+
+
+@dataclass
+class ValidationResult:
+    """
+    Resultado de una validación. `result` tiene el formato de
+    sunat_client.validate_invoice (lo que se guarda en validacionSunat).
+    """
+    result: Dict[str, Any]
+    http_status: Optional[int] = None
+    attempts: int = 0
+    elapsed_ms: float = 0.0
+
+    @property
+    def estado(self) -> str:
+        return self.result.get('estado', '')
+
+    @property
+    def from_cache(self) -> bool:
+        return bool(self.result.get('desdeCache'))
+
+    @property
+    def is_error(self) -> bool:
+        return self.estado.startswith('ERROR')
+
+
+class _Connection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.idle_since = time.monotonic()
+
+    def usable(self) -> bool:
+        return (
+            not self.writer.is_closing()
+            and not self.reader.at_eof()
+            and time.monotonic() - self.idle_since < IDLE_TIMEOUT_SECONDS
+        )
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class AsyncConnectionPool:
+    """
+    Conexiones keep-alive por (host, puerto, TLS), como máximo
+    max_per_host abiertas a la vez por host.
+    """
+
+    def __init__(self, max_per_host: int = 10):
+        self.max_per_host = max(1, max_per_host)
+        self._idle: Dict[Tuple[str, int, bool], List[_Connection]] = defaultdict(list)
+        self._limits: Dict[Tuple[str, int, bool], asyncio.Semaphore] = {}
+        self._ssl_context = None
+
+    def _limit(self, key) -> asyncio.Semaphore:
+        if key not in self._limits:
+            self._limits[key] = asyncio.Semaphore(self.max_per_host)
+        return self._limits[key]
+
+    async def _acquire(self, key) -> Tuple[_Connection, bool]:
+        idle = self._idle[key]
+        while idle:
+            connection = idle.pop()
+            if connection.usable():
+                return connection, True
+            connection.close()
+
+        host, port, secure = key
+        if secure and self._ssl_context is None:
+            self._ssl_context = ssl.create_default_context()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=self._ssl_context if secure else None),
+            CONNECT_TIMEOUT_SECONDS
+        )
+        return _Connection(reader, writer), False
+
+    def _release(self, key, connection: _Connection) -> None:
+        connection.idle_since = time.monotonic()
+        self._idle[key].append(connection)
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        body: bytes = b'',
+        timeout: float = SUNAT_HTTP_TIMEOUT
+    ) -> HTTPResponse:
+        parts = urlsplit(url)
+        secure = parts.scheme == 'https'
+        key = (parts.hostname, parts.port or (443 if secure else 80), secure)
+        target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+
+        async with self._limit(key):
+            for attempt in range(2):
+                connection, reused = await self._acquire(key)
+                try:
+                    response, keep_alive = await asyncio.wait_for(
+                        self._exchange(connection, method, parts.netloc, target, headers or {}, body),
+                        timeout
+                    )
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    connection.close()
+                    # El servidor cerró la conexión ociosa: una nueva y se reenvía
+                    if reused and attempt == 0:
+                        continue
+                    raise
+                except BaseException:
+                    connection.close()
+                    raise
+
+                if keep_alive:
+                    self._release(key, connection)
+                else:
+                    connection.close()
+                return response
+
+    async def _exchange(self, connection, method, host, target, headers, body) -> Tuple[HTTPResponse, bool]:
+        lines = [f'{method} {target} HTTP/1.1', f'Host: {host}', f'Content-Length: {len(body)}']
+        lines += [f'{name}: {value}' for name, value in headers.items()]
+        connection.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await connection.writer.drain()
+
+        reader = connection.reader
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError('Connection closed before response')
+        version, status = status_line.decode('latin-1').split(' ', 2)[:2]
+
+        response_headers: Dict[str, str] = {}
+        for _ in range(MAX_HEADER_LINES):
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == 'HTTP/1.1' and response_headers.get('connection', '').lower() != 'close'
+        if method == 'HEAD' or status in ('204', '304'):
+            data = b''
+        elif 'chunked' in response_headers.get('transfer-encoding', '').lower():
+            data = await self._read_chunked(reader)
+        elif 'content-length' in response_headers:
+            data = await reader.readexactly(int(response_headers['content-length']))
+        else:
+            # Sin longitud: el cuerpo termina al cerrar la conexión
+            data = await reader.read()
+            keep_alive = False
+        return HTTPResponse(int(status), response_headers, data), keep_alive
+
+    @staticmethod
+    async def _read_chunked(reader: asyncio.StreamReader) -> bytes:
+        chunks = []
+        while True:
+            size_line = (await reader.readline()).decode('latin-1')
+            size = int(size_line.split(';', 1)[0].strip() or '0', 16)
+            if size == 0:
+                # Trailers opcionales hasta la línea vacía
+                while (await reader.readline()).strip():
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    async def close(self) -> None:
+        for connections in self._idle.values():
+            for connection in connections:
+                connection.close()
+        self._idle.clear()
+
+
+class AsyncSunatClient:
+    """
+    - concurrency: validaciones en curso a la vez (y conexiones por host).
+    - rate / burst: consultas por segundo a SUNAT (0 = sin límite).
+    - max_attempts: > 1 reintenta 429/5xx respetando Retry-After.
+    - timeout: segundos por consulta HTTP.
+    - refresh: ignora la caché de resultados (igual se actualiza).
+    - prescreen: False si el emisor ya pasó por el padrón en la ingesta.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 50,
+        rate: float = 0.0,
+        burst: float = 1.0,
+        max_attempts: int = 1,
+        timeout: float = SUNAT_HTTP_TIMEOUT,
+        refresh: bool = False,
+        prescreen: bool = True
+    ):
+        self.concurrency = max(1, concurrency)
+        self.limiter = sunat_client.TokenBucket(rate, burst=burst)
+        self.max_attempts = max(1, max_attempts)
+        self.timeout = timeout
+        self.refresh = refresh
+        self.prescreen = prescreen
+        self.pool = AsyncConnectionPool(max_per_host=self.concurrency)
+        self._semaphore = None
+        self._token_lock = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self) -> None:
+        await self.pool.close()
+
+    async def validate_many(self, invoices: List[Dict[str, Any]]) -> List[ValidationResult]:
+        return list(await asyncio.gather(*(self.validate_invoice(invoice) for invoice in invoices)))
+
+    async def validate_rhe(self, invoice_data: Dict[str, Any]) -> ValidationResult:
+        return await self.validate_invoice({**invoice_data, 'tipoComprobante': 'RECIBO_HONORARIOS'})
+
+    async def validate_invoice(self, invoice_data: Dict[str, Any]) -> ValidationResult:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        started = time.monotonic()
+        async with self._semaphore:
+            outcome = await self._validate(invoice_data)
+        outcome.elapsed_ms = (time.monotonic() - started) * 1000
+        return outcome
+
+    async def _acquire_rate(self) -> None:
+        while True:
+            wait = self.limiter.try_acquire()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    async def _token(self) -> Optional[str]:
+        token = sunat_client.cached_token()
+        if token:
+            return token
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+        # Un solo refresco por cliente: el resto de consultas espera en el loop
+        # (no en threads del executor bloqueados en el lock de sunat_client)
+        async with self._token_lock:
+            token = sunat_client.cached_token()
+            if token:
+                return token
+            loop = asyncio.get_running_loop()
+
+            def request(client_id: str, client_secret: str) -> Tuple[Optional[str], float]:
+                # get_token corre en un thread (lee la tabla de control); el
+                # POST a api-seguridad vuelve al loop y usa el pool
+                future = asyncio.run_coroutine_threadsafe(self._request_token(client_id, client_secret), loop)
+                return future.result()
+
+            return await asyncio.to_thread(sunat_client.get_token, request)
+
+    async def _request_token(self, client_id: str, client_secret: str) -> Tuple[Optional[str], float]:
+        print("🔑 Requesting new SUNAT token...")
+        now = time.time()
+        try:
+            url, headers, body = sunat_client.token_request(client_id, client_secret)
+            response = await self.pool.request(
+                'POST', url, headers=headers, body=body.encode('utf-8'), timeout=self.timeout
+            )
+            return sunat_client.parse_token_response(response.status, response.data, now)
+        except Exception as e:
+            print(f"❌ Error getting SUNAT token: {str(e)}")
+            return None, 0.0
+
+    async def _post(self, ruc_consultante: str, request: Dict[str, Any], token: str) -> HTTPResponse:
+        return await self.pool.request(
+            'POST',
+            API_URL.format(ruc=ruc_consultante, endpoint=request['endpoint']),
+            headers={'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'},
+            body=json.dumps(request['body']).encode('utf-8'),
+            timeout=self.timeout
+        )
+
+    async def _validate(self, invoice_data: Dict[str, Any]) -> ValidationResult:
+        _, _, ruc_consultante = sunat_client.get_credentials()
+        if not ruc_consultante:
+            return ValidationResult(build_result('NO_VALIDADO', 'Credenciales SUNAT no configuradas'))
+
+        breaker = sunat_client.get_breaker()
+        # None: la consulta aún no pasó por el breaker (no se reporta)
+        probe = None
+        attempts = 0
+        try:
+            request, result = prepare_validation(invoice_data)
+            if result:
+                return ValidationResult(result)
+
+            # Búsqueda en mmap (microsegundos): no hace falta salir del loop
+            result = prescreen_emisor(invoice_data) if self.prescreen else None
+            if result:
+                return ValidationResult(result)
+
+            identity = request['identity']
+            if sunat_client.RESULT_CACHE_ENABLED and not self.refresh:
+                cached = await asyncio.to_thread(sunat_client.get_cached_result, identity)
+                if cached:
+                    return ValidationResult(cached)
+
+            if breaker:
+                # Relee el estado compartido cada pocos segundos: fuera del loop
+                allowed, probe = await asyncio.to_thread(breaker.allow)
+                if not allowed:
+                    return ValidationResult(circuit_open_result(breaker))
+
+            token = await self._token()
+            if not token:
+                if breaker and sunat_client.credentials_configured():
+                    await asyncio.to_thread(breaker.record, False, probe)
+                return ValidationResult(build_result('ERROR_TOKEN', 'No se pudo obtener token de SUNAT'))
+
+            reauthenticated = False
+            while True:
+                await self._acquire_rate()
+                attempts += 1
+                response = await self._post(ruc_consultante, request, token)
+                if response.status == 401 and not reauthenticated:
+                    # Token revocado o vencido antes de tiempo: uno nuevo y se
+                    # reenvía por el limitador (no cuenta como intento)
+                    reauthenticated = True
+                    await asyncio.to_thread(sunat_client.invalidate_token, token)
+                    token = await self._token()
+                    if not token:
+                        break
+                    attempts -= 1
+                    continue
+                if response.status not in RETRYABLE_HTTP or attempts >= self.max_attempts:
+                    break
+                delay = retry_delay(response, attempts)
+                print(f"⏳ SUNAT HTTP {response.status}, retrying in {delay:.1f}s ({attempts}/{self.max_attempts})")
+                self.limiter.pause(delay)
+
+            if breaker:
+                await asyncio.to_thread(breaker.record, breaker_outcome(response.status), probe)
+            result = parse_validation_response(response.status, response.data)
+            if sunat_client.RESULT_CACHE_ENABLED:
+                await asyncio.to_thread(sunat_client.store_result, identity, result)
+            return ValidationResult(result, http_status=response.status, attempts=attempts)
+
+        except asyncio.TimeoutError:
+            print(f"❌ SUNAT request timed out after {self.timeout}s")
+            if breaker and probe is not None:
+                await asyncio.to_thread(breaker.record, False, probe)
+            return ValidationResult(
+                build_result('ERROR_EXCEPCION', f'Timeout al consultar SUNAT ({self.timeout}s)'),
+                attempts=attempts
+            )
+        except Exception as e:
+            print(f"❌ Error validating with SUNAT: {str(e)}")
+            if breaker and probe is not None:
+                await asyncio.to_thread(breaker.record, False, probe)
+            return ValidationResult(
+                build_result('ERROR_EXCEPCION', f'Excepción al validar: {str(e)}'),
+                attempts=attempts
+            )
@@ -0,0 +1,1229 @@
+"""
+Cliente SUNAT compartido por lambda_claude, lambda_sunat_retry y
+validate_sunat_batch (se empaqueta junto al handler de cada Lambda).
+
+- Token OAuth en dos niveles: caché en proceso y un item en la tabla de
+  control que comparten todas las Lambdas y cold starts (la tabla se cifra
+  en reposo con la CMK de infra/dynamodb-control-table.tf). El refresco es
+  single-flight: un lease condicional en el item decide quién pide el token
+  a api-seguridad; el resto espera a que aparezca.
+- Validación de comprobantes (validarcomprobante) y recibos por honorarios
+  (validarreciboporhonorario) con un único formato de resultado.
+- Caché de resultados por identidad del comprobante (RUC emisor, codComp,
+  serie, número, fecha, monto) con TTL según el estado. Los errores
+  transitorios nunca se guardan.
+- Circuit breaker compartido (item en la tabla de control + caché local):
+  con SUNAT caída las consultas terminan al instante como ERROR_API
+  reintentable en vez de esperar timeouts.
+- Pre-filtro del emisor contra el padrón reducido de RUC (ruc_padron): un
+  RUC que no está ACTIVO se marca INVALIDO sin consultar la API.
+
+boto3 y urllib3 se importan en el primer uso (cold start).
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Any, Callable, Dict, Optional, Tuple
+from urllib.parse import urlencode
+
+TOKEN_URL = 'https://api-seguridad.sunat.gob.pe/v1/clientesextranet/{client_id}/oauth2/token/'
+TOKEN_SCOPE = 'https://api.sunat.gob.pe/v1/contribuyente/contribuyentes'
+API_URL = 'https://api.sunat.gob.pe/v1/contribuyente/contribuyentes/{ruc}/{endpoint}'
+
+# Margen para no usar un token a punto de vencer
+TOKEN_EXPIRY_MARGIN_SECONDS = 60
+# Lease del refresco compartido; quien no lo obtiene espera hasta
+# SUNAT_TOKEN_WAIT_SECONDS y luego pide su propio token
+TOKEN_LEASE_SECONDS = 10
+TOKEN_WAIT_SECONDS = float(os.environ.get('SUNAT_TOKEN_WAIT_SECONDS', '3'))
+TOKEN_POLL_SECONDS = 0.2
+SUNAT_HTTP_TIMEOUT = float(os.environ.get('SUNAT_HTTP_TIMEOUT_SECONDS', '10'))
+# Conexiones keep-alive por host; validate_sunat_batch lo iguala a --concurrency
+SUNAT_HTTP_POOL_SIZE = int(os.environ.get('SUNAT_HTTP_POOL_SIZE', '10'))
+# Respuestas de validación que se reintentan cuando el llamador pide reintentos
+RETRYABLE_HTTP = {429, 500, 502, 503, 504}
+MAX_RETRY_DELAY_SECONDS = 60.0
+
+# Circuit breaker: abre tras N fallas seguidas (5xx, timeout, sin token) o con
+# una tasa de fallas alta en las últimas BREAKER_WINDOW consultas
+BREAKER_ENABLED = os.environ.get('SUNAT_BREAKER', 'true').lower() in ('1', 'true', 'yes')
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('SUNAT_BREAKER_FAILURES', '5'))
+BREAKER_ERROR_RATE = float(os.environ.get('SUNAT_BREAKER_ERROR_RATE', '0.5'))
+BREAKER_WINDOW = int(os.environ.get('SUNAT_BREAKER_WINDOW', '20'))
+BREAKER_OPEN_SECONDS = int(os.environ.get('SUNAT_BREAKER_OPEN_SECONDS', '60'))
+# Cada cuánto se relee el estado compartido (entre lecturas se usa el local)
+BREAKER_CACHE_SECONDS = 5.0
+# Lease de la consulta de prueba en estado semiabierto
+BREAKER_PROBE_SECONDS = SUNAT_HTTP_TIMEOUT + 5
+BREAKER_KEY = {'PK': 'SUNAT_BREAKER', 'SK': 'api'}
+
+# Estados que el barrido de lambda_sunat_retry vuelve a consultar. Mientras
+# hay un reintento agendado el item lleva sunatRetryBucket / sunatNextRetryAt
+# (GSI disperso: el barrido consulta solo lo vencido)
+RETRY_STATUSES = {'PENDIENTE', 'ERROR_TOKEN', 'ERROR_API', 'ERROR_EXCEPCION', 'NO_VALIDADO'}
+# PENDIENTE: guardada por lambda_claude con la validación en cola. El barrido
+# solo la toma pasado este plazo (el mensaje pudo perderse)
+RETRY_PENDING_GRACE_MINUTES = int(os.environ.get('SUNAT_PENDING_GRACE_MINUTES', '15'))
+# Particiones por día del GSI de reintentos: un solo bucket diario concentra
+# todas las escrituras del día en una partición
+RETRY_BUCKET_SHARDS = max(1, int(os.environ.get('SUNAT_RETRY_BUCKET_SHARDS', '8')))
+
+# Caché de resultados: TTL por estado (segundos). Los estados sin TTL
+# (ERROR_*, DATOS_INCOMPLETOS, NO_VALIDADO) no se guardan.
+RESULT_CACHE_ENABLED = os.environ.get('SUNAT_RESULT_CACHE', 'true').lower() in ('1', 'true', 'yes')
+RESULT_CACHE_TTL = {
+    'VALIDO': int(os.environ.get('SUNAT_CACHE_TTL_VALIDO_DAYS', '30')) * 86400,
+    'INVALIDO': int(os.environ.get('SUNAT_CACHE_TTL_INVALIDO_DAYS', '7')) * 86400
+}
+# estadoCp 0 (no informado) puede cambiar cuando el emisor lo informe
+RESULT_CACHE_TTL_NO_INFORMADO = int(os.environ.get('SUNAT_CACHE_TTL_NO_INFORMADO_HOURS', '6')) * 3600
+LOCAL_RESULT_CACHE_SIZE = 1024
+
+ESTADOS_COMPROBANTE = {
+    '0': 'NO EXISTE - Comprobante no informado',
+    '1': 'ACEPTADO - Comprobante aceptado',
+    '2': 'ANULADO - Comunicado en una baja',
+    '3': 'AUTORIZADO - Con autorización de imprenta',
+    '4': 'NO AUTORIZADO - No autorizado por imprenta'
+}
+
+ESTADOS_RUC = {
+    '00': 'ACTIVO',
+    '01': 'BAJA PROVISIONAL',
+    '02': 'BAJA PROV. POR OFICIO',
+    '03': 'SUSPENSION TEMPORAL',
+    '10': 'BAJA DEFINITIVA',
+    '11': 'BAJA DE OFICIO',
+    '22': 'INHABILITADO-VENT.UNICA'
+}
+
+CONDICIONES_DOMICILIO = {
+    '00': 'HABIDO',
+    '09': 'PENDIENTE',
+    '11': 'POR VERIFICAR',
+    '12': 'NO HABIDO',
+    '20': 'NO HALLADO'
+}
+
+# Catálogo 01 de SUNAT (tipo de comprobante)
+CODIGOS_COMPROBANTE = {
+    'FACTURA': '01',
+    'RECIBO_HONORARIOS': '02',
+    'BOLETA': '03',
+    'NOTA_CREDITO': '07',
+    'NOTA_DEBITO': '08'
+}
+
+ESTADO_RUC_CODIGOS = {descripcion: codigo for codigo, descripcion in ESTADOS_RUC.items()}
+CONDICION_DOMICILIO_CODIGOS = {descripcion: codigo for codigo, descripcion in CONDICIONES_DOMICILIO.items()}
+
+NUMERO_RE = re.compile(r'^([A-Z0-9]{1,4})[- ]?0*([0-9]{1,12})$')
+
+_token_cache = {'token': None, 'expires_at': 0.0}
+_token_lock = threading.Lock()
+_result_cache = OrderedDict()
+_result_cache_lock = threading.Lock()
+_http = None
+_http_lock = threading.Lock()
+_breaker = None
+_breaker_lock = threading.Lock()
+# Los resources de boto3 no son thread-safe: cada worker usa su propia Table
+_thread_local = threading.local()
+
+
+def get_credentials() -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """
+    (client_id, client_secret, RUC consultante). Se leen en cada llamada:
+    validate_sunat_batch los carga en el entorno después de importar.
+    """
+    return (
+        os.environ.get('SUNAT_CLIENT_ID'),
+        os.environ.get('SUNAT_CLIENT_SECRET'),
+        os.environ.get('SUNAT_RUC')
+    )
+
+
+def get_http():
+    global _http
+    if _http is None:
+        with _http_lock:
+            if _http is None:
+                import urllib3
+                _http = urllib3.PoolManager(
+                    maxsize=SUNAT_HTTP_POOL_SIZE,
+                    block=True,
+                    timeout=urllib3.Timeout(connect=3.0, read=SUNAT_HTTP_TIMEOUT)
+                )
+    return _http
+
+
+def configure_http(pool_size: int) -> None:
+    """
+    Ajusta el pool de conexiones compartido (se recrea en el próximo uso).
+    """
+    global _http, SUNAT_HTTP_POOL_SIZE
+    with _http_lock:
+        SUNAT_HTTP_POOL_SIZE = max(1, pool_size)
+        _http = None
+
+
+def get_control_table():
+    table_name = os.environ.get('CONTROL_TABLE', 'FlowControl-dev')
+    tables = getattr(_thread_local, 'tables', None)
+    if tables is None:
+        tables = _thread_local.tables = {}
+    if table_name not in tables:
+        import boto3
+        tables[table_name] = boto3.session.Session().resource('dynamodb').Table(table_name)
+    return tables[table_name]
+
+
+def error_code(exc: Exception) -> Optional[str]:
+    return (getattr(exc, 'response', None) or {}).get('Error', {}).get('Code')
+
+
+def to_dynamodb(obj: Any) -> Any:
+    if isinstance(obj, dict):
+        return {k: to_dynamodb(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [to_dynamodb(v) for v in obj]
+    if isinstance(obj, float):
+        return Decimal(str(obj))
+    return obj
+
+
+def from_dynamodb(obj: Any) -> Any:
+    if isinstance(obj, dict):
+        return {k: from_dynamodb(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [from_dynamodb(v) for v in obj]
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    return obj
+
+
+# ---------- Token OAuth ----------
+
+def token_key(client_id: str) -> Dict[str, str]:
+    return {'PK': 'SUNAT_TOKEN', 'SK': client_id}
+
+
+def cached_token() -> Optional[str]:
+    """
+    Token del nivel en proceso si sigue vigente (sin I/O).
+    """
+    if _token_cache['token'] and time.time() < _token_cache['expires_at']:
+        return _token_cache['token']
+    return None
+
+
+def get_token(request: Optional[Callable[[str, str], Tuple[Optional[str], float]]] = None) -> Optional[str]:
+    """
+    Token vigente: caché en proceso → item compartido → api-seguridad.
+    Retorna None si no hay credenciales o SUNAT no entrega token.
+    request: reemplaza a request_token para la consulta a api-seguridad
+    (sunat_async la hace con su pool de conexiones).
+    """
+    client_id, client_secret, _ = get_credentials()
+    if not client_id or not client_secret:
+        print("⚠️ SUNAT credentials not configured, skipping validation")
+        return None
+
+    if _token_cache['token'] and time.time() < _token_cache['expires_at']:
+        return _token_cache['token']
+
+    # Single-flight dentro del contenedor: un solo thread refresca
+    with _token_lock:
+        if _token_cache['token'] and time.time() < _token_cache['expires_at']:
+            return _token_cache['token']
+        token, expires_at = get_shared_token(client_id, client_secret, request or request_token)
+        if token:
+            _token_cache['token'] = token
+            _token_cache['expires_at'] = expires_at
+        return token
+
+
+def get_shared_token(
+    client_id: str,
+    client_secret: str,
+    request: Optional[Callable[[str, str], Tuple[Optional[str], float]]] = None
+) -> Tuple[Optional[str], float]:
+    """
+    Nivel compartido (tabla de control). Si no hay token vigente, quien
+    obtiene el lease lo pide a SUNAT y lo publica; los demás releen el item
+    hasta TOKEN_WAIT_SECONDS. Si DynamoDB falla se pide el token directo.
+    """
+    request = request or request_token
+    key = token_key(client_id)
+    owner = os.urandom(16).hex()
+    deadline = time.time() + TOKEN_WAIT_SECONDS
+    try:
+        table = get_control_table()
+        while True:
+            now = time.time()
+            item = table.get_item(Key=key, ConsistentRead=True).get('Item') or {}
+            expires_at = float(item.get('tokenExpiresAt') or 0)
+            if item.get('token') and now < expires_at:
+                print("🔑 Using shared SUNAT token")
+                return item['token'], expires_at
+            if acquire_token_lease(table, key, owner, now):
+                break
+            if now >= deadline:
+                print("⚠️ SUNAT token refresh still in progress elsewhere; requesting token directly")
+                return request(client_id, client_secret)
+            time.sleep(TOKEN_POLL_SECONDS)
+    except Exception as e:
+        print(f"⚠️ Shared SUNAT token cache unavailable: {str(e)}")
+        return request(client_id, client_secret)
+
+    token, expires_at = request(client_id, client_secret)
+    try:
+        if token:
+            # put_item reemplaza el item completo: también libera el lease
+            table.put_item(Item={
+                **key,
+                'token': token,
+                'tokenExpiresAt': Decimal(str(round(expires_at, 3))),
+                'actualizadoEn': datetime.utcnow().isoformat() + 'Z',
+                'expiresAt': int(expires_at) + 3600
+            })
+        else:
+            table.update_item(
+                Key=key,
+                UpdateExpression='REMOVE leaseOwner, leaseUntil',
+                ConditionExpression='leaseOwner = :o',
+                ExpressionAttributeValues={':o': owner}
+            )
+    except Exception as e:
+        print(f"⚠️ Could not publish SUNAT token: {str(e)}")
+    return token, expires_at
+
+
+def acquire_token_lease(table, key: Dict[str, str], owner: str, now: float) -> bool:
+    try:
+        table.update_item(
+            Key=key,
+            UpdateExpression='SET leaseOwner = :o, leaseUntil = :u',
+            ConditionExpression='attribute_not_exists(leaseUntil) OR leaseUntil < :now',
+            ExpressionAttributeValues={
+                ':o': owner,
+                ':u': Decimal(str(round(now + TOKEN_LEASE_SECONDS, 3))),
+                ':now': Decimal(str(round(now, 3)))
+            }
+        )
+        return True
+    except Exception as e:
+        if error_code(e) == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+
+def token_request(client_id: str, client_secret: str) -> Tuple[str, Dict[str, str], str]:
+    """
+    (url, headers, body) del POST client_credentials a api-seguridad.
+    """
+    return (
+        TOKEN_URL.format(client_id=client_id),
+        {'Content-Type': 'application/x-www-form-urlencoded'},
+        urlencode({
+            'grant_type': 'client_credentials',
+            'scope': TOKEN_SCOPE,
+            'client_id': client_id,
+            'client_secret': client_secret
+        })
+    )
+
+
+def parse_token_response(status: int, raw: bytes, requested_at: float) -> Tuple[Optional[str], float]:
+    if status != 200:
+        print(f"❌ Failed to get SUNAT token: {status}")
+        print(f"Response: {raw.decode('utf-8')}")
+        return None, 0.0
+
+    data = json.loads(raw.decode('utf-8'))
+    expires_in = data.get('expires_in', 3600)  # Default 1 hora
+    print(f"✅ SUNAT token obtained (expires in {expires_in}s)")
+    return data.get('access_token'), requested_at + expires_in - TOKEN_EXPIRY_MARGIN_SECONDS
+
+
+def request_token(client_id: str, client_secret: str) -> Tuple[Optional[str], float]:
+    print("🔑 Requesting new SUNAT token...")
+    now = time.time()
+    try:
+        url, headers, body = token_request(client_id, client_secret)
+        response = get_http().request('POST', url, headers=headers, body=body)
+        return parse_token_response(response.status, response.data, now)
+    except Exception as e:
+        print(f"❌ Error getting SUNAT token: {str(e)}")
+        return None, 0.0
+
+
+def invalidate_token(token: str) -> None:
+    """
+    Descarta un token rechazado por SUNAT (401) en ambos niveles, sin borrar
+    uno más nuevo que otra invocación ya haya publicado.
+    """
+    client_id, _, _ = get_credentials()
+    with _token_lock:
+        if _token_cache['token'] == token:
+            _token_cache['token'] = None
+            _token_cache['expires_at'] = 0.0
+    try:
+        get_control_table().delete_item(
+            Key=token_key(client_id),
+            ConditionExpression='#t = :t',
+            ExpressionAttributeNames={'#t': 'token'},
+            ExpressionAttributeValues={':t': token}
+        )
+    except Exception as e:
+        if error_code(e) != 'ConditionalCheckFailedException':
+            print(f"⚠️ Could not invalidate shared SUNAT token: {str(e)}")
+
+
+# ---------- Ritmo de consultas ----------
+
+class TokenBucket:
+    """
+    Token bucket en proceso compartido por los threads de un llamador.
+
+    - try_acquire(): consume un token; retorna 0 o los segundos de espera.
+    - acquire(): bloquea hasta que haya un token (rate <= 0 = sin límite).
+    - pause(seconds): detiene a todos los consumidores, p. ej. por el
+      Retry-After de un 429; el bucket se rellena desde el fin de la pausa.
+    """
+
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._not_before = 0.0
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            if now < self._not_before:
+                return self._not_before - now
+            if self.rate <= 0:
+                return 0.0
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self) -> None:
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._not_before = max(self._not_before, time.monotonic() + seconds)
+            self._tokens = 0.0
+            self._updated = self._not_before
+
+
+def retry_after_seconds(response) -> Optional[float]:
+    """
+    Retry-After en segundos (acepta delta-seconds o fecha HTTP).
+    """
+    headers = getattr(response, 'headers', None) or {}
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(response, attempt: int) -> float:
+    delay = retry_after_seconds(response)
+    if delay is None:
+        # Backoff exponencial con jitter: 0.5s, 1s, 2s... por intento
+        import random
+        delay = 0.5 * (2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+    return min(delay, MAX_RETRY_DELAY_SECONDS)
+
+
+def breaker_outcome(status: int) -> bool:
+    """
+    Resultado de una respuesta para el circuit breaker: 429 y 5xx son
+    fallas. Un 429 sostenido debe abrir el circuito (y no cerrar un probe)
+    aunque SUNAT esté respondiendo.
+    """
+    return status < 500 and status != 429
+
+
+# ---------- Circuit breaker ----------
+
+class CircuitBreaker:
+    """
+    Circuit breaker de las APIs de SUNAT (token y validación) compartido por
+    lambda_claude, lambda_sunat_retry y el batch.
+
+    - Cada contenedor cuenta sus propias consultas y abre el circuito tras
+      BREAKER_FAILURE_THRESHOLD fallas seguidas o si la tasa de fallas de las
+      últimas BREAKER_WINDOW supera BREAKER_ERROR_RATE. Abrir publica
+      openUntil en el item compartido: el resto de contenedores lo ve en la
+      siguiente relectura (cada BREAKER_CACHE_SECONDS).
+    - Abierto: allow() rechaza sin I/O hasta openUntil.
+    - Semiabierto (openUntil vencido): una sola consulta obtiene el lease
+      probeUntil. Si SUNAT responde se borra el item (cerrado); si falla se
+      vuelve a abrir por BREAKER_OPEN_SECONDS.
+    Si la tabla de control no responde, el breaker sigue con el estado local.
+    """
+
+    def __init__(self):
+        self._open_until = 0.0
+        self._probe_until = 0.0
+        self._fetched_at = 0.0
+        self._outcomes = deque(maxlen=max(1, BREAKER_WINDOW))
+        self._consecutive_failures = 0
+        self._lock = threading.Lock()
+
+    def _refresh(self, now: float) -> None:
+        with self._lock:
+            if now - self._fetched_at < BREAKER_CACHE_SECONDS:
+                return
+            self._fetched_at = now
+        try:
+            item = get_control_table().get_item(Key=BREAKER_KEY).get('Item') or {}
+        except Exception as e:
+            print(f"⚠️ SUNAT circuit breaker state unavailable: {str(e)}")
+            return
+        with self._lock:
+            self._open_until = float(item.get('openUntil') or 0)
+            self._probe_until = float(item.get('probeUntil') or 0)
+
+    def is_open(self) -> bool:
+        """
+        Abierto y sin vencer (no cuenta el estado semiabierto).
+        """
+        now = time.time()
+        self._refresh(now)
+        return now < self._open_until
+
+    def retry_at(self) -> float:
+        return max(self._open_until, self._probe_until, time.time() + BREAKER_CACHE_SECONDS)
+
+    def allow(self) -> Tuple[bool, bool]:
+        """
+        (permitida, es_prueba). La consulta de prueba debe reportarse con
+        record(..., probe=True).
+        """
+        now = time.time()
+        self._refresh(now)
+        if not self._open_until:
+            return True, False
+        if now < self._open_until:
+            return False, False
+        return (True, True) if self._acquire_probe(now) else (False, False)
+
+    def _acquire_probe(self, now: float) -> bool:
+        with self._lock:
+            if self._probe_until > now:
+                return False
+            self._probe_until = now + BREAKER_PROBE_SECONDS
+        try:
+            get_control_table().update_item(
+                Key=BREAKER_KEY,
+                UpdateExpression='SET probeUntil = :p',
+                ConditionExpression='openUntil <= :now AND (attribute_not_exists(probeUntil) OR probeUntil < :now)',
+                ExpressionAttributeValues={
+                    ':p': Decimal(str(round(now + BREAKER_PROBE_SECONDS, 3))),
+                    ':now': Decimal(str(round(now, 3)))
+                }
+            )
+        except Exception as e:
+            if error_code(e) == 'ConditionalCheckFailedException':
+                # Otro contenedor está probando o ya cerró el circuito: releer
+                with self._lock:
+                    self._fetched_at = 0.0
+                return False
+            print(f"⚠️ Could not take SUNAT circuit breaker probe: {str(e)}")
+        print("🟡 SUNAT circuit breaker half-open: probing")
+        return True
+
+    def record(self, ok: bool, probe: bool = False) -> None:
+        now = time.time()
+        if probe:
+            if ok:
+                self._close(now)
+            else:
+                self._open(now, 'falló la consulta de prueba')
+            return
+
+        with self._lock:
+            self._outcomes.append(ok)
+            self._consecutive_failures = 0 if ok else self._consecutive_failures + 1
+            failures = self._outcomes.count(False)
+            reason = None
+            if ok or now < self._open_until:
+                pass
+            elif self._consecutive_failures >= BREAKER_FAILURE_THRESHOLD:
+                reason = f'{self._consecutive_failures} fallas seguidas'
+            elif (len(self._outcomes) == self._outcomes.maxlen
+                  and failures / len(self._outcomes) >= BREAKER_ERROR_RATE):
+                reason = f'{failures} fallas en las últimas {len(self._outcomes)} consultas'
+        if reason:
+            self._open(now, reason)
+
+    def _open(self, now: float, reason: str) -> None:
+        open_until = now + BREAKER_OPEN_SECONDS
+        with self._lock:
+            self._open_until = open_until
+            self._probe_until = 0.0
+            self._fetched_at = now
+            self._outcomes.clear()
+            self._consecutive_failures = 0
+        print(f"🔴 SUNAT circuit breaker open for {BREAKER_OPEN_SECONDS}s ({reason})")
+        try:
+            # Si otro contenedor ya lo abrió se respeta su openUntil
+            get_control_table().put_item(
+                Item={
+                    **BREAKER_KEY,
+                    'openUntil': Decimal(str(round(open_until, 3))),
+                    'motivo': reason,
+                    'abiertoEn': datetime.utcnow().isoformat() + 'Z',
+                    'expiresAt': int(open_until) + 86400
+                },
+                ConditionExpression='attribute_not_exists(openUntil) OR openUntil <= :now',
+                ExpressionAttributeValues={':now': Decimal(str(round(now, 3)))}
+            )
+        except Exception as e:
+            if error_code(e) == 'ConditionalCheckFailedException':
+                with self._lock:
+                    self._fetched_at = 0.0
+                return
+            print(f"⚠️ Could not publish SUNAT circuit breaker state: {str(e)}")
+
+    def _close(self, now: float) -> None:
+        with self._lock:
+            self._open_until = 0.0
+            self._probe_until = 0.0
+            self._fetched_at = now
+            self._outcomes.clear()
+            self._consecutive_failures = 0
+        print("🟢 SUNAT circuit breaker closed")
+        try:
+            get_control_table().delete_item(Key=BREAKER_KEY)
+        except Exception as e:
+            print(f"⚠️ Could not publish SUNAT circuit breaker state: {str(e)}")
+
+
+def get_breaker() -> Optional[CircuitBreaker]:
+    """
+    Breaker del contenedor; None si SUNAT_BREAKER está desactivado.
+    """
+    global _breaker
+    if not BREAKER_ENABLED:
+        return None
+    if _breaker is None:
+        with _breaker_lock:
+            if _breaker is None:
+                _breaker = CircuitBreaker()
+    return _breaker
+
+
+def circuit_open_result(breaker: CircuitBreaker) -> Dict[str, Any]:
+    """
+    Resultado reintentable sin consultar SUNAT; reintentarDesde indica
+    cuándo vuelve a tener sentido intentarlo.
+    """
+    retry_at = datetime.utcfromtimestamp(breaker.retry_at()).isoformat() + 'Z'
+    return build_result(
+        'ERROR_API',
+        'SUNAT no disponible (circuit breaker abierto)',
+        circuitoAbierto=True,
+        reintentarDesde=retry_at
+    )
+
+
+def credentials_configured() -> bool:
+    client_id, client_secret, _ = get_credentials()
+    return bool(client_id and client_secret)
+
+
+# ---------- Caché de resultados ----------
+
+def result_cache_key(identity: Tuple) -> Dict[str, str]:
+    ruc, codigo, serie, numero, fecha, monto = identity
+    return {
+        'PK': f'SUNAT_CPE#{ruc}#{codigo}#{serie}#{numero}',
+        'SK': f'{fecha}#{monto:.2f}'
+    }
+
+
+def result_cache_ttl(result: Dict[str, Any]) -> Optional[int]:
+    ttl = RESULT_CACHE_TTL.get(result.get('estado'))
+    codigo_cp = ((result.get('estadoSunat') or {}).get('estadoComprobante') or {}).get('codigo')
+    if ttl and codigo_cp == '0':
+        return min(ttl, RESULT_CACHE_TTL_NO_INFORMADO)
+    return ttl
+
+
+def get_cached_result(identity: Tuple) -> Optional[Dict[str, Any]]:
+    now = time.time()
+    with _result_cache_lock:
+        entry = _result_cache.get(identity)
+        if entry and now < entry[1]:
+            _result_cache.move_to_end(identity)
+            return dict(entry[0])
+
+    try:
+        item = get_control_table().get_item(Key=result_cache_key(identity)).get('Item')
+    except Exception as e:
+        print(f"⚠️ SUNAT result cache unavailable: {str(e)}")
+        return None
+    # El TTL de DynamoDB borra con retraso: se revisa el vencimiento
+    if not item or now >= float(item.get('expiresAt') or 0):
+        return None
+
+    result = from_dynamodb(item['resultado'])
+    remember_result(identity, result, float(item['expiresAt']))
+    return dict(result)
+
+
+def remember_result(identity: Tuple, result: Dict[str, Any], expires_at: float) -> None:
+    with _result_cache_lock:
+        _result_cache[identity] = (result, expires_at)
+        _result_cache.move_to_end(identity)
+        while len(_result_cache) > LOCAL_RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+
+
+def store_result(identity: Tuple, result: Dict[str, Any]) -> None:
+    ttl = result_cache_ttl(result)
+    if not ttl:
+        return
+    expires_at = time.time() + ttl
+    cached = {**result, 'desdeCache': True}
+    remember_result(identity, cached, expires_at)
+    try:
+        get_control_table().put_item(Item={
+            **result_cache_key(identity),
+            'resultado': to_dynamodb(cached),
+            'guardadoEn': datetime.utcnow().isoformat() + 'Z',
+            'expiresAt': int(expires_at)
+        })
+    except Exception as e:
+        print(f"⚠️ Could not cache SUNAT result: {str(e)}")
+
+
+# ---------- Validación ----------
+
+def build_result(estado: str, motivo: str, **extra) -> Dict[str, Any]:
+    return {
+        'validado': False,
+        'estado': estado,
+        'motivo': motivo,
+        'estadoSunat': None,
+        'timestampValidacion': datetime.utcnow().isoformat() + 'Z',
+        **extra
+    }
+
+
+def normalize_tipo_comprobante(tipo_raw, serie='', numero_factura=''):
+    raw = (tipo_raw or '').strip().upper()
+    raw = (raw.replace('Á', 'A')
+              .replace('É', 'E')
+              .replace('Í', 'I')
+              .replace('Ó', 'O')
+              .replace('Ú', 'U')
+              .replace('Ñ', 'N'))
+
+    if 'CREDITO' in raw or raw in {'NC', 'NOTA_CREDITO', 'NOTA DE CREDITO'}:
+        return 'NOTA_CREDITO'
+    if 'DEBITO' in raw or raw in {'ND', 'NOTA_DEBITO', 'NOTA DE DEBITO'}:
+        return 'NOTA_DEBITO'
+    if 'BOLETA' in raw:
+        return 'BOLETA'
+    if 'FACTURA' in raw:
+        return 'FACTURA'
+    if 'HONORARIO' in raw:
+        return 'RECIBO_HONORARIOS'
+
+    candidate = (serie or '').strip().upper()
+    if not candidate and numero_factura and '-' in numero_factura:
+        candidate = numero_factura.split('-', 1)[0].strip().upper()
+
+    if candidate.startswith(('FC', 'BC')):
+        return 'NOTA_CREDITO'
+    if candidate.startswith(('FD', 'BD')):
+        return 'NOTA_DEBITO'
+    if candidate.startswith('F'):
+        return 'FACTURA'
+    if candidate.startswith('B'):
+        return 'BOLETA'
+
+    return raw or 'OTRO'
+
+
+def normalize_tipo_documento(tipo_raw):
+    raw = (tipo_raw or '').strip().upper()
+    raw = (raw.replace('Á', 'A')
+              .replace('É', 'E')
+              .replace('Í', 'I')
+              .replace('Ó', 'O')
+              .replace('Ú', 'U')
+              .replace('Ñ', 'N'))
+
+    if raw in {'DNI', '01', '1'}:
+        return '1'
+    if raw in {'RUC', '06', '6'}:
+        return '6'
+    if raw in {'CE', 'CARNET DE EXTRANJERIA', '04', '4'}:
+        return '4'
+    if raw in {'PASAPORTE', '07', '7'}:
+        return '7'
+    if raw in {'PTP', '09', '9'}:
+        return '9'
+    return None
+
+
+def split_numero(numero_factura) -> Optional[Tuple[str, str]]:
+    """
+    'F001-00012345' → ('F001', '12345'); también acepta espacio o sin separador.
+    """
+    numero = str(numero_factura or '').strip().upper()
+    match = NUMERO_RE.match(numero)
+    if match:
+        return match.group(1), match.group(2)
+    if '-' in numero:
+        serie, correlativo = (part.strip() for part in numero.split('-', 1))
+        if serie and correlativo:
+            return serie, correlativo
+    return None
+
+
+def fill_serie_correlativo(invoice_data: Dict[str, Any]) -> None:
+    if invoice_data.get('serie') and invoice_data.get('correlativo'):
+        return
+    parsed = split_numero(invoice_data.get('numeroFactura'))
+    if parsed:
+        invoice_data['serie'] = invoice_data.get('serie') or parsed[0]
+        invoice_data['correlativo'] = invoice_data.get('correlativo') or parsed[1]
+
+
+def build_invoice_data(item: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Datos del comprobante a partir de un item de la tabla de facturas,
+    completando con los campos planos cuando faltan en `data`.
+    """
+    data = item.get('data') if isinstance(item.get('data'), dict) else {}
+    invoice_data: Dict[str, Any] = dict(data)
+
+    invoice_data['emisor'] = dict(invoice_data.get('emisor') or {})
+    invoice_data['receptor'] = dict(invoice_data.get('receptor') or {})
+    invoice_data['montos'] = dict(invoice_data.get('montos') or {})
+
+    if not invoice_data.get('numeroFactura') and item.get('numeroFactura'):
+        invoice_data['numeroFactura'] = item.get('numeroFactura')
+    if not invoice_data.get('fechaEmision') and item.get('fechaEmision'):
+        invoice_data['fechaEmision'] = item.get('fechaEmision')
+    if not invoice_data.get('tipoComprobante') and item.get('tipoComprobante'):
+        invoice_data['tipoComprobante'] = item.get('tipoComprobante')
+
+    if not invoice_data['emisor'].get('numeroDocumento') and item.get('emisorRUC'):
+        invoice_data['emisor']['numeroDocumento'] = str(item.get('emisorRUC'))
+    if not invoice_data['emisor'].get('razonSocial') and item.get('emisorRazonSocial'):
+        invoice_data['emisor']['razonSocial'] = item.get('emisorRazonSocial')
+
+    if not invoice_data['receptor'].get('numeroDocumento') and item.get('receptorRUC'):
+        invoice_data['receptor']['numeroDocumento'] = str(item.get('receptorRUC'))
+    if not invoice_data['receptor'].get('razonSocial') and item.get('receptorRazonSocial'):
+        invoice_data['receptor']['razonSocial'] = item.get('receptorRazonSocial')
+
+    if invoice_data['montos'].get('total') is None and item.get('total') is not None:
+        invoice_data['montos']['total'] = item.get('total')
+    if not invoice_data['montos'].get('moneda') and item.get('moneda'):
+        invoice_data['montos']['moneda'] = item.get('moneda')
+
+    fill_serie_correlativo(invoice_data)
+    return invoice_data
+
+
+def should_validate(invoice_data: Dict[str, Any]) -> Tuple[bool, str]:
+    ruc_emisor = invoice_data.get('emisor', {}).get('numeroDocumento')
+    numero_factura = invoice_data.get('numeroFactura')
+    fecha_emision = invoice_data.get('fechaEmision')
+    total = invoice_data.get('montos', {}).get('total')
+    serie = invoice_data.get('serie')
+    correlativo = invoice_data.get('correlativo')
+
+    if not ruc_emisor or not numero_factura:
+        return False, 'missing_ruc_or_numero'
+    if not fecha_emision:
+        return False, 'missing_fecha'
+    if total is None:
+        return False, 'missing_total'
+
+    try:
+        if float(total) <= 0:
+            return False, 'total_zero'
+    except Exception:
+        return False, 'invalid_total'
+
+    if not serie or not correlativo:
+        return False, 'missing_serie_correlativo'
+    if not str(correlativo).isdigit():
+        return False, 'invalid_correlativo'
+
+    return True, 'ok'
+
+
+def format_fecha_sunat(fecha_emision: str) -> str:
+    # YYYY-MM-DD → DD/MM/YYYY
+    if fecha_emision and '-' in fecha_emision:
+        parts = fecha_emision.split('-')
+        if len(parts) == 3:
+            return f"{parts[2]}/{parts[1]}/{parts[0]}"
+    return fecha_emision
+
+
+def prepare_validation(invoice_data: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """
+    Arma la consulta a SUNAT. Retorna (request, None) o (None, resultado)
+    cuando el comprobante no se puede consultar.
+    """
+    ruc_emisor = invoice_data.get('emisor', {}).get('numeroDocumento')
+    numero_factura = invoice_data.get('numeroFactura', '')
+    serie = invoice_data.get('serie', '')
+    correlativo = invoice_data.get('correlativo', '')
+    monto_total = invoice_data.get('montos', {}).get('total', 0)
+
+    tipo_comprobante = normalize_tipo_comprobante(invoice_data.get('tipoComprobante'), serie, numero_factura)
+    invoice_data['tipoComprobante'] = tipo_comprobante
+    codigo_comprobante = CODIGOS_COMPROBANTE.get(tipo_comprobante)
+    if not codigo_comprobante:
+        return None, build_result('NO_VALIDADO', f'Tipo de comprobante no soportado por SUNAT: {tipo_comprobante}')
+
+    if numero_factura and (not serie or not correlativo):
+        parsed = split_numero(numero_factura)
+        if parsed:
+            serie = serie or parsed[0]
+            correlativo = correlativo or parsed[1]
+
+    if not ruc_emisor or not numero_factura:
+        print("⚠️ Missing required data for SUNAT validation")
+        return None, build_result('DATOS_INCOMPLETOS', 'Faltan datos requeridos (RUC o número de factura)')
+
+    try:
+        numero_int = int(correlativo) if correlativo else 0
+    except ValueError:
+        numero_int = 0
+    fecha_sunat = format_fecha_sunat(invoice_data.get('fechaEmision', ''))
+    monto = float(monto_total) if monto_total is not None else 0.0
+
+    if tipo_comprobante == 'RECIBO_HONORARIOS':
+        receptor = invoice_data.get('receptor', {}) or {}
+        receptor_tipo = normalize_tipo_documento(receptor.get('tipoDocumento'))
+        receptor_num = receptor.get('numeroDocumento')
+        if not receptor_tipo or not receptor_num:
+            print("⚠️ Missing required data for RHE SUNAT validation")
+            return None, build_result(
+                'DATOS_INCOMPLETOS',
+                'Faltan datos requeridos (RUC emisor, tipo/num doc receptor o número)'
+            )
+        endpoint = 'validarreciboporhonorario'
+        body = {
+            'numRuc': ruc_emisor,
+            'codTipDoc': receptor_tipo,
+            'numDoc': receptor_num,
+            'numSerie': serie,
+            'numRec': numero_int,
+            'fechaEmision': fecha_sunat,
+            'monto': monto
+        }
+    else:
+        endpoint = 'validarcomprobante'
+        body = {
+            'numRuc': ruc_emisor,
+            'codComp': codigo_comprobante,
+            'numeroSerie': serie,
+            'numero': numero_int,  # numero debe ser int
+            'fechaEmision': fecha_sunat,  # Formato DD/MM/YYYY
+            'monto': monto
+        }
+
+    return {
+        'endpoint': endpoint,
+        'body': body,
+        'identity': (str(ruc_emisor), codigo_comprobante, str(serie).upper(), numero_int, fecha_sunat, round(monto, 2)),
+        'label': f"{ruc_emisor}-{numero_factura}"
+    }, None
+
+
+def padron_configured() -> bool:
+    return bool(os.environ.get('RUC_PADRON_PATH') or os.environ.get('RUC_PADRON_S3_URI'))
+
+
+def prescreen_emisor(invoice_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Consulta el RUC emisor en el padrón offline. Retorna un resultado
+    INVALIDO si el RUC no está ACTIVO; None si está activo, no figura o no
+    hay padrón configurado (la validación sigue contra la API).
+    """
+    if not padron_configured():
+        return None
+    ruc_emisor = (invoice_data.get('emisor') or {}).get('numeroDocumento')
+    if not ruc_emisor:
+        return None
+    try:
+        import ruc_padron
+        status = ruc_padron.lookup(ruc_emisor)
+    except Exception as e:
+        print(f"⚠️ RUC padrón lookup failed: {str(e)}")
+        return None
+    if status is None or status.activo:
+        return None
+
+    print(f"🚫 Emisor {ruc_emisor} not active in RUC padrón: {status.estado} / {status.condicion}")
+    return {
+        'validado': True,
+        'esValido': False,
+        'estado': 'INVALIDO',
+        'motivo': f'RUC del emisor no activo en el padrón SUNAT ({status.estado})',
+        'fuente': 'PADRON',
+        'estadoSunat': {
+            'estadoComprobante': {
+                'codigo': None,
+                'descripcion': 'No consultado (RUC no activo en padrón)'
+            },
+            'estadoRuc': {
+                'codigo': ESTADO_RUC_CODIGOS.get(status.estado),
+                'descripcion': status.estado
+            },
+            'condicionDomicilio': {
+                'codigo': CONDICION_DOMICILIO_CODIGOS.get(status.condicion),
+                'descripcion': status.condicion
+            },
+            'observaciones': []
+        },
+        'timestampValidacion': datetime.utcnow().isoformat() + 'Z'
+    }
+
+
+def parse_validation_response(status: int, raw: bytes) -> Dict[str, Any]:
+    """
+    Interpreta la respuesta de validarcomprobante / validarreciboporhonorario
+    (los datos vienen en `data`; se acepta también el formato plano).
+    """
+    text = raw.decode('utf-8') if isinstance(raw, (bytes, bytearray)) else str(raw or '')
+    if status != 200:
+        print(f"❌ SUNAT validation failed: {status}")
+        return build_result('ERROR_API', f'Error al consultar SUNAT: HTTP {status}', errorDetalle=text)
+
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return build_result('ERROR_API', 'Respuesta de SUNAT no es JSON', errorDetalle=text)
+    if data.get('success') is False:
+        return build_result('ERROR_API', data.get('message', 'Error desconocido de SUNAT'), errorDetalle=text)
+
+    response_data = data.get('data') or data
+    estado_cp = str(response_data.get('estadoCp', ''))
+    estado_ruc = str(response_data.get('estadoRuc', ''))
+    condicion_domicilio = str(response_data.get('condDomiRuc', response_data.get('condDomicilio', '')))
+
+    # 1=Aceptado, 0=No informado (se mantiene el criterio histórico) y RUC 00=Activo
+    es_valido = estado_cp in {'1', '0'} and estado_ruc == '00'
+    print(f"✅ SUNAT validation completed: {estado_cp}")
+
+    return {
+        'validado': True,
+        'esValido': es_valido,
+        'estado': 'VALIDO' if es_valido else 'INVALIDO',
+        'motivo': 'Comprobante validado exitosamente' if es_valido else 'Comprobante no válido en SUNAT',
+        'estadoSunat': {
+            'estadoComprobante': {
+                'codigo': estado_cp,
+                'descripcion': ESTADOS_COMPROBANTE.get(estado_cp, f'Codigo desconocido: {estado_cp}')
+            },
+            'estadoRuc': {
+                'codigo': estado_ruc,
+                'descripcion': ESTADOS_RUC.get(estado_ruc, f'Codigo desconocido: {estado_ruc}')
+            },
+            'condicionDomicilio': {
+                'codigo': condicion_domicilio,
+                'descripcion': CONDICIONES_DOMICILIO.get(
+                    condicion_domicilio, f'Codigo desconocido: {condicion_domicilio}'
+                )
+            },
+            'observaciones': response_data.get('observaciones', [])
+        },
+        'timestampValidacion': datetime.utcnow().isoformat() + 'Z'
+    }
+
+
+def post_validation(ruc_consultante: str, endpoint: str, token: str, body: Dict[str, Any]):
+    return get_http().request(
+        'POST',
+        API_URL.format(ruc=ruc_consultante, endpoint=endpoint),
+        headers={'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'},
+        body=json.dumps(body)
+    )
+
+
+def send_validation(
+    ruc_consultante: str,
+    request: Dict[str, Any],
+    token: str,
+    span,
+    limiter: Optional[TokenBucket] = None
+) -> Tuple[Any, str]:
+    response = post_validation(ruc_consultante, request['endpoint'], token, request['body'])
+    if response.status == 401:
+        # Token revocado o vencido antes de tiempo: uno nuevo y un reintento
+        # (otra consulta a SUNAT: también consume del bucket)
+        invalidate_token(token)
+        with span('SunatToken'):
+            token = get_token()
+        if token:
+            if limiter:
+                limiter.acquire()
+            response = post_validation(ruc_consultante, request['endpoint'], token, request['body'])
+    return response, token
+
+
+def validate_invoice(
+    invoice_data: Dict[str, Any],
+    span: Optional[Callable[[str], Any]] = None,
+    refresh: bool = False,
+    limiter: Optional[TokenBucket] = None,
+    max_attempts: int = 1,
+    prescreen: bool = True
+) -> Dict[str, Any]:
+    """
+    Valida el comprobante contra SUNAT (con caché de resultados).
+    span: context manager por etapa del llamador (métricas SunatCache /
+    SunatToken); refresh: ignora la caché y vuelve a consultar.
+    limiter: bucket que se consume antes de cada consulta (también en los
+    reintentos); max_attempts > 1 reintenta 429/5xx respetando Retry-After.
+    Las Lambdas usan un solo intento: sus reintentos los agenda el barrido.
+    prescreen=False omite el padrón cuando el llamador ya lo consultó (la
+    ingesta filtra el emisor antes de validar o encolar).
+    """
+    span = span or (lambda stage: nullcontext())
+    _, _, ruc_consultante = get_credentials()
+    if not ruc_consultante:
+        print("⚠️ SUNAT_RUC not configured, skipping SUNAT validation")
+        return build_result('NO_VALIDADO', 'Credenciales SUNAT no configuradas')
+
+    breaker = get_breaker()
+    # None: la consulta aún no pasó por el breaker (no se reporta)
+    probe = None
+    try:
+        request, result = prepare_validation(invoice_data)
+        if result:
+            return result
+
+        result = prescreen_emisor(invoice_data) if prescreen else None
+        if result:
+            return result
+
+        identity = request['identity']
+        if RESULT_CACHE_ENABLED and not refresh:
+            with span('SunatCache'):
+                cached = get_cached_result(identity)
+            if cached:
+                print(f"♻️ SUNAT result from cache for {request['label']}: {cached['estado']}")
+                return cached
+
+        if breaker:
+            allowed, probe = breaker.allow()
+            if not allowed:
+                print(f"⛔ SUNAT circuit open, skipping {request['label']}")
+                return circuit_open_result(breaker)
+
+        with span('SunatToken'):
+            token = get_token()
+        if not token:
+            if breaker and credentials_configured():
+                breaker.record(False, probe)
+            return build_result('ERROR_TOKEN', 'No se pudo obtener token de SUNAT')
+
+        print(f"🔍 Validating invoice with SUNAT: {request['label']}")
+        attempt = 1
+        while True:
+            if limiter:
+                limiter.acquire()
+            response, token = send_validation(ruc_consultante, request, token, span, limiter)
+            if response.status not in RETRYABLE_HTTP or attempt >= max_attempts:
+                break
+            delay = retry_delay(response, attempt)
+            print(f"⏳ SUNAT HTTP {response.status}, retrying in {delay:.1f}s ({attempt}/{max_attempts})")
+            if limiter:
+                limiter.pause(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
+
+        if breaker:
+            breaker.record(breaker_outcome(response.status), probe)
+        result = parse_validation_response(response.status, response.data)
+        if RESULT_CACHE_ENABLED:
+            store_result(identity, result)
+        return result
+
+    except Exception as e:
+        print(f"❌ Error validating with SUNAT: {str(e)}")
+        if breaker and probe is not None:
+            breaker.record(False, probe)
+        import traceback
+        traceback.print_exc()
+        return build_result('ERROR_EXCEPCION', f'Excepción al validar: {str(e)}')
+
+
+# ---------- Índice de reintentos ----------
+
+def retry_bucket(next_retry_at: str) -> str:
+    """
+    Partición del GSI de reintentos: RETRY#<día UTC del vencimiento>#<shard>,
+    con el shard al azar en cada escritura.
+    """
+    import random
+    return f"RETRY#{next_retry_at[:10]}#{random.randrange(RETRY_BUCKET_SHARDS)}"
+
+
+def retry_buckets(day: str) -> list:
+    """
+    Todos los buckets de un día (YYYY-MM-DD): el barrido consulta cada shard.
+    """
+    return [f"RETRY#{day}#{shard}" for shard in range(RETRY_BUCKET_SHARDS)]
+
+
+def retry_schedule(result: Optional[Dict[str, Any]]) -> Dict[str, str]:
+    """
+    Atributos del índice de reintentos para un item recién creado: PENDIENTE
+    vence pasada la gracia de la cola, un error reintentable de inmediato (o
+    en reintentarDesde si el breaker estaba abierto). {} si no hay reintento.
+    """
+    estado = (result or {}).get('estado') or 'NO_VALIDADO'
+    if result and estado not in RETRY_STATUSES:
+        return {}
+    if result and result.get('reintentarDesde'):
+        next_retry_at = result['reintentarDesde']
+    elif estado == 'PENDIENTE':
+        next_retry_at = (datetime.utcnow() + timedelta(minutes=RETRY_PENDING_GRACE_MINUTES)).isoformat() + 'Z'
+    else:
+        next_retry_at = datetime.utcnow().isoformat() + 'Z'
+    return {'sunatNextRetryAt': next_retry_at, 'sunatRetryBucket': retry_bucket(next_retry_at)}
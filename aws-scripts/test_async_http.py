@@ -0,0 +1,217 @@
+"""
+Test del pool HTTP/1.1 de sunat_async contra un servidor local
+(asyncio.start_server): Content-Length y chunked, Connection: close,
+reutilización de conexiones keep-alive, un servidor que corta a mitad de
+respuesta y la reautenticación tras un 401 (token pedido por el mismo
+pool, reenvío por el limitador).
+"""
+
+import asyncio
+import json
+
+import pytest
+
+import sunat_async
+import sunat_client
+
+
+def reply(status, body=b'', headers=None, close=False):
+    lines = [f'HTTP/1.1 {status} X']
+    lines += [f'{name}: {value}' for name, value in (headers or {'Content-Length': str(len(body))}).items()]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body, close
+
+
+class LocalServer:
+    """
+    Servidor HTTP/1.1 mínimo: `respond(method, path, headers, body)` retorna
+    (bytes crudos de la respuesta, cerrar la conexión después).
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+        self.connections = 0
+        self._server = None
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._server.close()
+
+    def url(self, path='/'):
+        return f'http://127.0.0.1:{self.port}{path}'
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                request_line, *header_lines = head.decode('latin-1').strip().split('\r\n')
+                headers = {name.lower(): value.strip() for name, _, value in
+                           (line.partition(':') for line in header_lines)}
+                body = await reader.readexactly(int(headers.get('content-length', '0')))
+                method, path, _ = request_line.split(' ')
+                self.requests.append((method, path, headers, body))
+                raw, close = self.respond(method, path, headers, body)
+                writer.write(raw)
+                await writer.drain()
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def scripted(*responses):
+    pending = list(responses)
+    return lambda method, path, headers, body: pending.pop(0)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_content_length_and_keep_alive_reuse():
+    async def scenario():
+        async with LocalServer(scripted(reply(200, b'hola'), reply(201, b'otra vez'))) as server:
+            pool = sunat_async.AsyncConnectionPool()
+            first = await pool.request('POST', server.url('/a'), {'X-Test': '1'}, b'{"a": 1}')
+            second = await pool.request('GET', server.url('/b'))
+            await pool.close()
+            return server, first, second
+
+    server, first, second = run(scenario())
+    assert (first.status, first.data, first.headers['content-length']) == (200, b'hola', '4')
+    assert (second.status, second.data) == (201, b'otra vez')
+    assert server.connections == 1
+    assert server.requests[0][3] == b'{"a": 1}' and server.requests[0][2]['x-test'] == '1'
+
+
+def test_chunked_body_with_extensions_and_trailers():
+    chunked = b'4\r\nhola\r\n7;ext=1\r\n, mundo\r\n0\r\nX-Trailer: 1\r\n\r\n'
+    response = reply(200, chunked, {'Transfer-Encoding': 'chunked'})
+
+    async def scenario():
+        async with LocalServer(scripted(response, reply(200, b'ok'))) as server:
+            pool = sunat_async.AsyncConnectionPool()
+            first = await pool.request('GET', server.url())
+            # Los trailers se consumieron: la conexión sigue usable
+            second = await pool.request('GET', server.url())
+            await pool.close()
+            return server, first, second
+
+    server, first, second = run(scenario())
+    assert first.data == b'hola, mundo' and second.data == b'ok'
+    assert server.connections == 1
+
+
+def test_connection_close_is_not_reused():
+    until_close = reply(200, b'hasta el cierre', {'Connection': 'close'}, close=True)
+    with_length = reply(200, b'ok', {'Content-Length': '2', 'Connection': 'close'}, close=True)
+
+    async def scenario():
+        async with LocalServer(scripted(until_close, with_length)) as server:
+            pool = sunat_async.AsyncConnectionPool()
+            first = await pool.request('GET', server.url())
+            second = await pool.request('GET', server.url())
+            idle = sum(len(connections) for connections in pool._idle.values())
+            await pool.close()
+            return server, first, second, idle
+
+    server, first, second, idle = run(scenario())
+    # Sin Content-Length el cuerpo termina al cerrar la conexión
+    assert first.data == b'hasta el cierre' and second.data == b'ok'
+    assert server.connections == 2 and idle == 0
+
+
+def test_server_closing_mid_response():
+    truncated = reply(200, b'{"incomp', {'Content-Length': '100'}, close=True)
+
+    async def scenario():
+        async with LocalServer(scripted(truncated)) as server:
+            pool = sunat_async.AsyncConnectionPool()
+            try:
+                with pytest.raises(asyncio.IncompleteReadError):
+                    await pool.request('GET', server.url())
+                return sum(len(connections) for connections in pool._idle.values())
+            finally:
+                await pool.close()
+
+    assert run(scenario()) == 0
+
+
+def test_stale_keep_alive_connection_is_replaced():
+    # El servidor cierra la conexión ociosa después de responder
+    async def scenario():
+        async with LocalServer(scripted(reply(200, b'uno', close=True), reply(200, b'dos'))) as server:
+            pool = sunat_async.AsyncConnectionPool()
+            first = await pool.request('GET', server.url())
+            await asyncio.sleep(0.05)
+            second = await pool.request('GET', server.url())
+            await pool.close()
+            return server, first, second
+
+    server, first, second = run(scenario())
+    assert (first.data, second.data) == (b'uno', b'dos')
+    assert server.connections == 2
+
+
+def test_401_refreshes_token_through_the_pool_and_the_limiter(monkeypatch, fake_table):
+    issued = []
+
+    def respond(method, path, headers, body):
+        if path.startswith('/token/'):
+            issued.append(f'tok-{len(issued) + 1}')
+            return reply(200, json.dumps({'access_token': issued[-1], 'expires_in': 3600}).encode())
+        if headers['authorization'] == 'Bearer tok-1':
+            return reply(401, b'{}')
+        data = {'success': True, 'data': {'estadoCp': '1', 'estadoRuc': '00', 'condDomiRuc': '00'}}
+        return reply(200, json.dumps(data).encode())
+
+    monkeypatch.setenv('SUNAT_CLIENT_ID', 'cliente')
+    monkeypatch.setenv('SUNAT_CLIENT_SECRET', 'secreto')
+    monkeypatch.setenv('SUNAT_RUC', '20100070970')
+    monkeypatch.setitem(sunat_client._token_cache, 'token', None)
+    monkeypatch.setitem(sunat_client._token_cache, 'expires_at', 0.0)
+    monkeypatch.setattr(sunat_client, 'BREAKER_ENABLED', False)
+    monkeypatch.setattr(sunat_client, 'RESULT_CACHE_ENABLED', False)
+    table = fake_table('control')
+    monkeypatch.setattr(sunat_client, 'get_control_table', lambda: table)
+
+    def no_sync_http():
+        raise AssertionError('el token debe pedirse por el pool asíncrono')
+
+    monkeypatch.setattr(sunat_client, 'get_http', no_sync_http)
+
+    invoice = {
+        'emisor': {'numeroDocumento': '20100070970'},
+        'numeroFactura': 'F001-1',
+        'tipoComprobante': 'FACTURA',
+        'fechaEmision': '2026-01-01',
+        'montos': {'total': 10}
+    }
+
+    async def scenario():
+        async with LocalServer(respond) as server:
+            monkeypatch.setattr(sunat_client, 'TOKEN_URL', server.url('/token/{client_id}/'))
+            monkeypatch.setattr(sunat_async, 'API_URL', server.url('/v1/{ruc}/{endpoint}'))
+            client = sunat_async.AsyncSunatClient()
+            acquired = []
+            try_acquire = client.limiter.try_acquire
+            monkeypatch.setattr(client.limiter, 'try_acquire', lambda: acquired.append(1) or try_acquire())
+            async with client:
+                outcome = await client.validate_invoice(invoice)
+            return server, outcome, acquired
+
+    server, outcome, acquired = run(scenario())
+    assert outcome.estado == 'VALIDO' and outcome.attempts == 1
+    assert issued == ['tok-1', 'tok-2']
+    validations = [request for request in server.requests if request[1].startswith('/v1/')]
+    assert [request[2]['authorization'] for request in validations] == ['Bearer tok-1', 'Bearer tok-2']
+    # Cada POST de validación pasó por el limitador, también el reenvío
+    assert len(acquired) == 2
+    assert table.get_item(Key=sunat_client.token_key('cliente'))['Item']['token'] == 'tok-2'
@@ -0,0 +1,214 @@
+"""
+Test del rate limiter compartido de Bedrock (AdaptiveTokenBucket) sobre la
+FakeTable de fake_dynamodb, que evalúa las ConditionExpression de verdad:
+recarga GCRA con UpdateItem condicional (también entre dos contenedores),
+AIMD (baja multiplicativa ante throttling, recuperación aditiva) y el
+camino BedrockCapacityUnavailable → defer_record con DelaySeconds.
+"""
+
+import json
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+import lambda_claude
+
+
+class FakeClock:
+    """Reemplaza el módulo time de lambda_claude: sleep avanza el reloj."""
+
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(lambda_claude, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def control_table(monkeypatch, fake_table):
+    table = fake_table('control')
+    monkeypatch.setattr(lambda_claude, 'get_control_table', lambda: table)
+    return table
+
+
+def bucket(rate=1.0, burst=3, min_rate=0.2, max_rate=1.2):
+    return lambda_claude.AdaptiveTokenBucket(
+        'test', initial_rate=rate, min_rate=min_rate, max_rate=max_rate,
+        burst=burst, increase=0.1, decrease=0.5
+    )
+
+
+def shared_rate(table):
+    return float(table.get_item(Key={'PK': 'RATELIMIT#test', 'SK': 'BUCKET'})['Item']['rate'])
+
+
+def test_burst_then_refill(clock, control_table):
+    limiter = bucket()
+    assert [limiter.try_acquire() for _ in range(3)] == [0, 0, 0]
+    assert limiter.try_acquire() == pytest.approx(1.0)
+
+    clock.now += 1
+    assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() == pytest.approx(1.0)
+
+    # Bucket lleno otra vez: tat quedó en el pasado
+    clock.now += 60
+    assert [limiter.try_acquire() for _ in range(3)] == [0, 0, 0]
+    assert limiter.try_acquire() > 0
+
+
+def test_two_containers_share_the_bucket(clock, control_table):
+    first, second = bucket(), bucket()
+    taken = [limiter.try_acquire() == 0 for limiter in [first, second] * 4]
+    # El segundo parte sin vista del item: la condición falla y usa ALL_OLD
+    assert taken.count(True) == 3
+    assert first.try_acquire() == second.try_acquire() == pytest.approx(1.0)
+
+    clock.now += 2
+    assert [second.try_acquire(), first.try_acquire(), second.try_acquire()] == [0, 0, pytest.approx(1.0)]
+
+
+def test_throttle_halves_the_rate_down_to_the_minimum(clock, control_table):
+    limiter = bucket()
+    limiter.try_acquire()
+    rates = []
+    for _ in range(5):
+        limiter.record_throttle()
+        rates.append(shared_rate(control_table))
+    assert rates == pytest.approx([0.5, 0.25, 0.2, 0.2, 0.2])
+
+    # Con menos tasa el próximo token tarda más
+    clock.now += 60
+    assert [limiter.try_acquire() for _ in range(3)] == [0, 0, 0]
+    assert limiter.try_acquire() == pytest.approx(5.0)
+
+
+def test_throttle_recomputes_over_a_rate_changed_by_another_container(clock, control_table):
+    first, second = bucket(), bucket()
+    first.try_acquire()
+    second.try_acquire()
+    first.record_throttle()
+    # second aún ve rate=1.0: la condición falla y reduce sobre 0.5
+    second.record_throttle()
+    assert shared_rate(control_table) == pytest.approx(0.25)
+
+
+def test_success_recovers_additively_up_to_the_maximum(clock, control_table):
+    limiter = bucket()
+    limiter.try_acquire()
+    limiter.record_throttle()
+    rates = []
+    for _ in range(10):
+        limiter.record_success()
+        rates.append(round(shared_rate(control_table), 4))
+    assert rates[:3] == [0.6, 0.7, 0.8]
+    assert max(rates) <= 1.2 and rates[-1] == rates[-2]
+
+
+def test_local_bucket_when_dynamodb_is_unavailable(clock, monkeypatch):
+    def unavailable():
+        raise ClientError({'Error': {'Code': 'ResourceNotFoundException', 'Message': 'x'}}, 'UpdateItem')
+
+    monkeypatch.setattr(lambda_claude, 'get_control_table', unavailable)
+    limiter = bucket()
+    assert [limiter.try_acquire() for _ in range(3)] == [0, 0, 0]
+    assert limiter.try_acquire() == pytest.approx(1.0)
+    limiter.record_throttle()
+    assert limiter._local['rate'] == 0.5
+
+
+class RecordingSqs:
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, **kwargs):
+        self.messages.append(kwargs)
+
+
+@pytest.fixture
+def sqs(monkeypatch):
+    sqs = RecordingSqs()
+    monkeypatch.setattr(lambda_claude, 'get_client', lambda name: sqs)
+    monkeypatch.setattr(lambda_claude, 'RETRY_QUEUE_URL', 'https://sqs.local/reintentos')
+    monkeypatch.setattr(lambda_claude, 'METRICS_ENABLED', False)
+    return sqs
+
+
+def s3_message(message_id, key):
+    body = {'Records': [{'s3': {'bucket': {'name': 'facturas'}, 'object': {'key': key, 'size': 10}}}]}
+    return {'messageId': message_id, 'body': json.dumps(body)}
+
+
+def test_capacity_wait_within_limit_sleeps(clock, control_table, monkeypatch):
+    monkeypatch.setattr(lambda_claude, 'bedrock_rate_limiter', bucket(rate=4.0, burst=1))
+    monkeypatch.setattr(lambda_claude, 'BEDROCK_MAX_TOKEN_WAIT', 0.5)
+    lambda_claude.acquire_bedrock_capacity()
+    lambda_claude.acquire_bedrock_capacity()
+    assert clock.sleeps == [pytest.approx(0.25)]
+
+
+def test_exhausted_bucket_defers_the_record(clock, control_table, sqs, monkeypatch):
+    monkeypatch.setattr(lambda_claude, 'bedrock_rate_limiter', bucket(rate=0.1, burst=1))
+    monkeypatch.setattr(lambda_claude, 'BEDROCK_MAX_TOKEN_WAIT', 0.5)
+    monkeypatch.setattr(lambda_claude, 'process_event_record', lambda record: lambda_claude.invoke_bedrock({}))
+    lambda_claude.bedrock_rate_limiter.try_acquire()
+
+    response = lambda_claude.lambda_handler({'Records': [s3_message('m-1', 'acme/factura.pdf')]}, None)
+
+    assert response['batchItemFailures'] == []
+    assert json.loads(response['body'])['records'][0]['status'] == 'deferred'
+    assert clock.sleeps == []
+    [message] = sqs.messages
+    assert message['DelaySeconds'] == 10
+    assert json.loads(message['MessageBody']) == {
+        'bucket': 'facturas', 'key': 'acme/factura.pdf', 'size': 10, 'motivo': 'bedrock_capacity'
+    }
+
+
+def test_throttling_lowers_the_rate_and_defers(clock, control_table, sqs, monkeypatch):
+    limiter = bucket()
+    monkeypatch.setattr(lambda_claude, 'bedrock_rate_limiter', limiter)
+    monkeypatch.setattr(lambda_claude, 'BEDROCK_STREAMING', False)
+
+    def throttled(model_id, request_body):
+        raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'x'}}, 'InvokeModel')
+
+    monkeypatch.setattr(lambda_claude, 'read_bedrock_response', throttled)
+    monkeypatch.setattr(lambda_claude, 'process_event_record', lambda record: lambda_claude.invoke_bedrock({}))
+
+    response = lambda_claude.lambda_handler({'Records': [s3_message('m-1', 'acme/factura.pdf')]}, None)
+
+    assert response['batchItemFailures'] == []
+    assert shared_rate(control_table) == pytest.approx(0.5)
+    [message] = sqs.messages
+    assert message['DelaySeconds'] == int(1.0 / lambda_claude.BEDROCK_RATE_MIN)
+
+
+def test_without_retry_queue_the_record_fails(clock, control_table, sqs, monkeypatch):
+    monkeypatch.setattr(lambda_claude, 'RETRY_QUEUE_URL', None)
+    monkeypatch.setattr(lambda_claude, 'bedrock_rate_limiter', bucket(rate=0.1, burst=1))
+    monkeypatch.setattr(lambda_claude, 'process_event_record', lambda record: lambda_claude.invoke_bedrock({}))
+    lambda_claude.bedrock_rate_limiter.try_acquire()
+
+    response = lambda_claude.lambda_handler({'Records': [s3_message('m-1', 'acme/factura.pdf')]}, None)
+    assert response['batchItemFailures'] == [{'itemIdentifier': 'm-1'}]
+    assert sqs.messages == []
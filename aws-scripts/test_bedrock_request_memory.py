@@ -0,0 +1,102 @@
+"""
+Test de memoria: construcción del request a Bedrock para un PDF de 30 MB
+Compara el armado anterior (base64 → str → dict → json.dumps) con el buffer
+pre-dimensionado de lambda_claude.build_document_request_body.
+No llama a AWS: solo arma los cuerpos y mide el pico con tracemalloc.
+"""
+
+import base64
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import lambda_claude
+
+PDF_SIZE = int(os.environ.get('TEST_PDF_SIZE_MB', '30')) * 1024 * 1024
+# El cuerpo en base64 ocupa 4/3 del documento; se tolera un margen para el JSON y los bloques
+MAX_PEAK_RATIO = 1.5
+
+
+def make_pdf(size):
+    """PDF sintético: cabecera válida + relleno binario no comprimible"""
+    header = b'%PDF-1.4\n'
+    return header + os.urandom(size - len(header))
+
+
+def legacy_request(pdf_bytes):
+    """Armado anterior de analyze_invoice_with_bedrock_document"""
+    request_body = {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": 8000,
+        "system": lambda_claude.build_system_prompt(),
+        "messages": [{
+            "role": "user",
+            "content": [{
+                "type": "document",
+                "source": {
+                    "type": "base64",
+                    "media_type": "application/pdf",
+                    "data": base64.standard_b64encode(pdf_bytes).decode('utf-8')
+                }
+            }]
+        }]
+    }
+    # botocore codifica el str a bytes antes de firmar
+    return json.dumps(request_body).encode('utf-8')
+
+
+def buffered_request(file_source):
+    write_body, body_size = lambda_claude.build_document_request_body(
+        file_source, 'application/pdf', 'document'
+    )
+    return write_body(bytearray(body_size))
+
+
+def measure(label, build, source, doc_size):
+    tracemalloc.start()
+    body = build(source)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    ratio = peak / doc_size
+    print(f"📏 {label}: body {len(body) / 1024 / 1024:.1f} MB, peak {peak / 1024 / 1024:.1f} MB ({ratio:.2f}x documento)")
+    return body, ratio
+
+
+def run_comparison():
+    pdf_bytes = make_pdf(PDF_SIZE)
+    print(f"📄 PDF sintético: {len(pdf_bytes) / 1024 / 1024:.0f} MB")
+
+    legacy_body, legacy_ratio = measure('anterior (json.dumps)', legacy_request, pdf_bytes, len(pdf_bytes))
+    memory_body, memory_ratio = measure('buffer desde memoria', buffered_request, pdf_bytes, len(pdf_bytes))
+
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as spilled:
+        spilled.write(pdf_bytes)
+    try:
+        file_body, file_ratio = measure('buffer desde /tmp', buffered_request, spilled.name, len(pdf_bytes))
+    finally:
+        os.unlink(spilled.name)
+
+    # Mismo contenido que el armado anterior (el JSON se compara parseado)
+    legacy_data = json.loads(legacy_body)['messages'][0]['content'][0]['source']['data']
+    for body in (memory_body, file_body):
+        data = json.loads(bytes(body))['messages'][0]['content'][0]['source']['data']
+        assert data == legacy_data, "base64 distinto al armado anterior"
+    return legacy_ratio, memory_ratio, file_ratio
+
+
+def test_document_request_peak_ratio():
+    _, memory_ratio, file_ratio = run_comparison()
+    assert memory_ratio <= MAX_PEAK_RATIO, f"pico {memory_ratio:.2f}x el documento (desde memoria)"
+    assert file_ratio <= MAX_PEAK_RATIO, f"pico {file_ratio:.2f}x el documento (desde /tmp)"
+
+
+if __name__ == '__main__':
+    legacy_ratio, memory_ratio, file_ratio = run_comparison()
+    if max(memory_ratio, file_ratio) > MAX_PEAK_RATIO:
+        print(f"❌ Pico de memoria sobre {MAX_PEAK_RATIO}x el documento")
+        sys.exit(1)
+    print(f"✅ Pico de memoria dentro de {MAX_PEAK_RATIO}x (anterior: {legacy_ratio:.2f}x)")
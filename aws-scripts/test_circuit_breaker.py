@@ -0,0 +1,210 @@
+"""
+Test del circuit breaker compartido de SUNAT (CircuitBreaker) con reloj
+falso y la FakeTable de fake_dynamodb como tabla de control: cerrado →
+abierto → semiabierto → cerrado (o de vuelta a abierto), el estado visto
+desde otro contenedor, y un 429 contado como falla en validate_invoice.
+"""
+
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import sunat_client
+
+INVOICE = {
+    'emisor': {'numeroDocumento': '20100070970'},
+    'numeroFactura': 'F001-1',
+    'tipoComprobante': 'FACTURA',
+    'fechaEmision': '2026-01-01',
+    'montos': {'total': 10}
+}
+
+
+class FakeClock:
+    """Reemplaza el módulo time de sunat_client."""
+
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(sunat_client, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def control_table(monkeypatch, fake_table):
+    table = fake_table('control')
+    monkeypatch.setattr(sunat_client, 'get_control_table', lambda: table)
+    return table
+
+
+def shared_state(table):
+    return table.get_item(Key=sunat_client.BREAKER_KEY).get('Item')
+
+
+def open_breaker(breaker):
+    for _ in range(sunat_client.BREAKER_FAILURE_THRESHOLD):
+        assert breaker.allow() == (True, False)
+        breaker.record(False)
+
+
+def test_consecutive_failures_open_the_circuit(clock, control_table):
+    breaker = sunat_client.CircuitBreaker()
+    for _ in range(sunat_client.BREAKER_FAILURE_THRESHOLD - 1):
+        breaker.record(False)
+    breaker.record(True)
+    assert breaker.allow() == (True, False) and shared_state(control_table) is None
+
+    open_breaker(breaker)
+    assert breaker.allow() == (False, False) and breaker.is_open()
+    assert float(shared_state(control_table)['openUntil']) == clock.now + sunat_client.BREAKER_OPEN_SECONDS
+    assert breaker.retry_at() == clock.now + sunat_client.BREAKER_OPEN_SECONDS
+
+
+def test_error_rate_over_the_window_opens_the_circuit(clock, control_table):
+    breaker = sunat_client.CircuitBreaker()
+    for ok in [True, False] * (sunat_client.BREAKER_WINDOW // 2 - 1):
+        breaker.record(ok)
+    assert not breaker.is_open()
+    breaker.record(True)
+    breaker.record(False)
+    assert breaker.is_open()
+
+
+def test_other_containers_see_the_open_circuit(clock, control_table):
+    first, second = sunat_client.CircuitBreaker(), sunat_client.CircuitBreaker()
+    assert second.allow() == (True, False)
+    open_breaker(first)
+
+    # second relee el item recién al vencer su caché local
+    assert second.allow() == (True, False)
+    clock.now += sunat_client.BREAKER_CACHE_SECONDS
+    assert second.allow() == (False, False)
+
+
+def test_half_open_single_probe_then_close(clock, control_table):
+    first, second = sunat_client.CircuitBreaker(), sunat_client.CircuitBreaker()
+    open_breaker(first)
+    clock.now += sunat_client.BREAKER_OPEN_SECONDS - 1
+    assert second.allow() == (False, False)
+    clock.now += 1
+
+    assert first.allow() == (True, True)
+    assert float(shared_state(control_table)['probeUntil']) > clock.now
+    # Un solo contenedor prueba; second aún no vio el lease (caché local):
+    # la condición del UpdateItem lo rechaza
+    assert first.allow() == (False, False)
+    assert second.allow() == (False, False)
+
+    first.record(True, probe=True)
+    assert shared_state(control_table) is None
+    assert first.allow() == (True, False)
+    clock.now += sunat_client.BREAKER_CACHE_SECONDS
+    assert second.allow() == (True, False)
+
+
+def test_failed_probe_reopens(clock, control_table):
+    breaker = sunat_client.CircuitBreaker()
+    open_breaker(breaker)
+    clock.now += sunat_client.BREAKER_OPEN_SECONDS
+    assert breaker.allow() == (True, True)
+
+    breaker.record(False, probe=True)
+    assert breaker.allow() == (False, False)
+    assert float(shared_state(control_table)['openUntil']) == clock.now + sunat_client.BREAKER_OPEN_SECONDS
+    assert 'probeUntil' not in shared_state(control_table)
+
+
+def test_expired_probe_lease_is_taken_over(clock, control_table):
+    first, second = sunat_client.CircuitBreaker(), sunat_client.CircuitBreaker()
+    open_breaker(first)
+    clock.now += sunat_client.BREAKER_OPEN_SECONDS
+    assert first.allow() == (True, True)
+
+    # El contenedor que probaba murió sin reportar
+    clock.now += sunat_client.BREAKER_PROBE_SECONDS + 1
+    assert second.allow() == (True, True)
+
+
+def test_local_state_when_the_control_table_is_unavailable(clock, monkeypatch):
+    def unavailable():
+        raise ConnectionError('DynamoDB no disponible')
+
+    monkeypatch.setattr(sunat_client, 'get_control_table', unavailable)
+    breaker = sunat_client.CircuitBreaker()
+    open_breaker(breaker)
+    assert breaker.allow() == (False, False)
+    clock.now += sunat_client.BREAKER_OPEN_SECONDS
+    assert breaker.allow() == (True, True)
+    breaker.record(True, probe=True)
+    assert breaker.allow() == (True, False)
+
+
+@pytest.fixture
+def sunat(monkeypatch, clock, control_table):
+    """validate_invoice contra un HTTP falso que responde `statuses` en orden."""
+    monkeypatch.setenv('SUNAT_CLIENT_ID', 'cliente')
+    monkeypatch.setenv('SUNAT_CLIENT_SECRET', 'secreto')
+    monkeypatch.setenv('SUNAT_RUC', '20100070970')
+    monkeypatch.setattr(sunat_client, 'BREAKER_ENABLED', True)
+    monkeypatch.setattr(sunat_client, '_breaker', None)
+    monkeypatch.setattr(sunat_client, 'RESULT_CACHE_ENABLED', False)
+    monkeypatch.setattr(sunat_client, 'get_token', lambda request=None: 'tok')
+
+    statuses = []
+    sent = []
+
+    def request(method, url, headers=None, body=None):
+        sent.append(url)
+        status = statuses.pop(0)
+        data = {'success': True, 'data': {'estadoCp': '1', 'estadoRuc': '00', 'condDomiRuc': '00'}}
+        return SimpleNamespace(status=status, data=json.dumps(data if status == 200 else {}).encode(), headers={})
+
+    monkeypatch.setattr(sunat_client, 'get_http', lambda: SimpleNamespace(request=request))
+    return SimpleNamespace(statuses=statuses, sent=sent)
+
+
+def validate():
+    return sunat_client.validate_invoice(INVOICE, prescreen=False)['estado']
+
+
+def test_sustained_429_opens_the_circuit(sunat, clock):
+    threshold = sunat_client.BREAKER_FAILURE_THRESHOLD
+    sunat.statuses.extend([429] * threshold)
+    assert [validate() for _ in range(threshold)] == ['ERROR_API'] * threshold
+
+    # Abierto: no se consulta a SUNAT
+    assert validate() == 'ERROR_API'
+    assert len(sunat.sent) == threshold
+
+    # Un 429 en la prueba no cierra el circuito
+    clock.now += sunat_client.BREAKER_OPEN_SECONDS
+    sunat.statuses.append(429)
+    validate()
+    assert sunat_client.get_breaker().is_open() and len(sunat.sent) == threshold + 1
+
+    clock.now += sunat_client.BREAKER_OPEN_SECONDS
+    sunat.statuses.append(200)
+    assert validate() == 'VALIDO'
+    assert not sunat_client.get_breaker().is_open()
+
+
+def test_client_errors_do_not_open_the_circuit(sunat):
+    sunat.statuses.extend([400, 404] * sunat_client.BREAKER_FAILURE_THRESHOLD)
+    for _ in range(2 * sunat_client.BREAKER_FAILURE_THRESHOLD):
+        validate()
+    assert not sunat_client.get_breaker().is_open()
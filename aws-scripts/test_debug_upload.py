@@ -0,0 +1,88 @@
+"""
+Test de la copia del adjunto en S3 (upload_debug_attachment): si la subida
+falla no se devuelve una key que no existe, Textract (síncrono con
+S3Object o asíncrono) falla con un error claro, y el pipeline espera la
+subida en segundo plano aunque falle el guardado (el archivo temporal se
+elimina al terminar el record).
+"""
+
+import threading
+from concurrent.futures import Future
+
+import pytest
+from botocore.exceptions import ClientError
+
+import lambda_claude
+
+
+class FailingS3:
+    def head_object(self, Bucket, Key):
+        raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+
+    def put_object(self, **kwargs):
+        raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}}, 'PutObject')
+
+
+def done(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+@pytest.fixture(autouse=True)
+def no_metrics(monkeypatch):
+    monkeypatch.setattr(lambda_claude, 'METRICS_ENABLED', False)
+
+
+def attachment(size=100):
+    return {
+        'filename': 'factura.pdf',
+        'media_type': 'application/pdf',
+        'bytes': b'%PDF-1.4\n' + b'0' * size,
+        'sha256': 'ab' * 32
+    }
+
+
+def test_failed_upload_returns_no_key(monkeypatch):
+    monkeypatch.setattr(lambda_claude, 'get_client', lambda name: FailingS3())
+    assert lambda_claude.upload_debug_attachment('facturas', attachment()) is None
+
+
+def test_textract_without_s3_copy_fails_clearly(monkeypatch):
+    monkeypatch.setattr(lambda_claude, 'TEXTRACT_BYTES_MAX', 10)
+    with pytest.raises(lambda_claude.S3CopyUnavailable):
+        lambda_claude.build_textract_document(attachment(), 'facturas', done(None))
+    # Dentro del límite va como Bytes y no depende de la copia
+    monkeypatch.setattr(lambda_claude, 'TEXTRACT_BYTES_MAX', 1024)
+    assert 'Bytes' in lambda_claude.build_textract_document(attachment(), 'facturas', done(None))
+
+    with pytest.raises(lambda_claude.S3CopyUnavailable):
+        lambda_claude.start_async_textract_job('acme', attachment(), 'facturas', 'correo', 100, done(None))
+
+
+def test_pipeline_waits_for_the_upload_when_saving_fails(monkeypatch):
+    release = threading.Event()
+    finished = []
+
+    def slow_upload(bucket, item):
+        release.wait(5)
+        finished.append(item['filename'])
+        return 'debug/sha256/x.pdf'
+
+    def failing_save(*args):
+        # La subida sigue en curso: se libera recién al fallar el guardado
+        threading.Timer(0.05, release.set).start()
+        raise RuntimeError('DynamoDB no disponible')
+
+    monkeypatch.setattr(lambda_claude, 'find_invoice_by_content_hash', lambda client_id, content_hash: None)
+    monkeypatch.setattr(lambda_claude, 'attach_pdf_text_layer', lambda item: None)
+    monkeypatch.setattr(lambda_claude, 'upload_debug_attachment', slow_upload)
+    monkeypatch.setattr(lambda_claude, 'should_use_async_textract', lambda item: False)
+    monkeypatch.setattr(lambda_claude, 'process_attachment',
+                        lambda item, bucket, upload: ({'numeroFactura': 'F001-1'}, {'ruta': 'pdf-texto-local'}))
+    monkeypatch.setattr(lambda_claude, 'save_processed_invoice', failing_save)
+
+    metrics = lambda_claude.StageMetrics(mediaType='application/pdf', tenant='acme')
+    with pytest.raises(RuntimeError):
+        lambda_claude.run_attachment_pipeline('acme', attachment(), 'facturas', 'correo', 100, metrics)
+    assert finished == ['factura.pdf']
@@ -0,0 +1,113 @@
+"""
+Test de IncrementalJsonParser (argumentos de la herramienta que llegan como
+fragmentos input_json_delta): el mismo payload partido en cada offset
+posible (a mitad de string, de escape \\" o \\u00f1, de número, dentro de
+objetos y arrays anidados) tiene que reconstruir lo mismo que json.loads y
+exponer los mismos campos de cabecera.
+"""
+
+import json
+
+import pytest
+
+import lambda_claude
+
+INVOICE = {
+    'numeroFactura': 'F001-00012345',
+    'razonSocial': 'Comercial "El Ñandú" S.A.C. \\ Lima',
+    'moneda': 'PEN',
+    'total': -1234.5e2,
+    'igv': 0.18,
+    'items': 3,
+    'pagada': False,
+    'observaciones': None,
+    'detraccion': True,
+    'emisor': {'numeroDocumento': '20100070970', 'direccion': {'distrito': 'Miraflores', 'lineas': ['Av. {1}', '[2]']}},
+    'lineas': [
+        {'descripcion': 'Servicio "premium"', 'cantidad': 2, 'precio': 10.25},
+        {'descripcion': 'Año 2026', 'cantidad': 1, 'precio': 0, 'tags': [[], {}, [1, [2, [3]]]]}
+    ],
+    'vacio': {},
+    'nada': [],
+    'ultimo': 42
+}
+
+PAYLOADS = [
+    # ASCII con ñ escapado y sin espacios
+    json.dumps(INVOICE, separators=(',', ':')),
+    # UTF-8 literal, indentado (saltos de línea fuera de los strings)
+    json.dumps(INVOICE, ensure_ascii=False, indent=2),
+    # Número de primer nivel cerrado por la llave raíz
+    '{"a": "x\\"y", "b": [1, {"c": "}"}], "n": 12.75e-1}'
+]
+
+
+def expected_headers(payload):
+    return {key: value for key, value in json.loads(payload).items() if not isinstance(value, (dict, list))}
+
+
+def parse(fragments):
+    parser = lambda_claude.IncrementalJsonParser()
+    headers = {}
+    for fragment in fragments:
+        new_headers = parser.feed(fragment)
+        assert not set(new_headers) & set(headers), 'cada campo de cabecera se emite una sola vez'
+        headers.update(new_headers)
+    return parser, headers
+
+
+def test_payloads_cover_the_tricky_splits():
+    assert '\\u00f1' in PAYLOADS[0] and '\\"' in PAYLOADS[0] and '-123450.0' in PAYLOADS[0]
+    assert 'ñ' in PAYLOADS[1]
+
+
+@pytest.mark.parametrize('payload', PAYLOADS)
+def test_split_at_every_offset_matches_json_loads(payload):
+    expected = json.loads(payload)
+    for offset in range(len(payload) + 1):
+        parser, headers = parse([payload[:offset], payload[offset:]])
+        assert parser.done, offset
+        assert json.loads(parser.text) == expected, offset
+        assert headers == expected_headers(payload), offset
+
+
+@pytest.mark.parametrize('payload', PAYLOADS)
+def test_one_character_at_a_time(payload):
+    parser, headers = parse(list(payload))
+    assert parser.done and json.loads(parser.text) == json.loads(payload)
+    assert headers == parser.headers == expected_headers(payload)
+
+
+def test_string_header_is_exposed_as_soon_as_it_closes():
+    parser = lambda_claude.IncrementalJsonParser()
+    assert parser.feed('{"numeroFactura": "F001-1') == {}
+    assert parser.feed('"') == {'numeroFactura': 'F001-1'}
+    # Los números se conocen recién con el separador siguiente
+    assert parser.feed(', "total": 12') == {}
+    assert parser.feed('.5,') == {'total': 12.5}
+
+
+def test_preamble_and_trailing_text_are_ignored():
+    payload = PAYLOADS[2]
+    parser, headers = parse(['Aquí está el JSON: ', payload, '\nListo.'])
+    assert parser.done and parser.text == payload
+    assert headers == expected_headers(payload)
+
+
+@pytest.mark.parametrize('payload', [
+    '{"a": [1, 2}',
+    '{"a": {"b": 1]}',
+    '{"a": "sin\ncerrar"}',
+    '{"a": 01, "b": 2}',
+    '{"a": tru}'
+])
+def test_invalid_json_is_rejected_at_any_split(payload):
+    for offset in range(len(payload) + 1):
+        with pytest.raises(lambda_claude.InvalidJsonStream):
+            parse([payload[:offset], payload[offset:]])
+
+
+def test_long_preamble_is_rejected():
+    parser = lambda_claude.IncrementalJsonParser(preamble_max=10)
+    with pytest.raises(lambda_claude.InvalidJsonStream):
+        parser.feed('No encontré una factura en el documento.')
@@ -0,0 +1,137 @@
+"""
+Test del parseo MIME en streaming (mime_stream): compara las partes
+decodificadas contra email.parser para correos base64, quoted-printable,
+multipart anidado y correos reenviados, alimentados en bloques que cortan
+los delimitadores en cualquier posición. Mide con tracemalloc que un correo
+de 24 MB no quede en memoria.
+"""
+
+import os
+import tempfile
+import tracemalloc
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesParser
+
+import mime_stream
+
+# Umbral de spill (2 MB, un spool en memoria) + un par de bloques de lectura de 1 MB
+MAX_STREAMING_PEAK_BYTES = 5 * 1024 * 1024
+
+
+def accept_files(headers):
+    return bool(headers.get_filename('')) or headers.get_content_disposition() in {'attachment', 'inline'}
+
+
+def build_email(pdf, image, text='Adjunto la factura F001-123.'):
+    msg = EmailMessage()
+    msg['From'] = 'proveedor@example.com'
+    msg['To'] = 'cliente@flow-cfo.com'
+    msg['Subject'] = 'Factura'
+    msg.set_content(text)
+    msg.add_alternative(f'<p>{text}</p>', subtype='html')
+    msg.add_attachment(pdf, maintype='application', subtype='pdf', filename='factura.pdf')
+    msg.add_attachment(image, maintype='image', subtype='png', filename='foto.png', disposition='inline')
+    notes = 'Línea con acentos: ñandú = 3\n' * 40
+    msg.add_attachment(notes.encode('utf-8'), maintype='text', subtype='plain', filename='notas.txt', cte='quoted-printable')
+    return msg
+
+
+def parse_streaming(raw, chunk_size, threshold=1024 * 1024, directory=None):
+    parser = mime_stream.StreamingMimeParser(accept_files, threshold, directory)
+    for start in range(0, len(raw), chunk_size):
+        parser.feed(raw[start:start + chunk_size])
+    return parser, parser.close()
+
+
+def read_part(part):
+    value = part.spool.getvalue()
+    if value is not None:
+        return value
+    with open(part.spool.path, 'rb') as spilled:
+        return spilled.read()
+
+
+def expected_parts(raw):
+    msg = BytesParser(policy=policy.default).parsebytes(raw)
+    return [
+        (part.get_filename(''), part.get_payload(decode=True))
+        for part in msg.walk()
+        if not part.is_multipart() and accept_files(part) and part.get_content_type() != 'message/rfc822'
+    ]
+
+
+def test_matches_email_parser_for_any_chunking():
+    pdf = b'%PDF-1.4\n' + os.urandom(50_000)
+    image = b'\x89PNG\r\n\x1a\n' + os.urandom(20_000)
+    raw = build_email(pdf, image).as_bytes()
+    expected = expected_parts(raw)
+    assert [name for name, _ in expected] == ['factura.pdf', 'foto.png', 'notas.txt']
+
+    for chunk_size in (1, 7, 76, 77, 4096, len(raw)):
+        parser, parts = parse_streaming(raw, chunk_size)
+        assert [(part.get_filename(''), read_part(part)) for part in parts] == expected, chunk_size
+        assert parser.headers['Subject'] == 'Factura'
+        assert parts[0].spool.head.startswith(b'%PDF')
+        assert parts[1].get_content_disposition() == 'inline'
+
+
+def test_crlf_and_forwarded_message():
+    pdf = b'%PDF-1.7\n' + os.urandom(10_000)
+    inner = build_email(pdf, b'\x89PNG\r\n\x1a\n' + os.urandom(100))
+    outer = EmailMessage()
+    outer['Subject'] = 'Fwd: Factura'
+    outer.set_content('Reenvío')
+    outer.add_attachment(inner)
+    raw = outer.as_bytes(policy=policy.SMTP)
+    assert b'\r\n' in raw
+
+    for chunk_size in (3, 1000):
+        parser, parts = parse_streaming(raw, chunk_size)
+        names = [part.get_filename('') for part in parts]
+        assert names == ['factura.pdf', 'foto.png', 'notas.txt']
+        assert read_part(parts[0]) == pdf
+        assert parser.headers['Subject'] == 'Fwd: Factura'
+
+
+def test_large_attachments_spill_to_disk():
+    pdf = b'%PDF-1.4\n' + os.urandom(3 * 1024 * 1024)
+    raw = build_email(pdf, b'\x89PNG\r\n\x1a\n' + os.urandom(100)).as_bytes()
+    with tempfile.TemporaryDirectory() as directory:
+        _, parts = parse_streaming(raw, 64 * 1024, threshold=512 * 1024, directory=directory)
+        spilled = parts[0]
+        assert spilled.spool.getvalue() is None
+        assert os.path.dirname(spilled.spool.path) == directory
+        assert spilled.size == len(pdf) and read_part(spilled) == pdf
+        assert parts[1].spool.path is None
+
+        for part in parts:
+            part.spool.discard()
+        assert os.listdir(directory) == []
+
+
+def test_streaming_peak_is_bounded():
+    pdf = b'%PDF-1.4\n' + os.urandom(12 * 1024 * 1024)
+    scan = b'\x89PNG\r\n\x1a\n' + os.urandom(6 * 1024 * 1024)
+    with tempfile.TemporaryDirectory() as directory:
+        eml_path = os.path.join(directory, 'correo.eml')
+        with open(eml_path, 'wb') as eml:
+            eml.write(build_email(pdf, scan).as_bytes())
+        pdf = scan = None
+
+        tracemalloc.start()
+        try:
+            parser = mime_stream.StreamingMimeParser(accept_files, 2 * 1024 * 1024, directory)
+            with open(eml_path, 'rb') as eml:
+                for chunk in iter(lambda: eml.read(1024 * 1024), b''):
+                    parser.feed(chunk)
+            parts = parser.close()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        assert os.path.getsize(eml_path) > 24 * 1024 * 1024
+        assert [part.spool.path is not None for part in parts] == [True, True, False]
+        assert peak < MAX_STREAMING_PEAK_BYTES, f"pico {peak / 1024 / 1024:.1f} MB"
+        for part in parts:
+            part.spool.discard()
@@ -0,0 +1,58 @@
+"""
+Test de analyze_invoice_text_tiered: un error del modelo rápido que no es
+throttling escala a MODEL_ID; el throttling sigue hacia la ruta de
+capacidad (el record se difiere).
+"""
+
+import pytest
+from botocore.exceptions import ClientError
+
+import lambda_claude
+
+INVOICE = {'numeroFactura': 'F001-1'}
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    monkeypatch.setattr(lambda_claude, 'FAST_MODEL_ID', 'fast-model')
+    monkeypatch.setattr(lambda_claude, 'get_escalation_reasons', lambda invoice_data: [])
+    calls = []
+    return calls
+
+
+def bedrock(monkeypatch, calls, fast_error):
+    def analyze(context_text, max_tokens=4000, model_id=lambda_claude.MODEL_ID):
+        calls.append(model_id)
+        if model_id == 'fast-model' and fast_error:
+            raise fast_error
+        return dict(INVOICE)
+
+    monkeypatch.setattr(lambda_claude, 'analyze_invoice_with_bedrock_text', analyze)
+
+
+@pytest.mark.parametrize('code', ['ValidationException', 'AccessDeniedException', 'ResourceNotFoundException'])
+def test_fast_model_error_escalates(monkeypatch, calls, code):
+    bedrock(monkeypatch, calls, ClientError({'Error': {'Code': code, 'Message': 'x'}}, 'InvokeModel'))
+
+    invoice_data, model_info = lambda_claude.analyze_invoice_text_tiered('texto')
+    assert invoice_data == INVOICE
+    assert calls == ['fast-model', lambda_claude.MODEL_ID]
+    assert model_info['modelTier'] == 'large'
+    assert model_info['motivosEscalado'] == ['error-modelo-rapido']
+
+
+def test_fast_model_accepted(monkeypatch, calls):
+    bedrock(monkeypatch, calls, None)
+    _, model_info = lambda_claude.analyze_invoice_text_tiered('texto')
+    assert calls == ['fast-model'] and model_info['modelTier'] == 'fast'
+
+
+@pytest.mark.parametrize('error', [
+    lambda_claude.BedrockCapacityUnavailable(2.0),
+    ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'x'}}, 'InvokeModel')
+])
+def test_throttling_is_not_escalated(monkeypatch, calls, error):
+    bedrock(monkeypatch, calls, error)
+    with pytest.raises(type(error)):
+        lambda_claude.analyze_invoice_text_tiered('texto')
+    assert calls == ['fast-model']
@@ -0,0 +1,98 @@
+"""
+Test del índice de reintentos de lambda_sunat_retry (GSI3-SunatRetryIndex):
+buckets diarios con shard, backfill que nunca agenda en un bucket fuera de
+la ventana del barrido y recuperación de vencimientos más viejos que
+RETRY_LOOKBACK_DAYS; validate_sunat_batch agenda lo que deja reintentable.
+Usa la FakeTable de fake_dynamodb (evalúa las KeyCondition y
+ConditionExpression de verdad).
+"""
+
+import argparse
+from datetime import timedelta
+
+import pytest
+
+import lambda_sunat_retry
+import sunat_client
+import validate_sunat_batch
+
+
+@pytest.fixture
+def table(monkeypatch, fake_table):
+    fake = fake_table('facturas')
+    monkeypatch.setattr(lambda_sunat_retry, 'get_table', lambda: fake)
+    return fake
+
+
+def put_invoice(table, sk, estado, next_retry_at=None, bucket=None):
+    item = {'PK': 'CLIENT#acme', 'SK': sk, 'validacionSunat': {'estado': estado}}
+    if next_retry_at:
+        item['sunatNextRetryAt'] = next_retry_at
+    if bucket:
+        item['sunatRetryBucket'] = bucket
+    table.put_item(Item=item)
+
+
+def days_ago(days):
+    return lambda_sunat_retry.isoformat_z(lambda_sunat_retry.now_utc() - timedelta(days=days))
+
+
+def test_buckets_are_sharded_per_day():
+    bucket = sunat_client.retry_bucket('2026-10-18T12:00:00Z')
+    assert bucket in sunat_client.retry_buckets('2026-10-18')
+    assert len(set(sunat_client.retry_buckets('2026-10-18'))) == sunat_client.RETRY_BUCKET_SHARDS
+
+
+def test_backfill_clamps_stale_retries_into_the_sweep_window(table):
+    future = lambda_sunat_retry.isoformat_z(lambda_sunat_retry.now_utc() + timedelta(hours=2))
+    stale = days_ago(30)
+    put_invoice(table, 'INVOICE#sin-indice', 'PENDIENTE')
+    put_invoice(table, 'INVOICE#vencida', 'ERROR_API', next_retry_at=stale)
+    put_invoice(table, 'INVOICE#sin-shard', 'ERROR_TOKEN', next_retry_at=stale, bucket=f'RETRY#{stale[:10]}')
+    put_invoice(table, 'INVOICE#futura', 'ERROR_API', next_retry_at=future)
+    put_invoice(table, 'INVOICE#agendada', 'ERROR_API', next_retry_at=future,
+                bucket=sunat_client.retry_bucket(future))
+    put_invoice(table, 'INVOICE#valida', 'VALIDO')
+
+    result = lambda_sunat_retry.backfill_retry_index()
+    assert result['body']['scheduled'] == 4
+
+    due = {key['SK'] for key in lambda_sunat_retry.iter_due_keys(lambda_sunat_retry.now_utc(), 100)}
+    assert due == {'INVOICE#sin-indice', 'INVOICE#vencida', 'INVOICE#sin-shard'}
+    assert table.get_item(Key={'PK': 'CLIENT#acme', 'SK': 'INVOICE#futura'})['Item']['sunatNextRetryAt'] == future
+
+
+def test_catch_up_reschedules_retries_older_than_the_lookback(table):
+    old = days_ago(lambda_sunat_retry.RETRY_LOOKBACK_DAYS + 20)
+    put_invoice(table, 'INVOICE#olvidada', 'ERROR_API', next_retry_at=old, bucket=sunat_client.retry_bucket(old))
+    recent = days_ago(1)
+    put_invoice(table, 'INVOICE#reciente', 'ERROR_API', next_retry_at=recent, bucket=sunat_client.retry_bucket(recent))
+
+    now = lambda_sunat_retry.now_utc()
+    assert [key['SK'] for key in lambda_sunat_retry.iter_due_keys(now, 100)] == ['INVOICE#reciente']
+
+    result = lambda_sunat_retry.handler({'catchUpRetryIndex': True}, None)
+    assert result['body']['rescheduled'] == 1
+
+    due = [key['SK'] for key in lambda_sunat_retry.iter_due_keys(lambda_sunat_retry.now_utc(), 100)]
+    assert sorted(due) == ['INVOICE#olvidada', 'INVOICE#reciente']
+    assert lambda_sunat_retry.handler({'catchUpRetryIndex': True}, None)['body']['rescheduled'] == 0
+
+
+def test_batch_tool_schedules_retryable_results(table, monkeypatch):
+    monkeypatch.setattr(validate_sunat_batch, 'get_thread_table', lambda name, region: table)
+    args = argparse.Namespace(dry_run=False, table='facturas', region='us-east-1')
+    item = {'PK': 'CLIENT#acme', 'SK': 'INVOICE#batch'}
+    table.put_item(Item={**item, 'validacionSunat': {'estado': 'NO_VALIDADO'}})
+
+    error = sunat_client.build_result('ERROR_API', 'Error HTTP 503')
+    validate_sunat_batch.save_result(args, ['PK', 'SK'], item, error)
+    saved = table.get_item(Key=item)['Item']
+    assert saved['validacionSunat']['estado'] == 'ERROR_API'
+    assert saved['sunatRetryBucket'] in sunat_client.retry_buckets(saved['sunatNextRetryAt'][:10])
+    due = [key['SK'] for key in lambda_sunat_retry.iter_due_keys(lambda_sunat_retry.now_utc(), 100)]
+    assert due == ['INVOICE#batch']
+
+    validate_sunat_batch.save_result(args, ['PK', 'SK'], item, sunat_client.build_result('VALIDO', 'OK'))
+    saved = table.get_item(Key=item)['Item']
+    assert 'sunatRetryBucket' not in saved and 'sunatNextRetryAt' not in saved
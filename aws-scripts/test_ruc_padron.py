@@ -0,0 +1,126 @@
+"""
+Test del índice offline del padrón (ruc_padron): ida y vuelta build_index →
+RucIndex.lookup sobre un padrón chico (.txt y .zip, desordenado, con RUC
+repetidos y filas inválidas) y prescreen_emisor con y sin índice (sin
+índice la validación sigue contra la API).
+"""
+
+import zipfile
+
+import pytest
+
+import ruc_padron
+import sunat_client
+
+HEADER = 'RUC|NOMBRE O RAZÓN SOCIAL|ESTADO DEL CONTRIBUYENTE|CONDICIÓN DE DOMICILIO|UBIGEO|\n'
+ROWS = [
+    '10000000001|PRIMERO ÑAÑEZ|ACTIVO|HABIDO|150101|',
+    '20100070970|SUPERMERCADOS PERUANOS S.A.|ACTIVO|HABIDO|150131|',
+    '20512345678|EMPRESA DADA DE BAJA S.A.C.|BAJA DE OFICIO|NO HABIDO|150101|',
+    '20600000001|REPETIDA (PRIMERA FILA)|ACTIVO|HABIDO|150101|',
+    '20600000001|REPETIDA (ÚLTIMA FILA)|SUSPENSION TEMPORAL|NO HALLADO|150101|',
+    '2060000000X|RUC INVÁLIDO|ACTIVO|HABIDO|150101|',
+    '123|RUC CORTO|ACTIVO|HABIDO|150101|',
+    'FILA SIN SEPARADORES',
+    '99999999999|ÚLTIMO|activo |habido|150101|'
+]
+EXPECTED = {
+    '10000000001': ('ACTIVO', 'HABIDO'),
+    '20100070970': ('ACTIVO', 'HABIDO'),
+    '20512345678': ('BAJA DE OFICIO', 'NO HABIDO'),
+    '20600000001': ('SUSPENSION TEMPORAL', 'NO HALLADO'),
+    '99999999999': ('ACTIVO', 'HABIDO')
+}
+
+
+def write_padron(path, rows):
+    path.write_text(HEADER + '\n'.join(rows) + '\n', encoding='latin-1')
+    return path
+
+
+@pytest.fixture(params=['ordenado', 'desordenado', 'zip'])
+def index(request, tmp_path):
+    rows = list(ROWS)
+    if request.param == 'desordenado':
+        # Los repetidos conservan su orden relativo: sigue ganando la última fila
+        rows = [ROWS[8], ROWS[3], ROWS[2], ROWS[0], ROWS[5], ROWS[4], ROWS[1], ROWS[7], ROWS[6]]
+    source = write_padron(tmp_path / 'padron_reducido_ruc.txt', rows)
+    if request.param == 'zip':
+        archive = tmp_path / 'padron_reducido_ruc.zip'
+        with zipfile.ZipFile(archive, 'w') as out:
+            out.write(source, 'padron_reducido_ruc.txt')
+        source = archive
+
+    summary = ruc_padron.build_index(str(source), str(tmp_path / 'padron.idx'))
+    assert summary['rucs'] == len(EXPECTED)
+    assert summary['duplicados'] == 1 and summary['filasOmitidas'] == 3
+    opened = ruc_padron.RucIndex(str(tmp_path / 'padron.idx'))
+    yield opened
+    opened.close()
+
+
+def test_round_trip(index):
+    assert len(index) == len(EXPECTED)
+    for ruc, (estado, condicion) in EXPECTED.items():
+        status = index.lookup(ruc)
+        assert (status.ruc, status.estado, status.condicion) == (ruc, estado, condicion)
+    assert index.lookup('10000000001').activo and not index.lookup('20512345678').habido
+    assert index.age_days() < 1
+
+
+@pytest.mark.parametrize('ruc', [
+    '10000000000', '10000000002', '20100070969', '20100070971', '20600000000', '99999999998',
+    '', None, '2010007097', '201000709700', '2010007097X'
+])
+def test_missing_and_malformed_rucs(index, ruc):
+    assert index.lookup(ruc) is None
+
+
+def test_lookup_accepts_numbers_and_whitespace(index):
+    assert index.lookup(20100070970).estado == 'ACTIVO'
+    assert index.lookup(' 20100070970 ').estado == 'ACTIVO'
+
+
+def test_rejects_files_that_are_not_an_index(tmp_path):
+    other = tmp_path / 'otro.idx'
+    other.write_bytes(b'no es un indice')
+    with pytest.raises(ValueError):
+        ruc_padron.RucIndex(str(other))
+
+
+@pytest.fixture
+def padron(monkeypatch):
+    """Configura RUC_PADRON_PATH y reinicia el índice del contenedor."""
+    def configure(path):
+        monkeypatch.setenv('RUC_PADRON_PATH', str(path))
+        monkeypatch.setattr(ruc_padron, 'PADRON_PATH', str(path))
+        monkeypatch.setattr(ruc_padron, '_index', None)
+        monkeypatch.setattr(ruc_padron, '_index_loaded', False)
+    return configure
+
+
+def invoice(ruc):
+    return {'emisor': {'numeroDocumento': ruc}}
+
+
+def test_prescreen_rejects_inactive_emisor(tmp_path, padron):
+    ruc_padron.build_index(str(write_padron(tmp_path / 'padron.txt', ROWS)), str(tmp_path / 'padron.idx'))
+    padron(tmp_path / 'padron.idx')
+
+    result = sunat_client.prescreen_emisor(invoice('20512345678'))
+    assert result['estado'] == 'INVALIDO' and result['fuente'] == 'PADRON'
+    assert result['estadoSunat']['estadoRuc']['descripcion'] == 'BAJA DE OFICIO'
+    # Activo o ausente del padrón: sigue contra la API
+    assert sunat_client.prescreen_emisor(invoice('20100070970')) is None
+    assert sunat_client.prescreen_emisor(invoice('20111111111')) is None
+
+
+def test_prescreen_falls_back_without_index(tmp_path, padron):
+    padron(tmp_path / 'no-existe.idx')
+    assert sunat_client.prescreen_emisor(invoice('20512345678')) is None
+    assert ruc_padron.get_index() is None
+
+    corrupt = tmp_path / 'corrupto.idx'
+    corrupt.write_bytes(b'\0' * 64)
+    padron(corrupt)
+    assert sunat_client.prescreen_emisor(invoice('20512345678')) is None
@@ -0,0 +1,172 @@
+"""
+Test de resume_textract_job: la notificación de Textract llega al menos una
+vez (SNS/SQS), así que una reentrega no debe volver a leer el resultado, ni
+llamar a Bedrock, ni guardar la factura. Usa la FakeTable de fake_dynamodb
+(evalúa las ConditionExpression de verdad) y un Textract que pagina
+get_expense_analysis con NextToken. También la elección de Textract
+asíncrono por número de páginas.
+"""
+
+import io
+import json
+import re
+
+import pytest
+
+import lambda_claude
+
+JOB_ID = 'job-123'
+
+
+class PagedTextract:
+    """get_expense_analysis en dos páginas (NextToken), una por página del PDF"""
+
+    def __init__(self):
+        self.calls = []
+
+    def get_expense_analysis(self, JobId, MaxResults, NextToken=None):
+        self.calls.append(NextToken)
+        page = 2 if NextToken else 1
+        response = {
+            'JobStatus': 'SUCCEEDED',
+            'ExpenseDocuments': [{'Blocks': [
+                {'BlockType': 'LINE', 'Page': page, 'Text': f'FACTURA F001-{page:06d} página {page}'}
+            ]}]
+        }
+        if page == 1:
+            response['NextToken'] = 'page-2'
+        return response
+
+
+@pytest.fixture
+def pipeline(monkeypatch, fake_table):
+    table = fake_table('control')
+    textract = PagedTextract()
+    analyzed = []
+    saved = []
+
+    def analyze(attachment, textract_text, textract_error=None):
+        analyzed.append((textract_text, dict(attachment['page_texts'])))
+        return {'numeroFactura': 'F001-000001'}, {'ruta': 'textract-async'}
+
+    def save(client_id, attachment, invoice_data, processing_overrides, bucket, key, file_size):
+        saved.append((client_id, key, processing_overrides['textractJobId']))
+        return {'invoiceId': '20100070970-F001-000001'}
+
+    monkeypatch.setattr(lambda_claude, 'get_control_table', lambda: table)
+    monkeypatch.setattr(lambda_claude, 'get_client', lambda name: textract)
+    monkeypatch.setattr(lambda_claude, 'analyze_pdf_from_textract', analyze)
+    monkeypatch.setattr(lambda_claude, 'save_processed_invoice', save)
+    monkeypatch.setattr(lambda_claude, 'METRICS_ENABLED', False)
+
+    table.put_item(Item={
+        **lambda_claude.textract_job_context_key(JOB_ID),
+        'clientId': 'acme',
+        'bucket': 'facturas',
+        'key': 'acme/2026/10/18/correo',
+        'fileSize': 1234,
+        'debugKey': 'debug/acme/factura.pdf',
+        'mediaType': 'application/pdf',
+        'filename': 'factura.pdf',
+        'index': 0,
+        'sha256': 'ab' * 32
+    })
+    return table, textract, analyzed, saved
+
+
+def notification_record():
+    message = {'JobId': JOB_ID, 'Status': 'SUCCEEDED', 'API': 'StartExpenseAnalysis', 'JobTag': 'flow-ingest'}
+    return {'EventSource': 'aws:sns', 'Sns': {'Message': json.dumps(message)}}
+
+
+def test_duplicate_notification_is_processed_once(pipeline):
+    table, textract, analyzed, saved = pipeline
+
+    first = lambda_claude.process_event_record(notification_record())
+    duplicate = lambda_claude.process_event_record(notification_record())
+
+    assert first[0]['invoiceId'] == '20100070970-F001-000001'
+    assert duplicate[0]['duplicado'] is True
+    # Las dos páginas del resultado, leídas una sola vez
+    assert textract.calls == [None, 'page-2']
+    assert len(analyzed) == 1
+    text, page_texts = analyzed[0]
+    assert 'página 1' in text and 'página 2' in text
+    assert sorted(page_texts) == [1, 2]
+    assert saved == [('acme', 'acme/2026/10/18/correo', JOB_ID)]
+
+    context = table.get_item(Key=lambda_claude.textract_job_context_key(JOB_ID))['Item']
+    assert context['jobStatus'] == 'COMPLETED'
+    assert context['invoiceId'] == '20100070970-F001-000001'
+
+
+def test_concurrent_delivery_is_skipped_while_claimed(pipeline):
+    table, textract, analyzed, saved = pipeline
+
+    context, skipped = lambda_claude.claim_textract_job(JOB_ID)
+    assert context['jobStatus'] == 'PROCESSING' and skipped is None
+
+    result = lambda_claude.resume_textract_job(json.loads(notification_record()['Sns']['Message']))
+    assert result['duplicado'] is True
+    assert textract.calls == [] and analyzed == [] and saved == []
+
+
+def test_failed_attempt_releases_the_claim(pipeline, monkeypatch):
+    table, textract, analyzed, saved = pipeline
+
+    def failing_save(*args):
+        raise RuntimeError('DynamoDB no disponible')
+
+    monkeypatch.setattr(lambda_claude, 'save_processed_invoice', failing_save)
+
+    with pytest.raises(RuntimeError):
+        lambda_claude.process_event_record(notification_record())
+    context = table.get_item(Key=lambda_claude.textract_job_context_key(JOB_ID))['Item']
+    assert 'jobStatus' not in context
+
+    monkeypatch.setattr(lambda_claude, 'save_processed_invoice', lambda *args: {'invoiceId': 'X'})
+    assert lambda_claude.process_event_record(notification_record())[0]['invoiceId'] == 'X'
+    assert len(analyzed) == 2
+
+
+def test_unknown_job_is_ignored(pipeline):
+    table, textract, analyzed, saved = pipeline
+    table.delete_item(Key=lambda_claude.textract_job_context_key(JOB_ID))
+
+    result = lambda_claude.process_event_record(notification_record())
+    assert result[0]['message'] == 'Unknown Textract job'
+    assert textract.calls == [] and analyzed == []
+
+
+def blank_pdf(pages):
+    pypdf = pytest.importorskip('pypdf')
+    writer = pypdf.PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(200, 200)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('pages, expected', [(1, False), (2, True), (5, True)])
+def test_multipage_pdfs_use_async_textract(monkeypatch, pages, expected):
+    monkeypatch.setattr(lambda_claude, 'TEXTRACT_SNS_TOPIC_ARN', 'arn:aws:sns:us-east-1:1:textract')
+    monkeypatch.setattr(lambda_claude, 'TEXTRACT_SNS_ROLE_ARN', 'arn:aws:iam::1:role/textract')
+    attachment = {'media_type': 'application/pdf', 'bytes': blank_pdf(pages)}
+    assert lambda_claude.should_use_async_textract(attachment) is expected
+
+
+def test_page_count_falls_back_to_pypdf(monkeypatch):
+    monkeypatch.setattr(lambda_claude, 'TEXTRACT_SNS_TOPIC_ARN', 'arn:aws:sns:us-east-1:1:textract')
+    monkeypatch.setattr(lambda_claude, 'TEXTRACT_SNS_ROLE_ARN', 'arn:aws:iam::1:role/textract')
+    # /P#61ge es /Page escrito con un escape de nombre: el regex no lo ve
+    hidden = re.sub(rb'/Type\s*/Page(?![a-zA-Z])', b'/Type /P#61ge', blank_pdf(2))
+    attachment = {'media_type': 'application/pdf', 'bytes': hidden}
+    assert lambda_claude.count_pdf_pages(attachment) == 2
+    assert lambda_claude.should_use_async_textract(attachment) is True
+
+    # Sin pypdf el conteo queda desconocido (0): también va por el job asíncrono
+    monkeypatch.setattr(lambda_claude, 'optional_import', lambda name: None)
+    unknown = {'media_type': 'application/pdf', 'bytes': hidden}
+    assert lambda_claude.count_pdf_pages(unknown) == 0
+    assert lambda_claude.should_use_async_textract(unknown) is True
@@ -0,0 +1,152 @@
+"""
+Test del token OAuth compartido y de la caché de resultados de sunat_client
+sobre la FakeTable de fake_dynamodb: llamadas concurrentes piden un solo
+token (lock del contenedor + lease del item compartido), un lease vencido se
+toma, y el TTL por estado (los resultados no definitivos duran menos o no
+se guardan).
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import pytest
+
+import sunat_client
+
+IDENTITY = ('20100070970', '01', 'F001', '1', '2026-01-01', 10.0)
+
+
+@pytest.fixture
+def control_table(monkeypatch, fake_table):
+    table = fake_table('control')
+    monkeypatch.setattr(sunat_client, 'get_control_table', lambda: table)
+    return table
+
+
+@pytest.fixture
+def token_requests(monkeypatch, control_table):
+    """Credenciales de prueba, caché en proceso vacía y un api-seguridad falso."""
+    monkeypatch.setenv('SUNAT_CLIENT_ID', 'cliente')
+    monkeypatch.setenv('SUNAT_CLIENT_SECRET', 'secreto')
+    monkeypatch.setitem(sunat_client._token_cache, 'token', None)
+    monkeypatch.setitem(sunat_client._token_cache, 'expires_at', 0.0)
+    requests = []
+
+    def request(client_id, client_secret):
+        requests.append(client_id)
+        # Ventana para que los demás llamadores lleguen mientras se pide
+        time.sleep(0.3)
+        return f'tok-{len(requests)}', time.time() + 3600
+
+    request.calls = requests
+    return request
+
+
+def test_concurrent_callers_in_a_container_fetch_one_token(token_requests):
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        tokens = list(executor.map(lambda _: sunat_client.get_token(token_requests), range(8)))
+    assert tokens == ['tok-1'] * 8
+    assert token_requests.calls == ['cliente']
+
+
+def test_concurrent_containers_share_one_token(token_requests, control_table):
+    # Cada thread es un contenedor distinto: sin caché en proceso, solo el item compartido
+    barrier = threading.Barrier(4)
+
+    def container(_):
+        barrier.wait()
+        return sunat_client.get_shared_token('cliente', 'secreto', token_requests)[0]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        tokens = list(executor.map(container, range(4)))
+    assert tokens == ['tok-1'] * 4
+    assert token_requests.calls == ['cliente']
+    item = control_table.get_item(Key=sunat_client.token_key('cliente'))['Item']
+    # Publicar el token libera el lease
+    assert item['token'] == 'tok-1' and 'leaseOwner' not in item
+
+
+def test_expired_lease_is_taken_over(token_requests, control_table):
+    control_table.put_item(Item={
+        **sunat_client.token_key('cliente'),
+        'leaseOwner': 'contenedor-caido',
+        'leaseUntil': Decimal(str(round(time.time() - 1, 3)))
+    })
+    started = time.monotonic()
+    assert sunat_client.get_token(token_requests) == 'tok-1'
+    # Sin esperar TOKEN_WAIT_SECONDS: el lease vencido se toma enseguida
+    assert time.monotonic() - started < sunat_client.TOKEN_WAIT_SECONDS
+    assert control_table.get_item(Key=sunat_client.token_key('cliente'))['Item']['token'] == 'tok-1'
+
+
+def test_held_lease_waits_then_requests_directly(monkeypatch, token_requests, control_table):
+    monkeypatch.setattr(sunat_client, 'TOKEN_WAIT_SECONDS', 0.3)
+    control_table.put_item(Item={
+        **sunat_client.token_key('cliente'),
+        'leaseOwner': 'otro-contenedor',
+        'leaseUntil': Decimal(str(round(time.time() + 60, 3)))
+    })
+    assert sunat_client.get_shared_token('cliente', 'secreto', token_requests)[0] == 'tok-1'
+    # El item sigue siendo del dueño del lease
+    assert 'token' not in control_table.get_item(Key=sunat_client.token_key('cliente'))['Item']
+
+
+def result(estado, codigo_cp='1'):
+    return {
+        **sunat_client.build_result(estado, 'motivo'),
+        'estadoSunat': {'estadoComprobante': {'codigo': codigo_cp}}
+    }
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [time.time()]
+    fake = type('FakeTime', (), {'time': staticmethod(lambda: now[0])})
+    monkeypatch.setattr(sunat_client, 'time', fake)
+    return now
+
+
+@pytest.fixture
+def result_cache(monkeypatch, control_table):
+    cache = sunat_client.OrderedDict()
+    monkeypatch.setattr(sunat_client, '_result_cache', cache)
+    return cache
+
+
+def test_ttl_depends_on_the_state():
+    assert sunat_client.result_cache_ttl(result('VALIDO')) == sunat_client.RESULT_CACHE_TTL['VALIDO']
+    assert sunat_client.result_cache_ttl(result('INVALIDO')) == sunat_client.RESULT_CACHE_TTL['INVALIDO']
+    # Comprobante aún no informado por el emisor: puede cambiar pronto
+    assert sunat_client.result_cache_ttl(result('INVALIDO', '0')) == sunat_client.RESULT_CACHE_TTL_NO_INFORMADO
+    for estado in ['PENDIENTE', 'ERROR_API', 'ERROR_TOKEN', 'NO_VALIDADO', 'DATOS_INCOMPLETOS']:
+        assert sunat_client.result_cache_ttl(result(estado)) is None
+
+
+@pytest.mark.parametrize('estado', ['PENDIENTE', 'ERROR_API'])
+def test_non_final_results_are_not_cached(result_cache, control_table, estado):
+    sunat_client.store_result(IDENTITY, result(estado))
+    assert not result_cache
+    assert control_table.get_item(Key=sunat_client.result_cache_key(IDENTITY)) == {}
+    assert sunat_client.get_cached_result(IDENTITY) is None
+
+
+def test_not_yet_reported_result_expires_before_a_final_one(clock, result_cache, control_table):
+    other = IDENTITY[:3] + ('2',) + IDENTITY[4:]
+    sunat_client.store_result(IDENTITY, result('VALIDO'))
+    sunat_client.store_result(other, result('INVALIDO', '0'))
+    assert sunat_client.get_cached_result(IDENTITY)['desdeCache']
+    assert sunat_client.get_cached_result(other)['estado'] == 'INVALIDO'
+
+    clock[0] += sunat_client.RESULT_CACHE_TTL_NO_INFORMADO
+    assert sunat_client.get_cached_result(other) is None
+    assert sunat_client.get_cached_result(IDENTITY)['estado'] == 'VALIDO'
+
+    # Otro contenedor (sin caché en proceso) lee el mismo vencimiento del item compartido
+    result_cache.clear()
+    assert sunat_client.get_cached_result(other) is None
+    assert sunat_client.get_cached_result(IDENTITY)['estado'] == 'VALIDO'
+
+    clock[0] += sunat_client.RESULT_CACHE_TTL['VALIDO']
+    assert sunat_client.get_cached_result(IDENTITY) is None
@@ -0,0 +1,40 @@
+"""
+Test de la etapa de cola de lambda_sunat_retry: las facturas se leen con
+lectura consistente y un mensaje cuya factura no se encuentra vuelve a la
+cola (batchItemFailures) en vez de descartarse.
+"""
+
+import json
+
+import fake_dynamodb
+import lambda_sunat_retry
+
+
+class RecordingResource(fake_dynamodb.FakeDynamoResource):
+    def __init__(self, tables):
+        super().__init__(tables)
+        self.requests = []
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        self.requests.append(RequestItems)
+        return super().batch_get_item(RequestItems, **kwargs)
+
+
+def message(message_id, sk):
+    body = {'sunatValidation': {'PK': 'CLIENT#acme', 'SK': sk}}
+    return {'messageId': message_id, 'eventSource': 'aws:sqs', 'body': json.dumps(body)}
+
+
+def test_missing_invoice_is_returned_to_the_queue(monkeypatch, fake_table):
+    table = fake_table(lambda_sunat_retry.TABLE_NAME)
+    table.put_item(Item={'PK': 'CLIENT#acme', 'SK': 'INVOICE#valida', 'validacionSunat': {'estado': 'VALIDO'}})
+    resource = RecordingResource({lambda_sunat_retry.TABLE_NAME: table})
+    monkeypatch.setattr(lambda_sunat_retry, 'get_dynamodb', lambda: resource)
+
+    response = lambda_sunat_retry.handler({'Records': [
+        message('m-1', 'INVOICE#valida'),
+        message('m-2', 'INVOICE#aun-no-visible')
+    ]}, None)
+
+    assert response == {'batchItemFailures': [{'itemIdentifier': 'm-2'}]}
+    assert all(request[lambda_sunat_retry.TABLE_NAME]['ConsistentRead'] for request in resource.requests)
@@ -7,33 +7,22 @@ Defaults to the same table/credentials used by the Lambda.
 from __future__ import annotations
 
 import argparse
+import asyncio
 import os
-import re
+import threading
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from decimal import Decimal
-from typing import Any, Dict, Iterable, Optional, Tuple
+from typing import Any, Dict, Iterable, List, Optional
 
 import boto3
-import urllib3
 
+import sunat_client
+from sunat_client import build_invoice_data, should_validate
 
-SUNAT_CLIENT_ID: Optional[str] = None
-SUNAT_CLIENT_SECRET: Optional[str] = None
-SUNAT_RUC: Optional[str] = None
-
-http = urllib3.PoolManager()
-sunat_token_cache = {
-    "token": None,
-    "expires_at": None,
-}
-
-
-def refresh_sunat_env() -> None:
-    global SUNAT_CLIENT_ID, SUNAT_CLIENT_SECRET, SUNAT_RUC
-    SUNAT_CLIENT_ID = os.environ.get("SUNAT_CLIENT_ID")
-    SUNAT_CLIENT_SECRET = os.environ.get("SUNAT_CLIENT_SECRET")
-    SUNAT_RUC = os.environ.get("SUNAT_RUC")
+_thread_local = threading.local()
 
 
 def load_env_from_lambda(function_name: str, region: str) -> None:
@@ -41,12 +30,11 @@ def load_env_from_lambda(function_name: str, region: str) -> None:
     response = lambda_client.get_function_configuration(FunctionName=function_name)
     variables = response.get("Environment", {}).get("Variables", {})
 
-    for key in ("SUNAT_CLIENT_ID", "SUNAT_CLIENT_SECRET", "SUNAT_RUC", "DYNAMODB_TABLE", "AWS_REGION"):
+    # CONTROL_TABLE holds the SUNAT token and result cache shared with the Lambdas
+    for key in ("SUNAT_CLIENT_ID", "SUNAT_CLIENT_SECRET", "SUNAT_RUC", "DYNAMODB_TABLE", "AWS_REGION", "CONTROL_TABLE"):
         if variables.get(key) and not os.environ.get(key):
             os.environ[key] = variables[key]
 
-    refresh_sunat_env()
-
 
 def convert_to_decimal(obj: Any) -> Any:
     if isinstance(obj, dict):
@@ -58,277 +46,6 @@ def convert_to_decimal(obj: Any) -> Any:
     return obj
 
 
-def get_sunat_token() -> Optional[str]:
-    if not SUNAT_CLIENT_ID or not SUNAT_CLIENT_SECRET:
-        print("SUNAT credentials not configured, skipping validation")
-        return None
-
-    now = datetime.now().timestamp()
-    if sunat_token_cache["token"] and sunat_token_cache["expires_at"]:
-        if now < sunat_token_cache["expires_at"]:
-            return sunat_token_cache["token"]
-
-    url = f"https://api-seguridad.sunat.gob.pe/v1/clientesextranet/{SUNAT_CLIENT_ID}/oauth2/token/"
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    body = urllib3.request.urlencode(
-        {
-            "grant_type": "client_credentials",
-            "scope": "https://api.sunat.gob.pe/v1/contribuyente/contribuyentes",
-            "client_id": SUNAT_CLIENT_ID,
-            "client_secret": SUNAT_CLIENT_SECRET,
-        }
-    )
-
-    response = http.request("POST", url, headers=headers, body=body)
-    if response.status != 200:
-        print(f"Failed to get SUNAT token: HTTP {response.status}")
-        return None
-
-    data = response.data.decode("utf-8")
-    token_data = eval_json(data)
-    token = token_data.get("access_token")
-    expires_in = token_data.get("expires_in", 3600)
-    sunat_token_cache["token"] = token
-    sunat_token_cache["expires_at"] = now + expires_in - 60
-    return token
-
-
-def eval_json(raw: str) -> Dict[str, Any]:
-    try:
-        import json
-        return json.loads(raw)
-    except Exception:
-        return {}
-
-
-def validate_invoice_with_sunat(invoice_data: Dict[str, Any]) -> Dict[str, Any]:
-    estados_comprobante = {
-        "0": "NO EXISTE - Comprobante no informado",
-        "1": "ACEPTADO - Comprobante aceptado",
-        "2": "ANULADO - Comunicado en una baja",
-        "3": "AUTORIZADO - Con autorización de imprenta",
-        "4": "NO AUTORIZADO - No autorizado por imprenta",
-    }
-
-    estados_ruc = {
-        "00": "ACTIVO",
-        "01": "BAJA PROVISIONAL",
-        "02": "BAJA PROV. POR OFICIO",
-        "03": "SUSPENSION TEMPORAL",
-        "10": "BAJA DEFINITIVA",
-        "11": "BAJA DE OFICIO",
-        "22": "INHABILITADO-VENT.UNICA",
-    }
-
-    condiciones_domicilio = {
-        "00": "HABIDO",
-        "09": "PENDIENTE",
-        "11": "POR VERIFICAR",
-        "12": "NO HABIDO",
-        "20": "NO HALLADO",
-    }
-
-    if not SUNAT_RUC:
-        return {
-            "validado": False,
-            "estado": "NO_VALIDADO",
-            "motivo": "Credenciales SUNAT no configuradas",
-            "estadoSunat": None,
-            "timestampValidacion": datetime.utcnow().isoformat() + "Z",
-        }
-
-    token = get_sunat_token()
-    if not token:
-        return {
-            "validado": False,
-            "estado": "ERROR_TOKEN",
-            "motivo": "No se pudo obtener token de SUNAT",
-            "estadoSunat": None,
-            "timestampValidacion": datetime.utcnow().isoformat() + "Z",
-        }
-
-    ruc_emisor = invoice_data.get("emisor", {}).get("numeroDocumento")
-    numero_factura = invoice_data.get("numeroFactura", "")
-    serie = invoice_data.get("serie", "")
-    correlativo = invoice_data.get("correlativo", "")
-    fecha_emision = invoice_data.get("fechaEmision", "")
-    monto_total = invoice_data.get("montos", {}).get("total", 0)
-
-    tipo_comprobante = invoice_data.get("tipoComprobante", "FACTURA")
-    codigo_comprobante = "01" if tipo_comprobante == "FACTURA" else "03"
-
-    if not ruc_emisor or not numero_factura:
-        return {
-            "validado": False,
-            "estado": "DATOS_INCOMPLETOS",
-            "motivo": "Faltan datos requeridos (RUC o numero de factura)",
-            "estadoSunat": None,
-            "timestampValidacion": datetime.utcnow().isoformat() + "Z",
-        }
-
-    if fecha_emision and "-" in fecha_emision:
-        parts = fecha_emision.split("-")
-        if len(parts) == 3:
-            fecha_sunat = f"{parts[2]}/{parts[1]}/{parts[0]}"
-        else:
-            fecha_sunat = fecha_emision
-    else:
-        fecha_sunat = fecha_emision
-
-    url = f"https://api.sunat.gob.pe/v1/contribuyente/contribuyentes/{SUNAT_RUC}/validarcomprobante"
-    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-
-    try:
-        numero_int = int(correlativo) if correlativo else 0
-    except Exception:
-        numero_int = 0
-
-    body = {
-        "numRuc": ruc_emisor,
-        "codComp": codigo_comprobante,
-        "numeroSerie": serie,
-        "numero": numero_int,
-        "fechaEmision": fecha_sunat,
-        "monto": float(monto_total) if monto_total is not None else 0,
-    }
-
-    import json
-    response = http.request("POST", url, headers=headers, body=json.dumps(body))
-
-    if response.status != 200:
-        return {
-            "validado": False,
-            "estado": "ERROR_API",
-            "motivo": f"Error al consultar SUNAT: HTTP {response.status}",
-            "estadoSunat": None,
-            "timestampValidacion": datetime.utcnow().isoformat() + "Z",
-            "errorDetalle": response.data.decode("utf-8"),
-        }
-
-    data = eval_json(response.data.decode("utf-8"))
-    if not data.get("success"):
-        return {
-            "validado": False,
-            "estado": "ERROR_API",
-            "motivo": data.get("message", "Error desconocido de SUNAT"),
-            "estadoSunat": None,
-            "timestampValidacion": datetime.utcnow().isoformat() + "Z",
-            "errorDetalle": response.data.decode("utf-8"),
-        }
-
-    response_data = data.get("data", {})
-    estado_cp = response_data.get("estadoCp", "")
-    estado_ruc = response_data.get("estadoRuc", "")
-    condicion_domicilio = response_data.get("condDomiRuc", "")
-    observaciones = response_data.get("observaciones", [])
-
-    desc_comprobante = estados_comprobante.get(estado_cp, f"Codigo desconocido: {estado_cp}")
-    desc_ruc = estados_ruc.get(estado_ruc, f"Codigo desconocido: {estado_ruc}")
-    desc_domicilio = condiciones_domicilio.get(
-        condicion_domicilio, f"Codigo desconocido: {condicion_domicilio}"
-    )
-
-    es_valido = estado_cp in ["1", "0"] and estado_ruc == "00"
-
-    return {
-        "validado": True,
-        "esValido": es_valido,
-        "estado": "VALIDO" if es_valido else "INVALIDO",
-        "motivo": "Comprobante validado exitosamente"
-        if es_valido
-        else "Comprobante no valido en SUNAT",
-        "estadoSunat": {
-            "estadoComprobante": {"codigo": estado_cp, "descripcion": desc_comprobante},
-            "estadoRuc": {"codigo": estado_ruc, "descripcion": desc_ruc},
-            "condicionDomicilio": {
-                "codigo": condicion_domicilio,
-                "descripcion": desc_domicilio,
-            },
-            "observaciones": observaciones,
-        },
-        "timestampValidacion": datetime.utcnow().isoformat() + "Z",
-    }
-
-
-def parse_serie_correlativo(invoice_data: Dict[str, Any]) -> None:
-    if invoice_data.get("serie") and invoice_data.get("correlativo"):
-        return
-
-    numero_factura = (invoice_data.get("numeroFactura") or "").strip().upper()
-    if not numero_factura:
-        return
-
-    match = re.match(r"^([A-Z0-9]{1,4})[- ]?0*([0-9]{1,12})$", numero_factura)
-    if not match:
-        return
-
-    invoice_data.setdefault("serie", match.group(1))
-    invoice_data.setdefault("correlativo", match.group(2))
-
-
-def build_invoice_data(item: Dict[str, Any]) -> Dict[str, Any]:
-    data = item.get("data") if isinstance(item.get("data"), dict) else {}
-    invoice_data: Dict[str, Any] = dict(data)
-
-    invoice_data.setdefault("emisor", {})
-    invoice_data.setdefault("receptor", {})
-    invoice_data.setdefault("montos", {})
-
-    if not invoice_data.get("numeroFactura") and item.get("numeroFactura"):
-        invoice_data["numeroFactura"] = item.get("numeroFactura")
-    if not invoice_data.get("fechaEmision") and item.get("fechaEmision"):
-        invoice_data["fechaEmision"] = item.get("fechaEmision")
-    if not invoice_data.get("tipoComprobante") and item.get("tipoComprobante"):
-        invoice_data["tipoComprobante"] = item.get("tipoComprobante")
-
-    if not invoice_data["emisor"].get("numeroDocumento") and item.get("emisorRUC"):
-        invoice_data["emisor"]["numeroDocumento"] = str(item.get("emisorRUC"))
-    if not invoice_data["emisor"].get("razonSocial") and item.get("emisorRazonSocial"):
-        invoice_data["emisor"]["razonSocial"] = item.get("emisorRazonSocial")
-
-    if not invoice_data["receptor"].get("numeroDocumento") and item.get("receptorRUC"):
-        invoice_data["receptor"]["numeroDocumento"] = str(item.get("receptorRUC"))
-    if not invoice_data["receptor"].get("razonSocial") and item.get("receptorRazonSocial"):
-        invoice_data["receptor"]["razonSocial"] = item.get("receptorRazonSocial")
-
-    if invoice_data["montos"].get("total") is None and item.get("total") is not None:
-        invoice_data["montos"]["total"] = item.get("total")
-    if not invoice_data["montos"].get("moneda") and item.get("moneda"):
-        invoice_data["montos"]["moneda"] = item.get("moneda")
-
-    parse_serie_correlativo(invoice_data)
-    return invoice_data
-
-
-def should_validate(invoice_data: Dict[str, Any]) -> Tuple[bool, str]:
-    ruc_emisor = invoice_data.get("emisor", {}).get("numeroDocumento")
-    numero_factura = invoice_data.get("numeroFactura")
-    fecha_emision = invoice_data.get("fechaEmision")
-    total = invoice_data.get("montos", {}).get("total")
-    serie = invoice_data.get("serie")
-    correlativo = invoice_data.get("correlativo")
-
-    if not ruc_emisor or not numero_factura:
-        return False, "missing_ruc_or_numero"
-    if not fecha_emision:
-        return False, "missing_fecha"
-    if total is None:
-        return False, "missing_total"
-
-    try:
-        if float(total) <= 0:
-            return False, "total_zero"
-    except Exception:
-        return False, "invalid_total"
-
-    if not serie or not correlativo:
-        return False, "missing_serie_correlativo"
-    if not str(correlativo).isdigit():
-        return False, "invalid_correlativo"
-
-    return True, "ok"
-
-
 def is_pending_validation(item: Dict[str, Any]) -> bool:
     sunat = item.get("validacionSunat") or {}
     estado = sunat.get("estado") or "NO_VALIDADO"
@@ -360,17 +77,211 @@ def iter_scan(table, limit: Optional[int] = None) -> Iterable[Dict[str, Any]]:
             break
 
 
-def build_item_key(table, item: Dict[str, Any]) -> Dict[str, Any]:
-    key_schema = table.key_schema
+def build_item_key(key_attrs: List[str], item: Dict[str, Any]) -> Dict[str, Any]:
     key: Dict[str, Any] = {}
-    for entry in key_schema:
-        attr = entry["AttributeName"]
+    for attr in key_attrs:
         if attr not in item:
             raise KeyError(f"Missing key attribute: {attr}")
         key[attr] = item[attr]
     return key
 
 
+def get_thread_table(table_name: str, region: str):
+    # boto3 resources are not thread-safe: one Table per worker thread
+    table = getattr(_thread_local, "table", None)
+    if table is None:
+        table = _thread_local.table = boto3.session.Session().resource("dynamodb", region_name=region).Table(table_name)
+    return table
+
+
+class Progress:
+    """
+    Thread-safe counters with a periodic one-line report
+    (throughput, error rate and ETA against the estimated item count).
+    """
+
+    def __init__(self, expected: Optional[int], interval: float):
+        self.expected = expected
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.lock = threading.Lock()
+        self.counts: Dict[str, int] = defaultdict(int)
+
+    def add(self, name: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counts[name] += amount
+        self.maybe_report()
+
+    def maybe_report(self, force: bool = False) -> None:
+        now = time.monotonic()
+        with self.lock:
+            if not force and now - self.last_report < self.interval:
+                return
+            self.last_report = now
+            counts = dict(self.counts)
+        elapsed = max(now - self.started, 1e-6)
+        done = counts.get("validated", 0) + counts.get("errors", 0)
+        finished = done + counts.get("skipped", 0)
+        error_rate = 100.0 * counts.get("errors", 0) / done if done else 0.0
+        eta = ""
+        if self.expected and finished:
+            remaining = max(self.expected - finished, 0)
+            eta = f" eta={format_duration(remaining / (finished / elapsed))}"
+        print(
+            f"[{format_duration(elapsed)}] seen={counts.get('seen', 0)} validated={counts.get('validated', 0)} "
+            f"cached={counts.get('cached', 0)} skipped={counts.get('skipped', 0)} "
+            f"errors={counts.get('errors', 0)} ({error_rate:.1f}%) "
+            f"circuit_waits={counts.get('circuit_waits', 0)} "
+            f"rate={counts.get('validated', 0) / elapsed:.1f}/s{eta}",
+            flush=True,
+        )
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600:d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def prepare_item(item: Dict[str, Any], progress: Progress) -> Optional[Dict[str, Any]]:
+    invoice_data = build_invoice_data(item)
+    ok, reason = should_validate(invoice_data)
+    if not ok:
+        progress.add("skipped")
+        progress.add(f"skipped:{reason}")
+        return None
+    return invoice_data
+
+
+def save_result(args: argparse.Namespace, key_attrs: List[str], item: Dict[str, Any],
+                result: Dict[str, Any]) -> None:
+    if args.dry_run:
+        return
+    expression = "SET validacionSunat = :v"
+    values: Dict[str, Any] = {":v": convert_to_decimal(result)}
+    schedule = sunat_client.retry_schedule(result)
+    if schedule:
+        # Still retryable: schedule it in lambda_sunat_retry's sparse retry index
+        # (the sweep only reads that index), like lambda_claude does on insert
+        expression += ", sunatNextRetryAt = :n, sunatRetryBucket = :b"
+        values[":n"] = schedule["sunatNextRetryAt"]
+        values[":b"] = schedule["sunatRetryBucket"]
+    else:
+        # Final result: drop the item from the retry index
+        expression += " REMOVE sunatNextRetryAt, sunatRetryBucket"
+    get_thread_table(args.table, args.region).update_item(
+        Key=build_item_key(key_attrs, item),
+        UpdateExpression=expression,
+        ExpressionAttributeValues=values,
+    )
+
+
+def circuit_wait_seconds(result: Dict[str, Any]) -> Optional[float]:
+    """Seconds until SUNAT may be queried again, or None if SUNAT was queried."""
+    if not result.get("circuitoAbierto"):
+        return None
+    retry_at = datetime.fromisoformat(result["reintentarDesde"].rstrip("Z"))
+    return max((retry_at - datetime.utcnow()).total_seconds(), 1.0)
+
+
+def count_result(progress: Progress, result: Dict[str, Any]) -> None:
+    # SUNAT errors are stored like the Lambda does, but count as errors
+    progress.add("errors" if str(result.get("estado", "")).startswith("ERROR") else "validated")
+    if result.get("desdeCache"):
+        progress.add("cached")
+
+
+def run_threads(args: argparse.Namespace, table, key_attrs: List[str], progress: Progress) -> None:
+    sunat_client.configure_http(args.concurrency)
+    limiter = sunat_client.TokenBucket(args.rate, burst=args.burst)
+    # Bounded in-flight work: the scan never runs far ahead of the workers
+    in_flight = threading.BoundedSemaphore(args.concurrency * 2)
+
+    def run(item: Dict[str, Any], invoice_data: Dict[str, Any]) -> None:
+        try:
+            while True:
+                result = sunat_client.validate_invoice(
+                    invoice_data, refresh=args.refresh, limiter=limiter, max_attempts=args.retries + 1
+                )
+                # Circuit breaker open: wait for SUNAT instead of storing the error
+                wait = circuit_wait_seconds(result)
+                if wait is None:
+                    break
+                progress.add("circuit_waits")
+                time.sleep(wait)
+            save_result(args, key_attrs, item, result)
+            count_result(progress, result)
+        except Exception as exc:
+            progress.add("errors")
+            print(f"Error processing {item.get('invoiceId') or 'unknown'}: {exc}")
+        finally:
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for item in iter_scan(table, limit=args.limit or None):
+            progress.add("seen")
+            if args.only_pending and not is_pending_validation(item):
+                progress.add("skipped")
+                continue
+            invoice_data = prepare_item(item, progress)
+            if invoice_data is None:
+                continue
+            in_flight.acquire()
+            executor.submit(run, item, invoice_data)
+
+
+async def run_asyncio(args: argparse.Namespace, table, key_attrs: List[str], progress: Progress) -> None:
+    """
+    One event loop with up to --concurrency validations in flight over
+    keep-alive connections. The scan and the DynamoDB writes run in threads.
+    """
+    import sunat_async
+
+    scan = iter_scan(table, limit=args.limit or None)
+    pending: set = set()
+
+    async with sunat_async.AsyncSunatClient(
+        concurrency=args.concurrency,
+        rate=args.rate,
+        burst=args.burst,
+        max_attempts=args.retries + 1,
+        refresh=args.refresh,
+    ) as client:
+
+        async def run(item: Dict[str, Any], invoice_data: Dict[str, Any]) -> None:
+            try:
+                while True:
+                    outcome = await client.validate_invoice(invoice_data)
+                    wait = circuit_wait_seconds(outcome.result)
+                    if wait is None:
+                        break
+                    progress.add("circuit_waits")
+                    await asyncio.sleep(wait)
+                await asyncio.to_thread(save_result, args, key_attrs, item, outcome.result)
+                count_result(progress, outcome.result)
+            except Exception as exc:
+                progress.add("errors")
+                print(f"Error processing {item.get('invoiceId') or 'unknown'}: {exc}")
+
+        while True:
+            item = await asyncio.to_thread(next, scan, None)
+            if item is None:
+                break
+            progress.add("seen")
+            if args.only_pending and not is_pending_validation(item):
+                progress.add("skipped")
+                continue
+            invoice_data = prepare_item(item, progress)
+            if invoice_data is None:
+                continue
+            if len(pending) >= args.concurrency * 2:
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending.add(asyncio.create_task(run(item, invoice_data)))
+
+        if pending:
+            await asyncio.wait(pending)
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="Validate DynamoDB invoices with SUNAT.")
     parser.add_argument("--table", default=os.environ.get("DYNAMODB_TABLE"))
@@ -378,70 +289,62 @@ def main() -> None:
     parser.add_argument("--lambda-function", default="lambda-claude-windsurf")
     parser.add_argument("--only-pending", action="store_true", help="Validate only pending/errored items.")
     parser.add_argument("--limit", type=int, default=0, help="Max items to process (0 = no limit).")
-    parser.add_argument("--sleep", type=float, default=0.2, help="Seconds to sleep between requests.")
+    parser.add_argument("--engine", choices=("threads", "asyncio"), default="threads",
+                        help="threads: worker pool over urllib3; asyncio: one event loop, suited to "
+                             "hundreds of requests in flight.")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Validations in flight (worker threads or asyncio tasks).")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Max SUNAT requests per second across all workers (0 = unlimited). "
+                             "Defaults to 1/--sleep.")
+    parser.add_argument("--burst", type=float, default=1.0, help="Token bucket size (requests).")
+    parser.add_argument("--retries", type=int, default=3,
+                        help="Retries per item on HTTP 429/5xx (honours Retry-After).")
+    parser.add_argument("--sleep", type=float, default=0.2,
+                        help="Deprecated: seconds between requests; used as --rate 1/sleep when --rate is not set.")
+    parser.add_argument("--progress-every", type=float, default=5.0, help="Seconds between progress lines.")
     parser.add_argument("--dry-run", action="store_true", help="Do not update DynamoDB.")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Ignore cached SUNAT results and query SUNAT again (results are re-cached).")
     args = parser.parse_args()
 
     load_env_from_lambda(args.lambda_function, args.region)
-    refresh_sunat_env()
+    os.environ.setdefault("AWS_DEFAULT_REGION", args.region)
 
-    table_name = args.table or os.environ.get("DYNAMODB_TABLE")
-    if not table_name:
+    args.table = args.table or os.environ.get("DYNAMODB_TABLE")
+    if not args.table:
         raise SystemExit("Missing table name. Set --table or DYNAMODB_TABLE.")
+    if args.rate is None:
+        args.rate = 1.0 / args.sleep if args.sleep > 0 else 0.0
+    args.concurrency = max(1, args.concurrency)
 
-    dynamodb = boto3.resource("dynamodb", region_name=args.region)
-    table = dynamodb.Table(table_name)
-
-    total_seen = 0
-    total_validated = 0
-    total_skipped = 0
-    total_errors = 0
-
-    for item in iter_scan(table, limit=args.limit or None):
-        total_seen += 1
-
-        if args.only_pending and not is_pending_validation(item):
-            total_skipped += 1
-            continue
-
-        try:
-            invoice_data = build_invoice_data(item)
-            ok, reason = should_validate(invoice_data)
-            if not ok:
-                total_skipped += 1
-                if total_seen % 50 == 0:
-                    print(f"Skipped {total_skipped} items (last reason: {reason})")
-                continue
-
-            result = validate_invoice_with_sunat(invoice_data)
-            result = convert_to_decimal(result)
+    table = boto3.resource("dynamodb", region_name=args.region).Table(args.table)
+    key_attrs = [entry["AttributeName"] for entry in table.key_schema]
+    # item_count is refreshed by DynamoDB about every six hours: good enough for an ETA
+    expected = args.limit or int(table.item_count or 0) or None
 
-            if not args.dry_run:
-                key = build_item_key(table, item)
-                table.update_item(
-                    Key=key,
-                    UpdateExpression="SET validacionSunat = :v",
-                    ExpressionAttributeValues={":v": result},
-                )
-
-            total_validated += 1
-        except Exception as exc:
-            total_errors += 1
-            invoice_id = item.get("invoiceId") or "unknown"
-            print(f"Error processing {invoice_id}: {exc}")
-            continue
-
-        if total_validated % 10 == 0:
-            print(
-                f"Validated {total_validated} items (seen={total_seen}, skipped={total_skipped})"
-            )
+    progress = Progress(expected, args.progress_every)
+    print(
+        f"Validating {args.table}: engine={args.engine} concurrency={args.concurrency} "
+        f"rate={args.rate or 'unlimited'}/s retries={args.retries} expected~{expected or '?'}"
+    )
 
-        time.sleep(max(args.sleep, 0))
+    if args.engine == "asyncio":
+        asyncio.run(run_asyncio(args, table, key_attrs, progress))
+    else:
+        run_threads(args, table, key_attrs, progress)
 
+    progress.maybe_report(force=True)
+    counts = progress.counts
+    skipped_reasons = {
+        name.split(":", 1)[1]: count for name, count in counts.items() if name.startswith("skipped:")
+    }
     print(
-        "Done. seen=%d validated=%d skipped=%d errors=%d"
-        % (total_seen, total_validated, total_skipped, total_errors)
+        "Done. seen=%d validated=%d cached=%d skipped=%d errors=%d"
+        % (counts["seen"], counts["validated"], counts["cached"], counts["skipped"], counts["errors"])
     )
+    if skipped_reasons:
+        print(f"Skipped reasons: {skipped_reasons}")
 
 
 if __name__ == "__main__":
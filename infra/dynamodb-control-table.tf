@@ -0,0 +1,69 @@
+# ========================================
+# DynamoDB - Tabla de control del pipeline de ingesta
+# Índices auxiliares y estado compartido entre Lambdas (no son facturas).
+# Se mantiene separada de Facturas-* para no disparar el stream hacia Postgres.
+# Se usa el mismo provider y variables de rds-aurora-serverless.tf
+# ========================================
+
+# Clave propia (CMK) para la tabla: guarda el token OAuth de SUNAT compartido
+# por las Lambdas, así que el acceso al dato queda sujeto a la política de la
+# clave y cada uso se registra en CloudTrail
+resource "aws_kms_key" "ingest_control" {
+  description             = "FlowControl-${var.environment} (token SUNAT y estado del pipeline)"
+  deletion_window_in_days = 30
+  enable_key_rotation     = true
+
+  tags = {
+    Name        = "FlowControl-${var.environment}"
+    Environment = var.environment
+  }
+}
+
+resource "aws_kms_alias" "ingest_control" {
+  name          = "alias/flow-control-${var.environment}"
+  target_key_id = aws_kms_key.ingest_control.key_id
+}
+
+resource "aws_dynamodb_table" "ingest_control" {
+  name         = "FlowControl-${var.environment}"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "PK"
+  range_key    = "SK"
+
+  attribute {
+    name = "PK"
+    type = "S"
+  }
+
+  attribute {
+    name = "SK"
+    type = "S"
+  }
+
+  # Items temporales (caches, locks) expiran solos
+  ttl {
+    attribute_name = "expiresAt"
+    enabled        = true
+  }
+
+  server_side_encryption {
+    enabled     = true
+    kms_key_arn = aws_kms_key.ingest_control.arn
+  }
+
+  tags = {
+    Name        = "FlowControl-${var.environment}"
+    Environment = var.environment
+    Purpose     = "Ingest pipeline control state"
+  }
+}
+
+output "control_table_name" {
+  description = "Nombre de la tabla de control (variable CONTROL_TABLE de las Lambdas)"
+  value       = aws_dynamodb_table.ingest_control.name
+}
+
+output "control_table_kms_key_arn" {
+  description = "CMK de la tabla de control: las Lambdas que usan CONTROL_TABLE necesitan kms:Decrypt, kms:Encrypt, kms:GenerateDataKey* y kms:DescribeKey sobre ella"
+  value       = aws_kms_key.ingest_control.arn
+}
@@ -146,9 +146,11 @@ output "next_steps" {
        - Lambda: InvoiceProcessor-bedrock-dev
        - Event source: SQS
        - Queue: ${aws_sqs_queue.invoice_retry.arn}
-       - Batch size: 1 (procesar de uno en uno para evitar throttling)
+       - Batch size: 10 (la Lambda procesa los records en paralelo, RECORD_CONCURRENCY)
+       - Function response types: ReportBatchItemFailures (solo se reintentan los records fallidos)
 
-    3. Agregar exponential backoff en Lambda para manejar ThrottlingException
+    3. Configurar RETRY_QUEUE_URL=${aws_sqs_queue.invoice_retry.url} en la Lambda:
+       sin capacidad Bedrock (rate limiter / ThrottlingException) el record se difiere a esta cola
 
     4. Monitorear DLQ en CloudWatch para facturas que fallen definitivamente
   EOT
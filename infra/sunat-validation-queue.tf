@@ -0,0 +1,56 @@
+# ========================================
+# Validación SUNAT asíncrona
+# lambda_claude guarda la factura como PENDIENTE y envía su clave a esta
+# cola; lambda_sunat_retry la consume en batches y actualiza el item.
+# Se usa el mismo provider y variables de rds-aurora-serverless.tf
+# ========================================
+
+resource "aws_sqs_queue" "sunat_validation_dlq" {
+  name                      = "sunat-validation-dlq-${var.environment}"
+  message_retention_seconds = 1209600  # 14 días
+
+  tags = {
+    Name        = "sunat-validation-dlq-${var.environment}"
+    Environment = var.environment
+    Purpose     = "Dead Letter Queue for SUNAT validation"
+  }
+}
+
+resource "aws_sqs_queue" "sunat_validation" {
+  name                       = "sunat-validation-${var.environment}"
+  message_retention_seconds  = 345600  # 4 días
+  receive_wait_time_seconds  = 10      # Long polling
+  visibility_timeout_seconds = 180     # > timeout de lambda_sunat_retry
+
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.sunat_validation_dlq.arn
+    maxReceiveCount     = 5
+  })
+
+  tags = {
+    Name        = "sunat-validation-${var.environment}"
+    Environment = var.environment
+    Purpose     = "Async SUNAT validation of extracted invoices"
+  }
+}
+
+output "sunat_validation_queue_url" {
+  description = "URL de la cola (variable SUNAT_VALIDATION_QUEUE_URL de lambda_claude)"
+  value       = aws_sqs_queue.sunat_validation.url
+}
+
+output "sunat_validation_next_steps" {
+  value = <<-EOT
+    1. Configurar SUNAT_VALIDATION_QUEUE_URL=${aws_sqs_queue.sunat_validation.url} en InvoiceProcessor
+       y darle sqs:SendMessage sobre la cola
+    2. Trigger SQS → lambda_sunat_retry:
+       - Batch size: 10, Maximum batching window: 5 s
+       - Maximum concurrency: 2 (tasa total a SUNAT = concurrencia × SUNAT_VALIDATION_RATE)
+       - Function response types: ReportBatchItemFailures
+    3. Dar a lambda_sunat_retry dynamodb:BatchGetItem y UpdateItem sobre Facturas-*, y dynamodb:Query
+       sobre su índice GSI3-SunatRetryIndex (Scan solo para {"backfillRetryIndex": true})
+    4. Mantener el barrido programado: consulta los buckets RETRY#<día>#<shard> vencidos de los
+       últimos SUNAT_RETRY_LOOKBACK_DAYS (PENDIENTE pasado SUNAT_PENDING_GRACE_MINUTES, default 15)
+    5. Regla diaria con input {"catchUpRetryIndex": true}: reagenda vencimientos más viejos que la ventana
+  EOT
+}
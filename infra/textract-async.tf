@@ -0,0 +1,66 @@
+# ========================================
+# Textract asíncrono - notificaciones de StartExpenseAnalysis
+# PDFs de varias páginas se procesan con un job asíncrono; Textract
+# publica la finalización en este tópico y la Lambda retoma el pipeline.
+# Se usa el mismo provider y variables de rds-aurora-serverless.tf
+# ========================================
+
+resource "aws_sns_topic" "textract_jobs" {
+  name = "textract-expense-jobs-${var.environment}"
+
+  tags = {
+    Name        = "textract-expense-jobs-${var.environment}"
+    Environment = var.environment
+    Purpose     = "Textract async job completion"
+  }
+}
+
+# Rol que Textract asume para publicar en el tópico
+resource "aws_iam_role" "textract_publish" {
+  name = "textract-publish-${var.environment}"
+
+  assume_role_policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect    = "Allow"
+        Principal = { Service = "textract.amazonaws.com" }
+        Action    = "sts:AssumeRole"
+      }
+    ]
+  })
+}
+
+resource "aws_iam_role_policy" "textract_publish" {
+  name = "textract-publish-sns"
+  role = aws_iam_role.textract_publish.id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect   = "Allow"
+        Action   = "sns:Publish"
+        Resource = aws_sns_topic.textract_jobs.arn
+      }
+    ]
+  })
+}
+
+output "textract_sns_topic_arn" {
+  description = "ARN del tópico (variable TEXTRACT_SNS_TOPIC_ARN de la Lambda)"
+  value       = aws_sns_topic.textract_jobs.arn
+}
+
+output "textract_sns_role_arn" {
+  description = "ARN del rol de publicación (variable TEXTRACT_SNS_ROLE_ARN de la Lambda)"
+  value       = aws_iam_role.textract_publish.arn
+}
+
+output "textract_async_next_steps" {
+  value = <<-EOT
+    1. Suscribir la Lambda InvoiceProcessor al tópico ${aws_sns_topic.textract_jobs.arn}
+    2. Dar a la Lambda permisos textract:StartExpenseAnalysis y textract:GetExpenseAnalysis
+    3. Configurar TEXTRACT_SNS_TOPIC_ARN, TEXTRACT_SNS_ROLE_ARN y TEXTRACT_ASYNC_MIN_PAGES (default 2: AnalyzeExpense síncrono solo acepta una página)
+  EOT
+}